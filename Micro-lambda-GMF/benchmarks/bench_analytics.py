@@ -0,0 +1,290 @@
+"""
+Benchmark y verificación del almacén analítico Parquet + DuckDB (analytics_engine).
+
+Uso:
+    python Micro-lambda-GMF/benchmarks/bench_analytics.py [--orders 1000,5000] [--months 2]
+        [--batch 200] [--resync 0.05] [--min-files 4] [--root DIR]
+
+Genera órdenes sintéticas (canales online / pickup / POS, 1-3 líneas y 1-3 filas de comisión
+cada una), las vuelca en lotes de --batch (un archivo por dataset y día, como el flush de
+ANALYTICS_LOG) y vuelve a volcar una fracción --resync con otro estado y sin comisiones
+(anulación). Verifica admin_stats contra sumas en Python (último snapshot por orden) y
+reporta el tiempo de la consulta en frío, con caché, tras un archivo nuevo (la huella
+invalida la caché) y después de compact(), que debe dar el mismo resultado con menos archivos.
+Luego repite el escenario por la ruta de producción: ORDER / CUSTOMER / COMMISSION_MONTH en el
+DynamoDB en memoria de memory_ddb, dashboard_lambda.handle_sync_iceberg por lote (bitácora
+ANALYTICS_LOG + contador + flush en proceso al cruzar ANALYTICS_FLUSH_ROWS) y un
+handle_flush_analytics final, y verifica que la bitácora quede vacía y el resultado sea el mismo.
+Todo corre sobre disco local (directorio temporal salvo --root); requiere pyarrow, duckdb y boto3.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from decimal import Decimal
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, "..", "python"))
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("AWS_DEFAULT_REGION", os.environ["AWS_REGION"])
+os.environ.setdefault("ORDER_EVENTS_DISPATCH", "off")
+
+import analytics_engine  # noqa: E402
+import core_utils as utils  # noqa: E402
+import dashboard_lambda  # noqa: E402
+import memory_ddb  # noqa: E402
+
+CENT = Decimal("0.01")
+
+
+def _month_keys(count: int) -> list:
+    return [f"2026-{m:02d}" for m in range(1, count + 1)]
+
+
+def _build(total: int, months: list, rng: random.Random) -> tuple:
+    """Órdenes y ledgers; cada comprador tiene un upline fijo de 1-3 beneficiarios (una fila por nivel)."""
+    orders, ledgers, uplines = [], {}, {}
+    for n in range(total):
+        month_key = rng.choice(months)
+        kind = rng.random()
+        order_id = f"POS-{n:08d}" if kind < 0.2 else f"ORD-{n:08d}"
+        customer_id = rng.randint(1, 5000)
+        upline = uplines.setdefault(customer_id, [str(rng.randint(1, 5000)) for _ in range(rng.randint(1, 3))])
+        order = {
+            "orderId": order_id, "customerId": customer_id, "buyerType": "associate",
+            "status": rng.choice(("paid", "delivered", "pending")), "monthKey": month_key,
+            "createdAt": f"{month_key}-{rng.randint(1, 28):02d}T12:00:00Z",
+            "deliveryType": "pickup" if kind < 0.5 else "delivery",
+            "items": [
+                {"productId": rng.randint(1, 50), "quantity": rng.randint(1, 4), "price": Decimal(rng.randint(100, 2000))}
+                for _ in range(rng.randint(1, 3))
+            ],
+        }
+        order["netTotal"] = sum(line["price"] * line["quantity"] for line in order["items"])
+        orders.append(order)
+        for level, beneficiary in enumerate(upline, start=1):
+            ledger = ledgers.setdefault((beneficiary, month_key), {"beneficiaryId": beneficiary, "monthKey": month_key, "ledger": []})
+            ledger["ledger"].append({
+                "rowId": f"{order_id}#{level}", "orderId": order_id, "level": level,
+                "status": rng.choice(("pending", "confirmed")),
+                "amount": (order["netTotal"] * Decimal("0.05")).quantize(CENT),
+            })
+    return orders, list(ledgers.values()), uplines
+
+
+def _sync(store, orders: list, ledgers_by_order: dict, synced_at: int) -> None:
+    order_days = {o["orderId"]: analytics_engine.order_day(o) for o in orders}
+    commissions = []
+    for ledger in {id(l): l for oid in order_days for l in ledgers_by_order.get(oid, [])}.values():
+        commissions.extend(analytics_engine.commission_rows(ledger, order_days, synced_at))
+    rows = {
+        "orders": [analytics_engine.order_row(o, synced_at) for o in orders],
+        "lines": [row for o in orders for row in analytics_engine.line_rows(o, synced_at)],
+        "commissions": commissions,
+    }
+    for dataset in analytics_engine.WRITE_ORDER:
+        if rows[dataset]:
+            store.append(dataset, rows[dataset])
+
+
+def _expected(orders: list, ledgers: list, month_key: str) -> dict:
+    month_orders = [o for o in orders if o["monthKey"] == month_key]
+    rows = [r for l in ledgers if l["monthKey"] == month_key for r in l["ledger"]]
+    products = {}
+    for order in month_orders:
+        if order["status"] == "cancelled":
+            continue
+        for line in order["items"]:
+            products[str(line["productId"])] = products.get(str(line["productId"]), 0) + line["price"] * line["quantity"]
+    return {
+        "total_sales": sum((Decimal(str(o["netTotal"])).quantize(CENT) for o in month_orders), Decimal("0.00")),
+        "order_count": len(month_orders),
+        "commissions": sum((r["amount"] for r in rows), Decimal("0.00")),
+        "topAmount": max(products.values(), default=0),
+    }
+
+
+def _timed(fn):
+    t0 = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - t0) * 1000
+
+
+def run(total: int, args, root: str) -> dict:
+    rng = random.Random(args.seed + total)
+    months = _month_keys(args.months)
+    orders, ledgers, _ = _build(total, months, rng)
+    ledgers_by_order = {}
+    for ledger in ledgers:
+        for row in ledger["ledger"]:
+            ledgers_by_order.setdefault(row["orderId"], []).append(ledger)
+
+    store = analytics_engine.AnalyticsStore(root)
+    synced_at = 1
+    started = time.perf_counter()
+    for start in range(0, total, args.batch):
+        _sync(store, orders[start:start + args.batch], ledgers_by_order, synced_at)
+        synced_at += 1
+    sync_ms = (time.perf_counter() - started) * 1000
+
+    # Re-sincronización: cambia el estado y anula sus comisiones (desaparecen de la vista)
+    resynced = rng.sample(orders, int(total * args.resync))
+    for order in resynced:
+        order["status"] = "cancelled"
+        for ledger in ledgers_by_order.pop(order["orderId"], []):
+            ledger["ledger"] = [r for r in ledger["ledger"] if r["orderId"] != order["orderId"]]
+    for start in range(0, len(resynced), args.batch):
+        _sync(store, resynced[start:start + args.batch], ledgers_by_order, synced_at)
+        synced_at += 1
+
+    month_key = months[-1]
+    cold, cold_ms = _timed(lambda: store.admin_stats(month_key))
+    _, warm_ms = _timed(lambda: store.admin_stats(month_key))
+    expected = _expected(orders, ledgers, month_key)
+    commissions = sum((r["amount"] for r in cold["commissionsByStatus"]), Decimal("0.00"))
+    assert cold["order_count"] == expected["order_count"], (cold["order_count"], expected["order_count"])
+    assert cold["total_sales"] == expected["total_sales"], (cold["total_sales"], expected["total_sales"])
+    assert commissions == expected["commissions"], (commissions, expected["commissions"])
+    top = cold["topProducts"][0]["amount"] if cold["topProducts"] else 0
+    assert top == expected["topAmount"], (top, expected["topAmount"])
+    cancelled = store.query("SELECT count(*) AS n FROM orders WHERE status = 'cancelled'")[0]["n"]
+    assert cancelled == len(resynced), (cancelled, len(resynced))
+
+    # Un archivo nuevo del mes cambia la huella: la siguiente consulta se recalcula
+    extra = dict(orders[0], orderId="ORD-EXTRA", monthKey=month_key, netTotal=Decimal("1.00"))
+    _sync(store, [extra], {}, synced_at)
+    after, after_ms = _timed(lambda: store.admin_stats(month_key))
+    assert after["order_count"] == expected["order_count"] + 1
+
+    files = sum(len(store.files(name)) for name in analytics_engine.SCHEMAS)
+    summary, compact_ms = _timed(lambda: store.compact(min_files=args.min_files))
+    compacted, compacted_ms = _timed(lambda: store.admin_stats(month_key))
+    assert compacted == after, "compact() cambió el resultado"
+    return {
+        "files": files, "syncMs": sync_ms, "coldMs": cold_ms, "warmMs": warm_ms, "afterAppendMs": after_ms,
+        "compactMs": compact_ms, "compactedFiles": sum(len(store.files(name)) for name in analytics_engine.SCHEMAS),
+        "rowsDropped": summary["rowsDropped"], "compactedMs": compacted_ms,
+        "hits": store.cache_stats["hits"], "misses": store.cache_stats["misses"],
+    }
+
+
+def _ddb_items(orders: list = (), ledgers: list = (), uplines: dict = None) -> list:
+    items = []
+    for customer_id, upline in (uplines or {}).items():
+        items.extend(utils._build_entity_items("CUSTOMER", customer_id, {
+            "entityType": "customer", "customerId": customer_id, "uplineIds": upline, "createdAt": "2026-01-01T00:00:00Z",
+        }))
+    for order in orders:
+        items.extend(utils._build_entity_items("ORDER", order["orderId"], dict(order, entityType="order")))
+    for ledger in ledgers:
+        items.append({**dashboard_lambda._commission_ledger_key(ledger["beneficiaryId"], ledger["monthKey"]), **ledger})
+    return items
+
+
+def run_pipeline(total: int, args, root: str) -> dict:
+    """Ruta bitácora -> flush -> Parquet de dashboard_lambda sobre memory_ddb."""
+    rng = random.Random(args.seed + total)
+    months = _month_keys(args.months)
+    orders, ledgers, uplines = _build(total, months, rng)
+    ledgers_by_order = {}
+    for ledger in ledgers:
+        for row in ledger["ledger"]:
+            ledgers_by_order.setdefault(row["orderId"], []).append(ledger)
+
+    db = memory_ddb.MemoryDynamo()
+    db.load(_ddb_items(orders, ledgers, uplines))
+    db.install(utils)
+    dashboard_lambda.ANALYTICS_ROOT = root
+    dashboard_lambda.ANALYTICS_FLUSH_DISPATCH = "local"
+    dashboard_lambda._analytics.clear()
+    flushes = []
+    original_flush = dashboard_lambda.handle_flush_analytics
+
+    def counted_flush():
+        result = original_flush()
+        flushes.append(result)
+        return result
+
+    dashboard_lambda.handle_flush_analytics = counted_flush
+    try:
+        started = time.perf_counter()
+        for start in range(0, total, args.batch):
+            dashboard_lambda.handle_sync_iceberg([o["orderId"] for o in orders[start:start + args.batch]])
+        sync_ms = (time.perf_counter() - started) * 1000
+        time.sleep(0.002)  # el syncedAt de la re-sincronización debe ser posterior (resolución en ms)
+
+        resynced = rng.sample(orders, int(total * args.resync))
+        touched = {}
+        for order in resynced:
+            order["status"] = "cancelled"
+            for ledger in ledgers_by_order.pop(order["orderId"], []):
+                ledger["ledger"] = [r for r in ledger["ledger"] if r["orderId"] != order["orderId"]]
+                touched[id(ledger)] = ledger
+        db.load(_ddb_items(resynced, touched.values()))
+        for start in range(0, len(resynced), args.batch):
+            dashboard_lambda.handle_sync_iceberg([o["orderId"] for o in resynced[start:start + args.batch]])
+        final = original_flush()
+    finally:
+        dashboard_lambda.handle_flush_analytics = original_flush
+
+    assert not db.partitions.get(dashboard_lambda.ANALYTICS_LOG_PK), "quedaron entradas en ANALYTICS_LOG"
+    counter = db.get(dashboard_lambda._ANALYTICS_COUNTER_KEY) or {}
+    assert int(counter.get("rowCount") or 0) == 0 and "oldestEpoch" not in counter, counter
+    month_key = months[-1]
+    stats = dashboard_lambda._analytics_store().admin_stats(month_key)
+    expected = _expected(orders, ledgers, month_key)
+    commissions = sum((r["amount"] for r in stats["commissionsByStatus"]), Decimal("0.00"))
+    assert stats["order_count"] == expected["order_count"], (stats["order_count"], expected["order_count"])
+    assert stats["total_sales"] == expected["total_sales"], (stats["total_sales"], expected["total_sales"])
+    assert commissions == expected["commissions"], (commissions, expected["commissions"])
+    return {
+        "syncMs": sync_ms, "syncCalls": -(-total // args.batch), "flushes": len(flushes),
+        "finalEntries": final["entries"], "ddbCalls": db.total_calls(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", default="1000,5000")
+    parser.add_argument("--months", type=int, default=2)
+    parser.add_argument("--batch", type=int, default=200, help="órdenes por sincronización (archivo)")
+    parser.add_argument("--resync", type=float, default=0.05, help="fracción de órdenes re-sincronizadas")
+    parser.add_argument("--min-files", type=int, default=4, help="archivos por día para compactar")
+    parser.add_argument("--root", default=None, help="directorio del almacén (por defecto uno temporal)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{'órdenes':>8} {'archivos':>8} {'sync ms':>9} {'frío ms':>8} {'caché ms':>8} {'+archivo ms':>11} "
+          f"{'compact ms':>10} {'arch. tras':>10} {'descart.':>8} {'tras ms':>8} {'hits':>5} {'misses':>6}")
+    for total in (int(s) for s in args.orders.split(",") if s.strip()):
+        root = os.path.join(args.root, str(total)) if args.root else tempfile.mkdtemp(prefix="analytics-")
+        try:
+            res = run(total, args, root)
+        finally:
+            if not args.root:
+                shutil.rmtree(root, ignore_errors=True)
+        print(f"{total:>8} {res['files']:>8} {res['syncMs']:>9.0f} {res['coldMs']:>8.1f} {res['warmMs']:>8.2f} "
+              f"{res['afterAppendMs']:>11.1f} {res['compactMs']:>10.0f} {res['compactedFiles']:>10} {res['rowsDropped']:>8} "
+              f"{res['compactedMs']:>8.1f} {res['hits']:>5} {res['misses']:>6}")
+
+    print("\nruta bitácora -> flush (memory_ddb)")
+    print(f"{'órdenes':>8} {'syncs':>6} {'sync ms':>9} {'ms/sync':>8} {'flushes':>8} {'final':>6} {'DDB':>7}")
+    for total in (int(s) for s in args.orders.split(",") if s.strip()):
+        root = os.path.join(args.root, f"pipeline-{total}") if args.root else tempfile.mkdtemp(prefix="analytics-")
+        try:
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                res = run_pipeline(total, args, root)
+        finally:
+            if not args.root:
+                shutil.rmtree(root, ignore_errors=True)
+        print(f"{total:>8} {res['syncCalls']:>6} {res['syncMs']:>9.0f} {res['syncMs'] / res['syncCalls']:>8.1f} "
+              f"{res['flushes']:>8} {res['finalEntries']:>6} {res['ddbCalls']:>7}")
+
+
+if __name__ == "__main__":
+    main()
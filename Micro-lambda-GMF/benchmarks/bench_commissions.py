@@ -0,0 +1,291 @@
+"""
+Benchmark de throughput del motor de comisiones (ORDER_PAID / ORDER_DELIVERED).
+
+Uso:
+    python Micro-lambda-GMF/benchmarks/bench_commissions.py [--customers 1000,10000,100000]
+        [--orders 2000] [--mode sfn,outbox] [--batch-size 50] [--ddb-latency-ms 0] [--bonus-rules] [--breakdown]
+
+Genera una red de clientes (cada uno con su uplineIds persistido), una orden pagada y
+entregada por comprador aleatorio, y procesa los eventos de dos formas:
+  - sfn: una ejecución por evento del stepFunctions.json, interpretado localmente
+    (DetermineAction -> ProcessCommissions / ConfirmCommissions -> SyncToAnalytics), llamando
+    a commissions_lambda.lambda_handler y dashboard_lambda.lambda_handler en proceso;
+  - outbox: los eventos se escriben en ORDER_OUTBOX y se drenan con PROCESS_ORDER_EVENTS.
+Reporta eventos/s, llamadas a DynamoDB por evento y latencia p50/p99 (por ejecución en sfn,
+por lote en outbox). DynamoDB es el stand-in en memoria de memory_ddb (sin AWS ni red);
+se requiere boto3 instalado. El almacén analítico de SyncToAnalytics (ANALYTICS_ROOT) va a un
+directorio temporal por corrida, que se borra al terminar. Con --ddb-latency-ms 0 se mide solo CPU; usar ~5 para aproximar
+la latencia real por llamada. Los contenedores se consideran calientes (config en caché).
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from decimal import Decimal
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_PYTHON_DIR = os.path.join(_HERE, "..", "python")
+sys.path.insert(0, _PYTHON_DIR)
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("AWS_DEFAULT_REGION", os.environ["AWS_REGION"])
+os.environ.setdefault("ORDER_EVENTS_DISPATCH", "off")
+
+import core_utils as utils  # noqa: E402
+import commissions_lambda  # noqa: E402
+import dashboard_lambda  # noqa: E402
+import memory_ddb  # noqa: E402
+
+MONTH_KEY = "2026-10"
+_ANALYTICS_TMP = tempfile.mkdtemp(prefix="bench-commissions-analytics-")
+
+
+class LocalStepFunctions:
+    """Intérprete mínimo de Amazon States Language: Choice, Task, Pass, Succeed/Fail, Catch."""
+
+    def __init__(self, definition: dict, resources: dict):
+        self.definition = definition
+        self.resources = resources
+        self.transitions = 0
+
+    @staticmethod
+    def _path(data, path: str):
+        if path == "$":
+            return data
+        current = data
+        for part in path[2:].split("."):
+            if not isinstance(current, dict) or part not in current:
+                raise KeyError(f"States.Runtime: {path} no existe en la entrada")
+            current = current[part]
+        return current
+
+    def _parameters(self, params: dict, data) -> dict:
+        out = {}
+        for key, value in params.items():
+            if key.endswith(".$"):
+                out[key[:-2]] = self._path(data, value)
+            elif isinstance(value, dict):
+                out[key] = self._parameters(value, data)
+            else:
+                out[key] = value
+        return out
+
+    def _choose(self, state: dict, data) -> str:
+        for choice in state.get("Choices", []):
+            try:
+                value = self._path(data, choice["Variable"])
+            except KeyError:
+                value = None
+            if "StringEquals" in choice and value == choice["StringEquals"]:
+                return choice["Next"]
+        return state["Default"]
+
+    def start_execution(self, payload: dict):
+        name = self.definition["StartAt"]
+        data = payload
+        while True:
+            self.transitions += 1
+            state = self.definition["States"][name]
+            kind = state["Type"]
+            if kind == "Choice":
+                name = self._choose(state, data)
+                continue
+            if kind == "Succeed":
+                return data
+            if kind == "Fail":
+                raise RuntimeError(state.get("Error") or "States.Fail")
+            if kind == "Pass":
+                data = state.get("Result", data)
+            elif kind == "Task":
+                handler = self.resources[state["Resource"].split("function:")[-1]]
+                task_input = self._parameters(state["Parameters"], data) if "Parameters" in state else data
+                try:
+                    data = handler(task_input, None)
+                except Exception as e:
+                    catch = next((c for c in state.get("Catch", []) if "States.ALL" in c["ErrorEquals"]), None)
+                    if catch is None:
+                        raise
+                    data = {"error": str(e)}
+                    name = catch["Next"]
+                    continue
+            if state.get("End"):
+                return data
+            name = state["Next"]
+
+
+def _build_network(size: int, rng: random.Random, with_descendants: bool) -> list:
+    """Árbol aleatorio: cada cliente patrocinado por uno anterior (sesgado a los recientes)."""
+    leaders = [None]
+    for cid in range(2, size + 1):
+        leaders.append(rng.randint(max(1, cid - 1 - rng.choice((5, 50, 5000))), cid - 1))
+    uplines = {}
+    directs = {cid: [] for cid in range(1, size + 1)}
+    for cid in range(1, size + 1):
+        leader = leaders[cid - 1]
+        uplines[cid] = ([leader] + uplines[leader])[:commissions_lambda.MAX_COMMISSION_LEVELS] if leader else []
+        if leader:
+            directs[leader].append(cid)
+
+    descendants = {}
+    if with_descendants:
+        for cid in range(size, 0, -1):
+            descendants[cid] = [d for child in directs[cid] for d in [child] + descendants[child]]
+
+    items = []
+    for cid in range(1, size + 1):
+        customer = {
+            "entityType": "customer", "customerId": cid, "name": f"Cliente {cid}",
+            "leaderId": leaders[cid - 1], "uplineIds": uplines[cid], "directReferralIds": directs[cid],
+            "createdAt": "2026-01-01T00:00:00Z",
+        }
+        if with_descendants:
+            customer["networkDescendantIds"] = descendants[cid]
+        items.extend(utils._build_entity_items("CUSTOMER", cid, customer))
+        if rng.random() < 0.6:
+            items.append({
+                "PK": "ASSOCIATE_MONTH", "SK": utils._associate_month_entity_id(cid, MONTH_KEY),
+                "entityType": "associateMonth", "associateId": str(cid), "monthKey": MONTH_KEY,
+                "netVolume": Decimal(rng.randint(0, 20) * 500), "isActive": False,
+            })
+    return items
+
+
+def _app_config(bonus_rules: bool) -> dict:
+    cfg = commissions_lambda._default_app_config()
+    if not bonus_rules:
+        cfg.setdefault("bonuses", {})["rules"] = []
+    return commissions_lambda._decimal_clean(cfg)
+
+
+def _build_orders(size: int, orders: int, rng: random.Random) -> tuple:
+    items, events = [], []
+    for n in range(orders):
+        order_id = f"ORD-BENCH-{n:07d}"
+        order = {
+            "entityType": "order", "orderId": order_id, "customerId": rng.randint(1, size),
+            "buyerType": "associate", "status": "paid", "monthKey": MONTH_KEY,
+            "netTotal": Decimal(rng.randint(300, 5000)),
+            "items": [{"productId": "P-1", "quantity": 1, "price": Decimal("100")}],
+        }
+        items.extend(utils._build_entity_items("ORDER", order_id, order))
+        events.append((order_id, "ORDER_PAID"))
+    delivered = [(order_id, "ORDER_DELIVERED") for order_id, _ in events]
+    rng.shuffle(delivered)
+    return items, events + delivered
+
+
+def _percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def _prepare(size: int, args) -> tuple:
+    rng = random.Random(args.seed + size)
+    db = memory_ddb.MemoryDynamo(args.ddb_latency_ms)
+    db.load(_build_network(size, rng, args.bonus_rules))
+    db.load(utils._build_entity_items("CONFIG", "app-v1", {"entityType": "config", "config": _app_config(args.bonus_rules)}))
+    order_items, events = _build_orders(size, args.orders, rng)
+    db.load(order_items)
+    db.install(utils)
+    utils._load_app_config.cache_clear()
+    # Nunca S3: cada corrida escribe su almacén analítico en un directorio local nuevo
+    dashboard_lambda.ANALYTICS_ROOT = tempfile.mkdtemp(dir=_ANALYTICS_TMP)
+    dashboard_lambda._analytics.clear()
+    return db, events
+
+
+def run_sfn(size: int, args) -> dict:
+    db, events = _prepare(size, args)
+    with open(os.path.join(_PYTHON_DIR, "stepFunctions.json")) as fh:
+        machine = LocalStepFunctions(json.load(fh), {
+            "commissions_lambda": commissions_lambda.lambda_handler,
+            "dashboard_lambda": dashboard_lambda.lambda_handler,
+            "auth_lambda": lambda event, context: {"status": "NOTIFIED"},
+        })
+    latencies = []
+    started = time.perf_counter()
+    for order_id, action in events:
+        t0 = time.perf_counter()
+        machine.start_execution({"orderId": order_id, "action": action})
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    return _result(db, len(events), elapsed, latencies, machine.transitions)
+
+
+def run_outbox(size: int, args) -> dict:
+    db, events = _prepare(size, args)
+    db.load(utils._order_event_item(order_id, action) for order_id, action in events)
+    db.calls.clear()
+
+    latencies = []
+    original = commissions_lambda._process_order_events_batch
+
+    def timed_batch(batch_events, *rest):
+        t0 = time.perf_counter()
+        try:
+            return original(batch_events, *rest)
+        finally:
+            latencies.append(time.perf_counter() - t0)
+
+    commissions_lambda._process_order_events_batch = timed_batch
+    commissions_lambda.ORDER_EVENTS_BATCH_SIZE = args.batch_size
+    commissions_lambda.ORDER_EVENTS_BUDGET_SECONDS = float("inf")
+    try:
+        started = time.perf_counter()
+        commissions_lambda.lambda_handler({"action": "PROCESS_ORDER_EVENTS"}, None)
+        elapsed = time.perf_counter() - started
+    finally:
+        commissions_lambda._process_order_events_batch = original
+    pending = len(db.partitions.get(utils.ORDER_OUTBOX_PK, {}))
+    if pending:
+        print(f"  ! quedaron {pending} eventos sin procesar", file=sys.stderr)
+    return _result(db, len(events), elapsed, latencies, 0)
+
+
+def _result(db, events: int, elapsed: float, latencies: list, transitions: int) -> dict:
+    return {
+        "events": events,
+        "eventsPerSec": events / elapsed if elapsed else 0.0,
+        "callsPerEvent": db.total_calls() / events if events else 0.0,
+        "p50": _percentile(latencies, 50) * 1000,
+        "p99": _percentile(latencies, 99) * 1000,
+        "transitionsPerEvent": transitions / events if events else 0.0,
+        "calls": dict(db.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--customers", default="1000,10000,100000")
+    parser.add_argument("--orders", type=int, default=2000, help="órdenes; cada una genera PAID + DELIVERED")
+    parser.add_argument("--mode", default="sfn,outbox")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--bonus-rules", action="store_true", help="evalúa las reglas de bonos por defecto (lento con redes grandes)")
+    parser.add_argument("--breakdown", action="store_true", help="muestra llamadas por operación")
+    parser.add_argument("--ddb-latency-ms", type=float, default=0.0, help="latencia simulada por llamada a DynamoDB")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    runners = {"sfn": run_sfn, "outbox": run_outbox}
+    print(f"{'clientes':>9} {'modo':<7} {'eventos':>8} {'ev/s':>9} {'DDB/ev':>7} {'p50 ms':>8} {'p99 ms':>8} {'trans/ev':>8}")
+    try:
+        for size in (int(s) for s in args.customers.split(",") if s.strip()):
+            for mode in (m.strip() for m in args.mode.split(",") if m.strip()):
+                with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    res = runners[mode](size, args)
+                print(f"{size:>9} {mode:<7} {res['events']:>8} {res['eventsPerSec']:>9.0f} {res['callsPerEvent']:>7.2f} "
+                      f"{res['p50']:>8.2f} {res['p99']:>8.2f} {res['transitionsPerEvent']:>8.1f}")
+                if args.breakdown:
+                    print("          " + ", ".join(f"{op}={n}" for op, n in sorted(res["calls"].items())))
+    finally:
+        shutil.rmtree(_ANALYTICS_TMP, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
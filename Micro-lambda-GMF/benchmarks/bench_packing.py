@@ -0,0 +1,116 @@
+"""
+Benchmark del empaquetado de envíos: packing_engine (FFD 3D) vs el greedy anterior.
+
+Uso:
+    python Micro-lambda-GMF/benchmarks/bench_packing.py [--repeat 5]
+
+Compara cajas usadas, volumen facturable (L) y tiempo por escenario. No requiere AWS:
+solo importa packing_engine (lógica pura). Ojo: el greedy anterior solo compara volumen,
+así que sus cajas no siempre son acomodos físicamente posibles.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import packing_engine  # noqa: E402
+
+_LEGACY_BOXES = [(25.0, 17.0, 28.0), (40.0, 29.0, 20.0), (35.0, 23.0, 30.0)]
+
+
+def legacy_pack(raw_items):
+    """Copia del greedy previo de shipping_lambda._pack_items_for_shipping (referencia)."""
+    expanded = []
+    for item in raw_items:
+        qty = max(1, int(item.get("quantity") or 1))
+        l = max(0.1, float(item.get("lengthCm") or 10))
+        w = max(0.1, float(item.get("widthCm") or 10))
+        h = max(0.1, float(item.get("heightCm") or 10))
+        wt = max(0.05, float(item.get("weightKg") or 0.5))
+        for _ in range(qty):
+            expanded.append((l, w, h, wt))
+
+    boxes_by_vol = sorted(_LEGACY_BOXES, key=lambda b: b[0] * b[1] * b[2])
+    remaining = list(range(len(expanded)))
+    packages = []
+    while remaining:
+        chosen_box = None
+        packed_indices = []
+        for box in boxes_by_vol:
+            box_sd = sorted(box, reverse=True)
+            box_vol = box[0] * box[1] * box[2]
+            fitting = [idx for idx in remaining if all(
+                sorted([expanded[idx][0], expanded[idx][1], expanded[idx][2]], reverse=True)[d] <= box_sd[d]
+                for d in range(3)
+            )]
+            if not fitting:
+                continue
+            in_box = []
+            used_vol = 0.0
+            for idx in sorted(fitting, key=lambda i: expanded[i][0] * expanded[i][1] * expanded[i][2], reverse=True):
+                item_vol = expanded[idx][0] * expanded[idx][1] * expanded[idx][2]
+                if used_vol + item_vol <= box_vol:
+                    in_box.append(idx)
+                    used_vol += item_vol
+            if in_box:
+                packed_indices = in_box
+                chosen_box = box_sd
+                break
+        if chosen_box:
+            packages.append({"dims": tuple(chosen_box), "weight": sum(expanded[i][3] for i in packed_indices)})
+            for idx in packed_indices:
+                remaining.remove(idx)
+        else:
+            idx = remaining.pop(0)
+            packages.append({"dims": expanded[idx][:3], "weight": expanded[idx][3]})
+    return packages
+
+
+def _scenarios():
+    rng = random.Random(42)
+    catalog = [
+        {"lengthCm": 10, "widthCm": 8, "heightCm": 20, "weightKg": 0.6},
+        {"lengthCm": 6, "widthCm": 6, "heightCm": 12, "weightKg": 0.3},
+        {"lengthCm": 22, "widthCm": 15, "heightCm": 9, "weightKg": 1.2},
+        {"lengthCm": 30, "widthCm": 5, "heightCm": 5, "weightKg": 0.4},
+    ]
+    yield "carrito 5 unidades", [dict(catalog[0], quantity=3), dict(catalog[1], quantity=2)]
+    yield "carrito mixto 24", [dict(p, quantity=6) for p in catalog]
+    yield "mayoreo 200 (1 SKU)", [dict(catalog[0], quantity=200)]
+    yield "mayoreo 200 (mixto)", [dict(p, quantity=50) for p in catalog]
+    yield "aleatorio 120", [dict(rng.choice(catalog), quantity=rng.randint(1, 10)) for _ in range(20)]
+
+
+def _billable_volume(packages):
+    return sum(p["dims"][0] * p["dims"][1] * p["dims"][2] for p in packages) / 1000.0
+
+
+def _timed(fn, items, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(items)
+        best = min(best, time.perf_counter() - t0)
+    return result, best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    catalog = packing_engine.box_catalog(None)
+    print(f"{'escenario':<22} {'cajas ant':>9} {'cajas nvo':>9} {'L ant':>8} {'L nvo':>8} {'ms ant':>9} {'ms nvo':>9}")
+    for name, items in _scenarios():
+        legacy, legacy_ms = _timed(legacy_pack, items, args.repeat)
+        new, new_ms = _timed(lambda it: packing_engine.pack(it, catalog), items, args.repeat)
+        print(f"{name:<22} {len(legacy):>9} {len(new):>9} {_billable_volume(legacy):>8.1f} "
+              f"{_billable_volume(new):>8.1f} {legacy_ms:>9.2f} {new_ms:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+"""
+DynamoDB en memoria para benchmarks locales (sin AWS ni red).
+
+Imita la interfaz de boto3 que usa core_utils: Table (get/put/update/delete_item, query,
+batch_writer), el resource (batch_get_item) y el client (transact_write_items), con expresiones
+de actualización/condición en texto o con boto3.dynamodb.conditions. Cuenta cada llamada como
+la facturaría DynamoDB (un batch_writer cuenta una llamada por cada 25 items).
+
+Uso:
+    db = memory_ddb.MemoryDynamo(latency_ms=0)
+    db.install(core_utils)      # reemplaza _table, _dynamodb y _ddb_client
+    ... db.calls -> Counter({"get_item": n, ...})
+"""
+import copy
+import re
+import time
+from collections import Counter
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+
+def _client_error(code: str, message: str = "", **extra) -> ClientError:
+    response = {"Error": {"Code": code, "Message": message or code}}
+    response.update(extra)
+    return ClientError(response, "MemoryDynamo")
+
+
+def _check_types(value, path="item"):
+    """Igual que el serializer de boto3: float no es un tipo válido de DynamoDB."""
+    if isinstance(value, float):
+        raise TypeError(f"Float types are not supported. Use Decimal types instead ({path})")
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _check_types(v, f"{path}.{k}")
+    elif isinstance(value, (list, tuple, set)):
+        for v in value:
+            _check_types(v, path)
+
+
+# --- Expresiones en texto (UpdateExpression / ConditionExpression) ---
+
+_TOKEN = re.compile(r"\s*(<>|<=|>=|[(),=<>+\-]|[#:]?[A-Za-z_][\w.#\[\]]*)")
+
+
+def _tokenize(text: str) -> list:
+    tokens, pos = [], 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match:
+            raise ValueError(f"Expresión no soportada: {text[pos:]!r}")
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+class _Expr:
+    def __init__(self, text: str, names: dict, values: dict):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and (token or "").upper() != expected:
+            raise ValueError(f"Se esperaba {expected!r}, llegó {token!r}")
+        self.pos += 1
+        return token
+
+    def path(self, token: str) -> list:
+        return [self.names.get(part, part) for part in token.split(".")]
+
+    def operand(self, item: dict):
+        token = self.take()
+        if token.startswith(":"):
+            return self.values[token]
+        if token == "if_not_exists":
+            self.take("(")
+            current = _get_path(item, self.path(self.take()))
+            self.take(",")
+            default = self.operand(item)
+            self.take(")")
+            return default if current is None else current
+        if token == "list_append":
+            self.take("(")
+            left = self.operand(item)
+            self.take(",")
+            right = self.operand(item)
+            self.take(")")
+            return list(left or []) + list(right or [])
+        return _get_path(item, self.path(token))
+
+    def value(self, item: dict):
+        result = self.operand(item)
+        while self.peek() in ("+", "-"):
+            op = self.take()
+            right = self.operand(item)
+            result = result + right if op == "+" else result - right
+        return result
+
+    # Condiciones: OR > AND > NOT > comparación / función
+    def condition(self, item: dict) -> bool:
+        result = self._and(item)
+        while (self.peek() or "").upper() == "OR":
+            self.take()
+            right = self._and(item)
+            result = result or right
+        return result
+
+    def _and(self, item):
+        result = self._not(item)
+        while (self.peek() or "").upper() == "AND":
+            self.take()
+            right = self._not(item)
+            result = result and right
+        return result
+
+    def _not(self, item):
+        if (self.peek() or "").upper() == "NOT":
+            self.take()
+            return not self._not(item)
+        return self._atom(item)
+
+    def _atom(self, item):
+        token = self.peek()
+        if token == "(":
+            self.take()
+            result = self.condition(item)
+            self.take(")")
+            return result
+        if token in ("attribute_exists", "attribute_not_exists", "begins_with", "contains"):
+            self.take()
+            self.take("(")
+            current = _get_path(item, self.path(self.take()))
+            arg = None
+            if token in ("begins_with", "contains"):
+                self.take(",")
+                arg = self.operand(item)
+            self.take(")")
+            if token == "attribute_exists":
+                return current is not None
+            if token == "attribute_not_exists":
+                return current is None
+            if current is None:
+                return False
+            return str(current).startswith(str(arg)) if token == "begins_with" else arg in current
+        left = self.operand(item)
+        op = self.take()
+        right = self.operand(item)
+        return _compare(left, op, right)
+
+
+def _compare(left, op, right) -> bool:
+    if op == "=":
+        return left == right
+    if op == "<>":
+        return left != right
+    if left is None or right is None:
+        return False
+    return {"<": left < right, "<=": left <= right, ">": left > right, ">=": left >= right}[op]
+
+
+def _get_path(item: dict, path: list):
+    current = item
+    for part in path:
+        if not isinstance(current, dict) or part not in current:
+            return None
+        current = current[part]
+    return current
+
+
+def _set_path(item: dict, path: list, value) -> None:
+    current = item
+    for part in path[:-1]:
+        current = current.setdefault(part, {})
+    current[path[-1]] = value
+
+
+def _remove_path(item: dict, path: list) -> None:
+    parent = _get_path(item, path[:-1]) if len(path) > 1 else item
+    if isinstance(parent, dict):
+        parent.pop(path[-1], None)
+
+
+def _split_clauses(expression: str) -> list:
+    """'SET a = :a, b = :b ADD c :c REMOVE d' -> [("SET", "a = :a, b = :b"), ("ADD", ...), ...]"""
+    parts = re.split(r"(?<![\w:#])(SET|ADD|REMOVE|DELETE)(?=\s)", expression)
+    return [(parts[i].upper(), parts[i + 1]) for i in range(1, len(parts) - 1, 2)]
+
+
+def _split_top_level(text: str) -> list:
+    chunks, depth, current = [], 0, ""
+    for ch in text:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0:
+            chunks.append(current)
+            current = ""
+        else:
+            current += ch
+    if current.strip():
+        chunks.append(current)
+    return [c.strip() for c in chunks]
+
+
+def _apply_update(item: dict, expression: str, names: dict, values: dict) -> None:
+    original = copy.deepcopy(item)  # los operandos se evalúan contra el estado previo
+    for clause, body in _split_clauses(expression):
+        for action in _split_top_level(body):
+            if clause == "SET":
+                target, _, rhs = action.partition("=")
+                expr = _Expr(rhs, names, values)
+                _set_path(item, expr.path(target.strip()), expr.value(original))
+            elif clause == "ADD":
+                target, rhs = action.split(None, 1)
+                expr = _Expr(rhs, names, values)
+                path = expr.path(target)
+                delta = expr.operand(original)
+                current = _get_path(original, path)
+                if isinstance(delta, set):
+                    _set_path(item, path, set(current or set()) | delta)
+                else:
+                    _set_path(item, path, (current or Decimal(0)) + delta)
+            elif clause == "REMOVE":
+                _remove_path(item, [names.get(p, p) for p in action.split(".")])
+            elif clause == "DELETE":
+                target, rhs = action.split(None, 1)
+                expr = _Expr(rhs, names, values)
+                path = expr.path(target)
+                _set_path(item, path, set(_get_path(original, path) or set()) - expr.operand(original))
+
+
+# --- boto3.dynamodb.conditions (Key / Attr) ---
+
+def _eval_condition_object(cond, item: dict) -> bool:
+    expr = cond.get_expression()
+    op = expr["operator"]
+    vals = expr["values"]
+    if op in ("AND", "OR"):
+        left, right = (_eval_condition_object(v, item) for v in vals)
+        return (left and right) if op == "AND" else (left or right)
+    if op == "NOT":
+        return not _eval_condition_object(vals[0], item)
+    current = _get_path(item, vals[0].name.split("."))
+    if op == "attribute_exists":
+        return current is not None
+    if op == "attribute_not_exists":
+        return current is None
+    if op == "begins_with":
+        return current is not None and str(current).startswith(str(vals[1]))
+    if op == "contains":
+        return current is not None and vals[1] in current
+    if op == "BETWEEN":
+        return current is not None and vals[1] <= current <= vals[2]
+    if op == "IN":
+        return current in vals[1]
+    return _compare(current, op, vals[1])
+
+
+def _matches(condition, item: dict, names=None, values=None) -> bool:
+    if condition is None:
+        return True
+    if isinstance(condition, str):
+        return _Expr(condition, names, values).condition(item)
+    return _eval_condition_object(condition, item)
+
+
+def _key_condition_parts(condition) -> tuple:
+    """Key("PK").eq(x) [& Key("SK").begins_with/between/...] -> (pk, condición de SK o None)."""
+    expr = condition.get_expression()
+    if expr["operator"] == "AND":
+        left, right = expr["values"]
+        pk, _ = _key_condition_parts(left)
+        return pk, right
+    return expr["values"][1], None
+
+
+class MemoryTable:
+    def __init__(self, db: "MemoryDynamo"):
+        self._db = db
+        self.meta = type("Meta", (), {"client": db.client})()
+
+    def get_item(self, Key, ConsistentRead=False, **_):
+        self._db.hit("get_item")
+        item = self._db.get(Key)
+        return {"Item": copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **_):
+        self._db.hit("put_item")
+        _check_types(Item)
+        current = self._db.get(Item)
+        if not _matches(ConditionExpression, current or {}, ExpressionAttributeNames, ExpressionAttributeValues):
+            raise _client_error("ConditionalCheckFailedException", "The conditional request failed")
+        self._db.put(copy.deepcopy(Item))
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None,
+                    ConditionExpression=None, ReturnValues="NONE", **_):
+        self._db.hit("update_item")
+        _check_types(ExpressionAttributeValues or {})
+        current = self._db.get(Key)
+        if not _matches(ConditionExpression, current or {}, ExpressionAttributeNames, ExpressionAttributeValues):
+            raise _client_error("ConditionalCheckFailedException", "The conditional request failed")
+        item = copy.deepcopy(current) if current is not None else {"PK": Key["PK"], "SK": Key["SK"]}
+        _apply_update(item, UpdateExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues or {})
+        self._db.put(item)
+        return {"Attributes": copy.deepcopy(item)} if ReturnValues in ("ALL_NEW", "UPDATED_NEW") else {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **_):
+        self._db.hit("delete_item")
+        current = self._db.get(Key)
+        if not _matches(ConditionExpression, current or {}, ExpressionAttributeNames, ExpressionAttributeValues):
+            raise _client_error("ConditionalCheckFailedException", "The conditional request failed")
+        self._db.delete(Key)
+        return {}
+
+    def query(self, KeyConditionExpression, Limit=None, ExclusiveStartKey=None, ScanIndexForward=True,
+              FilterExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **_):
+        self._db.hit("query")
+        pk, sk_condition = _key_condition_parts(KeyConditionExpression)
+        sks = self._db.sorted_sks(pk)
+        if not ScanIndexForward:
+            sks = list(reversed(sks))
+        if ExclusiveStartKey:
+            start = ExclusiveStartKey["SK"]
+            sks = [sk for sk in sks if (sk > start if ScanIndexForward else sk < start)]
+        partition = self._db.partitions.get(pk, {})
+        items, last = [], None
+        for sk in sks:
+            item = partition[sk]
+            if sk_condition is not None and not _eval_condition_object(sk_condition, item):
+                continue
+            last = sk
+            if _matches(FilterExpression, item, ExpressionAttributeNames, ExpressionAttributeValues):
+                items.append(copy.deepcopy(item))
+            if Limit and len(items) >= Limit:
+                break
+        resp = {"Items": items, "Count": len(items)}
+        if Limit and len(items) >= Limit and last is not None and last != sks[-1]:
+            resp["LastEvaluatedKey"] = {"PK": pk, "SK": last}
+        return resp
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self._db)
+
+
+class _BatchWriter:
+    def __init__(self, db: "MemoryDynamo"):
+        self._db = db
+        self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._flush()
+
+    def _count(self):
+        self._pending += 1
+        if self._pending == 25:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._db.hit("batch_write_item")
+            self._pending = 0
+
+    def put_item(self, Item):
+        _check_types(Item)
+        self._db.put(copy.deepcopy(Item))
+        self._count()
+
+    def delete_item(self, Key):
+        self._db.delete(Key)
+        self._count()
+
+
+class _MemoryResource:
+    def __init__(self, db: "MemoryDynamo"):
+        self._db = db
+
+    def batch_get_item(self, RequestItems):
+        self._db.hit("batch_get_item")
+        responses = {}
+        for table_name, request in RequestItems.items():
+            keys = request.get("Keys", [])
+            if len(keys) > 100:
+                raise _client_error("ValidationException", "Too many items requested for the BatchGetItem call")
+            responses[table_name] = [copy.deepcopy(i) for i in (self._db.get(k) for k in keys) if i is not None]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def Table(self, name):
+        return self._db.table
+
+
+class _MemoryClient:
+    def __init__(self, db: "MemoryDynamo"):
+        self._db = db
+
+    def transact_write_items(self, TransactItems):
+        self._db.hit("transact_write_items")
+        if len(TransactItems) > 100:
+            raise _client_error("ValidationException", "Member must have length less than or equal to 100")
+        reasons, staged = [], []
+        for op in TransactItems:
+            (kind, spec), = op.items()
+            key = spec.get("Key") or spec.get("Item")
+            current = self._db.get(key)
+            ok = _matches(spec.get("ConditionExpression"), current or {},
+                          spec.get("ExpressionAttributeNames"), spec.get("ExpressionAttributeValues"))
+            reasons.append({"Code": "None" if ok else "ConditionalCheckFailed"})
+            staged.append((kind, spec, current))
+        if any(r["Code"] != "None" for r in reasons):
+            raise _client_error("TransactionCanceledException", "Transaction cancelled", CancellationReasons=reasons)
+        for kind, spec, current in staged:
+            if kind == "Put":
+                _check_types(spec["Item"])
+                self._db.put(copy.deepcopy(spec["Item"]))
+            elif kind == "Update":
+                item = copy.deepcopy(current) if current is not None else dict(spec["Key"])
+                _apply_update(item, spec["UpdateExpression"], spec.get("ExpressionAttributeNames") or {},
+                              spec.get("ExpressionAttributeValues") or {})
+                self._db.put(item)
+            elif kind == "Delete":
+                self._db.delete(spec["Key"])
+        return {}
+
+
+class MemoryDynamo:
+    """Tabla única PK/SK en memoria, con contador de llamadas por operación."""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000.0  # latencia simulada por llamada (0 = solo CPU)
+        self.partitions = {}
+        self._sorted = {}
+        self.calls = Counter()
+        self.client = _MemoryClient(self)
+        self.resource = _MemoryResource(self)
+        self.table = MemoryTable(self)
+
+    def install(self, utils_module) -> None:
+        utils_module._table = self.table
+        utils_module._dynamodb = self.resource
+        utils_module._ddb_client = self.client
+
+    def hit(self, operation: str) -> None:
+        self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, key: dict):
+        return self.partitions.get(key["PK"], {}).get(key["SK"])
+
+    def put(self, item: dict) -> None:
+        partition = self.partitions.setdefault(item["PK"], {})
+        if item["SK"] not in partition:
+            self._sorted.pop(item["PK"], None)
+        partition[item["SK"]] = item
+
+    def delete(self, key: dict) -> None:
+        if self.partitions.get(key["PK"], {}).pop(key["SK"], None) is not None:
+            self._sorted.pop(key["PK"], None)
+
+    def sorted_sks(self, pk: str) -> list:
+        if pk not in self._sorted:
+            self._sorted[pk] = sorted(self.partitions.get(pk, {}))
+        return self._sorted[pk]
+
+    def load(self, items) -> None:
+        """Carga inicial sin contar llamadas."""
+        for item in items:
+            self.put(copy.deepcopy(item))
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
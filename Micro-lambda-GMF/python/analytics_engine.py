@@ -0,0 +1,389 @@
+"""
+Almacén analítico en Parquet con consultas DuckDB (reemplaza el sondeo a Athena).
+
+Layout (Hive), en disco local o en S3 / un servicio compatible con S3:
+    <root>/<dataset>/month=<yyyy-mm>/day=<dd>/part-<epoch ms>-<uuid>.parquet
+La partición es el dayKey de la orden (día de createdAt dentro de su monthKey), así todos
+los snapshots de una orden y sus filas hijas caen en el mismo directorio. Datasets con esquema fijo (SCHEMAS):
+  - orders: un snapshot por orden y sincronización;
+  - lines: las líneas de la orden en ese snapshot;
+  - commissions: las filas de ledger de la orden en ese momento, con el mismo syncedAt.
+Cada flush solo agrega archivos; compact() fusiona los de un día en uno por dataset y
+descarta los snapshots reemplazados. Las vistas `orders`, `lines` y `commissions` exponen
+el último snapshot de cada orden (y solo las filas hijas de ese snapshot, así una comisión
+anulada desaparece); `<dataset>_raw` expone todos los snapshots. Las vistas toleran filas
+repetidas (un flush reintentado), por lo que la escritura puede ser al-menos-una-vez.
+
+Las consultas se cachean por huella: SQL + parámetros + meses + listado de archivos
+(ruta, tamaño), de modo que un archivo nuevo invalida la entrada sin TTL.
+
+Requiere pyarrow y duckdb (Layer de analítica).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+import duckdb
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+# El canal sale de la misma regla que los rollups de ventas
+from core_utils import _order_sales_channel
+
+_MONEY = pa.decimal128(18, 2)
+_CENT = Decimal("0.01")
+
+SCHEMAS: Dict[str, pa.Schema] = {
+    "orders": pa.schema([
+        ("orderId", pa.string()),
+        ("monthKey", pa.string()),
+        ("dayKey", pa.string()),
+        ("createdAt", pa.string()),
+        ("status", pa.string()),
+        ("channel", pa.string()),
+        ("customerId", pa.string()),
+        ("buyerType", pa.string()),
+        ("stockId", pa.string()),
+        ("itemsCount", pa.int32()),
+        ("grossSubtotal", _MONEY),
+        ("discountAmount", _MONEY),
+        ("netTotal", _MONEY),
+        ("syncedAt", pa.int64()),
+    ]),
+    "lines": pa.schema([
+        ("orderId", pa.string()),
+        ("lineNo", pa.int32()),
+        ("monthKey", pa.string()),
+        ("dayKey", pa.string()),
+        ("channel", pa.string()),
+        ("stockId", pa.string()),
+        ("productId", pa.string()),
+        ("name", pa.string()),
+        ("quantity", pa.int32()),
+        ("unitPrice", _MONEY),
+        ("lineTotal", _MONEY),
+        ("syncedAt", pa.int64()),
+    ]),
+    "commissions": pa.schema([
+        ("rowId", pa.string()),
+        ("orderId", pa.string()),
+        ("beneficiaryId", pa.string()),
+        ("monthKey", pa.string()),
+        ("dayKey", pa.string()),
+        ("level", pa.int32()),
+        ("status", pa.string()),
+        ("amount", _MONEY),
+        ("createdAt", pa.string()),
+        ("syncedAt", pa.int64()),
+    ]),
+}
+
+VIEWS = {
+    "orders": (
+        "SELECT * EXCLUDE (_rn) FROM ("
+        " SELECT *, row_number() OVER (PARTITION BY orderId ORDER BY syncedAt DESC) AS _rn FROM orders_raw"
+        ") WHERE _rn = 1"
+    ),
+}
+# Filas hijas: solo las del último snapshot de su orden
+for _child in ("lines", "commissions"):
+    VIEWS[_child] = (
+        f"SELECT DISTINCT c.* FROM {_child}_raw c"
+        " JOIN (SELECT orderId, max(syncedAt) AS syncedAt FROM orders_raw GROUP BY orderId) o"
+        " ON c.orderId = o.orderId AND c.syncedAt = o.syncedAt"
+    )
+# Orden de escritura en un flush: la orden antes que sus hijas, así compact() nunca ve
+# filas hijas de un snapshot cuya orden aún no existe (las descartaría por reemplazadas)
+WRITE_ORDER = ("orders", "lines", "commissions")
+
+
+# --- FILAS ---
+
+def _money(value) -> Decimal:
+    try:
+        return Decimal(str(value if value not in (None, "") else 0)).quantize(_CENT)
+    except Exception:
+        return Decimal("0.00")
+
+
+def _text(value) -> Optional[str]:
+    return None if value in (None, "") else str(value)
+
+
+def order_month(order: dict) -> str:
+    return str(order.get("monthKey") or str(order.get("createdAt") or "")[:7])
+
+
+def order_day(order: dict) -> str:
+    """Día de la partición; si createdAt no cae en el monthKey de la orden, el día 01 del mes."""
+    month_key = order_month(order)
+    created = str(order.get("createdAt") or "")[:10]
+    return created if created.startswith(f"{month_key}-") else f"{month_key}-01"
+
+
+def order_row(order: dict, synced_at: int) -> dict:
+    net = order.get("netTotal") if order.get("netTotal") not in (None, "") else order.get("total")
+    return {
+        "orderId": str(order.get("orderId")),
+        "monthKey": order_month(order),
+        "dayKey": order_day(order),
+        "createdAt": _text(order.get("createdAt")),
+        "status": str(order.get("status") or "").lower(),
+        "channel": _order_sales_channel(order),
+        "customerId": _text(order.get("customerId")),
+        "buyerType": _text(order.get("buyerType")),
+        "stockId": _text(order.get("stockId") or order.get("pickupStockId")),
+        "itemsCount": sum(int(line.get("quantity") or line.get("qty") or 0) for line in order.get("items") or []),
+        "grossSubtotal": _money(order.get("grossSubtotal")),
+        "discountAmount": _money(order.get("discountAmount")),
+        "netTotal": _money(net),
+        "syncedAt": int(synced_at),
+    }
+
+
+def line_rows(order: dict, synced_at: int) -> List[dict]:
+    rows = []
+    for line_no, line in enumerate(order.get("items") or [], start=1):
+        quantity = int(line.get("quantity") or line.get("qty") or 0)
+        unit_price = _money(line.get("price"))
+        rows.append({
+            "orderId": str(order.get("orderId")),
+            "lineNo": line_no,
+            "monthKey": order_month(order),
+            "dayKey": order_day(order),
+            "channel": _order_sales_channel(order),
+            "stockId": _text(order.get("stockId") or order.get("pickupStockId")),
+            "productId": _text(line.get("productId")),
+            "name": _text(line.get("name")),
+            "quantity": quantity,
+            "unitPrice": unit_price,
+            "lineTotal": _money(line.get("lineTotal") if line.get("lineTotal") not in (None, "") else unit_price * quantity),
+            "syncedAt": int(synced_at),
+        })
+    return rows
+
+
+def commission_rows(ledger_item: dict, order_days: Dict[str, str], synced_at: int) -> List[dict]:
+    """Filas de un item COMMISSION_MONTH de las órdenes indicadas ({orderId: dayKey})."""
+    rows = []
+    for row in ledger_item.get("ledger") or []:
+        order_id = str(row.get("orderId"))
+        if order_id not in order_days:
+            continue
+        rows.append({
+            "rowId": str(row.get("rowId") or ""),
+            "orderId": order_id,
+            "beneficiaryId": str(ledger_item.get("beneficiaryId")),
+            "monthKey": str(ledger_item.get("monthKey")),
+            "dayKey": order_days[order_id],
+            "level": int(row.get("level") or 0),
+            "status": str(row.get("status") or "").lower(),
+            "amount": _money(row.get("amount")),
+            "createdAt": _text(row.get("createdAt")),
+            "syncedAt": int(synced_at),
+        })
+    return rows
+
+
+def coerce_rows(dataset: str, rows: List[dict]) -> List[dict]:
+    """Ajusta filas leídas de DynamoDB (números como Decimal) a los tipos del esquema."""
+    schema = SCHEMAS[dataset]
+    out = []
+    for row in rows:
+        clean = {}
+        for field in schema:
+            value = row.get(field.name)
+            if value is None:
+                clean[field.name] = None
+            elif pa.types.is_integer(field.type):
+                clean[field.name] = int(value)
+            elif pa.types.is_decimal(field.type):
+                clean[field.name] = _money(value)
+            else:
+                clean[field.name] = str(value)
+        out.append(clean)
+    return out
+
+
+# --- ALMACÉN ---
+
+def _resolve_filesystem(root: str, endpoint_override: Optional[str] = None) -> Tuple[pafs.FileSystem, str]:
+    if root.startswith("s3://") and endpoint_override:
+        return pafs.S3FileSystem(endpoint_override=endpoint_override), root[len("s3://"):].rstrip("/")
+    if "://" in root:
+        fs, path = pafs.FileSystem.from_uri(root)
+        return fs, path.rstrip("/")
+    return pafs.LocalFileSystem(), os.path.abspath(root)
+
+
+class AnalyticsStore:
+    """Escritura por partición mes/día, consultas SQL cacheadas y compactación."""
+
+    def __init__(self, root: str, endpoint_override: Optional[str] = None, cache_size: int = 128):
+        self.fs, self.base = _resolve_filesystem(root, endpoint_override)
+        self.cache_size = cache_size
+        self.cache_stats = {"hits": 0, "misses": 0}
+        self._cache: "OrderedDict[str, List[dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _dataset_dir(self, dataset: str) -> str:
+        return f"{self.base}/{dataset}"
+
+    def _partition_dir(self, dataset: str, day_key: str) -> str:
+        return f"{self._dataset_dir(dataset)}/month={day_key[:7]}/day={day_key[8:10]}"
+
+    def _write(self, directory: str, table: pa.Table, prefix: str = "part") -> str:
+        self.fs.create_dir(directory, recursive=True)
+        path = f"{directory}/{prefix}-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet"
+        pq.write_table(table, path, filesystem=self.fs, compression="zstd")
+        return path
+
+    def append(self, dataset: str, rows: List[dict]) -> List[str]:
+        """Un archivo Parquet por partición (día de la orden) presente en `rows`; devuelve las rutas."""
+        by_day: Dict[str, List[dict]] = {}
+        for row in rows:
+            by_day.setdefault(row["dayKey"], []).append(row)
+        return [
+            self._write(self._partition_dir(dataset, day_key), pa.Table.from_pylist(day_rows, schema=SCHEMAS[dataset]))
+            for day_key, day_rows in sorted(by_day.items())
+        ]
+
+    def files(self, dataset: str, months: Optional[List[str]] = None) -> List[pafs.FileInfo]:
+        selector = pafs.FileSelector(self._dataset_dir(dataset), recursive=True, allow_not_found=True)
+        infos = [i for i in self.fs.get_file_info(selector) if i.type == pafs.FileType.File and i.path.endswith(".parquet")]
+        if months:
+            wanted = tuple(f"/month={m}/" for m in months)
+            infos = [i for i in infos if any(w in i.path for w in wanted)]
+        return sorted(infos, key=lambda i: i.path)
+
+    def _connect(self, manifest: Dict[str, List[pafs.FileInfo]]) -> "duckdb.DuckDBPyConnection":
+        con = duckdb.connect()
+        for name, infos in manifest.items():
+            if infos:
+                source = ds.dataset([i.path for i in infos], schema=SCHEMAS[name], format="parquet", filesystem=self.fs)
+            else:
+                source = SCHEMAS[name].empty_table()
+            con.register(f"{name}_raw", source)
+        for name, view_sql in VIEWS.items():
+            con.execute(f"CREATE VIEW {name} AS {view_sql}")
+        return con
+
+    def _execute(self, manifest: Dict[str, List[pafs.FileInfo]], sql: str, params: Optional[list]) -> List[dict]:
+        con = self._connect(manifest)
+        try:
+            cursor = con.execute(sql, params or [])
+            columns = [d[0] for d in cursor.description]
+            return [dict(zip(columns, values)) for values in cursor.fetchall()]
+        finally:
+            con.close()
+
+    def query(self, sql: str, params: Optional[list] = None, months: Optional[List[str]] = None) -> List[dict]:
+        """
+        SQL de DuckDB sobre las vistas `orders` / `lines` / `commissions` (y `<dataset>_raw`).
+        `months` limita los archivos leídos a esas particiones.
+        """
+        for attempt in (1, 2):
+            manifest = {name: self.files(name, months) for name in SCHEMAS}
+            fingerprint = hashlib.sha256(json.dumps([
+                sql, params or [], sorted(months or []),
+                {name: [(i.path, i.size) for i in infos] for name, infos in manifest.items()},
+            ], default=str).encode("utf-8")).hexdigest()
+            with self._lock:
+                if fingerprint in self._cache:
+                    self._cache.move_to_end(fingerprint)
+                    self.cache_stats["hits"] += 1
+                    return self._cache[fingerprint]
+            try:
+                result = self._execute(manifest, sql, params)
+                break
+            except (OSError, duckdb.IOException):
+                # Un compact() concurrente borró archivos del listado: se vuelve a listar una vez
+                if attempt == 2:
+                    raise
+
+        with self._lock:
+            self.cache_stats["misses"] += 1
+            self._cache[fingerprint] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def admin_stats(self, month_key: str) -> dict:
+        """KPIs del mes (mismas llaves que el reporte de Athena, más desgloses)."""
+        totals = self.query(
+            "SELECT coalesce(sum(netTotal), 0) AS total_sales, count(*) AS order_count FROM orders WHERE monthKey = ?",
+            [month_key], months=[month_key],
+        )[0]
+        by_channel = self.query(
+            "SELECT channel, count(*) AS order_count, coalesce(sum(netTotal), 0) AS total_sales"
+            " FROM orders WHERE monthKey = ? GROUP BY channel ORDER BY channel",
+            [month_key], months=[month_key],
+        )
+        commissions = self.query(
+            "SELECT status, count(*) AS rows, coalesce(sum(amount), 0) AS amount"
+            " FROM commissions WHERE monthKey = ? GROUP BY status ORDER BY status",
+            [month_key], months=[month_key],
+        )
+        top_products = self.query(
+            "SELECT l.productId, any_value(l.name) AS name, sum(l.quantity) AS quantity, sum(l.lineTotal) AS amount"
+            " FROM lines l JOIN orders o ON l.orderId = o.orderId"
+            " WHERE l.monthKey = ? AND o.status NOT IN ('cancelled', 'refunded')"
+            " GROUP BY l.productId ORDER BY amount DESC, l.productId LIMIT 10",
+            [month_key], months=[month_key],
+        )
+        return {**totals, "byChannel": by_channel, "commissionsByStatus": commissions, "topProducts": top_products}
+
+    # --- COMPACTACIÓN ---
+
+    def partitions(self, months: Optional[List[str]] = None) -> Dict[Tuple[str, str], Dict[str, List[pafs.FileInfo]]]:
+        """{(month=..., day=...): {dataset: [archivos]}} a partir del listado."""
+        out: Dict[Tuple[str, str], Dict[str, List[pafs.FileInfo]]] = {}
+        for dataset in WRITE_ORDER:
+            for info in self.files(dataset, months):
+                month_part, day_part = info.path.split("/")[-3:-1]
+                out.setdefault((month_part, day_part), {name: [] for name in WRITE_ORDER})[dataset].append(info)
+        return out
+
+    def compact(self, months: Optional[List[str]] = None, min_files: int = 4) -> dict:
+        """
+        Por partición con al menos `min_files` archivos en algún dataset: reescribe cada dataset
+        como un solo archivo con el último snapshot de cada orden y borra los de entrada.
+        Debe correr con el mismo lease que el flush (ver dashboard_lambda).
+        """
+        summary = {"partitions": 0, "filesRead": 0, "filesWritten": 0, "rowsDropped": 0}
+        for (month_part, day_part), manifest in sorted(self.partitions(months).items()):
+            if max(len(infos) for infos in manifest.values()) < min_files:
+                continue
+            written, read, dropped = [], 0, 0
+            # Los padres de las filas hijas son las órdenes de la misma partición
+            con = self._connect(manifest)
+            try:
+                for dataset in WRITE_ORDER:
+                    infos = manifest[dataset]
+                    if not infos:
+                        continue
+                    table = con.execute(f"SELECT * FROM {dataset} ORDER BY orderId").fetch_arrow_table().cast(SCHEMAS[dataset])
+                    raw = con.execute(f"SELECT count(*) FROM {dataset}_raw").fetchone()[0]
+                    if table.num_rows:
+                        directory = f"{self._dataset_dir(dataset)}/{month_part}/{day_part}"
+                        written.append(self._write(directory, table, prefix="compacted"))
+                    read += len(infos)
+                    dropped += raw - table.num_rows
+            finally:
+                con.close()
+            for infos in manifest.values():
+                for info in infos:
+                    self.fs.delete_file(info.path)
+            summary["partitions"] += 1
+            summary["filesRead"] += read
+            summary["filesWritten"] += len(written)
+            summary["rowsDropped"] += dropped
+        return summary
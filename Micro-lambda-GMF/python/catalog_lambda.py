@@ -366,6 +366,7 @@ def handle_notifications(method, body, segments):
             utils._table.put_item(Item={
                 "PK": pk, "SK": ntf_id, "readAt": utils._now_iso(), "entityType": "notificationRead"
             })
+            utils._invalidate_customer_dashboards([user_id], "notification_read")
             return utils._json_response(200, {"ok": True})
 
         # Caso: Crear/Editar
@@ -377,6 +378,7 @@ def handle_notifications(method, body, segments):
             "endAt": body.get("endAt"), "active": True, "createdAt": utils._now_iso()
         }
         saved = utils._put_entity("NOTIFICATION", nid, ntf)
+        utils._invalidate_all_dashboards("notification")
         return utils._json_response(201, {"notification": saved})
 
 # --- LAMBDA HANDLER ---
@@ -6,6 +6,7 @@ import core_utils as utils # Importado desde la Lambda Layer
 
 # --- CONSTANTES ---
 MAX_COMMISSION_LEVELS = 3
+DASHBOARD_NETWORK_DEPTH = 5  # niveles del árbol que muestra el dashboard del cliente
 PK_MONTH = "COMMISSION_MONTH"
 BUCKET_NAME = utils.os.getenv("BUCKET_NAME", "findingu-ventas")
 
@@ -14,38 +15,67 @@ _s3 = boto3.client("s3", region_name=utils.AWS_REGION)
 
 # --- HELPERS DEL MOTOR MLM ---
 
-def _get_upline_chain(buyer_id):
-    """Busca los patrocinadores hacia arriba en la red."""
-    return utils._get_customer_upline_ids(buyer_id, MAX_COMMISSION_LEVELS)
+def _ledger_sk(beneficiary_id, month_key) -> str:
+    return f"#BENEFICIARY#{beneficiary_id}#MONTH#{month_key}"
+
+def _empty_ledger_month(beneficiary_id, month_key) -> dict:
+    return {
+        "PK": PK_MONTH, "SK": _ledger_sk(beneficiary_id, month_key), "entityType": "commissionMonth",
+        "beneficiaryId": beneficiary_id, "monthKey": month_key,
+        "ledger": [], "totalPending": utils.D_ZERO,
+        "totalConfirmed": utils.D_ZERO, "totalBlocked": utils.D_ZERO,
+        "status": "IN_PROGRESS", "createdAt": utils._now_iso()
+    }
 
 def _get_ledger_month(beneficiary_id, month_key):
     """Obtiene o inicializa el registro contable mensual del socio."""
-    sk = f"#BENEFICIARY#{beneficiary_id}#MONTH#{month_key}"
-    res = utils._table.get_item(Key={"PK": PK_MONTH, "SK": sk})
-    item = res.get("Item")
-    
-    if not item:
-        item = {
-            "PK": PK_MONTH, "SK": sk, "entityType": "commissionMonth",
-            "beneficiaryId": beneficiary_id, "monthKey": month_key,
-            "ledger": [], "totalPending": utils.D_ZERO, 
-            "totalConfirmed": utils.D_ZERO, "totalBlocked": utils.D_ZERO,
-            "status": "IN_PROGRESS", "createdAt": utils._now_iso()
-        }
-    return item
+    res = utils._table.get_item(Key={"PK": PK_MONTH, "SK": _ledger_sk(beneficiary_id, month_key)})
+    return res.get("Item") or _empty_ledger_month(beneficiary_id, month_key)
+
+def _apply_ledger_op(item: dict, op: tuple) -> None:
+    """Reaplica sobre un mes contable una operación de _CommissionBatch (upsert / confirm / void)."""
+    kind, value = op
+    if kind == "upsert":
+        item["ledger"] = [r for r in item.get("ledger") or [] if r["rowId"] != value["rowId"]] + [value]
+    elif kind == "confirm":
+        for r in item.get("ledger") or []:
+            if r.get("orderId") == value and r.get("status") == "pending":
+                r["status"] = "confirmed"
+    elif kind == "void":
+        item["ledger"] = [r for r in item.get("ledger") or [] if r.get("orderId") != value]
+
+def _put_ledger_if_unchanged(item: dict, created: bool) -> bool:
+    """
+    Escribe el mes contable solo si nadie lo cambió desde que se leyó (ledgerVersion).
+    Devuelve False si otro escritor (anulación en línea, recibo PAID) ganó la carrera.
+    """
+    expected = item.get("ledgerVersion")
+    kwargs = {}
+    if created:
+        kwargs["ConditionExpression"] = "attribute_not_exists(PK)"
+    elif expected is None:
+        kwargs["ConditionExpression"] = "attribute_exists(PK) AND attribute_not_exists(ledgerVersion)"
+    else:
+        kwargs["ConditionExpression"] = "ledgerVersion = :v"
+        kwargs["ExpressionAttributeValues"] = {":v": expected}
+    try:
+        utils._table.put_item(Item={**item, "ledgerVersion": int(expected or 0) + 1}, **kwargs)
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return False
+        raise
+    item["ledgerVersion"] = int(expected or 0) + 1
+    return True
 
-def _save_ledger_month(item):
-    """Recalcula totales y persiste el mes contable."""
+def _ledger_totals(ledger: list) -> dict:
     tp, tc, tb = utils.D_ZERO, utils.D_ZERO, utils.D_ZERO
-    for r in item.get("ledger", []):
+    for r in ledger or []:
         amt = utils._to_decimal(r.get("amount"))
         st = r.get("status")
         if st == "confirmed": tc += amt
         elif st == "blocked": tb += amt
         else: tp += amt
-
-    item.update({"totalPending": tp, "totalConfirmed": tc, "totalBlocked": tb, "updatedAt": utils._now_iso()})
-    utils._table.put_item(Item=item)
+    return {"totalPending": tp, "totalConfirmed": tc, "totalBlocked": tb}
 
 # --- MOTOR VP / VG ---
 
@@ -259,7 +289,7 @@ def handle_evaluate_bonuses(customer_id: str, month_key: str) -> dict:
         if not _evaluate_bonus_rule(rule, customer_id, month_key, vp, vg, bonus_cfg, customer_data):
             continue
         for reward in rule.get("rewards", []):
-            award_id = f"BONUS-{utils.uuid.uuid4().hex[:10].upper()}"
+            award_id = utils._new_id("BONUS-")
             award = {
                 "entityType": "bonusAward",
                 "id": award_id,
@@ -275,10 +305,12 @@ def handle_evaluate_bonuses(customer_id: str, month_key: str) -> dict:
                 "createdAt": utils._now_iso(),
                 "updatedAt": utils._now_iso(),
             }
-            utils._put_entity("BONUS_AWARD", award_id, award)
+            utils._put_entity("BONUS_AWARD", award_id, award, unique=True)
             awarded.append(award)
 
     print(f"[BONUSES] customer={customer_id} month={month_key} vp={vp:.1f} vg={vg:.1f} rank={rank} awarded={len(awarded)}")
+    if awarded:
+        utils._invalidate_customer_dashboards([customer_id], "bonus_award")
     return {"awarded": awarded, "vp": vp, "vg": vg, "rank": rank}
 
 # --- HELPERS DE CONFIGURACIÓN ---
@@ -483,33 +515,10 @@ def _commissionable_net(order: dict, fallback_net) -> utils.Decimal:
     return (net_amount * proportion).quantize(utils.D_CENT)
 
 
-# --- PROCESOS DE ORQUESTACIÓN (STEP FUNCTIONS) ---
-
-def handle_apply_rewards(order_id):
-    """Acción: ORDER_PAID. Calcula comisiones en estado 'pending'."""
-    order = utils._get_by_id("ORDER", order_id)
-    if not order: return {"error": "Order not found"}
-
-    app_cfg   = utils._load_app_config()
-    cfg       = app_cfg.get("rewards", {})
-    bonus_cfg = app_cfg.get("bonuses") or {}
-    vp_cfg    = bonus_cfg.get("vpConfig", {})
-    mxn_per_vp  = float(vp_cfg.get("mxnPerVp", 50))
-
-    month_key  = order.get("monthKey") or utils._month_key()
-    net_amount = utils._to_decimal(order.get("netTotal"))
+# --- PROCESOS DE ORQUESTACIÓN (OUTBOX DE ÓRDENES) ---
 
-    # Calcular monto comisionable: sólo ítems de productos con commissionable=True
-    commissionable_net = _commissionable_net(order, net_amount)
-
-    # 1. Actualizar volumen personal del comprador (solo monto comisionable)
-    buyer_id = order.get("customerId")
-    if order.get("buyerType") in ["associate", "registered"] and buyer_id:
-        utils._increment_associate_month_net_volume(buyer_id, month_key, commissionable_net)
-
-    # 2. Repartir comisiones al upline
-    chain = _get_upline_chain(order['customerId'])
-    levels_cfg = cfg.get("commissionLevels", [])
+def _commission_rates(rewards_cfg: dict) -> dict:
+    levels_cfg = rewards_cfg.get("commissionLevels", [])
     # Extraer tasas de la configuración; fallback a valores por defecto
     default_rates = {1: utils.Decimal("0.10"), 2: utils.Decimal("0.05"), 3: utils.Decimal("0.03")}
     rates = {}
@@ -517,56 +526,252 @@ def handle_apply_rewards(order_id):
         rates[i + 1] = utils._to_decimal(lvl.get("rate", default_rates.get(i + 1, 0)))
     for k, v in default_rates.items():
         rates.setdefault(k, v)
+    return rates
 
-    activation_vp = float(utils._to_decimal(cfg.get("activationNetMin", 50)))
-
-    for idx, b_id in enumerate(chain):
-        level  = idx + 1
-        rate   = rates.get(level, utils.D_ZERO)
-        amount = (commissionable_net * rate).quantize(utils.D_CENT)
+VOLUME_EVENTS_PER_TX = 99  # TransactWriteItems admite 100 items: el ASSOCIATE_MONTH + 99 eventos
+LEDGER_WRITE_ATTEMPTS = 5  # reintentos de un mes contable que otro escritor cambió durante el lote
 
-        # Verificar activación (ahora en VP)
-        m_state = utils._get_by_id("ASSOCIATE_MONTH", utils._associate_month_entity_id(b_id, month_key))
-        beneficiary_vp = _mxn_to_vp(float(utils._to_decimal(m_state.get("netVolume", 0)) if m_state else 0), mxn_per_vp)
-        is_active = beneficiary_vp >= activation_vp
 
-        item   = _get_ledger_month(b_id, month_key)
-        row_id = f"{order_id}#L{level}"
+class _CommissionBatch:
+    """
+    Estado compartido al procesar varias órdenes: config, uplines, estados mensuales y meses
+    contables se cargan una vez (batch gets) y se escriben una vez por beneficiario y mes en flush().
+    Los eventos se aplican en orden sobre el estado en memoria, así que un PAID y un DELIVERED
+    de la misma orden en el mismo lote dan el mismo resultado que procesarlos por separado.
+    """
 
-        new_row = {
-            "rowId": row_id, "orderId": order_id, "amount": amount,
-            "level": level, "status": "pending" if is_active else "blocked",
-            "createdAt": utils._now_iso()
+    def __init__(self, order_ids: list, app_cfg: dict = None):
+        self.app_cfg = app_cfg or utils._load_app_config()
+        rewards_cfg = self.app_cfg.get("rewards", {})
+        vp_cfg = (self.app_cfg.get("bonuses") or {}).get("vpConfig", {})
+        self.mxn_per_vp = float(vp_cfg.get("mxnPerVp", 50))
+        self.activation_vp = float(utils._to_decimal(rewards_cfg.get("activationNetMin", 50)))
+        self.rates = _commission_rates(rewards_cfg)
+
+        self.orders = {
+            str(o.get("orderId")): o
+            for o in utils._batch_get_entities("ORDER", list(dict.fromkeys(str(oid) for oid in order_ids)))
+            if o and o.get("orderId")
         }
-        ledger = [r for r in item['ledger'] if r['rowId'] != row_id]
-        ledger.append(new_row)
-        item['ledger'] = ledger
-        _save_ledger_month(item)
+        self.uplines = {}         # buyerId -> [beneficiarios]
+        self.net_volume = {}      # (customerId, monthKey) -> netVolume actual (incluye deltas del lote)
+        self.volume_deltas = {}   # (customerId, monthKey) -> delta pendiente de escribir
+        self.volume_sources = {}  # (customerId, monthKey) -> [(evento de la outbox, delta)] que lo originan
+        self.ledgers = {}         # (beneficiaryId, monthKey) -> item COMMISSION_MONTH
+        self.created = set()      # meses contables que no existían al leerlos
+        self.ledger_ops = {}      # (beneficiaryId, monthKey) -> operaciones del lote, para reaplicar si hay conflicto
+        self.dirty = set()
+        self.uncommitted = set()  # (PK, SK) de eventos cuyo incremento de volumen no se confirmó
+        self.bonus_targets = []
+        self.dashboard_uplines = {}
+        self._preload()
+
+    def _preload(self):
+        buyers = {str(o.get("customerId")) for o in self.orders.values() if o.get("customerId") not in (None, "")}
+        customers = {str(c.get("customerId")): c for c in utils._batch_get_entities("CUSTOMER", list(buyers))}
+        for buyer_id in buyers:
+            self.uplines[buyer_id] = utils._get_customer_upline_ids(customers.get(buyer_id) or buyer_id, MAX_COMMISSION_LEVELS)
+            stored = utils._customer_id_list((customers.get(buyer_id) or {}).get("uplineIds"))
+            self.dashboard_uplines[buyer_id] = stored[:DASHBOARD_NETWORK_DEPTH] or self.uplines[buyer_id]
+
+        month_keys, ledger_keys = set(), set()
+        for order in self.orders.values():
+            month_key = order.get("monthKey") or utils._month_key()
+            buyer_id = str(order.get("customerId") or "")
+            for b_id in self._beneficiaries(order):
+                month_keys.add((b_id, month_key))
+                ledger_keys.add((b_id, month_key))
+            if buyer_id:
+                month_keys.add((buyer_id, month_key))
+
+        states = utils._batch_get_entities(
+            "ASSOCIATE_MONTH", [utils._associate_month_entity_id(cid, mk) for cid, mk in month_keys]
+        )
+        for state in states:
+            key = (str(state.get("associateId")), str(state.get("monthKey")))
+            self.net_volume[key] = utils._to_decimal(state.get("netVolume", 0))
+        for key in month_keys:
+            self.net_volume.setdefault(key, utils.D_ZERO)
+
+        self.ledgers = {key: None for key in ledger_keys}  # None = precargado y aún no existe
+        for item in utils._batch_get_items([{"PK": PK_MONTH, "SK": _ledger_sk(b, mk)} for b, mk in ledger_keys]):
+            self.ledgers[(str(item.get("beneficiaryId")), str(item.get("monthKey")))] = item
+
+    def _beneficiaries(self, order: dict, include_referrer: bool = False) -> list:
+        chain = list(self.uplines.get(str(order.get("customerId") or ""), []))
+        if include_referrer and (order.get("buyerType") or "").lower() == "guest" and order.get("referrerAssociateId"):
+            chain = [str(order["referrerAssociateId"])] + chain
+        return chain
+
+    def _ledger(self, beneficiary_id, month_key, create: bool = True):
+        key = (str(beneficiary_id), str(month_key))
+        if key not in self.ledgers:
+            # Fuera de lo precargado (p. ej. referidor de invitado): una lectura puntual
+            self.ledgers[key] = utils._table.get_item(Key={"PK": PK_MONTH, "SK": _ledger_sk(beneficiary_id, month_key)}).get("Item")
+        if self.ledgers[key] is None and create:
+            self.ledgers[key] = _empty_ledger_month(beneficiary_id, month_key)
+            self.created.add(key)
+        return self.ledgers[key]
+
+    def _touch(self, key: tuple, op: tuple) -> None:
+        self.ledger_ops.setdefault(key, []).append(op)
+        self.dirty.add(key)
+
+    def apply_rewards(self, order_id, source: dict = None) -> dict:
+        """
+        ORDER_PAID: filas 'pending' (o 'blocked' si el beneficiario no está activo) por nivel.
+        source: evento de la outbox; flush() lo borra en la misma transacción que el volumen.
+        """
+        order = self.orders.get(str(order_id))
+        if not order: return {"error": "Order not found"}
+
+        month_key = order.get("monthKey") or utils._month_key()
+        commissionable_net = _commissionable_net(order, utils._to_decimal(order.get("netTotal")))
+
+        rows = []
+        for idx, b_id in enumerate(self._beneficiaries(order)):
+            level  = idx + 1
+            amount = (commissionable_net * self.rates.get(level, utils.D_ZERO)).quantize(utils.D_CENT)
+            beneficiary_vp = _mxn_to_vp(float(self.net_volume.get((b_id, month_key), utils.D_ZERO)), self.mxn_per_vp)
+            rows.append((b_id, {
+                "rowId": f"{order_id}#L{level}", "orderId": order_id, "amount": amount,
+                "level": level, "status": "pending" if beneficiary_vp >= self.activation_vp else "blocked",
+                "createdAt": utils._now_iso()
+            }))
+
+        for b_id, new_row in rows:
+            item = self._ledger(b_id, month_key)
+            _apply_ledger_op(item, ("upsert", new_row))
+            self._touch((b_id, month_key), ("upsert", new_row))
+
+        # Volumen personal del comprador (solo monto comisionable)
+        buyer_id = str(order.get("customerId") or "")
+        if order.get("buyerType") in ["associate", "registered"] and buyer_id:
+            key = (buyer_id, month_key)
+            self.net_volume[key] = self.net_volume.get(key, utils.D_ZERO) + commissionable_net
+            self.volume_deltas[key] = self.volume_deltas.get(key, utils.D_ZERO) + commissionable_net
+            if source:
+                self.volume_sources.setdefault(key, []).append(({"PK": source["PK"], "SK": source["SK"]}, commissionable_net))
+        return {"orderId": order_id, "rows": len(rows)}
+
+    def confirm(self, order_id) -> dict:
+        """ORDER_DELIVERED: 'pending' -> 'confirmed'; los bonos se evalúan tras el flush."""
+        order = self.orders.get(str(order_id))
+        if not order: return {"error": "Order not found"}
+        month_key = order.get("monthKey") or utils._month_key()
+
+        confirmed = 0
+        for b_id in self._beneficiaries(order):
+            item = self._ledger(b_id, month_key, create=False)
+            if not item: continue
+            pending = sum(1 for r in item["ledger"] if r.get("orderId") == order_id and r.get("status") == "pending")
+            if not pending: continue
+            _apply_ledger_op(item, ("confirm", order_id))
+            self._touch((b_id, month_key), ("confirm", order_id))
+            confirmed += pending
+
+        buyer_id = str(order.get("customerId", ""))
+        if buyer_id and (buyer_id, month_key) not in self.bonus_targets:
+            self.bonus_targets.append((buyer_id, month_key))
+        return {"orderId": order_id, "confirmed": confirmed}
+
+    def void(self, order_id, reason: str) -> dict:
+        """ORDER_CANCELLED / REFUNDED / RETURNED: quita las filas de la orden del mes contable."""
+        order = self.orders.get(str(order_id))
+        if not order:
+            print(f"[VOID_COMM] Orden {order_id} no encontrada")
+            return {"skipped": True}
+        if not order.get("customerId"):
+            return {"skipped": True, "reason": "no_buyer"}
+        month_key = order.get("monthKey") or utils._month_key()
+
+        voided = []
+        for b_id in self._beneficiaries(order, include_referrer=True):
+            item = self._ledger(b_id, month_key, create=False)
+            if not item: continue
+            removed = [r for r in item.get("ledger") or [] if r.get("orderId") == order_id]
+            if not removed: continue
+            _apply_ledger_op(item, ("void", order_id))
+            self._touch((b_id, month_key), ("void", order_id))
+            voided.append({
+                "beneficiaryId": b_id, "orderId": order_id,
+                "pendingRemoved": float(sum(utils._to_decimal(r.get("amount")) for r in removed if (r.get("status") or "").lower() == "pending")),
+                "confirmedRemoved": float(sum(utils._to_decimal(r.get("amount")) for r in removed if (r.get("status") or "").lower() == "confirmed")),
+                "reason": reason,
+            })
+        print(f"[VOID_COMM] order={order_id} reason={reason} voided={len(voided)}")
+        return {"voided": voided, "count": len(voided)}
+
+    def flush(self) -> dict:
+        """Una escritura por mes contable modificado y un incremento por (comprador, mes); luego bonos."""
+        items, before = [], []
+        for key in self.dirty:
+            item, created = self.ledgers[key], key in self.created
+            for _ in range(LEDGER_WRITE_ATTEMPTS):
+                old = {"monthKey": item.get("monthKey"), "status": item.get("status"), "totalConfirmed": item.get("totalConfirmed")}
+                item.update(_ledger_totals(item.get("ledger", [])))
+                item["updatedAt"] = utils._now_iso()
+                if _put_ledger_if_unchanged(item, created):
+                    break
+                # Otro escritor cambió el mes tras la precarga: releer y reaplicar solo lo de este lote
+                fresh = utils._table.get_item(Key={"PK": PK_MONTH, "SK": _ledger_sk(*key)}, ConsistentRead=True).get("Item")
+                created = fresh is None
+                item = fresh or _empty_ledger_month(*key)
+                for op in self.ledger_ops.get(key, []):
+                    _apply_ledger_op(item, op)
+                self.ledgers[key] = item
+            else:
+                raise RuntimeError(f"COMMISSION_MONTH_CONFLICT {key[0]}#{key[1]}")
+            self.created.discard(key)
+            before.append(old)
+            items.append(item)
+        utils._put_commission_month_index(items)
+        for old, item in zip(before, items):
+            utils._kpi_commission_month_change(old, item)
+        touched = {key[0] for key in self.dirty}
+        for (customer_id, month_key), delta in self.volume_deltas.items():
+            sources = self.volume_sources.get((customer_id, month_key)) or []
+            for start in range(0, len(sources), VOLUME_EVENTS_PER_TX):
+                chunk = sources[start:start + VOLUME_EVENTS_PER_TX]
+                committed = utils._increment_associate_month_net_volume(
+                    customer_id, month_key, sum((d for _, d in chunk), utils.D_ZERO), consumed_events=[e for e, _ in chunk]
+                )
+                if committed is None:
+                    # Transacción cancelada: los demás eventos del bloque siguen en la outbox y se reintentan
+                    self.uncommitted.update((e["PK"], e["SK"]) for e, _ in chunk)
+            untracked = delta - sum((d for _, d in sources), utils.D_ZERO)
+            if untracked or not sources:
+                utils._increment_associate_month_net_volume(customer_id, month_key, untracked)
+            # El volumen del comprador aparece en el árbol de su upline
+            touched.add(str(customer_id))
+            touched.update(self.dashboard_uplines.get(str(customer_id), []))
+        utils._invalidate_customer_dashboards(touched, "commissions")
+
+        # Evaluar bonos para el comprador y su upline al confirmar entrega (una vez por comprador y mes)
+        for buyer_id, month_key in self.bonus_targets:
+            try:
+                handle_evaluate_bonuses(buyer_id, month_key)
+            except Exception as e:
+                print(f"[BONUS_EVAL_ERROR] buyer={buyer_id} err={e}")
+        summary = {"ledgersWritten": len(items), "volumeUpdates": len(self.volume_deltas), "bonusEvaluations": len(self.bonus_targets)}
+        self.dirty, self.volume_deltas, self.volume_sources, self.bonus_targets = set(), {}, {}, []
+        self.ledger_ops = {}
+        return summary
 
-def handle_confirm_commissions(order_id):
+
+def handle_apply_rewards(order_id, batch: _CommissionBatch = None, source: dict = None):
+    """Acción: ORDER_PAID. Calcula comisiones en estado 'pending'."""
+    run = batch or _CommissionBatch([order_id])
+    result = run.apply_rewards(order_id, source)
+    if batch is None: run.flush()
+    return result
+
+def handle_confirm_commissions(order_id, batch: _CommissionBatch = None):
     """Acción: ORDER_DELIVERED. Cambia 'pending' -> 'confirmed' y evalúa bonos."""
-    order = utils._get_by_id("ORDER", order_id)
-    if not order: return
-    month_key = order.get("monthKey") or utils._month_key()
-    chain     = _get_upline_chain(order['customerId'])
-
-    for b_id in chain:
-        item    = _get_ledger_month(b_id, month_key)
-        changed = False
-        for r in item['ledger']:
-            if r.get('orderId') == order_id and r.get('status') == "pending":
-                r['status'] = "confirmed"
-                changed = True
-        if changed:
-            _save_ledger_month(item)
-
-    # Evaluar bonos para el comprador y su upline al confirmar entrega
-    buyer_id = str(order.get("customerId", ""))
-    if buyer_id:
-        try:
-            handle_evaluate_bonuses(buyer_id, month_key)
-        except Exception as e:
-            print(f"[BONUS_EVAL_ERROR] buyer={buyer_id} err={e}")
+    run = batch or _CommissionBatch([order_id])
+    result = run.confirm(order_id)
+    if batch is None: run.flush()
+    return result
 
 # --- HANDLERS DE API ---
 
@@ -610,19 +815,28 @@ def handle_admin_receipt(body):
         "assetId": asset.get("assetId"), "assetUrl": asset.get("url"),
         "status": "paid", "createdAt": now, "updatedAt": now,
     }
-    utils._put_entity("COMMISSION_RECEIPT", receipt_id, receipt_item, created_at_iso=now)
+    utils._put_commission_receipt(receipt_id, receipt_item, created_at_iso=now)
 
     # Marcar el mes contable como PAID
     sk = f"#BENEFICIARY#{cid}#MONTH#{month_key}"
     try:
-        utils._table.update_item(
+        updated = utils._table.update_item(
             Key={"PK": PK_MONTH, "SK": sk},
-            UpdateExpression="SET #s = :p, paidAt = :now",
+            UpdateExpression="SET #s = :p, paidAt = :now, updatedAt = :now, "
+                             "ledgerVersion = if_not_exists(ledgerVersion, :z) + :one",
             ExpressionAttributeNames={"#s": "status"},
-            ExpressionAttributeValues={":p": "PAID", ":now": now},
+            ExpressionAttributeValues={":p": "PAID", ":now": now, ":z": 0, ":one": 1},
+            ReturnValues="ALL_OLD",
         )
+        previous = updated.get("Attributes")
+        if previous:
+            # Solo cambian status y paidAt: el estado nuevo se arma sin otra lectura
+            current = {**previous, "status": "PAID", "paidAt": now}
+            utils._put_commission_month_index([current])
+            utils._kpi_commission_month_change(previous, current)
     except Exception:
         pass
+    utils._invalidate_customer_dashboards([cid], "commission_receipt")
     return utils._json_response(201, {"receipt": receipt_item, "asset": asset})
 
 
@@ -649,7 +863,8 @@ def handle_upload_receipt(body) -> dict:
         "assetId": asset.get("assetId"), "assetUrl": asset.get("url"),
         "status": "uploaded", "createdAt": now, "updatedAt": now,
     }
-    utils._put_entity("COMMISSION_RECEIPT", receipt_id, receipt_item, created_at_iso=now)
+    utils._put_commission_receipt(receipt_id, receipt_item, created_at_iso=now)
+    utils._invalidate_customer_dashboards([customer_id], "commission_receipt")
     return utils._json_response(201, {"receipt": receipt_item, "asset": asset})
 
 
@@ -717,98 +932,187 @@ def handle_get_associate_month(associate_id: str, month_key: str) -> dict:
 
 # --- VOID COMMISSIONS ACTION (Step Functions) ---
 
-def _handle_void_commissions_action(order_id: str, reason: str) -> dict:
+def _handle_void_commissions_action(order_id: str, reason: str, batch: _CommissionBatch = None) -> dict:
     """Acción de Step Functions: revertir comisiones por cancelación o devolución aprobada.
 
     Triggered by: ORDER_CANCELLED, ORDER_REFUNDED, ORDER_RETURNED
     """
-    order = utils._get_by_id("ORDER", order_id)
-    if not order:
-        print(f"[VOID_COMM] Orden {order_id} no encontrada")
-        return {"skipped": True}
-
-    month_key = order.get("monthKey") or utils._month_key()
-    buyer_id = order.get("customerId")
-    if not buyer_id:
-        return {"skipped": True, "reason": "no_buyer"}
-
-    # Construir cadena de beneficiarios (upline hasta MAX_COMMISSION_LEVELS)
-    beneficiaries = utils._get_customer_upline_ids(buyer_id, MAX_COMMISSION_LEVELS)
-
-    if (order.get("buyerType") or "").lower() == "guest":
-        referrer_id = order.get("referrerAssociateId")
-        if referrer_id:
-            beneficiaries = [str(referrer_id)] + beneficiaries
-
-    voided = []
-    for beneficiary_id in beneficiaries:
-        sk = f"#BENEFICIARY#{beneficiary_id}#MONTH#{month_key}"
-        resp = utils._table.get_item(Key={"PK": PK_MONTH, "SK": sk})
-        item = resp.get("Item")
-        if not item:
-            continue
+    run = batch or _CommissionBatch([order_id])
+    result = run.void(order_id, reason)
+    if batch is None: run.flush()
+    return result
 
-        ledger = item.get("ledger") or []
-        pending_delta = utils.D_ZERO
-        confirmed_delta = utils.D_ZERO
-        blocked_delta = utils.D_ZERO
-        new_ledger = []
-        removed = 0
-
-        for row in ledger:
-            if row.get("orderId") == order_id:
-                amt = utils._to_decimal(row.get("amount"))
-                st = (row.get("status") or "").lower()
-                if st == "pending":    pending_delta += amt
-                elif st == "confirmed": confirmed_delta += amt
-                elif st in ("blocked",) or row.get("blocked"): blocked_delta += amt
-                removed += 1
-                continue
-            new_ledger.append(row)
 
-        if removed == 0:
-            continue
+# --- CONSUMIDOR DE LA OUTBOX DE ÓRDENES ---
 
+ORDER_EVENTS_BATCH_SIZE = int(utils.os.getenv("ORDER_EVENTS_BATCH_SIZE", "50"))
+ORDER_EVENTS_MAX_ATTEMPTS = 5
+ORDER_EVENTS_BUDGET_SECONDS = 60
+ORDER_EVENTS_LEASE_SECONDS = 120
+_ORDER_EVENTS_LEASE_KEY = {"PK": "ORDER_OUTBOX#LEASE", "SK": "LEASE"}
+_VOID_ACTIONS = ("ORDER_CANCELLED", "ORDER_REFUNDED", "ORDER_RETURNED")
+
+
+def _acquire_order_events_lease(owner: str) -> bool:
+    """Un solo consumidor a la vez: los incrementos de volumen no son idempotentes."""
+    now_epoch = int(utils.time.time())
+    try:
+        utils._table.put_item(
+            Item={**_ORDER_EVENTS_LEASE_KEY, "owner": owner, "leaseUntil": now_epoch + ORDER_EVENTS_LEASE_SECONDS,
+                  "ttl": now_epoch + ORDER_EVENTS_LEASE_SECONDS * 10},
+            ConditionExpression="attribute_not_exists(PK) OR leaseUntil < :now OR #o = :owner",
+            ExpressionAttributeNames={"#o": "owner"},
+            ExpressionAttributeValues={":now": now_epoch, ":owner": owner},
+        )
+        return True
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+def _release_order_events_lease(owner: str) -> None:
+    try:
+        utils._table.delete_item(
+            Key=_ORDER_EVENTS_LEASE_KEY,
+            ConditionExpression="#o = :owner",
+            ExpressionAttributeNames={"#o": "owner"},
+            ExpressionAttributeValues={":owner": owner},
+        )
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+
+
+def _apply_order_event(batch: _CommissionBatch, event: dict):
+    action, order_id = event.get("action"), event["orderId"]
+    if action == "ORDER_PAID":
+        return handle_apply_rewards(order_id, batch, source=event)
+    if action == "ORDER_DELIVERED":
+        return handle_confirm_commissions(order_id, batch)
+    if action in _VOID_ACTIONS:
+        return _handle_void_commissions_action(order_id, action.lower(), batch)
+    return {"skipped": True, "action": action}
+
+
+def _process_order_events_batch(events: list, blocked: set = None) -> dict:
+    """
+    Aplica un lote de eventos en orden con lecturas y escrituras compartidas.
+    Si una orden falla, sus eventos posteriores se posponen para no desordenarlos: `blocked` lo
+    comparte toda la ejecución, y la siguiente empieza por el evento fallido (sigue en la outbox).
+    Los eventos que originan volumen se borran en la misma transacción que lo incrementa.
+    """
+    blocked = set() if blocked is None else blocked
+    batch = _CommissionBatch([e["orderId"] for e in events if e["orderId"] not in blocked])
+    done, failed = [], []
+    for event in events:
+        order_id = event["orderId"]
+        if order_id in blocked:
+            continue
         try:
+            _apply_order_event(batch, event)
+            done.append(event)
+        except Exception as e:
+            print(f"[ORDER_OUTBOX_ERROR] order={order_id} action={event.get('action')} err={e}")
+            blocked.add(order_id)
+            failed.append((event, str(e)))
+
+    flushed = batch.flush()
+    with utils._table.batch_writer() as writer:
+        for event in done:
+            if (event["PK"], event["SK"]) not in batch.uncommitted:
+                writer.delete_item(Key={"PK": event["PK"], "SK": event["SK"]})
+
+    dead = 0
+    for event, error in failed:
+        attempts = int(event.get("attempts") or 0) + 1
+        if attempts >= ORDER_EVENTS_MAX_ATTEMPTS:
+            # Se aparta para revisión manual; la orden deja de bloquear la outbox
+            utils._table.put_item(Item={**event, "PK": f"{utils.ORDER_OUTBOX_PK}#FAILED", "attempts": attempts,
+                                        "lastError": error, "failedAt": utils._now_iso()})
+            utils._table.delete_item(Key={"PK": event["PK"], "SK": event["SK"]})
+            blocked.discard(event["orderId"])
+            dead += 1
+        else:
             utils._table.update_item(
-                Key={"PK": PK_MONTH, "SK": sk},
-                UpdateExpression=(
-                    "SET ledger = :l, "
-                    "totalPending = if_not_exists(totalPending, :z) - :pd, "
-                    "totalConfirmed = if_not_exists(totalConfirmed, :z) - :cd, "
-                    "totalBlocked = if_not_exists(totalBlocked, :z) - :bd, "
-                    "updatedAt = :u"
-                ),
-                ExpressionAttributeValues={
-                    ":l": new_ledger, ":pd": pending_delta,
-                    ":cd": confirmed_delta, ":bd": blocked_delta,
-                    ":z": utils.D_ZERO, ":u": utils._now_iso(),
-                },
+                Key={"PK": event["PK"], "SK": event["SK"]},
+                UpdateExpression="SET attempts = :a, lastError = :e",
+                ExpressionAttributeValues={":a": attempts, ":e": error},
             )
-            voided.append({
-                "beneficiaryId": beneficiary_id, "orderId": order_id,
-                "pendingRemoved": float(pending_delta),
-                "confirmedRemoved": float(confirmed_delta), "reason": reason,
-            })
-        except Exception as e:
-            print(f"[VOID_SFN_ERROR] beneficiary={beneficiary_id} err={e}")
+    return {
+        "events": len(events), "orders": len(batch.orders), "processed": len(done),
+        "failed": len(failed), "deadLettered": dead, "orderIds": sorted({e["orderId"] for e in done}),
+        **flushed,
+    }
 
-    print(f"[VOID_COMM] order={order_id} reason={reason} voided={len(voided)}")
-    return {"voided": voided, "count": len(voided)}
+
+def _sync_orders_to_analytics(order_ids: list) -> None:
+    """Sustituye al paso SyncToAnalytics de Step Functions: una invocación por lote."""
+    if not order_ids:
+        return
+    utils._invoke_async(
+        utils.os.getenv("ANALYTICS_SYNC_FUNCTION"),
+        {"task": "sync_iceberg", "orderIds": order_ids},
+        tag="ANALYTICS_SYNC_ERROR",
+    )
+
+
+def handle_process_order_events(context=None) -> dict:
+    """
+    Consumidor de ORDER_OUTBOX: lotes de hasta ORDER_EVENTS_BATCH_SIZE eventos en orden de SK.
+    Lo invocan las lambdas productoras (asíncrono o en proceso, ver ORDER_EVENTS_DISPATCH)
+    o EventBridge con {"action": "PROCESS_ORDER_EVENTS"}.
+    """
+    owner = utils.uuid.uuid4().hex
+    if not _acquire_order_events_lease(owner):
+        return {"status": "BUSY"}
+    started = utils.time.monotonic()
+    totals = {"batches": 0, "events": 0, "processed": 0, "failed": 0, "deadLettered": 0, "ledgersWritten": 0}
+    blocked = set()  # órdenes con un evento fallido en esta ejecución: sus eventos posteriores esperan
+    try:
+        start_key = None
+        while utils.time.monotonic() - started < ORDER_EVENTS_BUDGET_SECONDS:
+            if context is not None and context.get_remaining_time_in_millis() < 15000:
+                break
+            query = {"KeyConditionExpression": utils.Key("PK").eq(utils.ORDER_OUTBOX_PK), "Limit": ORDER_EVENTS_BATCH_SIZE}
+            if start_key:
+                # Los fallidos se quedan en la outbox; no se repiten en la misma ejecución
+                query["ExclusiveStartKey"] = start_key
+            items = utils._table.query(**query).get("Items", [])
+            events = [e for e in items if e.get("orderId") and e.get("action")]
+            if not items:
+                break
+            start_key = {"PK": items[-1]["PK"], "SK": items[-1]["SK"]}
+            if not events:
+                continue
+            summary = _process_order_events_batch(events, blocked)
+            _sync_orders_to_analytics(summary["orderIds"])
+            totals["batches"] += 1
+            for key in ("events", "processed", "failed", "deadLettered", "ledgersWritten"):
+                totals[key] += summary[key]
+            if not _acquire_order_events_lease(owner):  # renueva el lease entre lotes
+                print("[ORDER_OUTBOX] Lease perdido; se detiene")
+                break
+    finally:
+        _release_order_events_lease(owner)
+    print(f"[ORDER_OUTBOX] {json.dumps(totals)}")
+    return {"status": "PROCESSED", **totals}
 
 
 # --- LAMBDA HANDLER PRINCIPAL ---
 
 def lambda_handler(event, context):
-    # 1. Detectar si es una invocación de Step Functions
+    # 1. Consumidor de la outbox (job programado / productores) o invocación directa de Step Functions
     if "action" in event:
         action = event["action"]
         oid = event.get("orderId")
+        if action == "PROCESS_ORDER_EVENTS":
+            return handle_process_order_events(context)
         if action == "ORDER_PAID" and oid:
             handle_apply_rewards(oid)
         if action == "ORDER_DELIVERED" and oid:
             handle_confirm_commissions(oid)
-        if action in ("ORDER_CANCELLED", "ORDER_REFUNDED", "ORDER_RETURNED") and oid:
+        if action in _VOID_ACTIONS and oid:
             _handle_void_commissions_action(oid, action.lower())
         return {"status": "PROCESSED", "action": action, "orderId": oid}
 
@@ -835,18 +1139,14 @@ def lambda_handler(event, context):
             if err: return err
             month = (event.get("queryStringParameters") or {}).get("month") or utils._month_key()
             prev_month = (event.get("queryStringParameters") or {}).get("prevMonth")
-            # Query all COMMISSION_MONTH records and filter in memory
-            all_comm = utils._query_bucket("COMMISSION_MONTH")
-            receipts_raw = utils._query_bucket("COMMISSION_RECEIPT")
-            receipt_by_cust = {}
-            for r in receipts_raw:
-                if str(r.get("monthKey")) == str(month):
-                    receipt_by_cust[str(r.get("customerId"))] = r.get("assetUrl") or ""
+            # Solo los beneficiarios del mes (espejo COMMISSION_MONTH#<mes>, segmentos en paralelo)
+            month_comm = utils._query_commission_month(month)
+            receipts_by_cust = {}
+            for r in utils._get_month_receipts(month):
+                receipts_by_cust.setdefault(str(r.get("customerId")), []).append(r)
+            receipt_by_cust = {cid: utils._latest_receipt_url(rows) for cid, rows in receipts_by_cust.items()}
             summary = {}
-            for item in all_comm:
-                sk = str(item.get("SK") or "")
-                if f"#MONTH#{month}" not in sk:
-                    continue
+            for item in month_comm:
                 bid = str(item.get("beneficiaryId") or "")
                 if not bid:
                     continue
@@ -879,13 +1179,23 @@ def lambda_handler(event, context):
             if err: return err
             return handle_upload_receipt(body)
 
-        # POST /commissions/admin/receipt
+        # POST /commissions/admin/receipt  |  POST /commissions/admin/receipt/backfill (índices por socio y mes)
         if root == "admin" and len(segments) >= 2 and segments[1] == "receipt":
             if method == "POST":
                 err = utils._require_admin(headers, "commissions_register_payment")
                 if err: return err
+                if len(segments) > 2 and segments[2] == "backfill":
+                    written = utils._backfill_receipt_index()
+                    return utils._json_response(200, {"ok": True, "written": written})
                 return handle_admin_receipt(body)
 
+        # POST /commissions/admin/month-index/backfill (espejo por mes de COMMISSION_MONTH)
+        if root == "admin" and segments[1:] == ["month-index", "backfill"] and method == "POST":
+            err = utils._require_admin(headers, "access_screen_stats")
+            if err: return err
+            written = utils._backfill_commission_month_index()
+            return utils._json_response(200, {"ok": True, "written": written})
+
         # /commissions/config/rewards  y  /commissions/config/app
         if root == "config" and len(segments) > 1:
             sub = segments[1]
@@ -5,7 +5,9 @@ import os
 import time
 import uuid
 import functools
-from datetime import datetime, timezone
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from typing import Any, Dict, List, Optional, Tuple, Union
 
@@ -54,11 +56,26 @@ def _json_default(value):
         return list(value)
     raise TypeError(f"Object of type {value.__class__.__name__} is not JSON serializable")
 
+def _content_hash(value: Any) -> str:
+    """sha256 estable (claves ordenadas) de cualquier valor serializable a JSON."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=_json_default).encode("utf-8")).hexdigest()
+
+def _floats_to_decimal(value: Any) -> Any:
+    """DynamoDB no acepta float: convierte recursivamente a Decimal."""
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _floats_to_decimal(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_floats_to_decimal(v) for v in value]
+    return value
+
 def _cors_headers(content_type: Optional[str] = "application/json") -> dict:
     headers = {
         "Access-Control-Allow-Origin": "*",
         "Access-Control-Allow-Methods": "GET,POST,PUT,PATCH,DELETE,OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type,Authorization,X-User-Id,X-User-Name,X-User-Role",
+        "Access-Control-Allow-Headers": "Content-Type,Authorization,X-User-Id,X-User-Name,X-User-Role,Idempotency-Key",
+        "Access-Control-Expose-Headers": "Idempotent-Replayed,Retry-After",
     }
     if content_type:
         headers["Content-Type"] = content_type
@@ -98,6 +115,47 @@ def _month_key(dt: Optional[datetime] = None) -> str:
     d = dt or datetime.now(timezone.utc)
     return f"{d.year:04d}-{d.month:02d}"
 
+def _ttl_epoch(seconds: int) -> int:
+    """Valor para el atributo `ttl` (TTL de DynamoDB habilitado sobre `ttl`, epoch en segundos)."""
+    return int(time.time()) + int(seconds)
+
+# ---------------------------------------------------------------------------
+# IDs ordenados por tiempo (sin lecturas para evitar colisiones)
+# ---------------------------------------------------------------------------
+# yymmdd + 12 caracteres Crockford base32 de 60 bits:
+#   27 bits ms del día | 10 bits secuencia | 23 bits de nodo (aleatorio por contenedor)
+# Monótono dentro del contenedor: misma ms -> secuencia; secuencia agotada o reloj hacia
+# atrás -> se avanza la ms lógica. Dos contenedores solo chocarían con el mismo nodo en la
+# misma ms y secuencia; para eso queda el put condicional (_put_entity(..., unique=True)).
+_ID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_ID_SEQ_BITS = 10
+_ID_NODE_BITS = 23
+_ID_NODE = int.from_bytes(os.urandom(4), "big") & ((1 << _ID_NODE_BITS) - 1)
+_id_lock = threading.Lock()
+_id_state = {"ms": 0, "seq": 0}
+
+class EntityIdCollision(Exception):
+    """El ID ya existía: el put condicional evitó sobrescribir otra entidad."""
+
+def _new_id(prefix: str = "") -> str:
+    now_ms = int(time.time() * 1000)
+    with _id_lock:
+        if now_ms > _id_state["ms"]:
+            _id_state["ms"], _id_state["seq"] = now_ms, 0
+        else:
+            _id_state["seq"] += 1
+            if _id_state["seq"] >= (1 << _ID_SEQ_BITS):
+                _id_state["ms"], _id_state["seq"] = _id_state["ms"] + 1, 0
+        ms, seq = _id_state["ms"], _id_state["seq"]
+    day = datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+    ms_of_day = ms % 86_400_000
+    value = (((ms_of_day << _ID_SEQ_BITS) | seq) << _ID_NODE_BITS) | _ID_NODE
+    chars = []
+    for _ in range(12):
+        chars.append(_ID_ALPHABET[value & 31])
+        value >>= 5
+    return f"{prefix}{day.strftime('%y%m%d')}{''.join(reversed(chars))}"
+
 # ---------------------------------------------------------------------------
 # Patrón de Persistencia (Pattern 1: BUCKET PK + REF)
 # ---------------------------------------------------------------------------
@@ -110,10 +168,10 @@ def _ref_pk(entity: str, entity_id: Any) -> str:
 def _make_bucket_sk(created_at_iso: str, entity_id: Any) -> str:
     return f"{created_at_iso}#{entity_id}"
 
-def _put_entity(entity: str, entity_id: Any, item: dict, created_at_iso: Optional[str] = None) -> dict:
+def _build_entity_items(entity: str, entity_id: Any, item: dict, created_at_iso: Optional[str] = None) -> Tuple[dict, dict]:
     entity = entity.upper()
     created_at = created_at_iso or item.get("createdAt") or _now_iso()
-    
+
     main_item = dict(item)
     main_item["PK"] = _bucket_pk(entity)
     main_item["SK"] = main_item.get("SK") or _make_bucket_sk(created_at, entity_id)
@@ -128,11 +186,65 @@ def _put_entity(entity: str, entity_id: Any, item: dict, created_at_iso: Optiona
         "refSK": main_item["SK"],
         "updatedAt": main_item["updatedAt"]
     }
+    return main_item, ref_item
 
+def _put_entity(entity: str, entity_id: Any, item: dict, created_at_iso: Optional[str] = None, unique: bool = False,
+                events: Optional[List[dict]] = None) -> dict:
+    """
+    unique=True: la REF se escribe primero con attribute_not_exists (IDs recién generados).
+    events: items de la outbox (ORDER_OUTBOX) que se escriben en la misma transacción.
+    """
+    main_item, ref_item = _build_entity_items(entity, entity_id, item, created_at_iso)
+    if events:
+        ref_put = {"TableName": TABLE_NAME, "Item": ref_item}
+        if unique:
+            ref_put["ConditionExpression"] = "attribute_not_exists(PK)"
+        try:
+            _ddb_client.transact_write_items(TransactItems=[
+                {"Put": ref_put},
+                {"Put": {"TableName": TABLE_NAME, "Item": main_item}},
+            ] + _outbox_puts(events))
+        except ClientError as e:
+            reasons = e.response.get("CancellationReasons") or []
+            if unique and reasons and reasons[0].get("Code") == "ConditionalCheckFailed":
+                raise EntityIdCollision(f"{entity.upper()}#{entity_id}") from e
+            raise
+        return main_item
+    if unique:
+        try:
+            _table.put_item(Item=ref_item, ConditionExpression="attribute_not_exists(PK)")
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                raise EntityIdCollision(f"{entity.upper()}#{entity_id}") from e
+            raise
+        _table.put_item(Item=main_item)
+        return main_item
     _table.put_item(Item=main_item)
     _table.put_item(Item=ref_item)
     return main_item
 
+def _put_items_batch(items: List[dict]) -> int:
+    """Escribe items crudos con BatchWriteItem (chunks de 25 y reintentos los maneja boto3)."""
+    written = 0
+    with _table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as writer:
+        for item in items or []:
+            if not isinstance(item, dict) or not _normalize_ddb_key(item):
+                continue
+            writer.put_item(Item=item)
+            written += 1
+    return written
+
+def _put_entities_batch(entity: str, rows: List[Tuple[Any, dict]]) -> List[dict]:
+    """Versión masiva de _put_entity: rows = [(entity_id, item), ...] -> items principales."""
+    main_items: List[dict] = []
+    pending: List[dict] = []
+    for entity_id, item in rows or []:
+        main_item, ref_item = _build_entity_items(entity, entity_id, item)
+        main_items.append(main_item)
+        pending.extend([main_item, ref_item])
+    _put_items_batch(pending)
+    return main_items
+
 def _get_by_id(entity: str, entity_id: Any) -> Optional[dict]:
     if str(entity or "").upper() == "ASSOCIATE_MONTH":
         return _get_associate_month_by_id(entity_id)
@@ -142,7 +254,8 @@ def _get_by_id(entity: str, entity_id: Any) -> Optional[dict]:
     resp_main = _table.get_item(Key={"PK": ref["refPK"], "SK": ref["refSK"]})
     return resp_main.get("Item")
 
-def _update_by_id(entity: str, entity_id: Any, expression: str, values: dict, names: Optional[dict] = None) -> dict:
+def _update_by_id(entity: str, entity_id: Any, expression: str, values: dict, names: Optional[dict] = None,
+                  events: Optional[List[dict]] = None, condition: Optional[str] = None) -> dict:
     resp_ref = _table.get_item(Key={"PK": _ref_pk(entity, entity_id), "SK": "REF"})
     ref = resp_ref.get("Item")
     if not ref: raise KeyError(f"{entity}_NOT_FOUND")
@@ -154,7 +267,14 @@ def _update_by_id(entity: str, entity_id: Any, expression: str, values: dict, na
         "ReturnValues": "ALL_NEW"
     }
     if names: kwargs["ExpressionAttributeNames"] = names
-    
+    if condition: kwargs["ConditionExpression"] = condition
+    if events:
+        # Cambio de estado + eventos de la outbox en una sola transacción
+        update = {k: v for k, v in kwargs.items() if k != "ReturnValues"}
+        update["TableName"] = TABLE_NAME
+        _ddb_client.transact_write_items(TransactItems=[{"Update": update}] + _outbox_puts(events))
+        return _table.get_item(Key=kwargs["Key"], ConsistentRead=True).get("Item")
+
     resp = _table.update_item(**kwargs)
     return resp.get("Attributes")
 
@@ -172,6 +292,21 @@ def _query_bucket(entity: str, limit: Optional[int] = None, forward: bool = Fals
         query_kwargs["ExclusiveStartKey"] = lek
     return items
 
+def _query_pk(pk: str, sk_prefix: Optional[str] = None, forward: bool = True) -> List[dict]:
+    """Partición completa (paginada) de un PK, opcionalmente acotada por prefijo de SK."""
+    condition = Key("PK").eq(pk)
+    if sk_prefix:
+        condition = condition & Key("SK").begins_with(sk_prefix)
+    query_kwargs = {"KeyConditionExpression": condition, "ScanIndexForward": forward}
+    items = []
+    while True:
+        resp = _table.query(**query_kwargs)
+        items.extend(resp.get("Items", []))
+        lek = resp.get("LastEvaluatedKey")
+        if not lek: break
+        query_kwargs["ExclusiveStartKey"] = lek
+    return items
+
 def _log_get_item_failure(event: str, key: dict, error: Exception, **extra) -> None:
     payload = {
         "event": event,
@@ -415,6 +550,870 @@ def _upsert_order_customer_history(order: dict) -> Optional[dict]:
     _table.put_item(Item=item)
     return item
 
+# ---------------------------------------------------------------------------
+# Ledger de Movimientos de Inventario (MOVEMENT#<stockId>#<yyyy-mm>)
+# ---------------------------------------------------------------------------
+MOVEMENT_LEDGER_DEFAULT_DAYS = 30
+MOVEMENT_LEDGER_MAX_MONTHS = 24
+MOVEMENT_LEDGER_MAX_LIMIT = 500
+
+def _movement_ledger_pk(stock_id: Any, month_key: str) -> str:
+    return f"MOVEMENT#{stock_id}#{month_key}"
+
+def _movement_ledger_sk(created_at_iso: str, movement_id: Any) -> str:
+    created_at = str(created_at_iso or _now_iso()).strip() or _now_iso()
+    return f"{created_at}#{movement_id}"
+
+def _movement_product_id(raw_id: Any) -> Any:
+    """productId llega como int o str según el origen; el ledger lo guarda como int si es numérico."""
+    try:
+        return int(raw_id)
+    except (ValueError, TypeError):
+        return raw_id
+
+def _build_movement_ledger_item(movement: dict) -> Optional[dict]:
+    stock_id = str(movement.get("stockId") or "").strip()
+    movement_id = str(movement.get("movementId") or "").strip()
+    if not stock_id or not movement_id:
+        return None
+
+    created_at = str(movement.get("createdAt") or _now_iso()).strip() or _now_iso()
+    movement_type = movement.get("movementType") or movement.get("type")
+    item = {k: v for k, v in movement.items() if k not in ("PK", "SK")}
+    item.update({
+        "PK": _movement_ledger_pk(stock_id, created_at[:7]),
+        "SK": _movement_ledger_sk(created_at, movement_id),
+        "entityType": "inventoryMovementLedger",
+        "stockId": stock_id,
+        "movementId": movement_id,
+        "movementType": movement_type,
+        "type": movement_type,
+        "productId": _movement_product_id(movement.get("productId")),
+        "createdAt": created_at,
+    })
+    return item
+
+def _upsert_movement_ledger(movement: dict) -> Optional[dict]:
+    item = _build_movement_ledger_item(movement)
+    if not item:
+        return None
+    _table.put_item(Item=item)
+    return item
+
+def _parse_ledger_bound(raw: Any, end_of_day: bool = False) -> Optional[str]:
+    """Normaliza from/to (fecha o datetime ISO) a un prefijo comparable con el SK del ledger."""
+    value = str(raw or "").strip()
+    if not value:
+        return None
+    if len(value) == 10:
+        datetime.strptime(value, "%Y-%m-%d")
+        return f"{value}T23:59:59Z" if end_of_day else f"{value}T00:00:00Z"
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
+
+def _ledger_months_desc(from_iso: str, to_iso: str) -> List[str]:
+    year, month = int(to_iso[:4]), int(to_iso[5:7])
+    first = from_iso[:7]
+    months: List[str] = []
+    while True:
+        key = f"{year:04d}-{month:02d}"
+        if key < first:
+            break
+        months.append(key)
+        month -= 1
+        if month == 0:
+            year, month = year - 1, 12
+    return months
+
+def _encode_movement_cursor(month_key: str, last_sk: Optional[str]) -> str:
+    payload = {"m": month_key}
+    if last_sk:
+        payload["sk"] = last_sk
+    token = json.dumps(payload).encode("utf-8")
+    return base64.urlsafe_b64encode(token).decode("utf-8").rstrip("=")
+
+def _decode_movement_cursor(token: Any) -> Optional[dict]:
+    token_value = str(token or "").strip()
+    if not token_value:
+        return None
+    try:
+        padded = token_value + ("=" * (-len(token_value) % 4))
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("utf-8")).decode("utf-8"))
+    except Exception:
+        raise ValueError("invalid_cursor")
+    month_key = str((payload or {}).get("m") or "").strip()
+    if len(month_key) != 7:
+        raise ValueError("invalid_cursor")
+    return {"m": month_key, "sk": str(payload.get("sk") or "").strip() or None}
+
+def _query_movement_ledger(
+    stock_id: Any,
+    date_from: Any = None,
+    date_to: Any = None,
+    movement_type: Optional[str] = None,
+    product_id: Any = None,
+    limit: Any = None,
+    cursor: Any = None,
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    Movimientos de un almacén en [from, to], más recientes primero.
+    Recorre solo las particiones mensuales del rango; type/productId se filtran en DynamoDB.
+    Lanza ValueError si el rango, el límite o el cursor son inválidos.
+    """
+    stock_key = str(stock_id or "").strip()
+    if not stock_key:
+        raise ValueError("stockId requerido")
+
+    to_iso = _parse_ledger_bound(date_to, end_of_day=True) or _now_iso()
+    from_iso = _parse_ledger_bound(date_from) or (
+        datetime.strptime(to_iso, "%Y-%m-%dT%H:%M:%SZ") - timedelta(days=MOVEMENT_LEDGER_DEFAULT_DAYS)
+    ).strftime("%Y-%m-%dT%H:%M:%SZ")
+    if from_iso > to_iso:
+        raise ValueError("from debe ser anterior a to")
+
+    months = _ledger_months_desc(from_iso, to_iso)
+    if len(months) > MOVEMENT_LEDGER_MAX_MONTHS:
+        raise ValueError(f"El rango no puede exceder {MOVEMENT_LEDGER_MAX_MONTHS} meses")
+
+    page_size = min(max(int(limit or 100), 1), MOVEMENT_LEDGER_MAX_LIMIT)
+
+    start = _decode_movement_cursor(cursor)
+    if start:
+        if start["m"] not in months:
+            raise ValueError("invalid_cursor")
+        months = months[months.index(start["m"]):]
+
+    filters = None
+    # Los tipos se guardan en minúsculas: el filtro no distingue mayúsculas (igual que el monolito)
+    movement_type = str(movement_type or "").strip().lower()
+    if movement_type:
+        filters = Attr("movementType").eq(movement_type)
+    if product_id not in (None, ""):
+        product_filter = Attr("productId").eq(_movement_product_id(product_id))
+        filters = product_filter if filters is None else filters & product_filter
+
+    items: List[dict] = []
+    for idx, month_key in enumerate(months):
+        query_kwargs = {
+            "KeyConditionExpression": Key("PK").eq(_movement_ledger_pk(stock_key, month_key))
+            & Key("SK").between(from_iso, f"{to_iso}~"),
+            "ScanIndexForward": False,
+        }
+        if filters is not None:
+            query_kwargs["FilterExpression"] = filters
+        if start and start["m"] == month_key and start["sk"]:
+            query_kwargs["ExclusiveStartKey"] = {"PK": _movement_ledger_pk(stock_key, month_key), "SK": start["sk"]}
+
+        while True:
+            query_kwargs["Limit"] = page_size - len(items)
+            resp = _table.query(**query_kwargs)
+            items.extend(resp.get("Items", []))
+            lek = resp.get("LastEvaluatedKey")
+            if len(items) >= page_size:
+                if lek:
+                    return items, _encode_movement_cursor(month_key, lek.get("SK"))
+                if idx + 1 < len(months):
+                    return items, _encode_movement_cursor(months[idx + 1], None)
+                return items, None
+            if not lek:
+                break
+            query_kwargs["ExclusiveStartKey"] = lek
+    return items, None
+
+def _iter_movement_ledger(stock_id: Any, after_iso: str, until_iso: str):
+    """Movimientos con createdAt en (after, until], en orden cronológico (sin paginar al cliente)."""
+    stock_key = str(stock_id or "").strip()
+    if not stock_key or after_iso >= until_iso:
+        return
+    for month_key in reversed(_ledger_months_desc(after_iso, until_iso)):
+        query_kwargs = {
+            "KeyConditionExpression": Key("PK").eq(_movement_ledger_pk(stock_key, month_key))
+            & Key("SK").between(f"{after_iso}~", f"{until_iso}~"),
+            "ScanIndexForward": True,
+        }
+        while True:
+            resp = _table.query(**query_kwargs)
+            for item in resp.get("Items", []):
+                yield item
+            lek = resp.get("LastEvaluatedKey")
+            if not lek:
+                break
+            query_kwargs["ExclusiveStartKey"] = lek
+
+def _backfill_movement_ledger(entity: str = "INVENTORY_MOVEMENT") -> int:
+    """Copia el bucket histórico de movimientos al ledger particionado (idempotente)."""
+    ledger_items = [
+        item for item in (_build_movement_ledger_item(m) for m in _query_bucket(entity))
+        if item
+    ]
+    return _put_items_batch(ledger_items)
+
+# ---------------------------------------------------------------------------
+# Índice de comprobantes de comisión
+# ---------------------------------------------------------------------------
+# COMMISSION_RECEIPT#<customerId> / SK=<monthKey>#<receiptId>: comprobantes de un socio (dashboard)
+# COMMISSION_RECEIPT_MONTH#<monthKey> / SK=<customerId>#<receiptId>: espejo por mes (resúmenes admin)
+def _receipt_customer_pk(customer_id: Any) -> str:
+    return f"COMMISSION_RECEIPT#{_customer_id_str(customer_id)}"
+
+def _receipt_month_pk(month_key: str) -> str:
+    return f"COMMISSION_RECEIPT_MONTH#{month_key}"
+
+def _build_receipt_index_items(receipt: dict) -> List[dict]:
+    customer_id = _customer_id_str(receipt.get("customerId"))
+    month_key = str(receipt.get("monthKey") or "").strip()
+    receipt_id = str(receipt.get("receiptId") or "").strip()
+    if not customer_id or not month_key or not receipt_id:
+        return []
+    base = {k: v for k, v in receipt.items() if k not in ("PK", "SK")}
+    return [
+        {**base, "PK": _receipt_customer_pk(customer_id), "SK": f"{month_key}#{receipt_id}"},
+        {**base, "PK": _receipt_month_pk(month_key), "SK": f"{customer_id}#{receipt_id}"},
+    ]
+
+def _put_commission_receipt(receipt_id: Any, item: dict, created_at_iso: Optional[str] = None) -> dict:
+    main = _put_entity("COMMISSION_RECEIPT", receipt_id, item, created_at_iso=created_at_iso)
+    _put_items_batch(_build_receipt_index_items(main))
+    return main
+
+def _get_customer_receipts(customer_id: Any, month_key: Optional[str] = None) -> List[dict]:
+    """Comprobantes de un socio (de un mes si se indica), del más antiguo al más reciente."""
+    return _query_pk(_receipt_customer_pk(customer_id), f"{month_key}#" if month_key else None)
+
+def _get_month_receipts(month_key: str) -> List[dict]:
+    return _query_pk(_receipt_month_pk(month_key))
+
+def _latest_receipt_url(receipts: List[dict]) -> str:
+    """El receiptId termina en uuid: lo reciente sale de createdAt, no del orden del SK."""
+    with_url = [r for r in receipts or [] if r.get("assetUrl")]
+    latest = max(with_url, key=lambda r: str(r.get("createdAt") or ""), default=None)
+    return latest.get("assetUrl") if latest else ""
+
+def _backfill_receipt_index() -> int:
+    """Copia el bucket histórico COMMISSION_RECEIPT a los dos índices (idempotente)."""
+    index_items = [
+        item for receipt in _query_bucket("COMMISSION_RECEIPT")
+        for item in _build_receipt_index_items(receipt)
+    ]
+    return _put_items_batch(index_items)
+
+# ---------------------------------------------------------------------------
+# Espejo por mes de COMMISSION_MONTH (resúmenes admin)
+# ---------------------------------------------------------------------------
+# COMMISSION_MONTH#<monthKey>#<segmento> / SK=<beneficiaryId>: copia del item (el monolito lee
+# el ledger para el resumen de pagos). Los beneficiarios se reparten por hash en segmentos que
+# se leen en paralelo. Cambiar el número de segmentos exige correr el backfill.
+COMMISSION_MONTH_INDEX_SEGMENTS = 4
+
+def _commission_month_segment(beneficiary_id: Any) -> int:
+    digest = hashlib.sha1(_customer_id_str(beneficiary_id).encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) % COMMISSION_MONTH_INDEX_SEGMENTS
+
+def _commission_month_index_pk(month_key: str, segment: int) -> str:
+    return f"COMMISSION_MONTH#{month_key}#{segment}"
+
+def _commission_month_index_item(item: Optional[dict]) -> Optional[dict]:
+    """Fila del espejo para un item COMMISSION_MONTH (None si le faltan beneficiario o mes)."""
+    beneficiary_id = _customer_id_str((item or {}).get("beneficiaryId"))
+    month_key = str((item or {}).get("monthKey") or "").strip()
+    if not beneficiary_id or not month_key:
+        return None
+    row = {k: v for k, v in item.items() if k not in ("PK", "SK")}
+    row.update({
+        "PK": _commission_month_index_pk(month_key, _commission_month_segment(beneficiary_id)),
+        "SK": beneficiary_id,
+        "entityType": "commissionMonthIndex",
+    })
+    return row
+
+def _put_commission_month_index(items: List[dict]) -> int:
+    """Reescribe el espejo con el estado ya guardado de los items (llamar tras cada escritura)."""
+    return _put_items_batch([row for row in (_commission_month_index_item(i) for i in items or []) if row])
+
+def _query_commission_month(month_key: str) -> List[dict]:
+    """Todos los beneficiarios de un mes: un query paginado por segmento, en paralelo."""
+    pks = [_commission_month_index_pk(month_key, seg) for seg in range(COMMISSION_MONTH_INDEX_SEGMENTS)]
+    with ThreadPoolExecutor(max_workers=len(pks)) as pool:
+        return [row for rows in pool.map(_query_pk, pks) for row in rows]
+
+def _backfill_commission_month_index() -> int:
+    """Genera el espejo desde la partición COMMISSION_MONTH completa (idempotente)."""
+    return _put_commission_month_index(_query_bucket("COMMISSION_MONTH", forward=True))
+
+# ---------------------------------------------------------------------------
+# Idempotencia (header Idempotency-Key -> IDEMPOTENCY#<key>)
+# ---------------------------------------------------------------------------
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# Una ejecución en curso bloquea la llave al menos lo que puede durar la lambda (LAMBDA_TIMEOUT_SECONDS,
+# por defecto el máximo de Lambda); antes de eso no se puede saber si murió o sigue escribiendo
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("LAMBDA_TIMEOUT_SECONDS", "900")) + 5
+IDEMPOTENCY_MAX_KEY_LENGTH = 128
+
+def _idempotency_key(headers: Optional[dict]) -> Optional[str]:
+    for name, value in (headers or {}).items():
+        if str(name).lower() in ("idempotency-key", "x-idempotency-key") and str(value or "").strip():
+            return str(value).strip()
+    return None
+
+def _idempotency_request_hash(body: Any) -> str:
+    return _content_hash(body or {})
+
+_idempotency_state = threading.local()
+
+def _idempotency_mark_written() -> None:
+    """El handler la llama justo antes de su primera escritura: desde ahí un fallo ya no libera la llave."""
+    _idempotency_state.wrote = True
+
+def _with_idempotency(scope: str, headers: Optional[dict], body: Any, handler) -> dict:
+    """
+    Ejecuta `handler()` una sola vez por (Idempotency-Key, scope).
+    - Reintento con la misma llave y el mismo body: responde lo guardado (una lectura).
+    - Misma llave con otro body: 422. Ejecución previa aún en curso: 409 con Retry-After.
+    - Excepción o 5xx antes de escribir (ver _idempotency_mark_written): se libera la llave.
+      Después de escribir la llave queda en `failed` con la respuesta, y el reintento la recibe
+      en lugar de repetir la orden o la venta.
+    Sin header, se comporta igual que antes.
+    """
+    key = _idempotency_key(headers)
+    if not key:
+        return handler()
+    if len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+        return _json_response(400, {"message": "Idempotency-Key inválida"})
+
+    item_key = {"PK": f"IDEMPOTENCY#{key}", "SK": scope}
+    request_hash = _idempotency_request_hash(body)
+    now_epoch = int(time.time())
+
+    existing = _table.get_item(Key=item_key, ConsistentRead=True).get("Item")
+    stale_lock = (
+        existing is not None
+        and existing.get("status") == "in_progress"
+        and existing.get("requestHash") == request_hash
+        and int(existing.get("lockedUntil") or 0) < now_epoch
+    )
+    if existing is None or stale_lock:
+        # Una ejecución que murió a medias libera la llave al vencer su bloqueo
+        existing = None
+        try:
+            _table.put_item(
+                Item={
+                    **item_key,
+                    "status": "in_progress",
+                    "requestHash": request_hash,
+                    "lockedUntil": now_epoch + IDEMPOTENCY_LOCK_SECONDS,
+                    "createdAt": _now_iso(),
+                    "ttl": _ttl_epoch(IDEMPOTENCY_TTL_SECONDS),
+                },
+                ConditionExpression="attribute_not_exists(PK) OR (#s = :in_progress AND lockedUntil < :now)",
+                ExpressionAttributeNames={"#s": "status"},
+                ExpressionAttributeValues={":in_progress": "in_progress", ":now": now_epoch},
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+            existing = _table.get_item(Key=item_key, ConsistentRead=True).get("Item") or {}
+
+    if existing is not None:
+        if existing.get("requestHash") != request_hash:
+            return _json_response(422, {"message": "La Idempotency-Key ya se usó con otro cuerpo de petición"})
+        if existing.get("status") in ("completed", "failed"):
+            headers_out = dict(existing.get("responseHeaders") or _cors_headers())
+            headers_out["Idempotent-Replayed"] = "true"
+            return {"statusCode": int(existing.get("statusCode") or 200), "headers": headers_out, "body": existing.get("responseBody") or "{}"}
+        response = _json_response(409, {"message": "La petición con esta Idempotency-Key sigue en proceso", "retryable": True})
+        response["headers"]["Retry-After"] = "1"
+        return response
+
+    _idempotency_state.wrote = False
+    try:
+        response = handler()
+    except Exception:
+        if not _idempotency_state.wrote:
+            _table.delete_item(Key=item_key)
+            raise
+        response = _json_response(500, {
+            "message": "La petición falló después de registrar cambios; revisa su estado antes de repetirla",
+            "retryable": False,
+        })
+        _store_idempotent_response(item_key, request_hash, "failed", response)
+        raise
+    status_code = int(response.get("statusCode") or 200)
+    if status_code >= 500 and not _idempotency_state.wrote:
+        _table.delete_item(Key=item_key)
+        return response
+    _store_idempotent_response(item_key, request_hash, "failed" if status_code >= 500 else "completed", response)
+    return response
+
+def _store_idempotent_response(item_key: dict, request_hash: str, status: str, response: dict) -> None:
+    status_code = int(response.get("statusCode") or 200)
+    _table.put_item(Item={
+        **item_key,
+        "status": status,
+        "requestHash": request_hash,
+        "statusCode": status_code,
+        "responseHeaders": response.get("headers") or {},
+        "responseBody": response.get("body") or "",
+        "completedAt": _now_iso(),
+        "ttl": _ttl_epoch(IDEMPOTENCY_TTL_SECONDS),
+    })
+
+# ---------------------------------------------------------------------------
+# Outbox de eventos de órdenes (ORDER_OUTBOX -> commissions_lambda por lotes)
+# ---------------------------------------------------------------------------
+ORDER_OUTBOX_PK = "ORDER_OUTBOX"
+# async: invoca al consumidor (ORDER_EVENTS_WORKER_FUNCTION); local: lo corre en este proceso
+# (pruebas/desarrollo); off: solo el job programado drena la outbox.
+ORDER_EVENTS_DISPATCH = os.getenv("ORDER_EVENTS_DISPATCH", "async").strip().lower()
+_lambda_client = None
+
+def _order_event_item(order_id: Any, action: str) -> dict:
+    """Puntero de la outbox. El SK ordenado por tiempo conserva el orden de los eventos de cada orden."""
+    event_id = _new_id("EVT-")
+    return {
+        "PK": ORDER_OUTBOX_PK,
+        "SK": event_id,
+        "entityType": "orderEvent",
+        "eventId": event_id,
+        "orderId": str(order_id),
+        "action": action,
+        "attempts": 0,
+        "createdAt": _now_iso(),
+    }
+
+def _outbox_puts(events: List[dict]) -> List[dict]:
+    return [{"Put": {"TableName": TABLE_NAME, "Item": event}} for event in events or []]
+
+def _invoke_async(function_name: Optional[str], payload: dict, tag: str = "LAMBDA") -> bool:
+    """Invocación asíncrona (InvocationType=Event). Devuelve False si no hay función o falla."""
+    global _lambda_client
+    if not function_name:
+        return False
+    try:
+        if _lambda_client is None:
+            _lambda_client = boto3.client("lambda", region_name=AWS_REGION)
+        _lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType="Event",
+            Payload=json.dumps(payload, default=_json_default).encode(),
+        )
+        return True
+    except Exception as e:
+        print(f"[{tag}] No se pudo invocar {function_name}: {e}")
+        return False
+
+def _kick_order_events_worker() -> None:
+    """Avisa al consumidor de la outbox; si falla, los eventos los recoge el job programado."""
+    if ORDER_EVENTS_DISPATCH == "local":
+        import commissions_lambda  # Despachador en proceso: mismo paquete, sin Lambda ni Step Functions
+        commissions_lambda.handle_process_order_events()
+        return
+    if ORDER_EVENTS_DISPATCH != "async":
+        return
+    _invoke_async(os.getenv("ORDER_EVENTS_WORKER_FUNCTION"), {"action": "PROCESS_ORDER_EVENTS"}, tag="ORDER_OUTBOX")
+
+# ---------------------------------------------------------------------------
+# Copia de campos del dashboard en CUSTOMER (goals / networkMembers / buyAgainIds)
+# ---------------------------------------------------------------------------
+# Contadores por contenedor; cada llamada los emite en el log dashboard_fields_write
+_dashboard_fields_writes: Dict[str, int] = {"written": 0, "skipped": 0, "failed": 0}
+_dashboard_fields_lock = threading.Lock()
+
+def _persist_customer_dashboard_fields(customer: dict, goals: list, network_members: list, buy_again_ids: list) -> str:
+    """
+    Escribe los campos solo si cambió su contenido: el hash se guarda junto a ellos y la
+    escritura es condicional sobre él. -> written | skipped | failed
+    """
+    customer_id = customer.get("customerId") if isinstance(customer, dict) else None
+    if customer_id in (None, ""):
+        return "skipped"
+    fields_hash = _content_hash({"goals": goals, "networkMembers": network_members, "buyAgainIds": buy_again_ids})
+    if customer.get("dashboardFieldsHash") == fields_hash:
+        result = "skipped"
+    else:
+        try:
+            _update_by_id(
+                "CUSTOMER", customer_id,
+                "SET goals = :g, networkMembers = :n, buyAgainIds = :b, dashboardFieldsHash = :h, updatedAt = :u",
+                _floats_to_decimal({
+                    ":g": goals, ":n": network_members, ":b": buy_again_ids,
+                    ":h": fields_hash, ":u": _now_iso(),
+                }),
+                condition="attribute_not_exists(dashboardFieldsHash) OR dashboardFieldsHash <> :h",
+            )
+            result = "written"
+        except ClientError as e:
+            # Otra petición ya guardó el mismo contenido
+            conflict = e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException"
+            result = "skipped" if conflict else "failed"
+        except Exception:
+            result = "failed"
+    with _dashboard_fields_lock:
+        _dashboard_fields_writes[result] += 1
+        totals = dict(_dashboard_fields_writes)
+    print(json.dumps({"event": "dashboard_fields_write", "customerId": str(customer_id), "result": result, "totals": totals}))
+    return result
+
+# ---------------------------------------------------------------------------
+# Documento de dashboard por cliente (DASHBOARD#<customerId>#<monthKey>)
+# ---------------------------------------------------------------------------
+# SK=DOC guarda la respuesta armada; SK=DIRTY la marca de invalidación del cliente.
+# DASHBOARD#GLOBAL/DIRTY invalida a todos (p. ej. notificaciones nuevas). Las marcas
+# usan epoch en ms: el documento es vigente si se armó después de la última marca.
+DASHBOARD_GLOBAL_KEY = {"PK": "DASHBOARD#GLOBAL", "SK": "DIRTY"}
+DASHBOARD_DIRTY_TTL_SECONDS = 40 * 24 * 3600
+
+def _dashboard_pk(customer_id: Any, month_key: Optional[str] = None) -> str:
+    return f"DASHBOARD#{_customer_entity_id(customer_id)}#{month_key or _month_key()}"
+
+def _epoch_ms() -> int:
+    return int(time.time() * 1000)
+
+def _invalidate_customer_dashboards(customer_ids, reason: str) -> int:
+    """
+    Marca como sucio el documento del mes en curso de cada cliente (un BatchWriteItem por 25).
+    Siempre el mes en curso: es el único que se sirve, y también muestra el mes anterior.
+    """
+    seen = set()
+    items = []
+    dirty_at = _epoch_ms()
+    for raw_id in customer_ids or []:
+        if raw_id in (None, ""):
+            continue
+        cid = _customer_entity_id(raw_id)
+        if str(cid) in seen:
+            continue
+        seen.add(str(cid))
+        items.append({
+            "PK": _dashboard_pk(cid),
+            "SK": "DIRTY",
+            "dirtyAt": dirty_at,
+            "reason": reason,
+            "ttl": _ttl_epoch(DASHBOARD_DIRTY_TTL_SECONDS),
+        })
+    if not items:
+        return 0
+    try:
+        return _put_items_batch(items)
+    except Exception as e:
+        # Sin la marca el documento igual caduca por DASHBOARD_DOC_MAX_AGE_SECONDS
+        print(f"[DASHBOARD_INVALIDATE_ERROR] reason={reason} customers={len(items)} err={e}")
+        return 0
+
+def _invalidate_all_dashboards(reason: str) -> None:
+    try:
+        _table.put_item(Item={**DASHBOARD_GLOBAL_KEY, "dirtyAt": _epoch_ms(), "reason": reason})
+    except Exception as e:
+        print(f"[DASHBOARD_INVALIDATE_ERROR] reason={reason} scope=global err={e}")
+
+# ---------------------------------------------------------------------------
+# Contadores KPI (KPI#<scope>#<period>)
+# ---------------------------------------------------------------------------
+# Los escritores suman con UpdateItem ADD y el panel admin / las alertas leen un item por
+# contador en vez de recorrer ORDER, STOCK_TRANSFER, POS_SALE o los meses de comisiones:
+#   KPI#ORDERS#ALL          ordersTotal, salesTotal, status_<estado> (gauge por estado)
+#   KPI#TRANSFERS#ALL       status_<estado>
+#   KPI#POS#<yyyy-mm-dd>    salesCount, salesTotal
+#   KPI#COMMISSIONS#<mes>   pendingDeposit (beneficiarios con confirmado > 0 sin PAID), confirmedTotal
+# Un fallo al sumar no interrumpe la escritura de negocio: el desvío lo corrige _reconcile_kpis.
+KPI_SK = "TOTALS"
+KPI_ALL = "ALL"
+
+def _kpi_key(scope: str, period: str = KPI_ALL) -> dict:
+    return {"PK": f"KPI#{scope}#{period}", "SK": KPI_SK}
+
+def _kpi_status_attr(status: Any) -> Optional[str]:
+    status = str(status or "").strip().lower()
+    return f"status_{status}" if status else None
+
+COUNTER_ADD_MAX_ATTRS = 100  # atributos por UpdateItem (mantiene la expresión bajo 4 KB)
+
+def _counter_add(key: dict, deltas: Dict[str, Any], tag: str) -> None:
+    """UpdateItem ADD de varios contadores de un item; un fallo se registra con `tag` y no se propaga."""
+    deltas = {attr: _to_decimal(delta) for attr, delta in deltas.items() if attr and _to_decimal(delta) != 0}
+    ordered = sorted(deltas.items())
+    for start in range(0, len(ordered), COUNTER_ADD_MAX_ATTRS):
+        names, values, parts = {"#u": "updatedAt"}, {":u": _now_iso()}, []
+        for idx, (attr, delta) in enumerate(ordered[start:start + COUNTER_ADD_MAX_ATTRS]):
+            names[f"#k{idx}"] = attr
+            values[f":k{idx}"] = delta
+            parts.append(f"#k{idx} :k{idx}")
+        try:
+            _table.update_item(
+                Key=key,
+                UpdateExpression="SET #u = :u ADD " + ", ".join(parts),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+        except Exception as e:
+            chunk = dict(ordered[start:start + COUNTER_ADD_MAX_ATTRS])
+            print(f"[{tag}] key={key['PK']} deltas={json.dumps(chunk, default=_json_default)} err={e}")
+
+def _kpi_add(scope: str, period: str, deltas: Dict[str, Any]) -> None:
+    _counter_add(_kpi_key(scope, period), deltas, "KPI_ADD_ERROR")
+
+def _order_kpi_total(order: dict) -> Decimal:
+    return _to_decimal(order.get("netTotal") or order.get("total") or 0)
+
+def _kpi_orders_created(orders: List[dict]) -> None:
+    """Órdenes nuevas (en línea o POS): conteo, venta total y gauge de su estado inicial."""
+    deltas: Dict[str, Decimal] = {}
+    for order in orders or []:
+        deltas["ordersTotal"] = deltas.get("ordersTotal", D_ZERO) + 1
+        deltas["salesTotal"] = deltas.get("salesTotal", D_ZERO) + _order_kpi_total(order)
+        attr = _kpi_status_attr(order.get("status"))
+        if attr:
+            deltas[attr] = deltas.get(attr, D_ZERO) + 1
+    _kpi_add("ORDERS", KPI_ALL, deltas)
+
+def _kpi_status_change(scope: str, previous_status: Any, new_status: Any) -> None:
+    """Mueve una unidad entre gauges de estado (previous_status=None al crear)."""
+    before, after = _kpi_status_attr(previous_status), _kpi_status_attr(new_status)
+    if before == after:
+        return
+    deltas = {}
+    if before:
+        deltas[before] = -1
+    if after:
+        deltas[after] = 1
+    _kpi_add(scope, KPI_ALL, deltas)
+
+def _kpi_order_status_change(previous_status: Any, new_status: Any) -> None:
+    _kpi_status_change("ORDERS", previous_status, new_status)
+
+def _kpi_transfer_status_change(previous_status: Any, new_status: Any) -> None:
+    _kpi_status_change("TRANSFERS", previous_status, new_status)
+
+def _kpi_pos_sales(sales: List[dict]) -> None:
+    """Ventas POS por día de registro (un ADD por día distinto)."""
+    by_day: Dict[str, Dict[str, Decimal]] = {}
+    for sale in sales or []:
+        day = str(sale.get("createdAt") or _now_iso())[:10]
+        deltas = by_day.setdefault(day, {"salesCount": D_ZERO, "salesTotal": D_ZERO})
+        deltas["salesCount"] += 1
+        deltas["salesTotal"] += _to_decimal(sale.get("total"))
+    for day, deltas in by_day.items():
+        _kpi_add("POS", day, deltas)
+
+def _commission_pending_deposit(item: Optional[dict]) -> bool:
+    return bool(item) and _to_decimal(item.get("totalConfirmed")) > 0 and (item.get("status") or "") != "PAID"
+
+def _kpi_commission_month_change(before: Optional[dict], after: Optional[dict]) -> None:
+    """Transición de un item COMMISSION_MONTH (before=None si no existía)."""
+    month_key = str((after or before or {}).get("monthKey") or "").strip()
+    if not month_key:
+        return
+    _kpi_add("COMMISSIONS", month_key, {
+        "pendingDeposit": int(_commission_pending_deposit(after)) - int(_commission_pending_deposit(before)),
+        "confirmedTotal": _to_decimal((after or {}).get("totalConfirmed")) - _to_decimal((before or {}).get("totalConfirmed")),
+    })
+
+def _get_kpis(keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], dict]:
+    """Un BatchGet para varios contadores; los que aún no existen vuelven como {}."""
+    by_pk = {item.get("PK"): item for item in _batch_get_items([_kpi_key(scope, period) for scope, period in keys])}
+    return {(scope, period): by_pk.get(_kpi_key(scope, period)["PK"]) or {} for scope, period in keys}
+
+def _kpi_int(item: dict, attr: str) -> int:
+    return int(_to_decimal((item or {}).get(attr)))
+
+def _reconcile_kpis(commission_months: List[str]) -> dict:
+    """
+    Recalcula los contadores desde las fuentes y los sobrescribe (job periódico).
+    Un ADD concurrente con el recorrido puede perderse; la siguiente corrida lo corrige.
+    """
+    now = _now_iso()
+    computed: Dict[Tuple[str, str], Dict[str, Decimal]] = {}
+
+    orders = computed.setdefault(("ORDERS", KPI_ALL), {"ordersTotal": D_ZERO, "salesTotal": D_ZERO})
+    for order in _query_bucket("ORDER"):
+        orders["ordersTotal"] += 1
+        orders["salesTotal"] += _order_kpi_total(order)
+        attr = _kpi_status_attr(order.get("status"))
+        if attr:
+            orders[attr] = orders.get(attr, D_ZERO) + 1
+
+    transfers = computed.setdefault(("TRANSFERS", KPI_ALL), {})
+    for transfer in _query_bucket("STOCK_TRANSFER"):
+        attr = _kpi_status_attr(transfer.get("status"))
+        if attr:
+            transfers[attr] = transfers.get(attr, D_ZERO) + 1
+
+    for sale in _query_bucket("POS_SALE"):
+        day = str(sale.get("createdAt") or "")[:10]
+        if not day:
+            continue
+        totals = computed.setdefault(("POS", day), {"salesCount": D_ZERO, "salesTotal": D_ZERO})
+        totals["salesCount"] += 1
+        totals["salesTotal"] += _to_decimal(sale.get("total"))
+
+    for month_key in commission_months or []:
+        totals = computed.setdefault(("COMMISSIONS", month_key), {"pendingDeposit": D_ZERO, "confirmedTotal": D_ZERO})
+        for item in _query_commission_month(month_key):
+            totals["pendingDeposit"] += int(_commission_pending_deposit(item))
+            totals["confirmedTotal"] += _to_decimal(item.get("totalConfirmed"))
+
+    stored = _get_kpis(list(computed))
+    drift = []
+    for key, totals in computed.items():
+        current = stored.get(key) or {}
+        for attr in sorted(set(totals) | {a for a in current if a.startswith("status_")}):
+            actual, recorded = totals.get(attr, D_ZERO), _to_decimal(current.get(attr))
+            if actual != recorded:
+                drift.append({"counter": _kpi_key(*key)["PK"], "attr": attr, "stored": recorded, "actual": actual})
+    _put_items_batch([
+        {**_kpi_key(scope, period), "entityType": "kpi", **totals, "updatedAt": now, "reconciledAt": now}
+        for (scope, period), totals in computed.items()
+    ])
+    result = {"counters": len(computed), "drifted": len(drift), "drift": drift[:100]}
+    print(json.dumps({"event": "kpi_reconcile", **result}, default=_json_default))
+    return result
+
+# ---------------------------------------------------------------------------
+# Rollups diarios de ventas (ROLLUP#SALES#<yyyy-mm-dd>)
+# ---------------------------------------------------------------------------
+# Un item por día con contadores ADD por evento y dimensión, en atributos planos:
+#   <evento>#orders | <evento>#qty | <evento>#amount                 totales del día
+#   <evento>#channel#<online|pickup|pos>#qty | #amount
+#   <evento>#stock#<stockId|unassigned>#qty | #amount
+#   <evento>#product#<productId>#qty | #amount
+# Eventos: paid (venta reconocida al salir de pending, o al registrarse en POS), delivered y
+# refunded. Los montos son netTotal; por producto se prorratea el descuento de la orden sobre
+# sus líneas. El día es el de la transición. Los reportes por periodo suman días con un
+# BatchGet (_get_sales_rollups) sin leer ORDER. Igual que los KPI, un fallo al sumar no
+# interrumpe la escritura de negocio.
+SALES_ROLLUP_EVENTS = ("paid", "delivered", "refunded")
+SALES_ROLLUP_DIMENSIONS = {"channel": "byChannel", "stock": "byStock", "product": "byProduct"}
+SALES_ROLLUP_MAX_DAYS = 370
+_SALES_ROLLUP_UNPAID = ("", "pending")
+_SALES_ROLLUP_SOLD = ("paid", "shipped", "delivered")
+
+def _sales_rollup_key(day: str) -> dict:
+    return {"PK": f"ROLLUP#SALES#{day}", "SK": KPI_SK}
+
+def _order_sales_channel(order: dict) -> str:
+    if str(order.get("orderId") or "").startswith("POS-"):
+        return "pos"
+    return "pickup" if order.get("deliveryType") == "pickup" else "online"
+
+def _sales_rollup_deltas(order: dict, events: List[str], deltas: Optional[Dict[str, Decimal]] = None,
+                         channel: Optional[str] = None) -> Dict[str, Decimal]:
+    deltas = {} if deltas is None else deltas
+
+    def add(attr: str, value) -> None:
+        deltas[attr] = deltas.get(attr, D_ZERO) + _to_decimal(value)
+
+    lines = []
+    for line in order.get("items") or []:
+        pid = str(line.get("productId") or "").strip()
+        qty = int(line.get("quantity") or line.get("qty") or 0)
+        if pid and qty > 0:
+            lines.append((pid, qty, _to_decimal(line.get("price")) * qty))
+    net = _order_kpi_total(order)
+    gross = sum((amount for _, _, amount in lines), D_ZERO)
+    qty_total = sum(qty for _, qty, _ in lines)
+    dimensions = (("channel", channel or _order_sales_channel(order)),
+                  ("stock", str(order.get("stockId") or order.get("pickupStockId") or "unassigned")))
+    for event in events:
+        add(f"{event}#orders", 1)
+        add(f"{event}#qty", qty_total)
+        add(f"{event}#amount", net)
+        for dimension, value in dimensions:
+            add(f"{event}#{dimension}#{value}#qty", qty_total)
+            add(f"{event}#{dimension}#{value}#amount", net)
+        for pid, qty, amount in lines:
+            add(f"{event}#product#{pid}#qty", qty)
+            add(f"{event}#product#{pid}#amount", (net * amount / gross).quantize(D_CENT) if gross > 0 else D_ZERO)
+    return deltas
+
+def _sales_rollup_order_status_change(order: dict, previous_status: Any, new_status: Any, day: Optional[str] = None) -> None:
+    """Transición de una orden en línea o pickup (las POS entran con _sales_rollup_pos_orders)."""
+    before = str(previous_status or "").strip().lower()
+    after = str(new_status or "").strip().lower()
+    if before == after:
+        return
+    events = []
+    if after in _SALES_ROLLUP_SOLD and before in _SALES_ROLLUP_UNPAID:
+        events.append("paid")
+    if after in ("delivered", "refunded"):
+        events.append(after)
+    if events:
+        _counter_add(_sales_rollup_key(day or _now_iso()[:10]), _sales_rollup_deltas(order, events), "SALES_ROLLUP_ERROR")
+
+def _sales_rollup_pos_orders(orders: List[dict]) -> None:
+    """Órdenes POS (pagadas y entregadas en sucursal) por día de registro: un ADD por día."""
+    by_day: Dict[str, Dict[str, Decimal]] = {}
+    for order in orders or []:
+        day = str(order.get("createdAt") or _now_iso())[:10]
+        _sales_rollup_deltas(order, ["paid", "delivered"], by_day.setdefault(day, {}), channel="pos")
+    for day, deltas in by_day.items():
+        _counter_add(_sales_rollup_key(day), deltas, "SALES_ROLLUP_ERROR")
+
+def _sales_rollup_days(start_day: str, end_day: str) -> List[str]:
+    """Días de [start_day, end_day]; ValueError si las fechas no son YYYY-MM-DD o el rango es inválido."""
+    start = datetime.strptime(start_day, "%Y-%m-%d")
+    end = datetime.strptime(end_day, "%Y-%m-%d")
+    span = (end - start).days + 1
+    if span < 1 or span > SALES_ROLLUP_MAX_DAYS:
+        raise ValueError(f"El rango debe ser de 1 a {SALES_ROLLUP_MAX_DAYS} días")
+    return [(start + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(span)]
+
+def _empty_sales_rollup_period(period: str) -> dict:
+    return {
+        "period": period,
+        "totals": {event: {"orders": D_ZERO, "qty": D_ZERO, "amount": D_ZERO} for event in SALES_ROLLUP_EVENTS},
+        **{field: {} for field in SALES_ROLLUP_DIMENSIONS.values()},
+    }
+
+def _get_sales_rollups(start_day: str, end_day: str, group_by: str = "total") -> dict:
+    """
+    Suma los rollups del rango (un BatchGet) agrupando por "total", "month" o "day".
+    Cada periodo trae totals[evento] y byChannel/byStock/byProduct[valor][evento] = {qty, amount},
+    además de net = paid - refunded en totals.
+    """
+    days = _sales_rollup_days(start_day, end_day)
+    period_of = {"total": lambda d: f"{days[0]}..{days[-1]}", "month": lambda d: d[:7], "day": lambda d: d}[group_by]
+    stored = {item.get("PK"): item for item in _batch_get_items([_sales_rollup_key(day) for day in days])}
+
+    periods: Dict[str, dict] = {}
+    for day in days:
+        bucket = periods.setdefault(period_of(day), _empty_sales_rollup_period(period_of(day)))
+        for attr, value in (stored.get(_sales_rollup_key(day)["PK"]) or {}).items():
+            parts = attr.split("#")
+            if len(parts) < 2 or parts[0] not in SALES_ROLLUP_EVENTS:
+                continue
+            event, metric = parts[0], parts[-1]
+            if len(parts) == 2:
+                target = bucket["totals"][event]
+            elif len(parts) >= 4 and parts[1] in SALES_ROLLUP_DIMENSIONS:
+                values = bucket[SALES_ROLLUP_DIMENSIONS[parts[1]]].setdefault("#".join(parts[2:-1]), {})
+                target = values.setdefault(event, {"qty": D_ZERO, "amount": D_ZERO})
+            else:
+                continue
+            target[metric] = target.get(metric, D_ZERO) + _to_decimal(value)
+
+    for bucket in periods.values():
+        paid, refunded = bucket["totals"]["paid"], bucket["totals"]["refunded"]
+        bucket["totals"]["net"] = {key: paid[key] - refunded[key] for key in ("orders", "qty", "amount")}
+    return {"from": days[0], "to": days[-1], "groupBy": group_by, "days": len(days), "periods": list(periods.values())}
+
+# ---------------------------------------------------------------------------
+# Caché de Almacenes (STOCK)
+# ---------------------------------------------------------------------------
+STOCKS_CACHE_TTL_SECONDS = int(os.getenv("STOCKS_CACHE_TTL_SECONDS", "30"))
+_stocks_cache: Dict[str, Any] = {"items": None, "loadedAt": 0.0}
+
+def _get_stocks_cached(force: bool = False) -> List[dict]:
+    """Bucket STOCK completo con TTL corto por contenedor (lecturas de disponibilidad/asignación)."""
+    now = time.time()
+    if force or _stocks_cache["items"] is None or now - _stocks_cache["loadedAt"] > STOCKS_CACHE_TTL_SECONDS:
+        _stocks_cache["items"] = [s for s in _query_bucket("STOCK") if s.get("stockId")]
+        _stocks_cache["loadedAt"] = now
+    return _stocks_cache["items"]
+
+def _invalidate_stocks_cache() -> None:
+    _stocks_cache["items"] = None
+
 # ---------------------------------------------------------------------------
 # Seguridad y Privilegios
 # ---------------------------------------------------------------------------
@@ -501,14 +1500,20 @@ def _put_associate_month_ref(entity_id: str, updated_at: str) -> None:
         "updatedAt": updated_at,
     })
 
-def _increment_associate_month_net_volume(associate_id: Any, month_key: str, delta: Any) -> dict:
+def _increment_associate_month_net_volume(associate_id: Any, month_key: str, delta: Any,
+                                           consumed_events: Optional[List[dict]] = None) -> Optional[dict]:
+    """
+    consumed_events: eventos de la outbox que originan el delta. El incremento no es idempotente,
+    así que se aplica en la misma transacción que los borra; si alguno ya no existe (el delta ya
+    se aplicó) la transacción se cancela y devuelve None: ningún evento del bloque se consumió.
+    """
     entity_id = _associate_month_entity_id(associate_id, month_key)
     if not entity_id:
         raise ValueError("ASSOCIATE_MONTH_INVALID_ID")
 
     normalized_associate_id = _customer_id_str(associate_id)
     now = _now_iso()
-    resp = _table.update_item(
+    update = dict(
         Key=_associate_month_key(entity_id),
         UpdateExpression=(
             "SET entityType = if_not_exists(entityType, :entity_type), "
@@ -529,8 +1534,23 @@ def _increment_associate_month_net_volume(associate_id: Any, month_key: str, del
             ":delta": _to_decimal(delta),
             ":inactive": False,
         },
-        ReturnValues="ALL_NEW",
     )
+    if consumed_events:
+        try:
+            _ddb_client.transact_write_items(TransactItems=[{"Update": {**update, "TableName": TABLE_NAME}}] + [
+                {"Delete": {"TableName": TABLE_NAME, "Key": {"PK": e["PK"], "SK": e["SK"]},
+                            "ConditionExpression": "attribute_exists(PK)"}}
+                for e in consumed_events
+            ])
+        except ClientError as e:
+            reasons = e.response.get("CancellationReasons") or []
+            if any(r.get("Code") == "ConditionalCheckFailed" for r in reasons[1:]):
+                print(json.dumps({"event": "associate_month_volume_already_applied", "associateMonth": entity_id}))
+                return None
+            raise
+        _put_associate_month_ref(entity_id, now)
+        return {}
+    resp = _table.update_item(**update, ReturnValues="ALL_NEW")
     _put_associate_month_ref(entity_id, now)
     return resp.get("Attributes") or {}
 
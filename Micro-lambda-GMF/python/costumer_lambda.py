@@ -1,14 +1,21 @@
 import base64
 import json
+import threading
 import time
 import boto3
 import core_utils as utils  # Importado desde la Lambda Layer
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 # Cliente S3 para subida de documentos propios del cliente
 BUCKET_NAME = utils.os.getenv("BUCKET_NAME", "findingu-ventas")
 _s3 = boto3.client("s3", region_name=utils.AWS_REGION)
 FRONTEND_URL = utils.os.getenv("FRONTEND_BASE_URL", "https://www.findingu.com.mx")
+DASHBOARD_LOADER_WORKERS = int(utils.os.getenv("DASHBOARD_LOADER_WORKERS", "8"))
+# Documento precalculado: cuánto se sirve uno invalidado mientras se refresca y edad máxima absoluta
+DASHBOARD_DOC_STALE_SECONDS = int(utils.os.getenv("DASHBOARD_DOC_STALE_SECONDS", "30"))
+DASHBOARD_DOC_MAX_AGE_SECONDS = int(utils.os.getenv("DASHBOARD_DOC_MAX_AGE_SECONDS", "900"))
+DASHBOARD_DOC_MAX_BYTES = 350_000  # margen bajo el límite de 400 KB por item
 DEFAULT_SPONSOR = {
     "name": "FindingU",
     "email": "contacto@findingu.com.mx",
@@ -155,22 +162,64 @@ class _DashboardTimer:
         self.request_id = utils.uuid.uuid4().hex[:12]
         self.started_at = time.perf_counter()
         self.last_at = self.started_at
+        self._lock = threading.Lock()  # las etapas concurrentes no intercalan sus líneas
 
-    def mark(self, stage: str, **extra):
-        now = time.perf_counter()
+    def _emit(self, stage: str, elapsed: float, now: float, extra: dict):
         payload = {
             "event": "customer_dashboard_timing",
             "requestId": self.request_id,
             "customerId": self.customer_id,
             "stage": stage,
-            "elapsedMs": round((now - self.last_at) * 1000, 2),
+            "elapsedMs": round(elapsed * 1000, 2),
             "totalMs": round((now - self.started_at) * 1000, 2),
         }
         if extra:
             payload.update(extra)
-        print(json.dumps(payload, default=utils._json_default))
+        with self._lock:
+            print(json.dumps(payload, default=utils._json_default))
+
+    def mark(self, stage: str, **extra):
+        now = time.perf_counter()
+        self._emit(stage, now - self.last_at, now, extra)
         self.last_at = now
 
+    def stage(self, stage: str, started_at: float, **extra):
+        """Etapa concurrente: elapsedMs es su propia duración, no el tiempo desde la marca anterior."""
+        now = time.perf_counter()
+        self._emit(stage, now - started_at, now, {**extra, "parallel": True})
+
+
+class _DashboardLoader:
+    """
+    Etapas con dependencias en un pool de hilos: cada una arranca en cuanto terminan las que
+    necesita, así la latencia total queda cerca de la rama más lenta y no de la suma.
+    Las dependencias se registran antes que quien las usa (cola FIFO), por lo que no hay bloqueos.
+    """
+
+    def __init__(self, timer: _DashboardTimer, max_workers: int = DASHBOARD_LOADER_WORKERS):
+        self.timer = timer
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=True)
+
+    def submit(self, name: str, fn, *deps, meta=None):
+        """fn recibe los resultados de `deps` en orden; meta(resultado) -> campos extra del log."""
+        def run():
+            args = [self.futures[dep].result() for dep in deps]
+            started = time.perf_counter()
+            result = fn(*args)
+            self.timer.stage(name, started, **(meta(result) if meta else {}))
+            return result
+        self.futures[name] = self.executor.submit(run)
+
+    def result(self, name: str):
+        return self.futures[name].result()
+
 
 def _load_customer_network_scope(customer: dict) -> tuple:
     if not customer or not isinstance(customer, dict):
@@ -1038,6 +1087,11 @@ def handle_create_customer(body, headers=None):
     if body.get("level") is not None:
         item["level"] = body.get("level")
     main = utils._put_entity("CUSTOMER", customer_id, item, created_at_iso=now)
+    if leader_id is not None:
+        # Nuevo miembro en la red del patrocinador y de su upline
+        utils._invalidate_customer_dashboards(
+            [leader_id] + utils._get_customer_upline_ids(leader_id, 4), "network"
+        )
     return utils._json_response(201, {"customer": _format_customer_output(main)})
 
 def handle_get_customer(customer_id, headers=None):
@@ -1100,6 +1154,9 @@ def handle_update_customer(customer_id, body, headers):
             updated = utils._get_by_id("CUSTOMER", cid) or updated
         except Exception as ex:
             print(f"[CUSTOMER_NETWORK_SYNC_ERROR] action=update_customer customerId={cid} error={ex}")
+        utils._invalidate_all_dashboards("network")
+    else:
+        utils._invalidate_customer_dashboards([cid], "profile")
 
     return utils._json_response(200, {"customer": _format_customer_output(updated)})
 
@@ -1131,6 +1188,7 @@ def handle_update_profile(body, headers):
             eav[f":{field}"] = str(body[field]).strip()
 
     updated = utils._update_by_id("CUSTOMER", cid, f"SET {', '.join(updates)}", eav, ean or None)
+    utils._invalidate_customer_dashboards([cid], "profile")
     return utils._json_response(200, {"customer": _format_customer_output(updated)})
 
 
@@ -1153,6 +1211,7 @@ def handle_update_clabe(customer_id, body, headers):
         eav[":bi"] = bank_institution
 
     utils._update_by_id("CUSTOMER", customer_id, update_expr, eav)
+    utils._invalidate_customer_dashboards([customer_id], "clabe")
 
     return utils._json_response(200, {"ok": True, "clabeLast4": clabe[-4:]})
 
@@ -1302,8 +1361,110 @@ def handle_rebuild_network_tree(headers):
     return utils._json_response(200, {"ok": True, "networkTree": result})
 
 
+def _load_dashboard_doc(customer_id, month_key: str) -> tuple:
+    """Un solo BatchGetItem: documento, marca del cliente y marca global -> (doc, marcas)."""
+    pk = utils._dashboard_pk(customer_id, month_key)
+    doc, marks = None, {"dirtyAt": 0, "globalDirtyAt": 0}
+    for item in utils._batch_get_items([{"PK": pk, "SK": "DOC"}, {"PK": pk, "SK": "DIRTY"}, utils.DASHBOARD_GLOBAL_KEY]):
+        if item.get("PK") == pk and item.get("SK") == "DOC":
+            doc = item
+        elif item.get("PK") == pk:
+            marks["dirtyAt"] = int(item.get("dirtyAt") or 0)
+        else:
+            marks["globalDirtyAt"] = int(item.get("dirtyAt") or 0)
+    return doc, marks
+
+
+def _dashboard_doc_state(doc, marks: dict) -> str:
+    """fresh: vigente | stale: invalidado hace poco (se sirve y se refresca) | expired/missing: reconstruir."""
+    if not doc or not doc.get("body"):
+        return "missing"
+    now_ms = utils._epoch_ms()
+    if now_ms - int(doc.get("builtAtMs") or 0) > DASHBOARD_DOC_MAX_AGE_SECONDS * 1000:
+        return "expired"
+    dirty_marks = [
+        mark for mark, seen in (
+            (marks["dirtyAt"], int(doc.get("sourceDirtyAt") or 0)),
+            (marks["globalDirtyAt"], int(doc.get("sourceGlobalDirtyAt") or 0)),
+        ) if mark > seen
+    ]
+    if not dirty_marks:
+        return "fresh"
+    return "stale" if now_ms - max(dirty_marks) <= DASHBOARD_DOC_STALE_SECONDS * 1000 else "expired"
+
+
+def _request_dashboard_refresh(customer_id, month_key: str) -> bool:
+    """
+    Pide la reconstrucción en segundo plano (como mucho una por ventana de staleness).
+    False si no hay a quién invocar: entonces quien llama reconstruye en línea.
+    """
+    function_name = utils.os.getenv("DASHBOARD_REFRESH_FUNCTION") or utils.os.getenv("AWS_LAMBDA_FUNCTION_NAME")
+    if not function_name:
+        return False
+    now_ms = utils._epoch_ms()
+    try:
+        utils._table.update_item(
+            Key={"PK": utils._dashboard_pk(customer_id, month_key), "SK": "DOC"},
+            UpdateExpression="SET refreshRequestedAt = :now",
+            ConditionExpression="attribute_exists(PK) AND (attribute_not_exists(refreshRequestedAt) OR refreshRequestedAt < :cutoff)",
+            ExpressionAttributeValues={":now": now_ms, ":cutoff": now_ms - DASHBOARD_DOC_STALE_SECONDS * 1000},
+        )
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return True  # ya hay un refresco en curso
+        raise
+    return utils._invoke_async(
+        function_name,
+        {"action": "REFRESH_DASHBOARD", "customerId": customer_id, "monthKey": month_key},
+        tag="DASHBOARD_REFRESH_ERROR",
+    )
+
+
+def _store_dashboard_doc(customer_id, month_key: str, body: str, marks: dict) -> bool:
+    """Guarda la respuesta armada; las marcas son las leídas ANTES de armarla."""
+    size = len(body.encode("utf-8"))
+    if size > DASHBOARD_DOC_MAX_BYTES:
+        print(f"[DASHBOARD_DOC_SKIPPED] customer={customer_id} bytes={size}")
+        return False
+    try:
+        utils._table.put_item(Item={
+            "PK": utils._dashboard_pk(customer_id, month_key),
+            "SK": "DOC",
+            "entityType": "customerDashboard",
+            "customerId": utils._customer_entity_id(customer_id),
+            "monthKey": month_key,
+            "body": body,
+            "builtAtMs": utils._epoch_ms(),
+            "sourceDirtyAt": marks["dirtyAt"],
+            "sourceGlobalDirtyAt": marks["globalDirtyAt"],
+            "ttl": utils._ttl_epoch(utils.DASHBOARD_DIRTY_TTL_SECONDS),
+        })
+        return True
+    except Exception as e:
+        print(f"[DASHBOARD_DOC_ERROR] customer={customer_id} err={e}")
+        return False
+
+
+def _rebuild_customer_dashboard(customer_id, month_key: str, marks: dict, timer: "_DashboardTimer") -> dict:
+    customer = utils._get_by_id("CUSTOMER", customer_id)
+    if not customer or not isinstance(customer, dict):
+        timer.mark("customer_missing")
+        return utils._json_response(404, {"message": "Cliente no encontrado"})
+    timer.mark("load_customer")
+
+    payload = _build_customer_dashboard(customer, month_key, timer)
+    response = utils._json_response(200, payload)
+    stored = _store_dashboard_doc(customer_id, month_key, response["body"], marks)
+    timer.mark("store_dashboard_doc", stored=stored, bytes=len(response["body"]))
+    return response
+
+
 def handle_customer_dashboard(headers):
-    """GET /customers/dashboard - Dashboard autenticado derivado del dashboard legacy."""
+    """
+    GET /customers/dashboard - Dashboard autenticado derivado del dashboard legacy.
+    Se sirve del documento DASHBOARD#<customerId>#<monthKey> mientras esté vigente; las escrituras
+    que lo afectan (comisiones, volumen, bonos, recibos, notificaciones) lo marcan como sucio.
+    """
     timer = _DashboardTimer("unknown")
     actor = utils._extract_actor_from_bearer(headers or {})
     actor_user_id = actor.get("user_id")
@@ -1313,123 +1474,128 @@ def handle_customer_dashboard(headers):
 
     customer_id = utils._customer_entity_id(actor_user_id)
     timer = _DashboardTimer(customer_id)
-    customer = utils._get_by_id("CUSTOMER", customer_id)
-    if not customer or not isinstance(customer, dict):
-        timer.mark("customer_missing")
-        return utils._json_response(404, {"message": "Cliente no encontrado"})
-    timer.mark("load_customer")
-
-    products_raw = utils._query_bucket("PRODUCT")
-    #campaigns_raw = utils._query_bucket("CAMPAIGN")
-    #featured = []
-    #for item in products_raw:
-    #    if not _is_product_active(item):
-    #        continue
-    #    if not bool(item.get("inOnlineStore", True)):
-    #        continue
-    #    summary = _get_product_summary(item)
-    #    if len(featured) < 4:
-    #        images = item.get("images") or []
-    #        featured.append({
-    #            "id": summary["id"],
-    #            "label": summary["name"],
-    #            "hook": summary.get("hook") or "",
-    #            "story": _pick_product_image(images, ["redes"]) or summary["img"],
-    #            "feed": _pick_product_image(images, ["miniatura", "redes"]) or summary["img"],
-    #            "banner": _pick_product_image(images, ["landing"]) or summary["img"],
-    #        })
-    #timer.mark("load_catalog", products=len(products_raw), campaigns=len(campaigns_raw), featured=len(featured))
-
-    #campaigns = [
-    #    _campaign_payload(item)
-    #    for item in campaigns_raw
-    #    if bool(item.get("active", True))
-    #]
-    #timer.mark("prepare_campaigns", activeCampaigns=len(campaigns))
-
-    app_cfg = utils._load_app_config()
-    cfg = app_cfg.get("rewards") or {}
-    bonus_cfg = app_cfg.get("bonuses") or {}
-    vp_cfg = bonus_cfg.get("vpConfig") or {}
-    mxn_per_vp = float(vp_cfg.get("mxnPerVp", 50))
-    rank_thresh = bonus_cfg.get("rankThresholds") or []
     month_key = utils._month_key()
-    prev_month_key = _prev_month_key()
-    timer.mark("load_config", monthKey=month_key, prevMonthKey=prev_month_key)
+    doc, marks = _load_dashboard_doc(customer_id, month_key)
+    state = _dashboard_doc_state(doc, marks)
+    timer.mark("load_dashboard_doc", state=state)
 
-    customers_raw, network_scope_meta = _load_customer_network_scope(customer)
-    timer.mark("load_network_scope", **network_scope_meta)
-    month_states = _load_month_states([item.get("customerId") for item in customers_raw], month_key)
-    timer.mark("load_month_states", states=len(month_states))
+    if state == "fresh" or (state == "stale" and _request_dashboard_refresh(customer_id, month_key)):
+        timer.mark("complete", status="ok", source=f"doc_{state}")
+        return {"statusCode": 200, "headers": utils._cors_headers(), "body": doc["body"]}
 
-    tree = _build_network_tree_with_month(
-        str(customer.get("customerId")), month_key, customers_raw, cfg, max_depth=5, month_states=month_states
-    )
-    timer.mark("build_network_tree", scopeCustomers=len(customers_raw))
-
-    computed_network = _network_members_from_tree(tree, max_rows=30)
-    computed_goals = _build_goals(customer, tree, customers_raw, cfg, bonus_cfg=bonus_cfg, month_states=month_states)
-    buy_again_ids = _compute_buy_again_ids(customer, products_raw)
-    active_notifications = _active_notifications_for_customer(customer.get("customerId"))
-    timer.mark(
-        "compute_dashboard_data",
-        networkMembers=len(computed_network),
-        goals=len(computed_goals),
-        buyAgain=len(buy_again_ids),
-        notifications=len(active_notifications),
-    )
+    response = _rebuild_customer_dashboard(customer_id, month_key, marks, timer)
+    timer.mark("complete", status="ok" if response["statusCode"] == 200 else "error", source="rebuild")
+    return response
+
+
+def handle_refresh_dashboard(event: dict) -> dict:
+    """Acción REFRESH_DASHBOARD (invocación asíncrona desde handle_customer_dashboard)."""
+    customer_id = utils._customer_entity_id(event.get("customerId"))
+    month_key = event.get("monthKey") or utils._month_key()
+    if customer_id in (None, "") or month_key != utils._month_key():
+        return {"status": "SKIPPED"}
+    timer = _DashboardTimer(customer_id)
+    _, marks = _load_dashboard_doc(customer_id, month_key)
+    response = _rebuild_customer_dashboard(customer_id, month_key, marks, timer)
+    timer.mark("complete", status="ok" if response["statusCode"] == 200 else "error", source="refresh")
+    return {"status": "REFRESHED" if response["statusCode"] == 200 else "FAILED"}
 
+
+def _build_customer_dashboard(customer: dict, month_key: str, timer: "_DashboardTimer") -> dict:
+    """Arma el cuerpo del dashboard con las lecturas en paralelo de _DashboardLoader."""
+    prev_month_key = _prev_month_key()
     cid = str(customer.get("customerId", ""))
-    st = _get_month_state(cid, month_key, month_states)
-    my_net = float(utils._to_decimal(st.get("netVolume", 0)))
-    vp_val = _mxn_to_vp_dash(my_net, mxn_per_vp)
-    vg_val = _calc_vg_from_tree(tree, mxn_per_vp)
-    rank_val = _get_rank_dash(vg_val, rank_thresh)
-    timer.mark("compute_rank_metrics", vp=round(vp_val, 2), vg=round(vg_val, 2), rank=rank_val)
-
-    all_awards = utils._query_bucket("BONUS_AWARD")
-    bonus_awards = [
-        award for award in all_awards
-        if str(award.get("customerId", "")) == cid and award.get("monthKey") == month_key
-    ]
-    timer.mark("load_bonus_awards", awards=len(bonus_awards), scannedAwards=len(all_awards))
+    customer_numeric_id = utils._customer_entity_id(customer.get("customerId"))
 
-    #_notify_goal_achievements(customer, computed_goals, bonus_cfg)
+    def _load_config():
+        return utils._load_app_config()
 
-    try:
-        utils._update_by_id(
-            "CUSTOMER", customer.get("customerId"),
-            "SET goals = :g, networkMembers = :n, buyAgainIds = :b, updatedAt = :u",
-            {":g": computed_goals, ":n": computed_network, ":b": buy_again_ids, ":u": utils._now_iso()},
+    def _load_month_states_for(scope):
+        customers_raw, _ = scope
+        return _load_month_states([item.get("customerId") for item in customers_raw], month_key)
+
+    def _load_bonus_awards():
+        all_awards = utils._query_bucket("BONUS_AWARD")
+        awards = [
+            award for award in all_awards
+            if str(award.get("customerId", "")) == cid and award.get("monthKey") == month_key
+        ]
+        return awards, len(all_awards)
+
+    def _load_commission_month(mk):
+        sk = f"#BENEFICIARY#{customer_numeric_id}#MONTH#{mk}"
+        return utils._table.get_item(Key={"PK": "COMMISSION_MONTH", "SK": sk}).get("Item") or {}
+
+    def _load_receipt():
+        receipts_raw = utils._get_customer_receipts(customer_numeric_id, prev_month_key)
+        return utils._latest_receipt_url(receipts_raw), len(receipts_raw)
+
+    with _DashboardLoader(timer) as loader:
+        # Lecturas independientes entre sí; solo los estados del mes esperan al alcance de la red
+        loader.submit("load_catalog", lambda: utils._query_bucket("PRODUCT"), meta=lambda r: {"products": len(r)})
+        loader.submit("load_config", _load_config, meta=lambda r: {"monthKey": month_key, "prevMonthKey": prev_month_key})
+        loader.submit("load_network_scope", lambda: _load_customer_network_scope(customer), meta=lambda r: r[1])
+        loader.submit("load_month_states", _load_month_states_for, "load_network_scope", meta=lambda r: {"states": len(r)})
+        loader.submit("load_notifications", lambda: _active_notifications_for_customer(customer.get("customerId")),
+                      meta=lambda r: {"notifications": len(r)})
+        loader.submit("load_bonus_awards", _load_bonus_awards, meta=lambda r: {"awards": len(r[0]), "scannedAwards": r[1]})
+        loader.submit("load_current_commissions", lambda: _load_commission_month(month_key))
+        loader.submit("load_previous_commissions", lambda: _load_commission_month(prev_month_key))
+        loader.submit("load_receipts", _load_receipt, meta=lambda r: {"scannedReceipts": r[1], "hasReceipt": bool(r[0])})
+        loader.submit("load_sponsor", lambda: _find_effective_sponsor(customer))
+
+        app_cfg = loader.result("load_config")
+        cfg = app_cfg.get("rewards") or {}
+        bonus_cfg = app_cfg.get("bonuses") or {}
+        vp_cfg = bonus_cfg.get("vpConfig") or {}
+        mxn_per_vp = float(vp_cfg.get("mxnPerVp", 50))
+        rank_thresh = bonus_cfg.get("rankThresholds") or []
+
+        customers_raw, _ = loader.result("load_network_scope")
+        month_states = loader.result("load_month_states")
+        timer.mark("await_network", scopeCustomers=len(customers_raw))
+
+        tree = _build_network_tree_with_month(
+            str(customer.get("customerId")), month_key, customers_raw, cfg, max_depth=5, month_states=month_states
+        )
+        timer.mark("build_network_tree", scopeCustomers=len(customers_raw))
+
+        computed_network = _network_members_from_tree(tree, max_rows=30)
+        computed_goals = _build_goals(customer, tree, customers_raw, cfg, bonus_cfg=bonus_cfg, month_states=month_states)
+        buy_again_ids = _compute_buy_again_ids(customer, loader.result("load_catalog"))
+        active_notifications = loader.result("load_notifications")
+        timer.mark(
+            "compute_dashboard_data",
+            networkMembers=len(computed_network),
+            goals=len(computed_goals),
+            buyAgain=len(buy_again_ids),
+            notifications=len(active_notifications),
         )
-        timer.mark("persist_dashboard_cache")
-    except Exception:
-        timer.mark("persist_dashboard_cache_failed")
 
-    customer_numeric_id = utils._customer_entity_id(customer.get("customerId"))
-    sk_curr = f"#BENEFICIARY#{customer_numeric_id}#MONTH#{month_key}"
-    comm_item = utils._table.get_item(Key={"PK": "COMMISSION_MONTH", "SK": sk_curr}).get("Item") or {}
-    pend = utils._to_decimal(comm_item.get("totalPending"))
-    conf = utils._to_decimal(comm_item.get("totalConfirmed"))
-    blocked = utils._to_decimal(comm_item.get("totalBlocked"))
-    timer.mark("load_current_commissions")
-
-    sk_prev = f"#BENEFICIARY#{customer_numeric_id}#MONTH#{prev_month_key}"
-    prev_comm = utils._table.get_item(Key={"PK": "COMMISSION_MONTH", "SK": sk_prev}).get("Item") or {}
-    prev_confirmed = utils._to_decimal(prev_comm.get("totalConfirmed"))
-    timer.mark("load_previous_commissions")
-
-    receipt_url = ""
-    receipts_raw = utils._query_bucket("COMMISSION_RECEIPT")
-    for receipt in receipts_raw:
-        if utils._customer_entity_id(receipt.get("customerId")) != customer_numeric_id:
-            continue
-        if str(receipt.get("monthKey")) != str(prev_month_key):
-            continue
-        if receipt.get("assetUrl"):
-            receipt_url = receipt.get("assetUrl")
-            break
-    timer.mark("load_receipts", scannedReceipts=len(receipts_raw), hasReceipt=bool(receipt_url))
+        st = _get_month_state(cid, month_key, month_states)
+        my_net = float(utils._to_decimal(st.get("netVolume", 0)))
+        vp_val = _mxn_to_vp_dash(my_net, mxn_per_vp)
+        vg_val = _calc_vg_from_tree(tree, mxn_per_vp)
+        rank_val = _get_rank_dash(vg_val, rank_thresh)
+        timer.mark("compute_rank_metrics", vp=round(vp_val, 2), vg=round(vg_val, 2), rank=rank_val)
+
+        #_notify_goal_achievements(customer, computed_goals, bonus_cfg)
+
+        def _persist_dashboard_cache():
+            return utils._persist_customer_dashboard_fields(customer, computed_goals, computed_network, buy_again_ids)
+
+        # La escritura corre mientras se arma la respuesta; el loader la espera al cerrar
+        loader.submit("persist_dashboard_cache", _persist_dashboard_cache, meta=lambda result: {"result": result})
+
+        bonus_awards, _ = loader.result("load_bonus_awards")
+        comm_item = loader.result("load_current_commissions")
+        pend = utils._to_decimal(comm_item.get("totalPending"))
+        conf = utils._to_decimal(comm_item.get("totalConfirmed"))
+        blocked = utils._to_decimal(comm_item.get("totalBlocked"))
+        prev_comm = loader.result("load_previous_commissions")
+        prev_confirmed = utils._to_decimal(prev_comm.get("totalConfirmed"))
+        receipt_url, _ = loader.result("load_receipts")
+        sponsor = loader.result("load_sponsor")
 
     clabe = (customer.get("clabeInterbancaria") or customer.get("clabe") or "").strip()
     if prev_confirmed <= 0:
@@ -1463,7 +1629,7 @@ def handle_customer_dashboard(headers):
     }
     timer.mark("assemble_response")
 
-    response = utils._json_response(200, {
+    return {
         "isGuest": False,
         "settings": {
             "cutoffDay": 25,
@@ -1474,7 +1640,7 @@ def handle_customer_dashboard(headers):
         },
         "customer": _normalize_dashboard_customer(customer),
         "user": user_payload,
-        "sponsor": _find_effective_sponsor(customer),
+        "sponsor": sponsor,
         "goals": computed_goals,
         "featured": [],
         "campaigns": [],
@@ -1486,14 +1652,15 @@ def handle_customer_dashboard(headers):
         "vg": round(vg_val, 2),
         "rank": rank_val,
         "bonuses": bonus_awards,
-    })
-    timer.mark("complete", status="ok")
-    return response
+    }
 
 
 # --- LAMBDA HANDLER ---
 
 def lambda_handler(event, context):
+    if event.get("action") == "REFRESH_DASHBOARD":
+        return handle_refresh_dashboard(event)
+
     path = event.get("path", "")
     method = event.get("httpMethod", "")
     if method == "OPTIONS":
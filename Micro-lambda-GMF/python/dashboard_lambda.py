@@ -8,6 +8,8 @@ import core_utils as utils # Importado desde la Layer
 FRONTEND_URL = utils.os.getenv("FRONTEND_BASE_URL", "https://www.findingu.com.mx")
 BUCKET_NAME = utils.os.getenv("BUCKET_NAME", "findingu-ventas")
 _s3 = boto3.client('s3', region_name=utils.AWS_REGION)
+# Meses (incluido el actual) que revisa la alerta de comisiones por depositar
+ADMIN_WARNING_COMMISSION_MONTHS = int(utils.os.getenv("ADMIN_WARNING_COMMISSION_MONTHS", "3"))
 
 _GOAL_EMAIL_BASE_CSS = """
 body { margin:0; padding:0; background-color:#F9F7F2; font-family:'Segoe UI',Arial,sans-serif; }
@@ -91,14 +93,26 @@ def _build_goal_achieved_email(
     text = f"¡Felicidades {name}! Lograste la meta '{goal_title}'. Ingresa a ver tus beneficios: {url}"
     return f"¡Meta lograda: {goal_title}! — Finding'U", text, html
 
-# Clientes de AWS (Athena para análitica avanzada, opcional)
-try:
-    athena = boto3.client('athena')
-    ATHENA_DB = utils.os.getenv("ATHENA_DATABASE", "findingu_analytics")
-    ATHENA_OUTPUT = f"s3://{utils.BUCKET_NAME}/athena-results/"
-    _ATHENA_ENABLED = True
-except Exception:
-    _ATHENA_ENABLED = False
+# Almacén analítico en Parquet (analytics_engine: pyarrow + duckdb de la Layer de analítica).
+# ANALYTICS_S3_ENDPOINT permite un servicio compatible con S3 (MinIO, LocalStack).
+ANALYTICS_ROOT = utils.os.getenv("ANALYTICS_ROOT") or f"s3://{BUCKET_NAME}/analytics"
+ANALYTICS_S3_ENDPOINT = utils.os.getenv("ANALYTICS_S3_ENDPOINT") or None
+MAX_COMMISSION_LEVELS = 3
+_analytics = {}  # store por contenedor: conserva la caché de consultas entre invocaciones
+
+# Bitácora de snapshots (ANALYTICS_LOG) que se vuelca a Parquet en micro-lotes
+ANALYTICS_LOG_PK = "ANALYTICS_LOG"
+ANALYTICS_LOG_ORDERS_PER_ITEM = 25  # mantiene cada item muy por debajo de 400 KB
+ANALYTICS_FLUSH_ROWS = int(utils.os.getenv("ANALYTICS_FLUSH_ROWS", "500"))
+ANALYTICS_FLUSH_SECONDS = int(utils.os.getenv("ANALYTICS_FLUSH_SECONDS", "300"))
+ANALYTICS_COMPACT_MIN_FILES = int(utils.os.getenv("ANALYTICS_COMPACT_MIN_FILES", "4"))
+ANALYTICS_LEASE_SECONDS = 300
+ANALYTICS_FLUSH_KICK_SECONDS = 60  # un aviso de flush por minuto como máximo
+_ANALYTICS_LEASE_KEY = {"PK": "ANALYTICS_LOG#LEASE", "SK": "LEASE"}
+# Contador corrido de la bitácora (filas pendientes y epoch de la entrada más vieja): el sync no la recorre
+_ANALYTICS_COUNTER_KEY = {"PK": "ANALYTICS_LOG#COUNTER", "SK": "COUNTER"}
+# async: invoca el flush (ANALYTICS_FLUSH_FUNCTION o esta misma lambda); local: en proceso; off: solo el job programado
+ANALYTICS_FLUSH_DISPATCH = utils.os.getenv("ANALYTICS_FLUSH_DISPATCH", "async").strip().lower()
 
 # --- HELPERS DE FECHA ---
 
@@ -108,6 +122,16 @@ def _prev_month_key() -> str:
         return f"{d.year - 1:04d}-12"
     return f"{d.year:04d}-{d.month - 1:02d}"
 
+def _recent_month_keys(count: int) -> list:
+    """Mes actual y los `count - 1` anteriores, del más reciente al más antiguo."""
+    d = datetime.now(timezone.utc)
+    year, month = d.year, d.month
+    keys = []
+    for _ in range(max(1, count)):
+        keys.append(f"{year:04d}-{month:02d}")
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return keys
+
 # --- HELPERS DE PRODUCTOS Y CAMPAÑAS ---
 
 def _pick_product_image(images, preferred_sections):
@@ -561,63 +585,255 @@ def _resolve_user_context(query: dict, headers: dict):
 
     return None, True
 
-# --- TAREA DE ORQUESTACIÓN: SYNC S3 TABLES ---
+# --- TAREA DE ORQUESTACIÓN: SYNC ANALÍTICO (PARQUET) ---
+
+def _analytics_store():
+    """AnalyticsStore del contenedor, o None si la Layer de analítica no está disponible."""
+    if "store" not in _analytics:
+        try:
+            import analytics_engine
+        except ImportError as e:
+            print(f"[ANALYTICS_UNAVAILABLE] {e}")
+            _analytics["store"] = None
+        else:
+            _analytics["store"] = analytics_engine.AnalyticsStore(ANALYTICS_ROOT, endpoint_override=ANALYTICS_S3_ENDPOINT)
+    return _analytics["store"]
+
+def _commission_ledger_key(beneficiary_id, month_key) -> dict:
+    # Mismo SK que commissions_lambda._ledger_sk
+    return {"PK": "COMMISSION_MONTH", "SK": f"#BENEFICIARY#{beneficiary_id}#MONTH#{month_key}"}
 
-def handle_sync_iceberg(order_id):
+def handle_sync_iceberg(order_ids):
     """
-    Invocado por Step Functions.
-    Crea un registro optimizado en S3 (Iceberg) para consultas SQL masivas.
+    Invocado por Step Functions (una orden) o por el consumidor de la outbox (lote).
+    Arma el snapshot de cada orden (orden, líneas y filas de comisión, con lecturas en lote)
+    y lo agrega a ANALYTICS_LOG. Al juntar ANALYTICS_FLUSH_ROWS filas o cuando la entrada más
+    vieja supera ANALYTICS_FLUSH_SECONDS dispara el flush a Parquet sin esperarlo.
     """
-    order = utils._get_by_id("ORDER", order_id)
-    if not order: return {"status": "NOT_FOUND"}
+    try:
+        import analytics_engine
+    except ImportError:
+        return {"status": "SKIPPED", "reason": "ANALYTICS_UNAVAILABLE"}
+
+    orders = utils._batch_get_entities("ORDER", [oid for oid in order_ids if oid not in (None, "")])
+    if not orders:
+        return {"status": "NOT_FOUND", "orderIds": list(order_ids)}
+
+    buyers = {str(o.get("customerId")) for o in orders if o.get("customerId") not in (None, "")}
+    customers = {str(c.get("customerId")): c for c in utils._batch_get_entities("CUSTOMER", list(buyers))}
+    ledger_keys = {}
+    for order in orders:
+        month_key = order.get("monthKey") or utils._month_key()
+        chain = utils._get_customer_upline_ids(customers.get(str(order.get("customerId"))) or order.get("customerId"), MAX_COMMISSION_LEVELS)
+        if (order.get("buyerType") or "").lower() == "guest" and order.get("referrerAssociateId"):
+            chain = [str(order["referrerAssociateId"])] + chain
+        for beneficiary_id in chain:
+            ledger_keys[(beneficiary_id, month_key)] = _commission_ledger_key(beneficiary_id, month_key)
+
+    synced_at = int(time.time() * 1000)
+    order_days = {str(o.get("orderId")): analytics_engine.order_day(o) for o in orders}
+    commissions_by_order = {}
+    for ledger in utils._batch_get_items(list(ledger_keys.values())):
+        for row in analytics_engine.commission_rows(ledger, order_days, synced_at):
+            commissions_by_order.setdefault(row["orderId"], []).append(row)
+
+    log_items = []
+    for start in range(0, len(orders), ANALYTICS_LOG_ORDERS_PER_ITEM):
+        chunk = orders[start:start + ANALYTICS_LOG_ORDERS_PER_ITEM]
+        rows = {
+            "orders": [analytics_engine.order_row(o, synced_at) for o in chunk],
+            "lines": [row for o in chunk for row in analytics_engine.line_rows(o, synced_at)],
+            "commissions": [row for o in chunk for row in commissions_by_order.get(str(o.get("orderId")), [])],
+        }
+        log_items.append({
+            "PK": ANALYTICS_LOG_PK, "SK": utils._new_id("ALOG-"), "entityType": "analyticsLog",
+            "rows": rows, "rowCount": sum(len(v) for v in rows.values()),
+            "createdAt": utils._now_iso(), "createdAtEpoch": int(time.time()),
+        })
+    utils._put_items_batch(log_items)
+
+    rows_added = sum(i["rowCount"] for i in log_items)
+    result = {"status": "BUFFERED", "orderIds": list(order_days), "rows": rows_added}
+    pending_rows, oldest = _analytics_log_add(rows_added)
+    if pending_rows >= ANALYTICS_FLUSH_ROWS or time.time() - oldest >= ANALYTICS_FLUSH_SECONDS:
+        result["flushRequested"] = _kick_analytics_flush()
+    return result
+
+def _analytics_log_add(rows: int):
+    """Suma filas al contador de la bitácora. Devuelve (filas pendientes, epoch de la entrada más vieja)."""
+    now_epoch = int(time.time())
+    counter = utils._table.update_item(
+        Key=_ANALYTICS_COUNTER_KEY,
+        UpdateExpression="ADD rowCount :n SET oldestEpoch = if_not_exists(oldestEpoch, :now)",
+        ExpressionAttributeValues={":n": rows, ":now": now_epoch},
+        ReturnValues="ALL_NEW",
+    ).get("Attributes") or {}
+    return int(counter.get("rowCount") or 0), int(counter.get("oldestEpoch") or now_epoch)
+
+def _kick_analytics_flush() -> bool:
+    """Avisa al flush (uno por ANALYTICS_FLUSH_KICK_SECONDS); si falla, lo recoge el job programado."""
+    now_epoch = int(time.time())
+    try:
+        utils._table.update_item(
+            Key=_ANALYTICS_COUNTER_KEY,
+            UpdateExpression="SET flushKickedAt = :now",
+            ConditionExpression="attribute_not_exists(flushKickedAt) OR flushKickedAt < :stale",
+            ExpressionAttributeValues={":now": now_epoch, ":stale": now_epoch - ANALYTICS_FLUSH_KICK_SECONDS},
+        )
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return False
+        raise
+    if ANALYTICS_FLUSH_DISPATCH == "local":
+        try:
+            handle_flush_analytics()
+        except Exception as e:
+            print(f"[ANALYTICS_FLUSH_ERROR] {e}")
+        return True
+    if ANALYTICS_FLUSH_DISPATCH != "async":
+        return False
+    return utils._invoke_async(
+        utils.os.getenv("ANALYTICS_FLUSH_FUNCTION") or utils.os.getenv("AWS_LAMBDA_FUNCTION_NAME"),
+        {"task": "flush_analytics"},
+        tag="ANALYTICS_FLUSH",
+    )
 
-    # Aquí se enviaría el dato a un Glue DataBrew o se escribiría directamente
-    # como Parquet en la ruta de S3 Tables. 
-    # Por ahora, simulamos el éxito de la integración analítica.
-    print(f"[ANALYTICS] Sincronizando orden {order_id} a S3 Tables...")
-    return {"status": "SYNCED", "orderId": order_id}
+def _analytics_log_consumed(rows: int, flush_started: int) -> None:
+    """Descuenta lo volcado del contador; lo que llegó durante el flush cuenta desde su inicio."""
+    if rows <= 0:
+        # Bitácora vacía: reinicia el contador por si quedó desfasado (p. ej. un flush que cayó tras borrar)
+        utils._table.update_item(
+            Key=_ANALYTICS_COUNTER_KEY,
+            UpdateExpression="SET rowCount = :zero REMOVE oldestEpoch, flushKickedAt",
+            ExpressionAttributeValues={":zero": 0},
+        )
+        return
+    counter = utils._table.update_item(
+        Key=_ANALYTICS_COUNTER_KEY,
+        UpdateExpression="ADD rowCount :neg SET oldestEpoch = :started REMOVE flushKickedAt",
+        ExpressionAttributeValues={":neg": -rows, ":started": flush_started},
+        ReturnValues="ALL_NEW",
+    ).get("Attributes") or {}
+    if int(counter.get("rowCount") or 0) > 0:
+        return
+    try:
+        utils._table.update_item(
+            Key=_ANALYTICS_COUNTER_KEY,
+            UpdateExpression="SET rowCount = :zero REMOVE oldestEpoch",
+            ConditionExpression="rowCount <= :zero",
+            ExpressionAttributeValues={":zero": 0},
+        )
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
 
-# --- HELPERS DE ATHENA (REPORTES) ---
+def _acquire_analytics_lease(owner: str) -> bool:
+    """Un solo flush / compactación a la vez (compact() reescribe las particiones)."""
+    now_epoch = int(time.time())
+    try:
+        utils._table.put_item(
+            Item={**_ANALYTICS_LEASE_KEY, "owner": owner, "leaseUntil": now_epoch + ANALYTICS_LEASE_SECONDS,
+                  "ttl": now_epoch + ANALYTICS_LEASE_SECONDS * 10},
+            ConditionExpression="attribute_not_exists(PK) OR leaseUntil < :now OR #o = :owner",
+            ExpressionAttributeNames={"#o": "owner"},
+            ExpressionAttributeValues={":now": now_epoch, ":owner": owner},
+        )
+        return True
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return False
+        raise
 
-def _query_athena(sql):
-    """Ejecuta SQL y retorna el primer registro (para KPIs)."""
+def _release_analytics_lease(owner: str) -> None:
     try:
-        execution = athena.start_query_execution(
-            QueryString=sql,
-            QueryExecutionContext={'Database': ATHENA_DB},
-            ResultConfiguration={'OutputLocation': ATHENA_OUTPUT}
+        utils._table.delete_item(
+            Key=_ANALYTICS_LEASE_KEY,
+            ConditionExpression="#o = :owner",
+            ExpressionAttributeNames={"#o": "owner"},
+            ExpressionAttributeValues={":owner": owner},
         )
-        query_id = execution['QueryExecutionId']
-        
-        # Espera simple (Máximo 5 segundos para mantener UX)
-        for _ in range(5):
-            state = athena.get_query_execution(QueryExecutionId=query_id)['QueryExecution']['Status']['State']
-            if state == 'SUCCEEDED': break
-            if state in ['FAILED', 'CANCELLED']: return None
-            time.sleep(1)
-        
-        results = athena.get_query_results(QueryExecutionId=query_id)
-        rows = results['ResultSet']['Rows']
-        if len(rows) < 2: return {}
-        
-        headers = [c['VarCharValue'] for c in rows[0]['Data']]
-        values = [c.get('VarCharValue', '0') for c in rows[1]['Data']]
-        return dict(zip(headers, values))
-    except Exception as e:
-        print(f"[ATHENA_ERROR] {e}")
-        return None
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+
+def handle_flush_analytics() -> dict:
+    """
+    Vuelca ANALYTICS_LOG a Parquet (un archivo por dataset y día) y borra lo volcado.
+    También lo invoca EventBridge con {"task": "flush_analytics"} para no dejar filas viejas.
+    Si falla a la mitad, las entradas siguen en la bitácora y se reescriben (las vistas deduplican).
+    """
+    store = _analytics_store()
+    if store is None:
+        return {"status": "SKIPPED", "reason": "ANALYTICS_UNAVAILABLE"}
+    import analytics_engine
+    owner = utils.uuid.uuid4().hex
+    if not _acquire_analytics_lease(owner):
+        return {"status": "BUSY"}
+    flush_started = int(time.time())
+    try:
+        entries = utils._query_pk(ANALYTICS_LOG_PK)
+        rows = {dataset: [] for dataset in analytics_engine.WRITE_ORDER}
+        for entry in entries:
+            for dataset in analytics_engine.WRITE_ORDER:
+                rows[dataset].extend((entry.get("rows") or {}).get(dataset) or [])
+        files = 0
+        for dataset in analytics_engine.WRITE_ORDER:
+            if rows[dataset]:
+                files += len(store.append(dataset, analytics_engine.coerce_rows(dataset, rows[dataset])))
+        with utils._table.batch_writer() as writer:
+            for entry in entries:
+                writer.delete_item(Key={"PK": entry["PK"], "SK": entry["SK"]})
+        _analytics_log_consumed(sum(int(entry.get("rowCount") or 0) for entry in entries), flush_started)
+    finally:
+        _release_analytics_lease(owner)
+    summary = {"status": "FLUSHED", "entries": len(entries), "files": files, **{k: len(v) for k, v in rows.items()}}
+    print(f"[ANALYTICS_FLUSH] {utils.json.dumps(summary)}")
+    return summary
+
+def handle_compact_analytics(months=None) -> dict:
+    """
+    EventBridge {"task": "compact_analytics", "months": [...]}: fusiona los archivos chicos de
+    cada día en uno por dataset. Sin `months` compacta el mes actual y el anterior.
+    """
+    store = _analytics_store()
+    if store is None:
+        return {"status": "SKIPPED", "reason": "ANALYTICS_UNAVAILABLE"}
+    owner = utils.uuid.uuid4().hex
+    if not _acquire_analytics_lease(owner):
+        return {"status": "BUSY"}
+    try:
+        summary = store.compact(months or [_prev_month_key(), utils._month_key()], min_files=ANALYTICS_COMPACT_MIN_FILES)
+    finally:
+        _release_analytics_lease(owner)
+    print(f"[ANALYTICS_COMPACT] {utils.json.dumps(summary)}")
+    return {"status": "COMPACTED", **summary}
 
 # --- HANDLERS ADMIN (GRANULARES) ---
 
-def get_admin_stats():
-    """GET /admin/stats - Usa S3 Tables (Athena)"""
-    month = utils._month_key()
-    sql = f"""
-        SELECT sum(netTotal) as total_sales, count(*) as order_count 
-        FROM orders_iceberg WHERE monthKey = '{month}'
+def get_admin_stats(query=None):
+    """GET /admin/stats?month=YYYY-MM - KPIs del mes desde el almacén Parquet (DuckDB, con caché)"""
+    store = _analytics_store()
+    if store is None:
+        return utils._json_response(501, {"message": "Analítica no disponible (requiere la Layer con pyarrow y duckdb)"})
+    month = ((query or {}).get("month") or "").strip() or utils._month_key()
+    return utils._json_response(200, {"month": month, "stats": store.admin_stats(month)})
+
+def get_admin_sales_rollups(query):
     """
-    stats = _query_athena(sql)
-    return utils._json_response(200, {"stats": stats or {"total_sales": 0, "order_count": 0}})
+    GET /admin/sales-rollups?from=YYYY-MM-DD&to=YYYY-MM-DD&groupBy=total|month|day
+    Ventas por producto, almacén y canal sumando los rollups diarios (sin leer órdenes).
+    Por defecto: del día 1 del mes actual a hoy, agrupado en un total.
+    """
+    end_day = (query.get("to") or "").strip() or utils._now_iso()[:10]
+    start_day = (query.get("from") or "").strip() or f"{end_day[:7]}-01"
+    group_by = (query.get("groupBy") or "total").strip().lower()
+    if group_by not in ("total", "month", "day"):
+        return utils._json_response(400, {"message": "groupBy debe ser total, month o day"})
+    try:
+        rollups = utils._get_sales_rollups(start_day, end_day, group_by)
+    except ValueError as e:
+        return utils._json_response(400, {"message": f"Rango inválido: {e}"})
+    return utils._json_response(200, rollups)
 
 def get_admin_orders(query):
     """GET /admin/orders?status=X&limit=N - Órdenes filtradas por status"""
@@ -631,37 +847,23 @@ def get_admin_orders(query):
     return utils._json_response(200, {"orders": items, "total": total, "limit": limit})
 
 def get_admin_warnings():
-    """GET /admin/warnings - Alertas reales desde DynamoDB"""
+    """GET /admin/warnings - Alertas desde los contadores KPI (un BatchGet)"""
     cfg = utils._load_app_config()
     warning_cfg = cfg.get("adminWarnings") if isinstance(cfg.get("adminWarnings"), dict) else {}
 
-    orders = utils._query_bucket("ORDER")
     now_date = utils._now_iso()[:10]
-
-    paid_no_ship = sum(1 for o in orders if (o.get("status") or "").lower() == "paid")
-    pending_pay = sum(1 for o in orders if (o.get("status") or "").lower() == "pending")
-
-    # Comisiones pendientes de depositar (status CONFIRMED, sin recibo)
-    from boto3.dynamodb.conditions import Key as _Key
-    try:
-        comm_resp = utils._table.query(KeyConditionExpression=_Key("PK").eq("COMMISSION_MONTH"))
-        comm_items = comm_resp.get("Items", [])
-    except Exception:
-        comm_items = []
-    commissions_count = sum(
-        1 for item in comm_items
-        if utils._to_decimal(item.get("totalConfirmed")) > 0 and (item.get("status") or "") != "PAID"
-    )
-
-    # Transferencias pendientes
-    transfers = utils._query_bucket("STOCK_TRANSFER")
-    pending_transfers = sum(1 for t in transfers if (t.get("status") or "").lower() == "pending")
-
-    # Ventas POS de hoy
-    pos_sales_today = sum(
-        1 for s in utils._query_bucket("POS_SALE")
-        if str(s.get("createdAt") or "")[:10] == now_date
+    month_keys = _recent_month_keys(ADMIN_WARNING_COMMISSION_MONTHS)
+    kpis = utils._get_kpis(
+        [("ORDERS", utils.KPI_ALL), ("TRANSFERS", utils.KPI_ALL), ("POS", now_date)]
+        + [("COMMISSIONS", mk) for mk in month_keys]
     )
+    orders = kpis[("ORDERS", utils.KPI_ALL)]
+    paid_no_ship = utils._kpi_int(orders, "status_paid")
+    pending_pay = utils._kpi_int(orders, "status_pending")
+    # Comisiones pendientes de depositar (confirmado > 0, sin PAID) de los últimos meses
+    commissions_count = sum(utils._kpi_int(kpis[("COMMISSIONS", mk)], "pendingDeposit") for mk in month_keys)
+    pending_transfers = utils._kpi_int(kpis[("TRANSFERS", utils.KPI_ALL)], "status_pending")
+    pos_sales_today = utils._kpi_int(kpis[("POS", now_date)], "salesCount")
 
     warnings = []
     if warning_cfg.get("showCommissions", True) and commissions_count:
@@ -930,15 +1132,8 @@ def get_user_dashboard(query: dict, headers: dict) -> dict:
         # Detectar metas recién logradas (transición False → True) y enviar correo
         _notify_goal_achievements(customer, computed_goals, bonus_cfg)
 
-        # Persistir estado del dashboard en el cliente
-        try:
-            utils._update_by_id(
-                "CUSTOMER", customer.get("customerId"),
-                "SET goals = :g, networkMembers = :n, buyAgainIds = :b, updatedAt = :u",
-                {":g": computed_goals, ":n": computed_network, ":b": buy_again_ids, ":u": utils._now_iso()},
-            )
-        except Exception:
-            pass
+        # Persistir estado del dashboard en el cliente (solo si cambió)
+        utils._persist_customer_dashboard_fields(customer, computed_goals, computed_network, buy_again_ids)
 
         cid = int(customer.get("customerId"))
         # Comisiones mes actual
@@ -954,15 +1149,7 @@ def get_user_dashboard(query: dict, headers: dict) -> dict:
         prev_confirmed = utils._to_decimal(prev_comm.get("totalConfirmed"))
 
         # Comprobante mes anterior
-        receipt_url = ""
-        for r in utils._query_bucket("COMMISSION_RECEIPT"):
-            if int(r.get("customerId") or 0) != cid:
-                continue
-            if str(r.get("monthKey")) != str(prev_month_key):
-                continue
-            if r.get("assetUrl"):
-                receipt_url = r.get("assetUrl")
-                break
+        receipt_url = utils._latest_receipt_url(utils._get_customer_receipts(cid, prev_month_key))
 
         clabe = (customer.get("clabeInterbancaria") or customer.get("clabe") or "").strip()
         if prev_confirmed <= 0:
@@ -1147,6 +1334,10 @@ def _handle_campaign_asset(method, body, headers):
     return utils._json_response(201, {"asset": asset_item})
 
 
+def handle_reconcile_kpis() -> dict:
+    """Recalcula los contadores KPI desde las fuentes (EventBridge {"action": "RECONCILE_KPIS"})."""
+    return utils._reconcile_kpis(_recent_month_keys(ADMIN_WARNING_COMMISSION_MONTHS))
+
 def _handle_campaigns(method, body):
     """GET /campaigns  |  POST /campaigns — también resuelve /dashboard/campaigns"""
     if method == "GET":
@@ -1193,6 +1384,7 @@ def _handle_notifications(method, body, segments):
             utils._table.put_item(Item={
                 "PK": pk, "SK": ntf_id, "readAt": utils._now_iso(), "entityType": "notificationRead"
             })
+            utils._invalidate_customer_dashboards([user_id], "notification_read")
             return utils._json_response(200, {"ok": True})
         nid = body.get("id") or f"NTF-{utils.uuid.uuid4().hex[:8].upper()}"
         ntf = {
@@ -1202,6 +1394,7 @@ def _handle_notifications(method, body, segments):
             "endAt": body.get("endAt"), "active": True, "createdAt": utils._now_iso()
         }
         saved = utils._put_entity("NOTIFICATION", nid, ntf)
+        utils._invalidate_all_dashboards("notification")
         return utils._json_response(201, {"notification": saved})
     return utils._json_response(405, {"message": "Método no permitido"})
 
@@ -1209,9 +1402,15 @@ def _handle_notifications(method, body, segments):
 # --- LAMBDA HANDLER PRINCIPAL ---
 
 def lambda_handler(event, context):
-    # 1. Detectar invocación de Step Functions (Sync Analítico)
+    # 1. Sync analítico: Step Functions (orderId) o lote del consumidor de la outbox (orderIds)
     if event.get("task") == "sync_iceberg":
-        return handle_sync_iceberg(event.get("orderId"))
+        return handle_sync_iceberg(event.get("orderIds") or [event.get("orderId")])
+    if event.get("task") == "flush_analytics":
+        return handle_flush_analytics()
+    if event.get("task") == "compact_analytics":
+        return handle_compact_analytics(event.get("months"))
+    if event.get("action") == "RECONCILE_KPIS":
+        return handle_reconcile_kpis()
 
     # 2. Peticiones de API Gateway
     path = event.get("path", "")
@@ -1233,9 +1432,12 @@ def lambda_handler(event, context):
             err = utils._require_admin(headers, "access_screen_stats")
             if err: return err
             sub = segments[1] if len(segments) > 1 else ""
-            if sub == "stats": return get_admin_stats()
+            if sub == "stats": return get_admin_stats(query)
             if sub == "orders": return get_admin_orders(query)
             if sub == "warnings": return get_admin_warnings()
+            if sub == "sales-rollups" and method == "GET": return get_admin_sales_rollups(query)
+            if sub == "kpis" and len(segments) > 2 and segments[2] == "reconcile" and method == "POST":
+                return utils._json_response(200, handle_reconcile_kpis())
 
         # ── /user/* ─────────────────────────────────────────────────────────────
         if root == "user":
@@ -0,0 +1,365 @@
+"""
+Cliente HTTP compartido para las integraciones externas (Envia, Mercado Pago / Mercado Libre).
+
+  - Pool de conexiones keep-alive por host (http.client), vive a nivel de módulo: se reutiliza
+    entre invocaciones del mismo contenedor caliente y es seguro entre hilos (fan-out de Envia).
+  - Timeout por host (HOST_SETTINGS / configure_host) y deadline absoluto opcional por llamada.
+  - Reintentos con backoff exponencial + jitter solo para llamadas idempotentes
+    (GET/HEAD/PUT/DELETE/OPTIONS o `idempotent=True`) ante errores de red, timeouts y 429/502/503/504.
+  - Circuit breaker por host: tras N fallas seguidas (red o 5xx) se corta durante `resetSeconds`
+    y luego se deja pasar una sola llamada de prueba.
+  - Histograma de latencia por host (buckets en ms); `stats()` lo expone y se imprime en logs
+    cada STATS_LOG_INTERVAL_SECONDS.
+Solo usa la librería estándar.
+"""
+import http.client
+import json
+import random
+import socket
+import ssl
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+RETRY_STATUSES = {429, 502, 503, 504}
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+MAX_IDLE_PER_HOST = 8
+STATS_LOG_INTERVAL_SECONDS = 60.0
+
+DEFAULT_HOST_SETTINGS = {
+    "timeout": 10.0,          # Segundos por intento (conexión + respuesta)
+    "retries": 2,             # Reintentos adicionales (solo idempotentes)
+    "backoffBase": 0.2,       # Segundos; se duplica por intento
+    "backoffMax": 2.0,
+    "failureThreshold": 5,    # Fallas seguidas para abrir el circuito
+    "resetSeconds": 30.0,     # Tiempo con el circuito abierto antes de probar de nuevo
+}
+HOST_SETTINGS: Dict[str, dict] = {
+    "api.mercadopago.com": {"timeout": 10.0},
+    "api.envia.com": {"timeout": 8.0, "retries": 1},
+    "api-test.envia.com": {"timeout": 8.0, "retries": 1},
+}
+
+# Errores de una conexión keep-alive que el servidor ya cerró: se reintenta una vez con conexión nueva
+_STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, http.client.CannotSendRequest)
+_NETWORK_ERRORS = (OSError, http.client.HTTPException)
+
+_SSL_CONTEXT = ssl.create_default_context()
+_lock = threading.Lock()
+
+
+class HttpError(Exception):
+    """Respuesta con status >= 400."""
+
+    def __init__(self, status: int, body: bytes, url: str):
+        super().__init__(f"HTTP {status} {url}")
+        self.status = status
+        self.code = status
+        self.body = body or b""
+        self.url = url
+
+    def read(self) -> bytes:
+        return self.body
+
+    def text(self) -> str:
+        return self.body.decode("utf-8", errors="replace")
+
+    def json(self):
+        try:
+            return json.loads(self.text()) if self.body else {}
+        except ValueError:
+            return {"raw": self.text()}
+
+
+class CircuitOpenError(Exception):
+    """El host tiene el circuito abierto: no se intentó la llamada."""
+
+
+class HttpResponse:
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status: int, headers: dict, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def text(self) -> str:
+        return self.body.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text()) if self.body else {}
+
+
+class _CircuitBreaker:
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self, settings: dict) -> bool:
+        with _lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < settings["resetSeconds"] or self.probing:
+                return False
+            self.probing = True  # Medio abierto: una sola llamada de prueba
+            return True
+
+    def release(self):
+        with _lock:
+            self.probing = False
+
+    def record(self, ok: bool, settings: dict):
+        with _lock:
+            self.probing = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= settings["failureThreshold"]:
+                self.opened_at = time.monotonic()
+
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.probing else "open"
+
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, elapsed_ms: float, error: bool):
+        idx = next((i for i, limit in enumerate(LATENCY_BUCKETS_MS) if elapsed_ms <= limit), len(LATENCY_BUCKETS_MS))
+        with _lock:
+            self.buckets[idx] += 1
+            self.count += 1
+            self.errors += 1 if error else 0
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def snapshot(self) -> dict:
+        labels = [f"le{limit}" for limit in LATENCY_BUCKETS_MS] + ["inf"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avgMs": round(self.total_ms / self.count, 1) if self.count else 0,
+            "maxMs": round(self.max_ms, 1),
+            "p50Ms": self._quantile(0.5),
+            "p95Ms": self._quantile(0.95),
+            "buckets": dict(zip(labels, self.buckets)),
+        }
+
+    def _quantile(self, q: float):
+        """Límite superior del bucket donde cae el cuantil (None si cae en el desbordamiento)."""
+        if not self.count:
+            return 0
+        target = q * self.count
+        seen = 0
+        for idx, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return LATENCY_BUCKETS_MS[idx] if idx < len(LATENCY_BUCKETS_MS) else None
+        return None
+
+
+_idle: Dict[tuple, list] = {}
+_breakers: Dict[str, _CircuitBreaker] = {}
+_histograms: Dict[str, _Histogram] = {}
+_stats_logged_at = [time.monotonic()]
+
+
+def configure_host(host: str, **settings):
+    """Sobrescribe timeout/retries/backoff/umbral del circuito para un host."""
+    with _lock:
+        HOST_SETTINGS[host] = dict(HOST_SETTINGS.get(host) or {}, **settings)
+
+
+def host_settings(host: str) -> dict:
+    return dict(DEFAULT_HOST_SETTINGS, **(HOST_SETTINGS.get(host) or {}))
+
+
+def _breaker(host: str) -> _CircuitBreaker:
+    with _lock:
+        return _breakers.setdefault(host, _CircuitBreaker())
+
+
+def _histogram(host: str) -> _Histogram:
+    with _lock:
+        return _histograms.setdefault(host, _Histogram())
+
+
+def _acquire(scheme: str, host: str, port: Optional[int], timeout: float):
+    """-> (conexión, reutilizada)"""
+    key = (scheme, host, port)
+    with _lock:
+        pool = _idle.get(key)
+        conn = pool.pop() if pool else None
+    if conn is not None:
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, port, timeout=timeout, context=_SSL_CONTEXT), False
+    return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+
+def _release(scheme: str, host: str, port: Optional[int], conn):
+    with _lock:
+        pool = _idle.setdefault((scheme, host, port), [])
+        if len(pool) < MAX_IDLE_PER_HOST:
+            pool.append(conn)
+            return
+    conn.close()
+
+
+def _send(method: str, parts, path: str, headers: dict, body: Optional[bytes], timeout: float) -> HttpResponse:
+    """Un intento; si la conexión reutilizada estaba muerta, repite una vez con conexión nueva."""
+    for attempt in range(2):
+        conn, reused = _acquire(parts.scheme, parts.hostname, parts.port, timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            payload = resp.read()
+        except _STALE_ERRORS:
+            conn.close()
+            if reused and attempt == 0:
+                continue
+            raise
+        except BaseException:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            _release(parts.scheme, parts.hostname, parts.port, conn)
+        return HttpResponse(resp.status, {k.lower(): v for k, v in resp.getheaders()}, payload)
+    raise http.client.RemoteDisconnected("connection closed")
+
+
+def _backoff_seconds(settings: dict, attempt: int, retry_after: Optional[str]) -> float:
+    if retry_after:
+        try:
+            return min(settings["backoffMax"], max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return random.uniform(0, min(settings["backoffMax"], settings["backoffBase"] * (2 ** attempt)))
+
+
+def request(
+    method: str,
+    url: str,
+    headers: Optional[dict] = None,
+    body: Optional[bytes] = None,
+    json_body=None,
+    timeout: Optional[float] = None,
+    retries: Optional[int] = None,
+    idempotent: Optional[bool] = None,
+    deadline: Optional[float] = None,
+    json_default=None,
+) -> HttpResponse:
+    """
+    Llamada HTTP con pool, reintentos y circuit breaker.
+    `deadline` es absoluto (time.monotonic()); ningún intento ni backoff lo rebasa.
+    Lanza HttpError (status >= 400), CircuitOpenError o el error de red/timeout del último intento.
+    """
+    method = method.upper()
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+    settings = host_settings(host)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    req_headers = {"Connection": "keep-alive"}
+    if json_body is not None:
+        body = json.dumps(json_body, default=json_default).encode("utf-8")
+        req_headers["Content-Type"] = "application/json"
+    req_headers.update(headers or {})
+
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    max_retries = (settings["retries"] if retries is None else retries) if idempotent else 0
+    per_try = float(timeout or settings["timeout"])
+    breaker = _breaker(host)
+    histogram = _histogram(host)
+
+    attempt = 0
+    while True:
+        if not breaker.allow(settings):
+            raise CircuitOpenError(f"circuit open for {host}")
+        attempt_timeout = per_try
+        if deadline is not None:
+            attempt_timeout = min(per_try, deadline - time.monotonic())
+            if attempt_timeout <= 0:
+                breaker.release()  # No se llegó a llamar: no cuenta como éxito ni como falla
+                raise socket.timeout(f"deadline exceeded for {host}")
+
+        t0 = time.monotonic()
+        error = None
+        response = None
+        recorded = False
+        try:
+            try:
+                response = _send(method, parts, path, req_headers, body, attempt_timeout)
+            except _NETWORK_ERRORS as exc:
+                error = exc
+            elapsed_ms = (time.monotonic() - t0) * 1000
+            failed = error is not None or response.status >= 500
+            histogram.observe(elapsed_ms, failed)
+            breaker.record(not failed, settings)
+            recorded = True
+        finally:
+            if not recorded:
+                breaker.release()  # Error no de red: libera la prueba medio abierta para no trabar el breaker
+        _maybe_log_stats()
+
+        retryable = error is not None or response.status in RETRY_STATUSES
+        if retryable and attempt < max_retries:
+            pause = _backoff_seconds(settings, attempt, None if response is None else response.headers.get("retry-after"))
+            if deadline is None or time.monotonic() + pause < deadline:
+                attempt += 1
+                time.sleep(pause)
+                continue
+        if error is not None:
+            raise error
+        if response.status >= 400:
+            raise HttpError(response.status, response.body, url)
+        return response
+
+
+def request_json(method: str, url: str, **kwargs):
+    """Como `request`, pero devuelve el cuerpo ya decodificado como JSON."""
+    return request(method, url, **kwargs).json()
+
+
+def stats() -> dict:
+    """{host: {latencia..., "circuit": closed|open|half_open, "idle": conexiones en el pool}}"""
+    with _lock:
+        hosts = set(_histograms) | set(_breakers)
+        idle = {}
+        for (_, host, _), pool in _idle.items():
+            idle[host] = idle.get(host, 0) + len(pool)
+    result = {}
+    for host in sorted(hosts):
+        hist = _histograms.get(host)
+        breaker = _breakers.get(host)
+        result[host] = dict(
+            hist.snapshot() if hist else {},
+            circuit=breaker.state() if breaker else "closed",
+            idle=idle.get(host, 0),
+        )
+    return result
+
+
+def _maybe_log_stats():
+    now = time.monotonic()
+    if now - _stats_logged_at[0] < STATS_LOG_INTERVAL_SECONDS:
+        return
+    _stats_logged_at[0] = now
+    print(f"[http_client] stats {json.dumps(stats())}")
@@ -1,14 +1,8 @@
 import json
-import boto3
 import core_utils as utils # Importado desde la Lambda Layer
+import stock_allocator
 from datetime import datetime
 
-# Clientes de AWS
-sfn = boto3.client('stepfunctions')
-
-# Configuración de Orquestación
-ORDER_SFN_ARN = utils.os.getenv("ORDER_FULFILLMENT_SFN_ARN")
-
 # --- HELPERS DE INVENTARIO (Lógica Atómica) ---
 
 def _apply_stock_delta(stock_id: str, deltas: dict):
@@ -36,11 +30,12 @@ def _apply_stock_delta(stock_id: str, deltas: dict):
         "SET inventory = :inv, updatedAt = :u",
         {":inv": next_inventory, ":u": utils._now_iso()}
     )
+    utils._invalidate_stocks_cache()
     return updated, None
 
 def _log_movement(stock_id, m_type, product_id, qty, ref_id, user_id, reason="", payment_method=None):
     """Crea un registro individual de movimiento de inventario."""
-    move_id = f"MOV-{utils.uuid.uuid4().hex[:12].upper()}"
+    move_id = utils._new_id("MOV-")
     item = {
         "entityType": "inventoryMovement",
         "movementId": move_id,
@@ -55,7 +50,9 @@ def _log_movement(stock_id, m_type, product_id, qty, ref_id, user_id, reason="",
         "reason": reason,
         "createdAt": utils._now_iso()
     }
-    return utils._put_entity("INVENTORY_MOVEMENT", move_id, item)
+    saved = utils._put_entity("INVENTORY_MOVEMENT", move_id, item, unique=True)
+    utils._upsert_movement_ledger(saved)
+    return saved
 
 # --- HANDLERS: GESTIÓN DE ALMACENES ---
 
@@ -69,19 +66,20 @@ def handle_stocks(method, body, stock_id=None):
         sid = body.get("stockId") or f"STK-{utils.uuid.uuid4().hex[:6].upper()}"
         item = {
             "entityType": "stock", "stockId": sid, "name": body.get("name"),
-            "location": body.get("location"),
+            "location": body.get("location"), "postalCode": body.get("postalCode"),
             "allowPickup": bool(body.get("allowPickup", False)),
             "isMainWarehouse": bool(body.get("isMainWarehouse", False)),
             "linkedUserIds": [int(u) for u in (body.get("linkedUserIds") or []) if u is not None],
             "inventory": body.get("inventory") or {}, "createdAt": utils._now_iso()
         }
         utils._put_entity("STOCK", sid, item)
+        utils._invalidate_stocks_cache()
         return utils._json_response(201, {"stock": item})
 
     if method == "PATCH" and stock_id:
         updates = ["updatedAt = :u"]
         eav = {":u": utils._now_iso()}
-        for f in ["name", "location", "allowPickup", "isMainWarehouse", "inventory"]:
+        for f in ["name", "location", "postalCode", "allowPickup", "isMainWarehouse", "inventory"]:
             if f in body:
                 updates.append(f"{f} = :{f}")
                 eav[f":{f}"] = body[f]
@@ -89,8 +87,204 @@ def handle_stocks(method, body, stock_id=None):
             updates.append("linkedUserIds = :linkedUserIds")
             eav[":linkedUserIds"] = [int(u) for u in (body["linkedUserIds"] or []) if u is not None]
         updated = utils._update_by_id("STOCK", stock_id, f"SET {', '.join(updates)}", eav)
+        utils._invalidate_stocks_cache()
         return utils._json_response(200, {"stock": updated})
 
+# --- HANDLERS: MOVIMIENTOS ---
+
+def handle_list_movements(query):
+    """GET /stocks/movements?stockId=&from=&to=&type=&productId=&limit=&cursor="""
+    stock_id = str(query.get("stockId") or "").strip()
+    if not stock_id:
+        # Sin almacén no hay partición que consultar: vista global legacy (bucket completo)
+        moves = utils._query_bucket("INVENTORY_MOVEMENT")
+        m_type = str(query.get("type") or "").strip().lower()
+        if m_type:
+            moves = [m for m in moves if str(m.get("movementType") or m.get("type") or "").strip().lower() == m_type]
+        return utils._json_response(200, {"movements": moves})
+
+    try:
+        moves, next_cursor = utils._query_movement_ledger(
+            stock_id,
+            date_from=query.get("from"),
+            date_to=query.get("to"),
+            movement_type=query.get("type"),
+            product_id=query.get("productId"),
+            limit=query.get("limit"),
+            cursor=query.get("cursor"),
+        )
+    except ValueError as e:
+        return utils._json_response(400, {"message": f"Parámetros inválidos: {e}"})
+    return utils._json_response(200, {"movements": moves, "nextCursor": next_cursor})
+
+# --- SNAPSHOTS Y RECONCILIACIÓN DE INVENTARIO ---
+
+# Signo con el que cada tipo de movimiento afecta el inventario del almacén
+_MOVEMENT_SIGN = {
+    "entry": 1, "entry_transfer": 1,
+    "damage": -1, "damaged": -1, "exit_transfer": -1, "exit_order": -1, "pos_sale": -1,
+}
+
+def _stock_snapshot_pk(stock_id) -> str:
+    return f"STOCK_SNAPSHOT#{stock_id}"
+
+def _normalize_inventory(inventory) -> dict:
+    return {str(k): int(v) for k, v in (inventory or {}).items()}
+
+def _replay_movements(inventory: dict, movements, direction: int = 1):
+    """Aplica (direction=1) o revierte (direction=-1) movimientos sobre una copia del inventario."""
+    result = dict(inventory)
+    count = 0
+    for m in movements:
+        sign = _MOVEMENT_SIGN.get(str(m.get("movementType") or m.get("type") or ""))
+        if not sign:
+            continue
+        pid = str(m.get("productId"))
+        result[pid] = result.get(pid, 0) + direction * sign * int(m.get("qty") or 0)
+        count += 1
+    return result, count
+
+def _nearest_stock_snapshot(stock_id, at_iso: str, before: bool = True):
+    key_cond = utils.Key("PK").eq(_stock_snapshot_pk(stock_id))
+    key_cond = key_cond & (utils.Key("SK").lte(at_iso) if before else utils.Key("SK").gt(at_iso))
+    resp = utils._table.query(KeyConditionExpression=key_cond, ScanIndexForward=not before, Limit=1)
+    items = resp.get("Items", [])
+    return items[0] if items else None
+
+def handle_stock_snapshot_job(event=None):
+    """Job diario (EventBridge): checkpoint del inventario vivo de cada almacén."""
+    taken_at = utils._now_iso()
+    snapshots = [{
+        "PK": _stock_snapshot_pk(stock["stockId"]), "SK": taken_at,
+        "entityType": "stockSnapshot", "stockId": stock["stockId"],
+        "inventory": _normalize_inventory(stock.get("inventory")),
+        "takenAt": taken_at, "createdAt": taken_at,
+    } for stock in utils._query_bucket("STOCK") if stock.get("stockId")]
+    written = utils._put_items_batch(snapshots)
+    print(json.dumps({"event": "stock_snapshot_job", "takenAt": taken_at, "stocks": written}))
+    return {"status": "OK", "takenAt": taken_at, "stocks": written}
+
+def _inventory_at(stock: dict, at_iso: str) -> dict:
+    """Checkpoint más cercano + replay del ledger hasta `at` (hacia adelante o hacia atrás)."""
+    stock_id = stock["stockId"]
+    base = _nearest_stock_snapshot(stock_id, at_iso, before=True)
+    if base:
+        movements = utils._iter_movement_ledger(stock_id, base["takenAt"], at_iso)
+        inventory, replayed = _replay_movements(_normalize_inventory(base.get("inventory")), movements, 1)
+        source = {"type": "checkpoint", "takenAt": base["takenAt"], "direction": "forward"}
+    else:
+        # `at` es anterior al primer checkpoint: se revierte desde el siguiente (o desde el inventario vivo)
+        base = _nearest_stock_snapshot(stock_id, at_iso, before=False)
+        if base:
+            base_inventory, base_at = _normalize_inventory(base.get("inventory")), base["takenAt"]
+            source = {"type": "checkpoint", "takenAt": base_at, "direction": "backward"}
+        else:
+            base_inventory, base_at = _normalize_inventory(stock.get("inventory")), utils._now_iso()
+            source = {"type": "live", "takenAt": base_at, "direction": "backward"}
+        movements = utils._iter_movement_ledger(stock_id, at_iso, base_at)
+        inventory, replayed = _replay_movements(base_inventory, movements, -1)
+    return {"stockId": stock_id, "at": at_iso, "inventory": inventory, "source": source, "replayedMovements": replayed}
+
+def handle_stock_inventory_at(stock_id, query):
+    """GET /stocks/{id}/inventory?at="""
+    stock = utils._get_by_id("STOCK", stock_id)
+    if not stock:
+        return utils._json_response(404, {"message": "Almacén no encontrado"})
+    try:
+        at_iso = utils._parse_ledger_bound(query.get("at"), end_of_day=True) or utils._now_iso()
+    except ValueError:
+        return utils._json_response(400, {"message": "Parámetro at inválido"})
+    return utils._json_response(200, _inventory_at(stock, at_iso))
+
+def _reconcile_stock(stock: dict) -> dict:
+    now = utils._now_iso()
+    base = _nearest_stock_snapshot(stock["stockId"], now, before=True)
+    live = _normalize_inventory(stock.get("inventory"))
+    if not base:
+        return {"stockId": stock["stockId"], "checkpoint": None, "drift": [], "replayedMovements": 0}
+
+    movements = utils._iter_movement_ledger(stock["stockId"], base["takenAt"], now)
+    expected, replayed = _replay_movements(_normalize_inventory(base.get("inventory")), movements, 1)
+    drift = [
+        {"productId": pid, "expected": expected.get(pid, 0), "actual": live.get(pid, 0),
+         "drift": live.get(pid, 0) - expected.get(pid, 0)}
+        for pid in sorted(set(expected) | set(live))
+        if expected.get(pid, 0) != live.get(pid, 0)
+    ]
+    return {"stockId": stock["stockId"], "checkpoint": base["takenAt"], "drift": drift, "replayedMovements": replayed}
+
+def handle_stock_reconciliation(query):
+    """GET /stocks/reconciliation?stockId= : checkpoint + movimientos vs inventario vivo."""
+    stock_id = query.get("stockId")
+    if stock_id:
+        stock = utils._get_by_id("STOCK", stock_id)
+        if not stock:
+            return utils._json_response(404, {"message": "Almacén no encontrado"})
+        stocks = [stock]
+    else:
+        stocks = [s for s in utils._query_bucket("STOCK") if s.get("stockId")]
+    report = [_reconcile_stock(stock) for stock in stocks]
+    return utils._json_response(200, {
+        "generatedAt": utils._now_iso(),
+        "stocks": report,
+        "stocksWithDrift": sum(1 for r in report if r["drift"]),
+    })
+
+# --- ASIGNACIÓN DE SURTIDO Y DISPONIBILIDAD ---
+
+def handle_allocate(body):
+    """POST /stocks/allocate {items[], postalCode?} -> almacén(es) que surten la orden."""
+    items = body.get("items") or body.get("lines") or []
+    try:
+        needs = stock_allocator.normalize_lines(items)
+    except ValueError as e:
+        return utils._json_response(400, {"message": str(e)})
+    if not needs:
+        return utils._json_response(400, {"message": "Se requieren items con productId y quantity"})
+    plan = stock_allocator.allocate(items, utils._get_stocks_cached(), body.get("postalCode"))
+    return utils._json_response(200, {"allocation": plan})
+
+def handle_pickup_availability(body):
+    """POST /pickup-stocks/availability {items[]} -> sucursales que pueden surtir el carrito."""
+    items = body.get("items") or []
+    try:
+        needs = stock_allocator.normalize_lines(items)
+    except ValueError as e:
+        return utils._json_response(400, {"message": str(e)})
+    if not needs:
+        return utils._json_response(400, {"message": "Se requieren items con productId y quantity"})
+    stocks = stock_allocator.pickup_availability(items, utils._get_stocks_cached())
+    return utils._json_response(200, {"stocks": stocks})
+
+# --- SUGERENCIAS DE REABASTO ---
+
+def handle_reorder_suggestions(query):
+    """GET /stocks/reorder-suggestions?stockId= : velocidad de salida y transferencias sugeridas."""
+    try:
+        import reorder_engine
+    except ImportError:
+        return utils._json_response(501, {"message": "Motor de reabasto no disponible (requiere NumPy en la Layer)"})
+
+    cfg = reorder_engine.reorder_config(utils._load_app_config())
+    stocks = [s for s in utils._query_bucket("STOCK") if s.get("stockId")]
+    branch_ids = [
+        str(s["stockId"]) for s in stocks
+        if not s.get("isMainWarehouse") and (not query.get("stockId") or str(s["stockId"]) == str(query.get("stockId")))
+    ]
+
+    now = utils.datetime.now(utils.timezone.utc)
+    until_iso = utils._now_iso()
+    after_iso = (now - utils.timedelta(days=cfg["windowDays"])).strftime("%Y-%m-%dT00:00:00Z")
+    movements = (
+        m for sid in branch_ids
+        for m in utils._iter_movement_ledger(sid, after_iso, until_iso)
+    )
+    branch_set = set(branch_ids)
+    scoped = [s for s in stocks if s.get("isMainWarehouse") or str(s["stockId"]) in branch_set]
+    result = reorder_engine.compute_reorder_suggestions(scoped, movements, cfg, now)
+    result["generatedAt"] = until_iso
+    return utils._json_response(200, result)
+
 # --- HANDLERS: TRANSFERENCIAS ---
 
 def handle_transfers(method, body, query, transfer_id=None):
@@ -108,11 +302,14 @@ def handle_transfers(method, body, query, transfer_id=None):
             # Sumar a destino
             deltas = {str(line['productId']): int(line['qty']) for line in trf['lines']}
             _apply_stock_delta(trf['destinationStockId'], deltas)
+            for line in trf['lines']:
+                _log_movement(trf['destinationStockId'], "entry_transfer", line['productId'], line['qty'], transfer_id, body.get("receivedByUserId"))
             
             # Actualizar transferencia
             updated = utils._update_by_id("STOCK_TRANSFER", transfer_id, 
                                          "SET #s = :s, receivedAt = :ra", 
                                          {":s": "received", ":ra": utils._now_iso()}, {"#s": "status"})
+            utils._kpi_transfer_status_change(trf.get("status"), "received")
             return utils._json_response(200, {"transfer": updated})
 
         # Crear transferencia (Salida de origen)
@@ -123,49 +320,33 @@ def handle_transfers(method, body, query, transfer_id=None):
         _, error = _apply_stock_delta(source_id, deltas)
         if error: return utils._json_response(400, {"message": error})
 
-        tid = f"TRF-{utils.uuid.uuid4().hex[:8].upper()}"
+        tid = utils._new_id("TRF-")
         item = {
             "entityType": "stockTransfer", "transferId": tid,
             "sourceStockId": source_id, "destinationStockId": body.get("destinationStockId"),
             "lines": lines, "status": "pending", "createdAt": utils._now_iso()
         }
-        utils._put_entity("STOCK_TRANSFER", tid, item)
+        utils._put_entity("STOCK_TRANSFER", tid, item, unique=True)
+        utils._kpi_transfer_status_change(None, "pending")
+        for line in lines:
+            _log_movement(source_id, "exit_transfer", line['productId'], line['qty'], tid, body.get("createdByUserId"))
         return utils._json_response(201, {"transfer": item})
 
 # --- HANDLERS: PUNTO DE VENTA (POS) ---
 
-def handle_pos_sale(body, headers):
-    """POST /pos/sales"""
-    stock_id = body.get("stockId")
-    items = body.get("items", [])
-    user_id = headers.get("x-user-id", "system")
-    payment_method = str(body.get("paymentMethod") or "cash").strip().lower()
-    if payment_method not in ("cash", "card", "transfer"):
-        return utils._json_response(400, {"message": "Forma de pago invalida"})
-
-    # 1. Aplicar descuento de stock
-    deltas = {str(it['productId']): -int(it['quantity']) for it in items}
-    _, error = _apply_stock_delta(stock_id, deltas)
-    if error: return utils._json_response(400, {"message": error})
-
-    # 2. Calcular totales y crear Orden
-    total = sum([utils._to_decimal(it['price']) * int(it['quantity']) for it in items])
-    order_id = f"POS-{utils.uuid.uuid4().hex[:8].upper()}"
-    now = utils._now_iso()
-
-    order_item = {
+def _build_pos_order_item(body, order_id, stock_id, user_id, payment_method, total, now, month_key=None):
+    """Orden POS (ya entregada en sucursal)."""
+    return {
         "entityType": "order", "orderId": order_id, "customerId": body.get("customerId"),
         "customerName": body.get("customerName", "Público General"),
-        "status": "delivered", "items": items, "netTotal": total, "total": total,
+        "status": "delivered", "items": body.get("items", []), "netTotal": total, "total": total,
         "deliveryType": "pickup", "stockId": stock_id, "attendantUserId": user_id,
-        "monthKey": utils._month_key(), "paymentMethod": payment_method, "createdAt": now
+        "monthKey": month_key or utils._month_key(), "paymentMethod": payment_method, "createdAt": now
     }
-    utils._put_entity("ORDER", order_id, order_item)
-    utils._upsert_order_customer_history(order_item)
 
-    # 3. Crear registro de venta POS (para contabilidad de sucursal)
-    sale_id = f"SALE-{utils.uuid.uuid4().hex[:8].upper()}"
-    sale_item = {
+def _build_pos_sale_item(body, sale_id, order_id, stock_id, user_id, payment_method, total, now):
+    """Registro de venta POS (para contabilidad de sucursal)."""
+    return {
         "entityType": "posSale", "saleId": sale_id, "orderId": order_id,
         "stockId": stock_id,
         "total": total,
@@ -178,28 +359,412 @@ def handle_pos_sale(body, headers):
         "paymentStatus": body.get("paymentStatus") or "paid_branch",
         "deliveryStatus": body.get("deliveryStatus") or "delivered_branch",
         "paymentMethod": payment_method,
-        "lines": items,
+        "lines": body.get("items", []),
         "createdAt": now,
         "updatedAt": now,
     }
-    utils._put_entity("POS_SALE", sale_id, sale_item)
+
+def handle_pos_sale(body, headers):
+    """POST /pos/sales — con header Idempotency-Key un reintento no vuelve a descontar stock."""
+    actor_id = headers.get("x-user-id", "system")
+    return utils._with_idempotency(f"POST /pos/sales#{actor_id}", headers, body, lambda: _register_pos_sale(body, headers))
+
+def _register_pos_sale(body, headers):
+    stock_id = body.get("stockId")
+    items = body.get("items", [])
+    user_id = headers.get("x-user-id", "system")
+    payment_method = str(body.get("paymentMethod") or "cash").strip().lower()
+    if payment_method not in ("cash", "card", "transfer"):
+        return utils._json_response(400, {"message": "Forma de pago invalida"})
+
+    # 1. Aplicar descuento de stock
+    deltas = {str(it['productId']): -int(it['quantity']) for it in items}
+    utils._idempotency_mark_written()
+    _, error = _apply_stock_delta(stock_id, deltas)
+    if error: return utils._json_response(400, {"message": error})
+
+    # 2. Calcular totales y crear Orden
+    total = sum([utils._to_decimal(it['price']) * int(it['quantity']) for it in items])
+    order_id = utils._new_id("POS-")
+    now = utils._now_iso()
+
+    order_item = _build_pos_order_item(body, order_id, stock_id, user_id, payment_method, total, now)
+    # La orden y su evento de comisiones (entregada) se escriben en la misma transacción
+    utils._put_entity("ORDER", order_id, order_item, unique=True,
+                      events=[utils._order_event_item(order_id, "ORDER_DELIVERED")])
+    utils._upsert_order_customer_history(order_item)
+
+    # 3. Crear registro de venta POS (para contabilidad de sucursal)
+    sale_id = utils._new_id("SALE-")
+    sale_item = _build_pos_sale_item(body, sale_id, order_id, stock_id, user_id, payment_method, total, now)
+    utils._put_entity("POS_SALE", sale_id, sale_item, unique=True)
+    utils._kpi_orders_created([order_item])
+    utils._kpi_pos_sales([sale_item])
+    utils._sales_rollup_pos_orders([order_item])
 
     # 4. Registrar movimientos
     for it in items:
         _log_movement(stock_id, "pos_sale", it['productId'], it['quantity'], order_id, user_id, payment_method=payment_method)
 
-    # 5. DISPARAR STEP FUNCTION (Motor de Comisiones)
-    if ORDER_SFN_ARN:
-        try:
-            sfn.start_execution(
-                stateMachineArn=ORDER_SFN_ARN,
-                input=json.dumps({"orderId": order_id, "action": "ORDER_DELIVERED"})
-            )
-        except Exception as e:
-            print(f"[SFN_ERROR] pos_sale={sale_id} err={e}")
+    # 5. Avisar al motor de comisiones (consume la outbox por lotes)
+    utils._kick_order_events_worker()
 
     return utils._json_response(201, {"sale": sale_item, "saleId": sale_id, "orderId": order_id})
 
+# --- HANDLERS: POS BATCH (terminales offline) ---
+
+POS_BATCH_MAX_SALES = 500
+POS_BATCH_MAX_STOCK_RETRIES = 3
+POS_BATCH_CLAIMS_PER_TX = 99  # TransactWriteItems admite 100 items: el STOCK + 99 marcadores
+POS_CLAIM_COMPLETIONS_PER_TX = 50  # marcador + evento ORDER_DELIVERED por venta
+
+def _pos_client_sale_key(client_sale_id: str) -> dict:
+    """Marcador de idempotencia por id de cliente de la terminal."""
+    return {"PK": f"POS_CLIENT_SALE#{client_sale_id}", "SK": "DEDUPE"}
+
+def _pos_client_sale_claim(sale: dict) -> dict:
+    """
+    Marcador que reclama la venta; se escribe en la misma transacción que descuenta su stock.
+    Queda en status=claimed hasta que ORDER, POS_SALE y movimientos están escritos; una
+    réplica que lo encuentra así completa la venta con sus ids (ver _complete_pos_claims).
+    """
+    return {
+        **_pos_client_sale_key(sale["clientSaleId"]),
+        "entityType": "posClientSale", "clientSaleId": sale["clientSaleId"],
+        "saleId": sale["saleId"], "orderId": sale["orderId"], "stockId": sale["stockId"],
+        "status": "claimed", "createdAt": sale["ingestedAt"],
+    }
+
+def _pos_claim_completion(sale: dict) -> list:
+    """Cierra el marcador y encola el ORDER_DELIVERED de su orden en la misma transacción."""
+    return [{"Update": {
+        "TableName": utils.TABLE_NAME,
+        "Key": _pos_client_sale_key(sale["clientSaleId"]),
+        "UpdateExpression": "SET #s = :done, completedAt = :u",
+        "ConditionExpression": "#s = :claimed",
+        "ExpressionAttributeNames": {"#s": "status"},
+        "ExpressionAttributeValues": {":done": "completed", ":claimed": "claimed", ":u": utils._now_iso()},
+    }}] + utils._outbox_puts([utils._order_event_item(sale["orderId"], "ORDER_DELIVERED")])
+
+def _complete_pos_claims(sales: list) -> list:
+    """
+    Marca como completas las ventas cuyos registros ya están escritos. La condición
+    status=claimed deja que solo una carga (la original o una réplica que termina una venta
+    interrumpida) emita el evento y los KPIs. Devuelve las ventas que completó esta llamada.
+    """
+    won = []
+    for start in range(0, len(sales), POS_CLAIM_COMPLETIONS_PER_TX):
+        pending = sales[start:start + POS_CLAIM_COMPLETIONS_PER_TX]
+        while pending:
+            try:
+                utils._ddb_client.transact_write_items(
+                    TransactItems=[op for sale in pending for op in _pos_claim_completion(sale)]
+                )
+                won.extend(pending)
+                break
+            except utils.ClientError as ex:
+                if ex.response.get("Error", {}).get("Code") != "TransactionCanceledException":
+                    raise
+                reasons = ex.response.get("CancellationReasons") or []
+                done_elsewhere = {i // 2 for i, r in enumerate(reasons) if r.get("Code") == "ConditionalCheckFailed"}
+                if not done_elsewhere:
+                    raise
+                pending = [sale for i, sale in enumerate(pending) if i not in done_elsewhere]
+    return won
+
+def _write_pos_sale_records(sales: list, user_id) -> tuple:
+    """
+    ORDER, historial, POS_SALE, movimientos y su ledger de ventas ya reclamadas. Los ids salen
+    del marcador (los de movimiento, del saleId), así que reescribirlos en una réplica es idempotente.
+    Devuelve (órdenes, ventas).
+    """
+    order_rows, sale_rows, movement_rows, raw_items = [], [], [], []
+    for sale in sales:
+        sold_at = sale["soldAt"]
+        now = sold_at.replace(microsecond=0).isoformat().replace("+00:00", "Z") if sold_at else sale["ingestedAt"]
+        month_key = utils._month_key(sold_at) if sold_at else utils._month_key()
+        order_id = sale["orderId"]
+        sale_id = sale["saleId"]
+        sale_body = sale["body"]
+
+        order_item = _build_pos_order_item(sale_body, order_id, sale["stockId"], user_id, sale["paymentMethod"], sale["total"], now, month_key)
+        order_item["clientSaleId"] = sale["clientSaleId"]
+        order_rows.append((order_id, order_item))
+        history_item = utils._build_order_customer_history_item(order_item)
+        if history_item:
+            raw_items.append(history_item)
+
+        sale_item = _build_pos_sale_item(sale_body, sale_id, order_id, sale["stockId"], user_id, sale["paymentMethod"], sale["total"], now)
+        sale_item["clientSaleId"] = sale["clientSaleId"]
+        sale_rows.append((sale_id, sale_item))
+
+        for line_no, it in enumerate(sale_body.get("items") or []):
+            move_id = f"{sale_id.replace('SALE-', 'MOV-', 1)}-{line_no}"
+            movement_rows.append((move_id, {
+                "entityType": "inventoryMovement", "movementId": move_id,
+                "stockId": sale["stockId"], "movementType": "pos_sale", "type": "pos_sale",
+                "productId": it["productId"], "qty": int(it["quantity"]),
+                "referenceId": order_id, "userId": user_id,
+                "paymentMethod": sale["paymentMethod"], "reason": "",
+                # El stock se descuenta al ingerir: el ledger usa esa fecha para que el replay
+                # desde un checkpoint no vea drift; la hora de venta de la terminal va aparte
+                "createdAt": sale["ingestedAt"], "soldAt": now,
+            }))
+
+    utils._put_entities_batch("ORDER", order_rows)
+    utils._put_entities_batch("POS_SALE", sale_rows)
+    movement_items = utils._put_entities_batch("INVENTORY_MOVEMENT", movement_rows)
+    raw_items.extend(filter(None, (utils._build_movement_ledger_item(m) for m in movement_items)))
+    utils._put_items_batch(raw_items)
+    return [order for _, order in order_rows], [item for _, item in sale_rows]
+
+def _parse_client_timestamp(raw):
+    """Acepta el timestamp ISO de la terminal; None si no es válido."""
+    value = str(raw or "").strip()
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=utils.timezone.utc)
+    return dt.astimezone(utils.timezone.utc)
+
+def _normalize_batch_sale(raw, default_stock_id):
+    """Valida una venta del lote. Devuelve (venta_normalizada, error)."""
+    if not isinstance(raw, dict):
+        return None, "Venta invalida"
+    client_sale_id = str(raw.get("clientSaleId") or raw.get("clientId") or "").strip()
+    if not client_sale_id:
+        return None, "clientSaleId es obligatorio"
+    stock_id = str(raw.get("stockId") or default_stock_id or "").strip()
+    if not stock_id:
+        return None, "stockId es obligatorio"
+    payment_method = str(raw.get("paymentMethod") or "cash").strip().lower()
+    if payment_method not in ("cash", "card", "transfer"):
+        return None, "Forma de pago invalida"
+
+    deltas, items, total = {}, [], utils.D_ZERO
+    for it in raw.get("items") or []:
+        if not isinstance(it, dict) or it.get("productId") in (None, ""):
+            return None, "Linea invalida"
+        qty = stock_allocator.parse_quantity(it.get("quantity"))
+        if not qty or qty <= 0:
+            return None, f"Cantidad invalida para el producto {it.get('productId')}"
+        pid = str(it["productId"])
+        deltas[pid] = deltas.get(pid, 0) - qty
+        items.append({**it, "quantity": qty})
+        total += utils._to_decimal(it.get("price")) * qty
+    if not deltas:
+        return None, "items es obligatorio"
+
+    sold_at = _parse_client_timestamp(raw.get("soldAt") or raw.get("createdAt"))
+    return {
+        "clientSaleId": client_sale_id,
+        "stockId": stock_id,
+        "paymentMethod": payment_method,
+        "deltas": deltas,
+        "total": total,
+        "soldAt": sold_at,
+        "body": {**raw, "items": items},
+    }, None
+
+def _plan_stock_batch(inventory: dict, sales: list):
+    """Acepta ventas en orden mientras el inventario alcance. Devuelve (aceptadas, rechazadas, deltas)."""
+    running = {str(k): int(v) for k, v in (inventory or {}).items()}
+    accepted, rejected, aggregated = [], [], {}
+    for sale in sales:
+        short = next((pid for pid, d in sale["deltas"].items() if running.get(pid, 0) + d < 0), None)
+        if short is not None:
+            rejected.append((sale, f"Stock insuficiente para el producto {short}"))
+            continue
+        for pid, d in sale["deltas"].items():
+            running[pid] = running.get(pid, 0) + d
+            aggregated[pid] = aggregated.get(pid, 0) + d
+        accepted.append(sale)
+    return accepted, rejected, aggregated
+
+def _apply_stock_deltas_atomic(stock: dict, deltas: dict, claims: list = None) -> dict:
+    """
+    Aplica todos los deltas del lote en UN UpdateItem condicional sobre el STOCK.
+    Cada producto con salida lleva su guarda (inventory.pid >= qty), así que el
+    descuento es atómico aunque otras lambdas escriban en paralelo.
+    Lanza ClientError(ConditionalCheckFailedException) si el inventario cambió.
+    claims: marcadores POS_CLIENT_SALE que se escriben en la misma transacción con
+    attribute_not_exists(PK); si alguno ya existe se cancela todo
+    (ClientError(TransactionCanceledException), CancellationReasons[1 + i] es el marcador i).
+    """
+    sets, conditions = ["updatedAt = :u"], []
+    names, values = {}, {":u": utils._now_iso(), ":z": 0}
+    for idx, (pid, delta) in enumerate(sorted(deltas.items())):
+        if not delta:
+            continue
+        names[f"#p{idx}"] = pid
+        values[f":d{idx}"] = int(delta)
+        sets.append(f"inventory.#p{idx} = if_not_exists(inventory.#p{idx}, :z) + :d{idx}")
+        if delta < 0:
+            values[f":n{idx}"] = -int(delta)
+            conditions.append(f"inventory.#p{idx} >= :n{idx}")
+
+    kwargs = {
+        "Key": {"PK": stock["PK"], "SK": stock["SK"]},
+        "UpdateExpression": f"SET {', '.join(sets)}",
+        "ExpressionAttributeValues": values,
+        "ReturnValues": "ALL_NEW",
+    }
+    if names:
+        kwargs["ExpressionAttributeNames"] = names
+    if conditions:
+        kwargs["ConditionExpression"] = " AND ".join(conditions)
+    if claims:
+        update = {k: v for k, v in kwargs.items() if k != "ReturnValues"}
+        update["TableName"] = utils.TABLE_NAME
+        utils._ddb_client.transact_write_items(TransactItems=[{"Update": update}] + [
+            {"Put": {"TableName": utils.TABLE_NAME, "Item": claim, "ConditionExpression": "attribute_not_exists(PK)"}}
+            for claim in claims
+        ])
+        return {}
+    return utils._table.update_item(**kwargs).get("Attributes") or {}
+
+def _commit_stock_chunk(stock_id: str, sales: list):
+    """
+    Planifica y aplica hasta POS_BATCH_CLAIMS_PER_TX ventas de un almacén con reintento optimista:
+    el descuento y los marcadores de sus clientSaleId van en una transacción, así una réplica
+    concurrente o un reintento tras una caída nunca descuenta dos veces.
+    Devuelve (aceptadas, rechazadas, ya reclamadas por otra carga).
+    """
+    pending, taken, conflicts = list(sales), [], 0
+    while pending and conflicts < POS_BATCH_MAX_STOCK_RETRIES:
+        stock = utils._get_by_id("STOCK", stock_id)
+        if not stock:
+            return [], [(sale, "Almacén no encontrado") for sale in pending], taken
+        if not isinstance(stock.get("inventory"), dict):
+            utils._update_by_id("STOCK", stock_id, "SET inventory = if_not_exists(inventory, :inv)", {":inv": {}})
+            stock["inventory"] = {}
+
+        accepted, rejected, deltas = _plan_stock_batch(stock.get("inventory"), pending)
+        if not accepted:
+            return accepted, rejected, taken
+        try:
+            _apply_stock_deltas_atomic(stock, deltas, [_pos_client_sale_claim(sale) for sale in accepted])
+            return accepted, rejected, taken
+        except utils.ClientError as ex:
+            if ex.response.get("Error", {}).get("Code") != "TransactionCanceledException":
+                raise
+            reasons = ex.response.get("CancellationReasons") or []
+            lost = {accepted[i - 1]["clientSaleId"] for i, r in enumerate(reasons)
+                    if i and r.get("Code") == "ConditionalCheckFailed"}
+            if lost:
+                # Otra carga reclamó esas ventas entre la lectura de marcadores y la transacción
+                taken.extend(sale for sale in pending if sale["clientSaleId"] in lost)
+                pending = [sale for sale in pending if sale["clientSaleId"] not in lost]
+                continue
+            conflicts += 1
+            print(json.dumps({"event": "pos_batch_stock_conflict", "stockId": stock_id}))
+    return [], [(sale, "Inventario en uso, reintenta la sincronización") for sale in pending], taken
+
+def _commit_stock_batch(stock_id: str, sales: list):
+    """Aplica las ventas de un almacén en transacciones de POS_BATCH_CLAIMS_PER_TX. Devuelve (aceptadas, rechazadas, ya reclamadas)."""
+    accepted, rejected, taken = [], [], []
+    for start in range(0, len(sales), POS_BATCH_CLAIMS_PER_TX):
+        ok, bad, dup = _commit_stock_chunk(stock_id, sales[start:start + POS_BATCH_CLAIMS_PER_TX])
+        accepted.extend(ok)
+        rejected.extend(bad)
+        taken.extend(dup)
+    return accepted, rejected, taken
+
+def handle_pos_sales_batch(body, headers):
+    """POST /pos/sales/batch — reingesta de ventas de terminales sin conexión."""
+    raw_sales = body.get("sales")
+    if not isinstance(raw_sales, list) or not raw_sales:
+        return utils._json_response(400, {"message": "sales es obligatorio"})
+    if len(raw_sales) > POS_BATCH_MAX_SALES:
+        return utils._json_response(400, {"message": f"Máximo {POS_BATCH_MAX_SALES} ventas por lote"})
+
+    user_id = headers.get("x-user-id", "system")
+    ingested_at = utils._now_iso()
+    results = [None] * len(raw_sales)
+
+    # 1. Validar y deduplicar dentro del lote (gana la primera ocurrencia válida)
+    candidates = []
+    index_by_client = {}
+    for idx, raw in enumerate(raw_sales):
+        sale, error = _normalize_batch_sale(raw, body.get("stockId"))
+        client_sale_id = str(raw.get("clientSaleId") or raw.get("clientId") or "").strip() if isinstance(raw, dict) else ""
+        if error:
+            results[idx] = {"index": idx, "clientSaleId": client_sale_id or None, "status": "rejected", "message": error}
+            continue
+        if client_sale_id in index_by_client:
+            results[idx] = {"index": idx, "clientSaleId": client_sale_id, "status": "duplicate", "duplicateOf": index_by_client[client_sale_id]}
+            continue
+        index_by_client[client_sale_id] = idx
+        sale["index"] = idx
+        sale["orderId"] = utils._new_id("POS-")
+        sale["saleId"] = utils._new_id("SALE-")
+        sale["ingestedAt"] = ingested_at
+        candidates.append(sale)
+
+    # 2. Deduplicar contra lotes anteriores (un BatchGetItem por cada 100 ids). Un marcador que
+    #    sigue en claimed es una carga interrumpida tras descontar stock: esta réplica la completa
+    incomplete = []
+
+    def _mark_duplicates(sales):
+        seen = utils._batch_get_items([_pos_client_sale_key(s["clientSaleId"]) for s in sales])
+        seen_by_client = {str(item.get("clientSaleId")): item for item in seen}
+        fresh = []
+        for sale in sales:
+            prior = seen_by_client.get(sale["clientSaleId"])
+            if not prior:
+                fresh.append(sale)
+                continue
+            if prior.get("status") == "claimed":
+                incomplete.append({
+                    **sale, "orderId": prior.get("orderId"), "saleId": prior.get("saleId"),
+                    "stockId": prior.get("stockId"), "ingestedAt": prior.get("createdAt") or ingested_at,
+                })
+            results[sale["index"]] = {
+                "index": sale["index"], "clientSaleId": sale["clientSaleId"], "status": "duplicate",
+                "saleId": prior.get("saleId"), "orderId": prior.get("orderId"),
+            }
+        return fresh
+
+    pending_by_stock = {}
+    for sale in _mark_duplicates(candidates):
+        pending_by_stock.setdefault(sale["stockId"], []).append(sale)
+
+    # 3. Por almacén, una transacción por cada 99 ventas: deltas agregados + marcadores de clientSaleId
+    accepted, taken = [], []
+    for stock_id, sales in pending_by_stock.items():
+        ok, rejected, dup = _commit_stock_batch(stock_id, sales)
+        accepted.extend(ok)
+        taken.extend(dup)
+        for sale, message in rejected:
+            results[sale["index"]] = {"index": sale["index"], "clientSaleId": sale["clientSaleId"], "status": "rejected", "message": message}
+    if taken:
+        _mark_duplicates(taken)
+
+    # 4. Escrituras masivas idempotentes: ORDER, historial, POS_SALE y movimientos
+    for sale in accepted:
+        results[sale["index"]] = {
+            "index": sale["index"], "clientSaleId": sale["clientSaleId"], "status": "created",
+            "saleId": sale["saleId"], "orderId": sale["orderId"],
+        }
+    to_write = accepted + incomplete
+    orders, pos_sales = _write_pos_sale_records(to_write, user_id)
+
+    # 5. Cerrar los marcadores con el evento de cada orden; KPIs y rollups solo de las que cerró esta carga
+    won = {sale["orderId"] for sale in _complete_pos_claims(to_write)}
+    utils._kpi_orders_created([order for order in orders if order["orderId"] in won])
+    utils._kpi_pos_sales([item for item in pos_sales if item["orderId"] in won])
+    utils._sales_rollup_pos_orders([order for order in orders if order["orderId"] in won])
+    if won:
+        utils._kick_order_events_worker()
+
+    rows = [row for row in results if row]
+    summary = {status: sum(1 for r in rows if r["status"] == status) for status in ("created", "duplicate", "rejected")}
+    return utils._json_response(200, {"results": rows, "summary": summary})
+
 def _stock_id_str(value) -> str:
     """Normaliza stockId a string."""
     if value is None:
@@ -298,6 +863,10 @@ def handle_cash_cut(body, headers):
 # --- LAMBDA ROUTER ---
 
 def lambda_handler(event, context):
+    # Invocación programada (EventBridge) del job de snapshots
+    if event.get("action") == "STOCK_SNAPSHOT":
+        return handle_stock_snapshot_job(event)
+
     path = event.get("path", "")
     method = event.get("httpMethod", "")
     if method == "OPTIONS":
@@ -333,8 +902,28 @@ def lambda_handler(event, context):
             if segments[1] == "movements":
                 err = utils._require_admin(headers, "access_screen_stocks")
                 if err: return err
-                moves = utils._query_bucket("INVENTORY_MOVEMENT")
-                return utils._json_response(200, {"movements": moves})
+                if len(segments) > 2 and segments[2] == "backfill" and method == "POST":
+                    written = utils._backfill_movement_ledger()
+                    return utils._json_response(200, {"ok": True, "written": written})
+                return handle_list_movements(query)
+
+            # /stocks/snapshots (disparo manual del job) y /stocks/reconciliation
+            if segments[1] == "snapshots" and method == "POST":
+                err = utils._require_admin(headers, "stock_create")
+                if err: return err
+                return utils._json_response(200, handle_stock_snapshot_job())
+            if segments[1] == "allocate" and method == "POST":
+                err = utils._require_admin(headers, "access_screen_stocks")
+                if err: return err
+                return handle_allocate(body)
+            if segments[1] == "reorder-suggestions" and method == "GET":
+                err = utils._require_admin(headers, "access_screen_stocks")
+                if err: return err
+                return handle_reorder_suggestions(query)
+            if segments[1] == "reconciliation" and method == "GET":
+                err = utils._require_admin(headers, "access_screen_stocks")
+                if err: return err
+                return handle_stock_reconciliation(query)
 
             # /stocks/{id}/...
             sid = segments[1]
@@ -345,6 +934,11 @@ def lambda_handler(event, context):
                 return handle_stocks(method, body, sid)
 
             sub = segments[2]
+            if sub == "inventory" and method == "GET":
+                err = utils._require_admin(headers, "access_screen_stocks")
+                if err: return err
+                return handle_stock_inventory_at(sid, query)
+
             if sub == "entries" and method == "POST":
                 err = utils._require_admin(headers, "stock_add_inventory")
                 if err: return err
@@ -363,6 +957,10 @@ def lambda_handler(event, context):
 
         # /pos
         if root == "pos":
+            if segments[1] == "sales" and len(segments) > 2 and segments[2] == "batch" and method == "POST":
+                err = utils._require_admin(headers, "pos_register_sale")
+                if err: return err
+                return handle_pos_sales_batch(body, headers)
             if segments[1] == "sales":
                 err = utils._require_admin(headers, "pos_register_sale")
                 if err: return err
@@ -398,7 +996,9 @@ def lambda_handler(event, context):
 
         # /pickup-stocks
         if root == "pickup-stocks":
-            stocks = [s for s in utils._query_bucket("STOCK") if s.get("allowPickup")]
+            if len(segments) > 1 and segments[1] == "availability" and method == "POST":
+                return handle_pickup_availability(body)
+            stocks = [s for s in utils._get_stocks_cached() if s.get("allowPickup")]
             return utils._json_response(200, {"stocks": stocks})
 
         return utils._json_response(404, {"message": "Ruta de inventario no encontrada"})
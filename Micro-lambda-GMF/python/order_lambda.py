@@ -1,20 +1,18 @@
 import base64
 import json
 import boto3
-import urllib.error
 import urllib.parse
-import urllib.request
 import core_utils as utils  # Importado desde la Layer
+import http_client
+import stock_allocator
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from decimal import Decimal
 
 # Clientes de AWS
-sfn = boto3.client('stepfunctions')
 _s3 = boto3.client("s3", region_name=utils.AWS_REGION)
 
 # Configuración de Entorno
-ORDER_SFN_ARN = utils.os.getenv("ORDER_FULFILLMENT_SFN_ARN")
 ML_TOKEN = utils.os.getenv("MERCADOPAGO_ACCESS_TOKEN")
 BUCKET_NAME = utils.os.getenv("BUCKET_NAME", "findingu-ventas")
 
@@ -23,6 +21,18 @@ DEFAULT_ORDER_HISTORY_PAGE_SIZE = 10
 MAX_ORDER_HISTORY_PAGE_SIZE = 50        # clientes
 MAX_ADMIN_ORDER_PAGE_SIZE = 500         # admins
 
+# Webhooks de Mercado Pago: se confirman al persistir y un worker los procesa por lotes
+WEBHOOK_QUEUE_PK = "WEBHOOK_QUEUE#MP"
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_EVENT_TTL_SECONDS = 30 * 24 * 3600
+WEBHOOK_WORKER_BUDGET_SECONDS = 60
+WEBHOOK_WORKER_LEASE_SECONDS = 120
+_WEBHOOK_WORKER_LEASE_KEY = {"PK": f"{WEBHOOK_QUEUE_PK}#LEASE", "SK": "LEASE"}
+WEBHOOK_WORKER_ASYNC_INVOKE = utils.os.getenv("WEBHOOK_WORKER_ASYNC_INVOKE", "1") not in ("0", "false", "no")
+_ORDER_PAID_OR_LATER = {"paid", "shipped", "delivered", "refunded", "en_devolucion", "devuelto_validado", "devolucion_rechazada"}
+_lambda_client = None
+
 # ---------------------------------------------------------------------------
 # HELPERS DE LÓGICA DE NEGOCIO
 # ---------------------------------------------------------------------------
@@ -97,9 +107,42 @@ def _apply_stock_delta(stock_id: str, deltas: dict):
     return updated, None
 
 
+def _update_order_status_if_unchanged(order_id: str, order: dict, expression: str, values: dict, events=None):
+    """Aplica el cambio de estado solo si el pedido sigue en el estado leído.
+
+    Devuelve None si otro escritor ganó la carrera; así los deltas de KPI/rollup
+    se emiten una sola vez por transición.
+    """
+    prev_status = order.get("status")
+    values = dict(values)
+    if prev_status is None:
+        condition = "attribute_not_exists(#s)"
+    else:
+        condition = "#s = :prev_status"
+        values[":prev_status"] = prev_status
+    try:
+        return utils._update_by_id("ORDER", order_id, expression, values, {"#s": "status"},
+                                   events=events, condition=condition)
+    except utils.ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        reasons = e.response.get("CancellationReasons") or []
+        if code == "ConditionalCheckFailedException" or (
+            code == "TransactionCanceledException" and reasons and reasons[0].get("Code") == "ConditionalCheckFailed"
+        ):
+            return None
+        raise
+
+
+def _status_changed_response():
+    return utils._json_response(409, {
+        "message": "El pedido cambió de estado; vuelve a intentarlo.",
+        "code": "STATUS_CHANGED",
+    })
+
+
 def _log_inventory_movement(stock_id, movement_type, product_id, qty, reference_id, user_id, reason=""):
-    move_id = f"MOV-{utils.uuid.uuid4().hex[:12].upper()}"
-    return utils._put_entity("INVENTORY_MOVEMENT", move_id, {
+    move_id = utils._new_id("MOV-")
+    saved = utils._put_entity("INVENTORY_MOVEMENT", move_id, {
         "entityType": "inventoryMovement",
         "movementId": move_id,
         "stockId": stock_id,
@@ -111,7 +154,9 @@ def _log_inventory_movement(stock_id, movement_type, product_id, qty, reference_
         "userId": user_id,
         "reason": reason,
         "createdAt": utils._now_iso(),
-    })
+    }, unique=True)
+    utils._upsert_movement_ledger(saved)
+    return saved
 
 
 def _user_can_operate_pickup_stock(user_id, pickup_stock_id) -> bool:
@@ -124,8 +169,9 @@ def _user_can_operate_pickup_stock(user_id, pickup_stock_id) -> bool:
     return str(user_id) in linked_ids
 
 
-def _register_branch_sale_for_pickup_order(order: dict, user_id, now_iso: str, payment_method: str) -> str:
-    sale_id = f"SALE-{utils.uuid.uuid4().hex[:8].upper()}"
+def _register_branch_sale_for_pickup_order(order: dict, user_id, now_iso: str, payment_method: str,
+                                           sale_id: str = None) -> str:
+    sale_id = sale_id or utils._new_id("SALE-")
     pickup_stock_id = order.get("pickupStockId")
     sale_item = {
         "entityType": "posSale",
@@ -147,7 +193,8 @@ def _register_branch_sale_for_pickup_order(order: dict, user_id, now_iso: str, p
         "updatedAt": now_iso,
         "source": f"pickup_{payment_method}_payment",
     }
-    utils._put_entity("POS_SALE", sale_id, sale_item, created_at_iso=now_iso)
+    utils._put_entity("POS_SALE", sale_id, sale_item, created_at_iso=now_iso, unique=True)
+    utils._kpi_pos_sales([sale_item])
     return sale_id
 
 
@@ -390,10 +437,29 @@ def _void_commissions_for_order(order_id: str, reason: str) -> list:
     pk_month = "COMMISSION_MONTH"
     for beneficiary_id in beneficiaries:
         sk = f"#BENEFICIARY#{beneficiary_id}#MONTH#{month_key}"
-        resp = utils._table.get_item(Key={"PK": pk_month, "SK": sk})
-        item = resp.get("Item")
-        if not item:
+        voided = _void_commission_month_rows(pk_month, sk, order_id)
+        if not voided:
             continue
+        pending_delta, confirmed_delta = voided
+        out.append({
+            "action": "void", "beneficiaryId": beneficiary_id,
+            "orderId": order_id, "pendingRemoved": float(pending_delta),
+            "confirmedRemoved": float(confirmed_delta), "reason": reason,
+        })
+    utils._invalidate_customer_dashboards([row["beneficiaryId"] for row in out], "commissions_void")
+    return out
+
+
+def _void_commission_month_rows(pk_month: str, sk: str, order_id: str, attempts: int = 5):
+    """
+    Quita las filas de la orden de un mes contable; devuelve (pendiente, confirmado) retirados
+    o None si no había filas. La escritura está condicionada a ledgerVersion para no pisar
+    (ni ser pisada por) el flush del consumidor de comisiones.
+    """
+    for _ in range(attempts):
+        item = utils._table.get_item(Key={"PK": pk_month, "SK": sk}, ConsistentRead=True).get("Item")
+        if not item:
+            return None
 
         ledger = item.get("ledger") or []
         pending_delta = utils.D_ZERO
@@ -417,33 +483,46 @@ def _void_commissions_for_order(order_id: str, reason: str) -> list:
             new_ledger.append(row)
 
         if removed == 0:
-            continue
-
+            return None
+
+        version = item.get("ledgerVersion")
+        condition = "attribute_not_exists(ledgerVersion)" if version is None else "ledgerVersion = :v"
+        values = {
+            ":l": new_ledger, ":pd": pending_delta,
+            ":cd": confirmed_delta, ":bd": blocked_delta,
+            ":z": utils.D_ZERO, ":u": utils._now_iso(), ":one": 1,
+        }
+        if version is not None:
+            values[":v"] = version
         try:
-            utils._table.update_item(
+            updated = utils._table.update_item(
                 Key={"PK": pk_month, "SK": sk},
                 UpdateExpression=(
                     "SET ledger = :l, "
                     "totalPending = if_not_exists(totalPending, :z) - :pd, "
                     "totalConfirmed = if_not_exists(totalConfirmed, :z) - :cd, "
                     "totalBlocked = if_not_exists(totalBlocked, :z) - :bd, "
-                    "updatedAt = :u"
+                    "updatedAt = :u, "
+                    "ledgerVersion = if_not_exists(ledgerVersion, :z) + :one"
                 ),
-                ExpressionAttributeValues={
-                    ":l": new_ledger, ":pd": pending_delta,
-                    ":cd": confirmed_delta, ":bd": blocked_delta,
-                    ":z": utils.D_ZERO, ":u": utils._now_iso(),
-                },
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values,
+                ReturnValues="ALL_NEW",
             )
+        except utils.ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                continue
+            print(f"[VOID_COMM_ERROR] {e}")
+            return pending_delta, confirmed_delta
         except Exception as e:
             print(f"[VOID_COMM_ERROR] {e}")
-
-        out.append({
-            "action": "void", "beneficiaryId": beneficiary_id,
-            "orderId": order_id, "pendingRemoved": float(pending_delta),
-            "confirmedRemoved": float(confirmed_delta), "reason": reason,
-        })
-    return out
+            return pending_delta, confirmed_delta
+        utils._put_commission_month_index([updated.get("Attributes")])
+        utils._kpi_commission_month_change(item, updated.get("Attributes"))
+        return pending_delta, confirmed_delta
+    # Conflictos repetidos: el evento de la outbox de la orden completa la anulación
+    print(f"[VOID_COMM_CONFLICT] {sk} order={order_id}")
+    return None
 
 
 # ---------------------------------------------------------------------------
@@ -451,6 +530,12 @@ def _void_commissions_for_order(order_id: str, reason: str) -> list:
 # ---------------------------------------------------------------------------
 
 def handle_create_order(body, headers):
+    """POST /orders/create — con header Idempotency-Key los reintentos devuelven la misma orden."""
+    actor_id = utils._extract_actor(headers).get("user_id") or ""
+    return utils._with_idempotency(f"POST /orders#{actor_id}", headers, body, lambda: _create_order(body, headers))
+
+
+def _create_order(body, headers):
     """POST /orders/create"""
     customer_id = body.get("customerId")
     customer_name = body.get("customerName", "Cliente")
@@ -463,7 +548,7 @@ def handle_create_order(body, headers):
     # Enriquecer ítems con la bandera commissionable del catálogo
     enriched_items = _enrich_items_commissionable(raw_items)
     totals = _calculate_totals(enriched_items, customer_id, buyer_type)
-    order_id = f"ORD-{utils.uuid.uuid4().hex[:8].upper()}"
+    order_id = utils._new_id("ORD-")
     now = utils._now_iso()
 
     delivery_type = body.get("deliveryType", "delivery")
@@ -498,8 +583,10 @@ def handle_create_order(body, headers):
             pickup_payment = "online"
         order_item["pickupPaymentMethod"] = pickup_payment
 
-    utils._put_entity("ORDER", order_id, order_item)
+    utils._idempotency_mark_written()
+    utils._put_entity("ORDER", order_id, order_item, unique=True)
     utils._upsert_order_customer_history(order_item)
+    utils._kpi_orders_created([order_item])
     utils._audit_event("order.create", headers, body, {"orderId": order_id})
     return utils._json_response(201, {"order": order_item})
 
@@ -535,18 +622,15 @@ def handle_update_status(order_id, body, headers):
         "refunded": "ORDER_REFUNDED",
     }
 
-    sfn_action = action_map.get(new_status)
-    if sfn_action and ORDER_SFN_ARN:
-        try:
-            sfn.start_execution(
-                stateMachineArn=ORDER_SFN_ARN,
-                input=json.dumps({"orderId": order_id, "action": sfn_action, "payload": body}),
-            )
-        except Exception as e:
-            print(f"[SFN_ERROR] {e}")
+    event_action = action_map.get(new_status)
 
     extra_updates = {}
     now = utils._now_iso()
+    # Los efectos (venta de sucursal, movimientos) se escriben solo si gana el cambio de
+    # estado; el stock se descuenta antes para validar existencia y se devuelve si pierde
+    branch_sale = None
+    stock_taken = []
+    movements = []
     payment_method = (body.get("paymentMethod") or order.get("paymentMethod") or "").strip().lower()
     if payment_method and payment_method not in ("cash", "card", "transfer"):
         return utils._json_response(400, {"message": "Forma de pago invalida"})
@@ -558,7 +642,8 @@ def handle_update_status(order_id, body, headers):
     if new_status == "paid" and is_pickup_order and order.get("pickupPaymentMethod") == "at_store":
         extra_updates["paymentStatus"] = body.get("paymentStatus") or "paid_branch"
         if payment_method and not (order.get("cashSaleId") or order.get("branchSaleId")):
-            branch_sale_id = _register_branch_sale_for_pickup_order(order, actor_user_id, now, payment_method)
+            branch_sale_id = utils._new_id("SALE-")
+            branch_sale = (branch_sale_id, payment_method)
             extra_updates["branchSaleId"] = branch_sale_id
             if payment_method == "cash":
                 extra_updates["cashSaleId"] = branch_sale_id
@@ -575,19 +660,13 @@ def handle_update_status(order_id, body, headers):
                 _, stock_error = _apply_stock_delta(pickup_stock_id_str, deltas)
                 if stock_error:
                     return utils._json_response(400, {"message": stock_error})
+                stock_taken.append((pickup_stock_id_str, {pid: -delta for pid, delta in deltas.items()}))
                 for line in order.get("items") or []:
                     qty = int(line.get("quantity") or line.get("qty") or 0)
                     if qty <= 0:
                         continue
-                    _log_inventory_movement(
-                        pickup_stock_id_str,
-                        "exit_order",
-                        line.get("productId"),
-                        qty,
-                        order_id,
-                        actor_user_id,
-                        f"Entrega pickup orden {order_id}",
-                    )
+                    movements.append((pickup_stock_id_str, line.get("productId"), qty, actor_user_id,
+                                      f"Entrega pickup orden {order_id}"))
                 extra_updates["pickupStockDeductedAt"] = now
     if new_status == "devolucion_rechazada":
         rejection_reason = (body.get("rejectionReason") or "").strip()
@@ -608,27 +687,49 @@ def handle_update_status(order_id, body, headers):
         # Procesar salida de inventario si se proveen dispatchLines
         dispatch_lines = body.get("dispatchLines") or []
         stock_id_for_dispatch = body.get("stockId")
+        try:
+            dispatch_needs = stock_allocator.normalize_lines(dispatch_lines)
+        except ValueError as e:
+            return utils._json_response(400, {"message": str(e)})
+        dispatch_plan = []
         if dispatch_lines and stock_id_for_dispatch:
-            deltas = {}
-            for line in dispatch_lines:
-                pid = str(line.get("productId", ""))
-                qty = int(line.get("quantity") or line.get("qty") or 0)
-                if pid and qty > 0:
-                    deltas[pid] = deltas.get(pid, 0) - qty
-            if deltas:
-                stock = utils._get_by_id("STOCK", stock_id_for_dispatch)
-                if stock:
-                    inventory = {str(k): int(v) for k, v in (stock.get("inventory") or {}).items()}
-                    for pid, delta in deltas.items():
-                        inventory[pid] = max(0, inventory.get(pid, 0) + delta)
-                    utils._update_by_id(
-                        "STOCK", stock_id_for_dispatch,
-                        "SET inventory = :inv, updatedAt = :u",
-                        {":inv": inventory, ":u": now},
-                    )
-                    user_id = actor_user_id or body.get("attendantUserId")
-                    for pid, delta in deltas.items():
-                        _log_inventory_movement(stock_id_for_dispatch, "exit_order", pid, abs(delta), order_id, user_id, f"Despacho orden {order_id}")
+            dispatch_plan = [(stock_id_for_dispatch, dispatch_needs)]
+        elif dispatch_lines:
+            # Sin almacén indicado: el asignador elige el almacén (o conjunto mínimo) que surte la orden
+            allocation = stock_allocator.allocate(
+                dispatch_lines, utils._get_stocks_cached(force=True), order.get("postalCode")
+            )
+            if not allocation["fulfillable"]:
+                return utils._json_response(400, {
+                    "message": "Ningún almacén (o combinación) tiene existencia suficiente",
+                    "unfulfilled": allocation["unfulfilled"],
+                })
+            dispatch_plan = [
+                (a["stockId"], {line["productId"]: line["qty"] for line in a["lines"]})
+                for a in allocation["allocations"]
+            ]
+            if dispatch_plan:
+                extra_updates["stockId"] = dispatch_plan[0][0]
+                extra_updates["fulfillmentAllocation"] = allocation["allocations"]
+        user_id = actor_user_id or body.get("attendantUserId")
+        for dispatch_stock_id, quantities in dispatch_plan:
+            stock = utils._get_by_id("STOCK", dispatch_stock_id)
+            if not stock or not quantities:
+                continue
+            inventory = {str(k): int(v) for k, v in (stock.get("inventory") or {}).items()}
+            taken = {}
+            for pid, qty in quantities.items():
+                current = inventory.get(pid, 0)
+                inventory[pid] = max(0, current - qty)
+                taken[pid] = current - inventory[pid]
+            utils._update_by_id(
+                "STOCK", dispatch_stock_id,
+                "SET inventory = :inv, updatedAt = :u",
+                {":inv": inventory, ":u": now},
+            )
+            stock_taken.append((dispatch_stock_id, taken))
+            for pid, qty in quantities.items():
+                movements.append((dispatch_stock_id, pid, qty, user_id, f"Despacho orden {order_id}"))
 
     update_expr = "SET #s = :s, updatedAt = :u"
     eav = {":s": new_status, ":u": now}
@@ -637,8 +738,24 @@ def handle_update_status(order_id, body, headers):
         update_expr += f", {safe_key} = :{safe_key}"
         eav[f":{safe_key}"] = v
 
-    updated = utils._update_by_id("ORDER", order_id, update_expr, eav, {"#s": "status"})
+    # El evento para comisiones va en la misma transacción que el cambio de estado
+    events = [utils._order_event_item(order_id, event_action)] if event_action else None
+    updated = _update_order_status_if_unchanged(order_id, order, update_expr, eav, events=events)
+    if updated is None:
+        # Perdió la carrera: devolver el stock descontado; el escritor ganador ya hizo lo suyo
+        for stock_id, taken in stock_taken:
+            if any(taken.values()):
+                _apply_stock_delta(stock_id, taken)
+        return _status_changed_response()
+    if branch_sale:
+        _register_branch_sale_for_pickup_order(order, actor_user_id, now, branch_sale[1], sale_id=branch_sale[0])
+    for stock_id, product_id, qty, user_id, reason in movements:
+        _log_inventory_movement(stock_id, "exit_order", product_id, qty, order_id, user_id, reason)
     utils._upsert_order_customer_history(updated)
+    utils._kpi_order_status_change(order.get("status"), new_status)
+    utils._sales_rollup_order_status_change(updated, order.get("status"), new_status)
+    if events:
+        utils._kick_order_events_worker()
     return utils._json_response(200, {"order": updated})
 
 
@@ -694,48 +811,47 @@ def handle_mercadopago_checkout(order_id, body):
     if notification_url:
         mp_payload["notification_url"] = notification_url
 
-    headers = {"Authorization": f"Bearer {ML_TOKEN}", "Content-Type": "application/json"}
-    
-    req = urllib.request.Request(
-        "https://api.mercadopago.com/checkout/preferences",
-        data=json.dumps(mp_payload, default=utils._json_default).encode(), 
-        headers=headers,
-        method="POST"
-    )
+    headers = {"Authorization": f"Bearer {ML_TOKEN}"}
     
     try:
-        with urllib.request.urlopen(req) as res:
-            result = json.loads(res.read().decode())
-            # Actualizar orden con datos del proveedor
-            utils._update_by_id(
-                "ORDER", order_id, 
-                "SET paymentProvider = :pp, paymentPreferenceId = :id, paymentInitPoint = :ip", 
-                {
-                    ":pp": "mercadolibre", 
-                    ":id": result["id"], 
-                    ":ip": result.get("init_point")
-                }
-            )
-            preference_id = result["id"]
-            init_point = result.get("init_point")
-            sandbox_init_point = result.get("sandbox_init_point")
-            return utils._json_response(200, {
-                "orderId": order_id,
-                "checkout": {
-                    "provider": "mercadolibre",
-                    "preferenceId": preference_id,
-                    "initPoint": init_point,
-                    "sandboxInitPoint": sandbox_init_point,
-                    "externalReference": order_id,
-                },
+        # Crear la preferencia no es idempotente: sin reintentos
+        result = http_client.request_json(
+            "POST",
+            "https://api.mercadopago.com/checkout/preferences",
+            headers=headers,
+            json_body=mp_payload,
+            json_default=utils._json_default,
+        )
+        # Actualizar orden con datos del proveedor
+        utils._update_by_id(
+            "ORDER", order_id, 
+            "SET paymentProvider = :pp, paymentPreferenceId = :id, paymentInitPoint = :ip", 
+            {
+                ":pp": "mercadolibre", 
+                ":id": result["id"], 
+                ":ip": result.get("init_point")
+            }
+        )
+        preference_id = result["id"]
+        init_point = result.get("init_point")
+        sandbox_init_point = result.get("sandbox_init_point")
+        return utils._json_response(200, {
+            "orderId": order_id,
+            "checkout": {
+                "provider": "mercadolibre",
                 "preferenceId": preference_id,
-                "init_point": init_point,
-                "sandbox_init_point": sandbox_init_point,
-            })
-            
-    except urllib.error.HTTPError as exc:
-        err_msg = exc.read().decode()
-        print(f"[Checkout] HTTPError {exc.code}: {err_msg}")
+                "initPoint": init_point,
+                "sandboxInitPoint": sandbox_init_point,
+                "externalReference": order_id,
+            },
+            "preferenceId": preference_id,
+            "init_point": init_point,
+            "sandbox_init_point": sandbox_init_point,
+        })
+        
+    except http_client.HttpError as exc:
+        err_msg = exc.text()
+        print(f"[Checkout] HTTPError {exc.status}: {err_msg}")
         return utils._json_response(502, {"message": "Error al comunicarse con Mercado Libre", "provider_error": err_msg})
     except Exception as e:
         print(f"[Checkout] Error: {e}")
@@ -781,26 +897,20 @@ def handle_cancel_order(order_id: str, body: dict, headers: dict) -> dict:
     # Órdenes pagadas generan reembolso pendiente; las pendientes no (pago no confirmado)
     pending_refund = current_status == "paid"
 
-    updated_order = utils._update_by_id(
-        "ORDER", order_id,
+    updated_order = _update_order_status_if_unchanged(
+        order_id, order,
         "SET #s = :s, cancelReason = :r, pendingRefund = :pr, cancelledAt = :ca, updatedAt = :u",
         {":s": "cancelled", ":r": reason, ":pr": pending_refund, ":ca": now, ":u": now},
-        {"#s": "status"},
+        events=[utils._order_event_item(order_id, "ORDER_CANCELLED")],
     )
+    if updated_order is None:
+        return _status_changed_response()
     utils._upsert_order_customer_history(updated_order)
+    utils._kpi_order_status_change(current_status, "cancelled")
 
     # Void commissions solo si había pago confirmado
     commission_actions = _void_commissions_for_order(order_id, reason="cancel") if pending_refund else []
-
-    # Trigger Step Functions (notify admin, etc.)
-    if ORDER_SFN_ARN:
-        try:
-            sfn.start_execution(
-                stateMachineArn=ORDER_SFN_ARN,
-                input=json.dumps({"orderId": order_id, "action": "ORDER_CANCELLED", "payload": body}),
-            )
-        except Exception as e:
-            print(f"[SFN_CANCEL_ERROR] {e}")
+    utils._kick_order_events_worker()
 
     utils._audit_event("order.cancel", headers, body, {"orderId": order_id, "reason": reason, "previousStatus": current_status})
 
@@ -952,16 +1062,19 @@ def handle_return_request(order_id: str, body: dict, headers: dict) -> dict:
         "createdAt": now,
         "updatedAt": now,
     }
-    utils._put_entity("RETURN_REQUEST", request_id, return_item, created_at_iso=now)
 
-    # Actualizar orden → EN_DEVOLUCION
-    updated_order = utils._update_by_id(
-        "ORDER", order_id,
+    # Actualizar orden → EN_DEVOLUCION antes de registrar la solicitud: si otro
+    # escritor cambió el estado no queda una solicitud huérfana
+    updated_order = _update_order_status_if_unchanged(
+        order_id, order,
         "SET #s = :s, returnRequestId = :rid, updatedAt = :u",
         {":s": "en_devolucion", ":rid": request_id, ":u": now},
-        {"#s": "status"},
     )
+    if updated_order is None:
+        return _status_changed_response()
+    utils._put_entity("RETURN_REQUEST", request_id, return_item, created_at_iso=now)
     utils._upsert_order_customer_history(updated_order)
+    utils._kpi_order_status_change(current_status, "en_devolucion")
 
     utils._audit_event("order.return_request", headers, body,
                        {"orderId": order_id, "requestId": request_id, "motivo": motivo})
@@ -1057,13 +1170,6 @@ def handle_return_inspection(order_id: str, body: dict, headers: dict) -> dict:
     # Motivo de rechazo opcional (cuando admin rechaza desde devuelto_validado)
     rejection_reason = (body.get("rejectionReason") or "").strip()
 
-    utils._update_by_id(
-        "RETURN_REQUEST", request_id,
-        "SET #s = :s, inspection = :i, inspectedAt = :ia, inspectedBy = :ib, updatedAt = :u",
-        {":s": new_return_status, ":i": inspection_record, ":ia": now, ":ib": actor, ":u": now},
-        {"#s": "status"},
-    )
-
     order_update_expr = "SET #s = :s, updatedAt = :u"
     order_eav = {":s": new_order_status, ":u": now}
     if not approved and rejection_reason:
@@ -1071,14 +1177,25 @@ def handle_return_inspection(order_id: str, body: dict, headers: dict) -> dict:
         order_eav[":rr"] = rejection_reason
         order_eav[":ra"] = now
 
-    updated_order = utils._update_by_id(
-        "ORDER", order_id, order_update_expr, order_eav, {"#s": "status"},
+    # La devolución aprobada también va a la outbox: el consumidor anula las filas que un
+    # ORDER_PAID aún pendiente de consumir crearía después de la anulación en línea
+    events = [utils._order_event_item(order_id, "ORDER_RETURNED")] if approved else None
+    updated_order = _update_order_status_if_unchanged(order_id, order, order_update_expr, order_eav, events=events)
+    if updated_order is None:
+        return _status_changed_response()
+    utils._update_by_id(
+        "RETURN_REQUEST", request_id,
+        "SET #s = :s, inspection = :i, inspectedAt = :ia, inspectedBy = :ib, updatedAt = :u",
+        {":s": new_return_status, ":i": inspection_record, ":ia": now, ":ib": actor, ":u": now},
+        {"#s": "status"},
     )
     utils._upsert_order_customer_history(updated_order)
+    utils._kpi_order_status_change(order.get("status"), new_order_status)
 
     commission_actions = []
     if approved:
         commission_actions = _void_commissions_for_order(order_id, reason="return_approved")
+        utils._kick_order_events_worker()
 
     utils._audit_event("order.return_inspected", headers, body, {
         "orderId": order_id, "requestId": request_id, "approved": approved,
@@ -1140,9 +1257,16 @@ def handle_refund_order(order_id: str, body: dict, headers: dict) -> dict:
         update_expr += ", refundReceiptUrl = :rru"
         eav[":rru"] = refund_receipt_url
 
-    updated_order = utils._update_by_id("ORDER", order_id, update_expr, eav, {"#s": "status"})
+    updated_order = _update_order_status_if_unchanged(
+        order_id, order, update_expr, eav, events=[utils._order_event_item(order_id, "ORDER_REFUNDED")],
+    )
+    if updated_order is None:
+        return _status_changed_response()
     utils._upsert_order_customer_history(updated_order)
+    utils._kpi_order_status_change(current_status, "refunded")
+    utils._sales_rollup_order_status_change(updated_order, current_status, "refunded")
     actions = _void_commissions_for_order(order_id, reason="refund")
+    utils._kick_order_events_worker()
     utils._audit_event("order.refund", headers, body, {"orderId": order_id})
     return utils._json_response(200, {
         "orderId": order_id,
@@ -1152,31 +1276,279 @@ def handle_refund_order(order_id: str, body: dict, headers: dict) -> dict:
     })
 
 
-def handle_mp_webhook(query, body):
-    """POST /webhooks/mercadolibre"""
+def _webhook_event_key(payment_id) -> dict:
+    return {"PK": f"WEBHOOK_EVENT#{payment_id}", "SK": "MP"}
+
+
+def _enqueue_mp_webhook_event(payment_id: str, topic: str) -> dict:
+    """
+    Registra la notificación (dedupe por pago) y deja un puntero en la cola.
+    El puntero se llama igual que el pago: notificaciones repetidas se coalescen en uno solo.
+    Ambas escrituras son idempotentes, así que un reintento de MP tras un error es seguro.
+    """
+    now = utils._now_iso()
+    ttl = utils._ttl_epoch(WEBHOOK_EVENT_TTL_SECONDS)
+    event = utils._table.update_item(
+        Key=_webhook_event_key(payment_id),
+        UpdateExpression=(
+            "SET #s = :pending, paymentId = :pid, topic = :topic, lastReceivedAt = :now, #ttl = :ttl, "
+            "firstReceivedAt = if_not_exists(firstReceivedAt, :now), "
+            "notifications = if_not_exists(notifications, :zero) + :one"
+        ),
+        ExpressionAttributeNames={"#s": "status", "#ttl": "ttl"},
+        ExpressionAttributeValues={
+            ":pending": "pending", ":pid": payment_id, ":topic": topic, ":now": now,
+            ":ttl": ttl, ":zero": 0, ":one": 1,
+        },
+        ReturnValues="ALL_NEW",
+    ).get("Attributes") or {}
+    utils._table.put_item(Item={
+        "PK": WEBHOOK_QUEUE_PK,
+        "SK": payment_id,
+        "paymentId": payment_id,
+        "lastReceivedAt": now,
+        "ttl": ttl,
+    })
+    return event
+
+
+def _kick_webhook_worker(context) -> None:
+    """Dispara el worker de forma asíncrona; si falla, lo recoge el job programado."""
+    global _lambda_client
+    function_name = utils.os.getenv("WEBHOOK_WORKER_FUNCTION") or getattr(context, "function_name", None)
+    if not WEBHOOK_WORKER_ASYNC_INVOKE or not function_name:
+        return
+    try:
+        if _lambda_client is None:
+            _lambda_client = boto3.client("lambda", region_name=utils.AWS_REGION)
+        _lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType="Event",
+            Payload=json.dumps({"action": "PROCESS_WEBHOOK_EVENTS"}).encode(),
+        )
+    except Exception as e:
+        print(f"[mp-webhook] No se pudo disparar el worker: {e}")
+
+
+def handle_mp_webhook(query, body, context=None):
+    """POST /webhooks/mercadolibre — solo persiste y confirma; el pago se procesa en el worker."""
     topic = query.get("topic") or body.get("type")
-    resource_id = query.get("id") or body.get("data", {}).get("id")
+    resource_id = query.get("id") or (body.get("data") or {}).get("id")
 
     if topic == "payment" and resource_id:
-        req = urllib.request.Request(
-            f"https://api.mercadopago.com/v1/payments/{resource_id}",
-            headers={"Authorization": f"Bearer {ML_TOKEN}"},
-        )
-        with urllib.request.urlopen(req) as res:
-            payment_info = json.loads(res.read().decode())
-        status = payment_info.get("status")
-        order_id = payment_info.get("external_reference")
-        if status == "approved" and order_id:
-            return handle_update_status(order_id, {"status": "paid", "paymentId": resource_id}, {})
+        payment_id = str(resource_id).strip()
+        event = _enqueue_mp_webhook_event(payment_id, topic)
+        _kick_webhook_worker(context)
+        return utils._json_response(200, {
+            "ok": True,
+            "queued": True,
+            "paymentId": payment_id,
+            "notifications": int(event.get("notifications") or 1),
+        })
 
     return utils._json_response(200, {"ok": True})
 
 
+def _fetch_mp_payment(payment_id: str) -> dict:
+    return http_client.request_json(
+        "GET",
+        f"https://api.mercadopago.com/v1/payments/{urllib.parse.quote(str(payment_id), safe='')}",
+        headers={"Authorization": f"Bearer {ML_TOKEN}"},
+    )
+
+
+def _apply_mp_payment(payment_id: str, payment_info: dict) -> dict:
+    """Aplica un pago ya consultado a su orden. Idempotente: no repite el paso a `paid`."""
+    status = payment_info.get("status")
+    order_id = payment_info.get("external_reference")
+    outcome = {"paymentStatus": status, "orderId": order_id, "result": "ignored"}
+    if status != "approved" or not order_id:
+        return outcome
+    order = utils._get_by_id("ORDER", order_id)
+    if not order:
+        outcome["result"] = "order_not_found"
+        return outcome
+    if str(order.get("status") or "").lower() in _ORDER_PAID_OR_LATER:
+        outcome["result"] = "already_paid"
+        return outcome
+    res = handle_update_status(order_id, {"status": "paid", "paymentId": payment_id}, {})
+    code = int(res.get("statusCode") or 500)
+    if code == 409:
+        # Otra notificación (u operador) cambió el estado entre la lectura y la escritura
+        current = utils._get_by_id("ORDER", order_id) or {}
+        if str(current.get("status") or "").lower() in _ORDER_PAID_OR_LATER:
+            outcome["result"] = "already_paid"
+            return outcome
+    outcome["result"] = "paid" if code < 300 else f"rejected_{code}"
+    if code >= 300:
+        outcome["error"] = json.loads(res.get("body") or "{}").get("message")
+    return outcome
+
+
+def _finish_webhook_pointer(pointer: dict) -> bool:
+    """Borra el puntero solo si no llegó otra notificación mientras se procesaba."""
+    try:
+        utils._table.delete_item(
+            Key={"PK": WEBHOOK_QUEUE_PK, "SK": pointer["SK"]},
+            ConditionExpression="lastReceivedAt = :seen",
+            ExpressionAttributeValues={":seen": pointer.get("lastReceivedAt")},
+        )
+        return True
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+def _process_webhook_batch(pointers: list) -> dict:
+    events = {
+        str(item.get("paymentId")): item
+        for item in utils._batch_get_items([_webhook_event_key(p["paymentId"]) for p in pointers])
+    }
+    summary = {"payments": len(pointers), "processed": 0, "retrying": 0, "failed": 0, "requeued": 0}
+
+    # Una consulta a MP por pago, en paralelo
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=min(8, max(1, len(pointers)))) as executor:
+        futures = {executor.submit(_fetch_mp_payment, p["paymentId"]): p["paymentId"] for p in pointers}
+        for future in as_completed(futures):
+            payment_id = futures[future]
+            try:
+                fetched[payment_id] = (future.result(), None)
+            except Exception as e:
+                fetched[payment_id] = (None, str(e))
+
+    for pointer in pointers:
+        payment_id = pointer["paymentId"]
+        payment_info, fetch_error = fetched[payment_id]
+        now = utils._now_iso()
+        if fetch_error is not None:
+            attempts = int((events.get(payment_id) or {}).get("attempts") or 0) + 1
+            final = attempts >= WEBHOOK_MAX_ATTEMPTS
+            utils._table.update_item(
+                Key=_webhook_event_key(payment_id),
+                UpdateExpression="SET attempts = :a, lastError = :e, #s = :s, updatedAt = :now",
+                ExpressionAttributeNames={"#s": "status"},
+                ExpressionAttributeValues={":a": attempts, ":e": fetch_error, ":s": "failed" if final else "pending", ":now": now},
+            )
+            if final:
+                _finish_webhook_pointer(pointer)
+                summary["failed"] += 1
+            else:
+                summary["retrying"] += 1
+            continue
+
+        outcome = _apply_mp_payment(payment_id, payment_info)
+        failed = outcome["result"].startswith("rejected_")
+        values = {
+            ":s": "failed" if failed else "processed",
+            ":ps": outcome.get("paymentStatus") or "",
+            ":oid": outcome.get("orderId") or "",
+            ":r": outcome["result"],
+            ":now": now,
+            ":zero": 0,
+        }
+        utils._table.update_item(
+            Key=_webhook_event_key(payment_id),
+            UpdateExpression="SET #s = :s, paymentStatus = :ps, orderId = :oid, #r = :r, processedAt = :now, attempts = :zero",
+            ExpressionAttributeNames={"#s": "status", "#r": "result"},
+            ExpressionAttributeValues=values,
+        )
+        if _finish_webhook_pointer(pointer):
+            summary["failed" if failed else "processed"] += 1
+        else:
+            summary["requeued"] += 1
+    return summary
+
+
+def _acquire_webhook_worker_lease(owner: str) -> bool:
+    """Un solo worker a la vez: dos workers consultarían y aplicarían el mismo pago."""
+    now_epoch = int(utils.time.time())
+    try:
+        utils._table.put_item(
+            Item={**_WEBHOOK_WORKER_LEASE_KEY, "owner": owner, "leaseUntil": now_epoch + WEBHOOK_WORKER_LEASE_SECONDS,
+                  "ttl": now_epoch + WEBHOOK_WORKER_LEASE_SECONDS * 10},
+            ConditionExpression="attribute_not_exists(PK) OR leaseUntil < :now OR #o = :owner",
+            ExpressionAttributeNames={"#o": "owner"},
+            ExpressionAttributeValues={":now": now_epoch, ":owner": owner},
+        )
+        return True
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+def _release_webhook_worker_lease(owner: str) -> None:
+    try:
+        utils._table.delete_item(
+            Key=_WEBHOOK_WORKER_LEASE_KEY,
+            ConditionExpression="#o = :owner",
+            ExpressionAttributeNames={"#o": "owner"},
+            ExpressionAttributeValues={":owner": owner},
+        )
+    except utils.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+
+
+def handle_process_webhook_events(context=None) -> dict:
+    """
+    Worker: lee la cola por lotes, consulta cada pago una vez y lo aplica.
+    Lo invoca el propio webhook (asíncrono) o EventBridge con {"action": "PROCESS_WEBHOOK_EVENTS"}.
+    Recorre la cola paginando; al terminar una pasada con pagos nuevos vuelve al inicio para
+    recoger los punteros que llegaron detrás del cursor (el SK es el id del pago, no la hora).
+    """
+    owner = utils.uuid.uuid4().hex
+    if not _acquire_webhook_worker_lease(owner):
+        return utils._json_response(200, {"status": "BUSY"})
+    started = utils.time.monotonic()
+    totals = {"batches": 0, "payments": 0, "processed": 0, "retrying": 0, "failed": 0, "requeued": 0}
+    # (pago, lastReceivedAt): un reintento no se repite en la misma ejecución, una notificación nueva sí
+    seen = set()
+    try:
+        query = {"KeyConditionExpression": utils.Key("PK").eq(WEBHOOK_QUEUE_PK), "Limit": WEBHOOK_BATCH_SIZE}
+        fresh_in_pass = False
+        while utils.time.monotonic() - started < WEBHOOK_WORKER_BUDGET_SECONDS:
+            if context is not None and context.get_remaining_time_in_millis() < 15000:
+                break
+            resp = utils._table.query(**query)
+            pointers = [
+                p for p in resp.get("Items", [])
+                if p.get("paymentId") and (p["paymentId"], p.get("lastReceivedAt")) not in seen
+            ]
+            if pointers:
+                fresh_in_pass = True
+                seen.update((p["paymentId"], p.get("lastReceivedAt")) for p in pointers)
+                summary = _process_webhook_batch(pointers)
+                totals["batches"] += 1
+                for key in ("payments", "processed", "retrying", "failed", "requeued"):
+                    totals[key] += summary[key]
+                if not _acquire_webhook_worker_lease(owner):  # renueva el lease entre lotes
+                    print("[mp-webhook-worker] Lease perdido; se detiene")
+                    break
+            lek = resp.get("LastEvaluatedKey")
+            if lek:
+                query["ExclusiveStartKey"] = lek
+                continue
+            if not fresh_in_pass:
+                break
+            query.pop("ExclusiveStartKey", None)
+            fresh_in_pass = False
+    finally:
+        _release_webhook_worker_lease(owner)
+    print(f"[mp-webhook-worker] {json.dumps(totals)}")
+    return utils._json_response(200, totals)
+
+
 # ---------------------------------------------------------------------------
 # LAMBDA ROUTER
 # ---------------------------------------------------------------------------
 
 def lambda_handler(event, context):
+    if event.get("action") == "PROCESS_WEBHOOK_EVENTS":
+        return handle_process_webhook_events(context)
+
     path = event.get("path", "")
     method = event.get("httpMethod", "")
     if method == "OPTIONS":
@@ -1188,7 +1560,7 @@ def lambda_handler(event, context):
     print(segments)
     try:
         if "webhooks" in segments:
-            return handle_mp_webhook(query, body)
+            return handle_mp_webhook(query, body, context)
 
         if "orders" in segments:
             # /orders (legacy alias) and /orders/find
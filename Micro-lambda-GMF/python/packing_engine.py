@@ -0,0 +1,244 @@
+"""
+Empaquetado 3D para cotizaciones de envío.
+
+First-fit-decreasing con puntos extremos (extreme points): cada caja abierta mantiene los
+puntos donde puede apoyarse la siguiente pieza; se prueban las 6 orientaciones de cada
+unidad, se respeta el peso máximo por tipo de caja y, al final, cada caja se intenta
+reducir al tipo más chico que contenga lo mismo.
+
+Las unidades idénticas (mismas medidas/peso) se agrupan: los pedidos de mayoreo llenan cajas
+completas en rejilla con el tipo más denso, y en la fase de puntos extremos, si una unidad no
+cupo en una caja, el resto del grupo ya no la intenta. Se evalúa con y sin la fase de rejilla y
+gana la que use menos cajas. Lógica pura: no accede a red ni a DynamoDB.
+"""
+from itertools import permutations
+from typing import Dict, List, Optional, Tuple
+
+# Catálogo por defecto (Largo, Ancho, Alto en cm; peso máximo en kg)
+DEFAULT_BOX_CATALOG = [
+    {"name": "Chica", "lengthCm": 25.0, "widthCm": 17.0, "heightCm": 28.0, "maxWeightKg": 20.0},
+    {"name": "Mediana", "lengthCm": 40.0, "widthCm": 29.0, "heightCm": 20.0, "maxWeightKg": 25.0},
+    {"name": "Grande", "lengthCm": 35.0, "widthCm": 23.0, "heightCm": 30.0, "maxWeightKg": 30.0},
+]
+
+_EPS = 1e-6
+
+
+def box_catalog(ship_cfg: Optional[dict]) -> List[dict]:
+    """Catálogo desde `config.shipping.boxes` (mismo formato que DEFAULT_BOX_CATALOG), ordenado por volumen."""
+    raw = (ship_cfg or {}).get("boxes") or DEFAULT_BOX_CATALOG
+    boxes = []
+    for idx, box in enumerate(raw):
+        try:
+            dims = (float(box["lengthCm"]), float(box["widthCm"]), float(box["heightCm"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if min(dims) <= 0:
+            continue
+        max_weight = box.get("maxWeightKg")
+        boxes.append({
+            "name": str(box.get("name") or f"box-{idx}"),
+            "dims": dims,
+            "volume": dims[0] * dims[1] * dims[2],
+            "maxWeight": float(max_weight) if max_weight not in (None, "") else float("inf"),
+        })
+    boxes.sort(key=lambda b: b["volume"])
+    return boxes or box_catalog({"boxes": DEFAULT_BOX_CATALOG})
+
+
+def _orientations(dims: Tuple[float, float, float]) -> List[Tuple[float, float, float]]:
+    return list(dict.fromkeys(permutations(dims)))
+
+
+def _fits_box(dims, box) -> bool:
+    return all(a <= b + _EPS for a, b in zip(sorted(dims), sorted(box["dims"])))
+
+
+class _OpenBox:
+    __slots__ = ("box", "placed", "points", "weight", "volume", "units")
+
+    def __init__(self, box: dict):
+        self.box = box
+        self.placed: List[Tuple[float, float, float, float, float, float]] = []
+        self.points: List[Tuple[float, float, float]] = [(0.0, 0.0, 0.0)]
+        self.weight = 0.0
+        self.volume = 0.0
+        self.units: List[int] = []
+
+    def _collides(self, x, y, z, l, w, h) -> bool:
+        for px, py, pz, pl, pw, ph in self.placed:
+            if x < px + pl - _EPS and px < x + l - _EPS and \
+               y < py + pw - _EPS and py < y + w - _EPS and \
+               z < pz + ph - _EPS and pz < z + h - _EPS:
+                return True
+        return False
+
+    def try_place(self, unit_id: int, dims, weight: float, orientations) -> bool:
+        if self.weight + weight > self.box["maxWeight"] + _EPS:
+            return False
+        if self.volume + dims[0] * dims[1] * dims[2] > self.box["volume"] + _EPS:
+            return False
+        bl, bw, bh = self.box["dims"]
+        best = None
+        for x, y, z in self.points:
+            for l, w, h in orientations:
+                if x + l > bl + _EPS or y + w > bw + _EPS or z + h > bh + _EPS:
+                    continue
+                # Colocación más baja, luego la que menos crece hacia el fondo/lado
+                score = (z + h, y + w, x + l)
+                if best is not None and score >= best[0]:
+                    continue
+                if self._collides(x, y, z, l, w, h):
+                    continue
+                best = (score, (x, y, z), (l, w, h))
+        if best is None:
+            return False
+        _, (x, y, z), (l, w, h) = best
+        self.placed.append((x, y, z, l, w, h))
+        self.points.remove((x, y, z))
+        for point in ((x + l, y, z), (x, y + w, z), (x, y, z + h)):
+            if point[0] < bl - _EPS and point[1] < bw - _EPS and point[2] < bh - _EPS and point not in self.points:
+                self.points.append(point)
+        self.weight += weight
+        self.volume += l * w * h
+        self.units.append(unit_id)
+        return True
+
+
+def _expand(raw_items) -> Tuple[List[Tuple[Tuple[float, float, float], float]], List[int]]:
+    """Unidades (dims, peso) y el grupo (SKU físico) al que pertenece cada una."""
+    units: List[Tuple[Tuple[float, float, float], float]] = []
+    groups: List[int] = []
+    group_ids: Dict[Tuple, int] = {}
+    for item in raw_items or []:
+        qty = max(1, int(item.get("quantity") or 1))
+        dims = (
+            max(0.1, float(item.get("lengthCm") or 10)),
+            max(0.1, float(item.get("widthCm") or 10)),
+            max(0.1, float(item.get("heightCm") or 10)),
+        )
+        weight = max(0.05, float(item.get("weightKg") or 0.5))
+        gid = group_ids.setdefault((tuple(sorted(dims)), weight), len(group_ids))
+        units.extend([(dims, weight)] * qty)
+        groups.extend([gid] * qty)
+    return units, groups
+
+
+def _grid_capacity(dims, weight: float, box: dict) -> int:
+    """Unidades idénticas que caben acomodadas en rejilla (mejor orientación), limitadas por peso."""
+    bl, bw, bh = box["dims"]
+    best = 0
+    for l, w, h in _orientations(dims):
+        best = max(best, int((bl + _EPS) // l) * int((bw + _EPS) // w) * int((bh + _EPS) // h))
+    if weight > 0 and box["maxWeight"] != float("inf"):
+        best = min(best, int((box["maxWeight"] + _EPS) // weight))
+    return best
+
+
+def _fill(unit_ids: List[int], units, box: dict) -> Optional[_OpenBox]:
+    """Intenta meter exactamente estas unidades en una caja del tipo `box`."""
+    target = _OpenBox(box)
+    for uid in unit_ids:
+        dims, weight = units[uid]
+        if not target.try_place(uid, dims, weight, _orientations(dims)):
+            return None
+    return target
+
+
+def _pack_units(units, groups, catalog: List[dict], use_grid: bool) -> Tuple[List[_OpenBox], List[int]]:
+    # 1) Grupos grandes de unidades idénticas: cajas llenas en rejilla con el tipo más denso
+    full_boxes: List[_OpenBox] = []
+    pending: List[int] = []
+    by_group: Dict[int, List[int]] = {}
+    for uid, gid in enumerate(groups):
+        by_group.setdefault(gid, []).append(uid)
+    for gid, members in by_group.items():
+        if not use_grid:
+            pending.extend(members)
+            continue
+        dims, weight = units[members[0]]
+        unit_volume = dims[0] * dims[1] * dims[2]
+        best_box, best_cap = None, 0
+        for box in catalog:
+            cap = _grid_capacity(dims, weight, box)
+            if cap and (best_box is None or cap * unit_volume / box["volume"] > best_cap * unit_volume / best_box["volume"]):
+                best_box, best_cap = box, cap
+        full = len(members) // best_cap if best_cap > 1 else 0
+        for n in range(full):
+            grid_box = _OpenBox(best_box)
+            grid_box.units = members[n * best_cap:(n + 1) * best_cap]
+            grid_box.weight = weight * best_cap
+            grid_box.volume = unit_volume * best_cap
+            full_boxes.append(grid_box)
+        pending.extend(members[full * best_cap:])
+
+    # 2) Resto: decreciente por volumen; las unidades de un mismo grupo quedan contiguas
+    order = sorted(pending, key=lambda i: (-(units[i][0][0] * units[i][0][1] * units[i][0][2]), groups[i]))
+
+    open_boxes: List[_OpenBox] = []
+    oversized: List[int] = []
+    failed: Dict[int, set] = {}  # grupo -> índices de cajas abiertas donde ya no cupo
+    for uid in order:
+        dims, weight = units[uid]
+        orientations = _orientations(dims)
+        gid = groups[uid]
+        skip = failed.setdefault(gid, set())
+
+        placed = False
+        for idx, open_box in enumerate(open_boxes):
+            if idx in skip:
+                continue
+            if open_box.try_place(uid, dims, weight, orientations):
+                placed = True
+                break
+            skip.add(idx)
+        if placed:
+            continue
+
+        # Se abre la caja más grande posible; al final se reduce al tipo más chico que alcance
+        box = next((b for b in reversed(catalog) if _fits_box(dims, b) and weight <= b["maxWeight"] + _EPS), None)
+        if box is None:
+            oversized.append(uid)
+            continue
+        new_box = _OpenBox(box)
+        new_box.try_place(uid, dims, weight, orientations)
+        open_boxes.append(new_box)
+
+    # 3) Reducir cada caja al tipo más chico que contenga lo mismo
+    packed: List[_OpenBox] = list(full_boxes)
+    for open_box in open_boxes:
+        best = open_box
+        for box in catalog:
+            if box["volume"] >= open_box.box["volume"]:
+                break
+            if box["volume"] + _EPS < open_box.volume or box["maxWeight"] + _EPS < open_box.weight:
+                continue
+            candidate = _fill(sorted(open_box.units, key=lambda u: -(units[u][0][0] * units[u][0][1] * units[u][0][2])), units, box)
+            if candidate:
+                best = candidate
+                break
+        packed.append(best)
+    return packed, oversized
+
+
+def pack(raw_items, boxes: Optional[List[dict]] = None) -> List[dict]:
+    """-> [{"box": nombre|None, "dims": (l, w, h), "weight": kg, "units": n}] (None = sobremedida)."""
+    catalog = boxes or box_catalog(None)
+    units, groups = _expand(raw_items)
+
+    # Rejilla por SKU + puntos extremos vs solo puntos extremos: gana menos cajas, luego menos volumen
+    packed, oversized = min(
+        (_pack_units(units, groups, catalog, use_grid) for use_grid in (True, False)),
+        key=lambda res: (len(res[0]), sum(b.box["volume"] for b in res[0])),
+    )
+
+    result = [{
+        "box": b.box["name"],
+        "dims": tuple(sorted(b.box["dims"], reverse=True)),
+        "weight": b.weight,
+        "units": len(b.units),
+    } for b in packed]
+    for uid in oversized:
+        dims, weight = units[uid]
+        result.append({"box": None, "dims": tuple(sorted(dims, reverse=True)), "weight": weight, "units": 1})
+    return result
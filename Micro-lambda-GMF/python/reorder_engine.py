@@ -0,0 +1,142 @@
+"""
+Motor de sugerencias de reabasto por sucursal.
+
+Construye en una sola pasada la matriz de salidas diarias (stock, producto) x día a partir
+de los movimientos `pos_sale` / `exit_order` del ledger, calcula velocidad (promedio móvil),
+días de cobertura contra el `inventory` vivo y la cantidad sugerida a transferir desde el
+almacén principal (`isMainWarehouse`), repartiendo su existencia entre las sucursales con
+menor cobertura primero.
+
+Requiere NumPy (disponible en la Layer de analítica).
+"""
+import math
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+EXIT_MOVEMENT_TYPES = ("pos_sale", "exit_order")
+
+DEFAULT_REORDER_CONFIG = {
+    "windowDays": 28,      # Ventana del promedio móvil de salidas
+    "shortWindowDays": 7,  # Ventana corta (tendencia)
+    "targetCoverDays": 21, # Cobertura objetivo después de reabastecer
+    "leadTimeDays": 3,     # Días que tarda en llegar una transferencia
+}
+
+
+def reorder_config(app_cfg: Optional[dict]) -> dict:
+    cfg = dict(DEFAULT_REORDER_CONFIG)
+    raw = ((app_cfg or {}).get("inventory") or {}).get("reorder") or {}
+    for key, default in DEFAULT_REORDER_CONFIG.items():
+        try:
+            value = int(raw.get(key, default))
+        except (TypeError, ValueError):
+            value = default
+        cfg[key] = max(1, value) if key != "leadTimeDays" else max(0, value)
+    cfg["shortWindowDays"] = min(cfg["shortWindowDays"], cfg["windowDays"])
+    return cfg
+
+
+def _day_index(created_at: str, start: datetime) -> int:
+    try:
+        day = datetime.strptime(str(created_at)[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return -1
+    return (day - start).days
+
+
+def build_exit_matrix(
+    movements: Iterable[dict],
+    window_days: int,
+    now: Optional[datetime] = None,
+) -> Tuple[List[Tuple[str, str]], np.ndarray]:
+    """
+    Una pasada sobre los movimientos -> (pares (stockId, productId), matriz [pares x días]).
+    La última columna corresponde al día de `now`.
+    """
+    now = now or datetime.now(timezone.utc)
+    start = (now - timedelta(days=window_days - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    pair_index: Dict[Tuple[str, str], int] = {}
+    rows: List[int] = []
+    cols: List[int] = []
+    qtys: List[int] = []
+    for m in movements:
+        if str(m.get("movementType") or m.get("type") or "") not in EXIT_MOVEMENT_TYPES:
+            continue
+        day = _day_index(m.get("createdAt"), start)
+        if day < 0 or day >= window_days:
+            continue
+        pair = (str(m.get("stockId")), str(m.get("productId")))
+        idx = pair_index.setdefault(pair, len(pair_index))
+        rows.append(idx)
+        cols.append(day)
+        qtys.append(int(m.get("qty") or 0))
+
+    matrix = np.zeros((len(pair_index), window_days), dtype=np.float64)
+    if rows:
+        np.add.at(matrix, (np.asarray(rows), np.asarray(cols)), np.asarray(qtys, dtype=np.float64))
+    pairs = [None] * len(pair_index)
+    for pair, idx in pair_index.items():
+        pairs[idx] = pair
+    return pairs, matrix
+
+
+def compute_reorder_suggestions(
+    stocks: List[dict],
+    movements: Iterable[dict],
+    config: Optional[dict] = None,
+    now: Optional[datetime] = None,
+) -> dict:
+    cfg = dict(DEFAULT_REORDER_CONFIG, **(config or {}))
+    window = int(cfg["windowDays"])
+    short_window = int(cfg["shortWindowDays"])
+
+    main_stock = next((s for s in stocks if s.get("isMainWarehouse")), None)
+    main_id = str(main_stock["stockId"]) if main_stock else None
+    main_available = {str(k): int(v) for k, v in ((main_stock or {}).get("inventory") or {}).items()}
+
+    pairs, matrix = build_exit_matrix(movements, window, now)
+    branch_inventory = {
+        str(s["stockId"]): {str(k): int(v) for k, v in (s.get("inventory") or {}).items()}
+        for s in stocks if s.get("stockId") and str(s["stockId"]) != main_id
+    }
+    pairs_mask = np.array([p[0] in branch_inventory for p in pairs], dtype=bool)
+    pairs = [p for p, keep in zip(pairs, pairs_mask) if keep]
+    matrix = matrix[pairs_mask]
+
+    if not pairs:
+        return {"mainStockId": main_id, "config": cfg, "suggestions": []}
+
+    on_hand = np.array([branch_inventory[s].get(p, 0) for s, p in pairs], dtype=np.float64)
+    velocity = matrix.mean(axis=1)
+    velocity_short = matrix[:, -short_window:].mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_of_cover = np.where(velocity > 0, on_hand / velocity, np.inf)
+    need = np.ceil(velocity * (cfg["targetCoverDays"] + cfg["leadTimeDays"]) - on_hand)
+    need = np.clip(np.nan_to_num(need, nan=0.0, posinf=0.0), 0, None).astype(np.int64)
+
+    # Repartir la existencia del almacén principal: primero quien se queda sin stock antes
+    suggestions = []
+    for idx in np.argsort(days_of_cover, kind="stable"):
+        if need[idx] <= 0:
+            continue
+        stock_id, product_id = pairs[idx]
+        available = main_available.get(product_id, 0)
+        qty = int(min(need[idx], available))
+        main_available[product_id] = available - qty
+        cover = float(days_of_cover[idx])
+        suggestions.append({
+            "stockId": stock_id,
+            "productId": product_id,
+            "onHand": int(on_hand[idx]),
+            "velocity": round(float(velocity[idx]), 3),
+            "velocityShort": round(float(velocity_short[idx]), 3),
+            "daysOfCover": None if math.isinf(cover) else round(cover, 1),
+            "neededQty": int(need[idx]),
+            "suggestedQty": qty,
+            "fromStockId": main_id,
+            "shortfall": int(need[idx]) - qty,
+        })
+    return {"mainStockId": main_id, "config": cfg, "suggestions": suggestions}
@@ -1,12 +1,32 @@
+import hashlib
 import json
-import urllib.request
-import urllib.error
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 import core_utils as utils # Importado desde la Lambda Layer
+import http_client
+import packing_engine
+import zone_rates
 
 # --- CONFIGURACIÓN DE ORIGEN (Env Vars) ---
 ENVIA_API_KEY = utils.os.getenv("ENVIA_API_KEY", "")
 ENVIA_API_URL = "https://api-test.envia.com/ship/rate/" # Cambiar a prod en producción
 
+# Presupuesto de tiempo total de la cotización (todas las paqueterías en paralelo)
+QUOTE_DEADLINE_SECONDS = float(utils.os.getenv("SHIPPING_QUOTE_DEADLINE_SECONDS", "6"))
+CARRIER_TIMEOUT_SECONDS = 8.0
+
+# Caché de tarifas crudas por (origen, CP destino, paquetes, paquetería): LRU del contenedor + DynamoDB con TTL
+QUOTE_CACHE_TTL_SECONDS = int(utils.os.getenv("SHIPPING_QUOTE_CACHE_TTL_SECONDS", "21600"))
+QUOTE_CACHE_MAX_ENTRIES = 512
+_quote_lru = OrderedDict()
+
+# Tabla local de tarifas por zona (respaldo cuando Envia no responde dentro del deadline)
+RATE_TABLE_KEY = {"PK": "SHIPPING_RATE_TABLE", "SK": "CURRENT"}
+RATE_TABLE_RELOAD_SECONDS = 900
+RATE_SAMPLE_MONTHS = int(utils.os.getenv("SHIPPING_RATE_SAMPLE_MONTHS", "3"))
+_rate_table_cache = {"table": None, "loadedAt": 0.0}
+
 ORIGIN_DATA = {
     "name": utils.os.getenv("SHIPPING_ORIGIN_NAME", "Warehouse MX"),
     "phone": utils.os.getenv("SHIPPING_ORIGIN_PHONE", "8180000000"),
@@ -18,100 +38,262 @@ ORIGIN_DATA = {
     "postalCode": utils.os.getenv("SHIPPING_ORIGIN_POSTAL_CODE", "64060")
 }
 
-# Dimensiones de cajas estándar FindingU (Largo, Ancho, Alto) en cm
-_STANDARD_BOXES = [
-    (25.0, 17.0, 28.0),   # Chica
-    (40.0, 29.0, 20.0),   # Mediana
-    (35.0, 23.0, 30.0),   # Grande
-]
-
 # --- ALGORITMO DE EMPAQUETADO (PACKING) ---
 
-def _pack_items_for_shipping(raw_items):
+def _pack_items_for_shipping(raw_items, boxes=None):
     """
-    Algoritmo Greedy Bin-Packing:
-    Determina cuántas cajas y de qué tamaño se necesitan basándose en las dimensiones
-    de los productos.
+    Determina cuántas cajas y de qué tamaño se necesitan (packing_engine: FFD 3D con
+    puntos extremos, rotaciones y peso máximo por caja). `boxes` = catálogo de
+    packing_engine.box_catalog(config.shipping); por defecto las cajas estándar FindingU.
     """
-    expanded = []
-    for item in raw_items:
-        qty = max(1, int(item.get("quantity") or 1))
-        # Dimensiones por defecto si el producto no tiene
-        l = max(0.1, float(item.get("lengthCm") or 10))
-        w = max(0.1, float(item.get("widthCm") or 10))
-        h = max(0.1, float(item.get("heightCm") or 10))
-        wt = max(0.05, float(item.get("weightKg") or 0.5))
-        for _ in range(qty):
-            expanded.append((l, w, h, wt))
-
-    if not expanded:
+    if not raw_items:
         return [{
             "type": "box", "content": "Productos", "amount": 1, "declaredValue": 100,
             "weight": 0.5, "dimensions": {"length": 25, "width": 17, "height": 28}
         }]
 
     # Si es un solo producto, usamos sus dimensiones reales
-    if len(expanded) == 1:
-        l, w, h, wt = expanded[0]
-        dims = sorted([l, w, h], reverse=True)
+    if len(raw_items) == 1 and max(1, int(raw_items[0].get("quantity") or 1)) == 1:
+        item = raw_items[0]
+        dims = sorted([
+            max(0.1, float(item.get("lengthCm") or 10)),
+            max(0.1, float(item.get("widthCm") or 10)),
+            max(0.1, float(item.get("heightCm") or 10)),
+        ], reverse=True)
         return [{
             "type": "box", "content": "Producto", "amount": 1, "declaredValue": 100,
-            "weight": wt, "dimensions": {"length": dims[0], "width": dims[1], "height": dims[2]}
+            "weight": max(0.05, float(item.get("weightKg") or 0.5)),
+            "dimensions": {"length": dims[0], "width": dims[1], "height": dims[2]}
         }]
 
-    # Lógica de agrupación en cajas estándar (Greedy)
-    boxes_by_vol = sorted(_STANDARD_BOXES, key=lambda b: b[0] * b[1] * b[2])
-    remaining = list(range(len(expanded)))
     packages = []
+    for pkg in packing_engine.pack(raw_items, boxes):
+        length, width, height = pkg["dims"]
+        packages.append({
+            "type": "box",
+            "content": "Productos" if pkg["box"] else "Sobremedida",
+            "amount": 1,
+            "declaredValue": 100 * pkg["units"],
+            "weight": round(max(0.1, pkg["weight"]), 3),
+            "dimensions": {"length": length, "width": width, "height": height}
+        })
+    return packages
 
-    while remaining:
-        chosen_box = None
-        packed_indices = []
-
-        for box in boxes_by_vol:
-            box_sd = sorted(box, reverse=True)
-            box_vol = box[0] * box[1] * box[2]
-            
-            # Encontrar items que caben en esta caja
-            fitting = [idx for idx in remaining if all(
-                sorted([expanded[idx][0], expanded[idx][1], expanded[idx][2]], reverse=True)[d] <= box_sd[d]
-                for d in range(3)
-            )]
-            
-            if not fitting: continue
-
-            in_box = []
-            used_vol = 0.0
-            for idx in sorted(fitting, key=lambda i: expanded[i][0]*expanded[i][1]*expanded[i][2], reverse=True):
-                item_vol = expanded[idx][0] * expanded[idx][1] * expanded[idx][2]
-                if used_vol + item_vol <= box_vol:
-                    in_box.append(idx)
-                    used_vol += item_vol
-            
-            if in_box:
-                packed_indices = in_box
-                chosen_box = box_sd
-                break
+# --- CONSULTA A PAQUETERÍAS (FAN-OUT CONCURRENTE) ---
 
-        if chosen_box:
-            total_wt = sum(expanded[i][3] for i in packed_indices)
-            packages.append({
-                "type": "box", "content": "Productos", "amount": 1,
-                "declaredValue": 100 * len(packed_indices),
-                "weight": max(0.1, total_wt),
-                "dimensions": {"length": chosen_box[0], "width": chosen_box[1], "height": chosen_box[2]}
-            })
-            for idx in packed_indices: remaining.remove(idx)
+def _request_carrier_rates(carrier, destination, packages, timeout, deadline=None):
+    """Una llamada a Envia para una paquetería; devuelve los items crudos de `data`."""
+    api_payload = {
+        "origin": ORIGIN_DATA,
+        "destination": destination,
+        "packages": packages,
+        "shipment": {"type": 1, "carrier": carrier}
+    }
+    headers = {"Authorization": f"Bearer {ENVIA_API_KEY}", "User-Agent": "FinfingU/1.0"}
+    print(f"[REQUEST] {carrier.upper()} - Payload: {json.dumps(api_payload)}")
+
+    # Cotizar no tiene efectos: se permite reintentar dentro del deadline
+    result = http_client.request_json(
+        "POST", ENVIA_API_URL, headers=headers, json_body=api_payload,
+        timeout=timeout, idempotent=True, deadline=deadline,
+    )
+    print(f"[RESPONSE] {carrier.upper()} - Result: {json.dumps(result)}")
+    return result.get("data", []) or []
+
+def _fan_out_carriers(carriers, destination, packages, deadline_seconds):
+    """
+    Consulta todas las paqueterías en paralelo con un deadline compartido.
+    -> {carrier: {"carrier", "status": ok|error|timeout, "latencyMs", "rates": [...], "error"?}}
+    Las que no responden a tiempo se reportan como timeout y no bloquean al resto.
+    """
+    started = time.monotonic()
+    timeout = max(0.5, min(CARRIER_TIMEOUT_SECONDS, deadline_seconds))
+
+    def _call(carrier):
+        t0 = time.monotonic()
+        try:
+            rates = _request_carrier_rates(carrier, destination, packages, timeout, started + deadline_seconds)
+            return {"carrier": carrier, "status": "ok", "rates": rates,
+                    "latencyMs": int((time.monotonic() - t0) * 1000)}
+        except http_client.HttpError as exc:
+            print(f"[shipping_quote] HTTPError carrier={carrier}: {exc.status} body={exc.text()}")
+            error = f"HTTP {exc.status}"
+        except Exception as exc:
+            print(f"[shipping_quote] Error carrier={carrier}: {exc}")
+            error = str(exc)
+        return {"carrier": carrier, "status": "error", "rates": [], "error": error,
+                "latencyMs": int((time.monotonic() - t0) * 1000)}
+
+    executor = ThreadPoolExecutor(max_workers=max(1, len(carriers)))
+    try:
+        futures = {executor.submit(_call, carrier): carrier for carrier in carriers}
+        done, _ = wait(futures, timeout=deadline_seconds)
+    finally:
+        # No esperar a las rezagadas: el deadline manda
+        executor.shutdown(wait=False)
+
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    results = {}
+    for future, carrier in futures.items():
+        if future in done:
+            results[carrier] = future.result()
+        else:
+            results[carrier] = {"carrier": carrier, "status": "timeout", "rates": [], "latencyMs": elapsed_ms}
+    return results
+
+# --- CACHÉ DE COTIZACIONES ---
+
+def _canonical_packages(packages):
+    """Firma estable de la lista de paquetes (independiente del orden de los items del carrito)."""
+    rows = []
+    for pkg in packages:
+        dims = pkg.get("dimensions") or {}
+        rows.append((
+            round(float(dims.get("length") or 0), 1),
+            round(float(dims.get("width") or 0), 1),
+            round(float(dims.get("height") or 0), 1),
+            round(float(pkg.get("weight") or 0), 2),
+            int(pkg.get("amount") or 1),
+        ))
+    return sorted(rows)
+
+def _quote_cache_key(dest_zip, packages, carrier):
+    raw = json.dumps({
+        "origin": ORIGIN_DATA["postalCode"],
+        "destZip": dest_zip,
+        "packages": _canonical_packages(packages),
+        "carrier": carrier,
+    }, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _quote_cache_ddb_key(cache_key):
+    return {"PK": f"SHIPPING_QUOTE#{cache_key}", "SK": "RATES"}
+
+def _lru_get(cache_key):
+    entry = _quote_lru.get(cache_key)
+    if not entry:
+        return None
+    if entry["expiresAt"] <= time.time():
+        _quote_lru.pop(cache_key, None)
+        return None
+    _quote_lru.move_to_end(cache_key)
+    return entry["rates"]
+
+def _lru_put(cache_key, rates, expires_at):
+    _quote_lru[cache_key] = {"rates": rates, "expiresAt": expires_at}
+    _quote_lru.move_to_end(cache_key)
+    while len(_quote_lru) > QUOTE_CACHE_MAX_ENTRIES:
+        _quote_lru.popitem(last=False)
+
+def _load_cached_rates(keys_by_carrier):
+    """-> ({carrier: rates}, {carrier: "memory"|"dynamo"}) para las paqueterías con caché vigente."""
+    found, sources, pending = {}, {}, {}
+    for carrier, cache_key in keys_by_carrier.items():
+        rates = _lru_get(cache_key)
+        if rates is not None:
+            found[carrier], sources[carrier] = rates, "memory"
         else:
-            # Item no cabe en ninguna caja estándar, usar dimensiones del item
-            idx = remaining.pop(0)
-            packages.append({
-                "type": "box", "content": "Sobremedida", "amount": 1, "declaredValue": 100,
-                "weight": expanded[idx][3],
-                "dimensions": {"length": expanded[idx][0], "width": expanded[idx][1], "height": expanded[idx][2]}
+            pending[cache_key] = carrier
+    if not pending:
+        return found, sources
+
+    now = time.time()
+    try:
+        items = utils._batch_get_items([_quote_cache_ddb_key(k) for k in pending])
+    except Exception as e:
+        print(f"[shipping_quote] cache read failed: {e}")
+        items = []
+    for item in items:
+        cache_key = str(item.get("PK", "")).split("#", 1)[-1]
+        carrier = pending.get(cache_key)
+        # El TTL de DynamoDB borra con retraso: validar la expiración al leer
+        if not carrier or int(item.get("ttl") or 0) <= now:
+            continue
+        rates = json.loads(item.get("ratesJson") or "[]")
+        _lru_put(cache_key, rates, int(item["ttl"]))
+        found[carrier], sources[carrier] = rates, "dynamo"
+    return found, sources
+
+def _rate_sample_pk(month_key):
+    return f"SHIPPING_RATE_SAMPLE#{month_key}"
+
+def _store_cached_rates(rates_by_key, ttl_seconds, dest_zip, weight_kg):
+    expires_at = utils._ttl_epoch(ttl_seconds)
+    now = utils._now_iso()
+    items = []
+    for cache_key, (carrier, rates) in rates_by_key.items():
+        _lru_put(cache_key, rates, expires_at)
+        items.append({
+            **_quote_cache_ddb_key(cache_key),
+            "entityType": "shippingQuoteCache", "carrier": carrier,
+            # Tarifas crudas de Envia (sin markup) como JSON: evita convertir floats a Decimal
+            "ratesJson": json.dumps(rates),
+            "ttl": expires_at, "createdAt": now,
+        })
+        # Muestra compacta (sin TTL) para aprender la tabla de zonas
+        samples = [{
+            "service": r.get("serviceDescription", ""),
+            "price": float(r.get("totalPrice", 0)),
+            "deliveryEstimate": r.get("deliveryEstimate", ""),
+        } for r in rates if float(r.get("totalPrice", 0) or 0) > 0]
+        if samples:
+            items.append({
+                "PK": _rate_sample_pk(now[:7]), "SK": f"{now}#{cache_key[:16]}",
+                "entityType": "shippingRateSample", "carrier": carrier,
+                "destZip": dest_zip, "weightKg": utils._to_decimal(round(weight_kg, 3)),
+                "samplesJson": json.dumps(samples), "createdAt": now,
             })
+    try:
+        utils._put_items_batch(items)
+    except Exception as e:
+        print(f"[shipping_quote] cache write failed: {e}")
 
-    return packages
+# --- TABLA LOCAL DE TARIFAS POR ZONA ---
+
+def _get_rate_table():
+    """Tabla de zonas en memoria del contenedor; se relee de DynamoDB cada RATE_TABLE_RELOAD_SECONDS."""
+    now = time.time()
+    if _rate_table_cache["table"] is None or now - _rate_table_cache["loadedAt"] > RATE_TABLE_RELOAD_SECONDS:
+        try:
+            item = utils._table.get_item(Key=RATE_TABLE_KEY).get("Item") or {}
+            _rate_table_cache["table"] = json.loads(item.get("tableJson") or "{}")
+        except Exception as e:
+            print(f"[shipping_quote] rate table load failed: {e}")
+            _rate_table_cache["table"] = _rate_table_cache["table"] or {}
+        _rate_table_cache["loadedAt"] = now
+    return _rate_table_cache["table"]
+
+def handle_refresh_rate_table(months=None):
+    """Job: reconstruye la tabla de zonas con las muestras de los últimos `months` meses."""
+    months = int(months or RATE_SAMPLE_MONTHS)
+    now = utils.datetime.now(utils.timezone.utc)
+    year, month = now.year, now.month
+    samples = []
+    for _ in range(months):
+        query_kwargs = {"KeyConditionExpression": utils.Key("PK").eq(_rate_sample_pk(f"{year:04d}-{month:02d}"))}
+        while True:
+            resp = utils._table.query(**query_kwargs)
+            for item in resp.get("Items", []):
+                for sample in json.loads(item.get("samplesJson") or "[]"):
+                    samples.append({
+                        "destZip": item.get("destZip"), "weightKg": float(item.get("weightKg") or 0),
+                        "carrier": item.get("carrier"), **sample,
+                    })
+            lek = resp.get("LastEvaluatedKey")
+            if not lek:
+                break
+            query_kwargs["ExclusiveStartKey"] = lek
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+
+    table = zone_rates.build_rate_table(samples, built_at=utils._now_iso())
+    utils._table.put_item(Item={
+        **RATE_TABLE_KEY, "entityType": "shippingRateTable",
+        "tableJson": json.dumps(table), "samples": table["samples"], "updatedAt": table["builtAt"],
+    })
+    _rate_table_cache.update({"table": table, "loadedAt": time.time()})
+    summary = {"samples": table["samples"], "zones": len(table["rates"]), "prefixes": len(table["zoneByPrefix"])}
+    print(json.dumps({"event": "shipping_rate_table_refreshed", **summary}))
+    return summary
 
 # --- HANDLER DE COTIZACIÓN ---
 
@@ -161,11 +343,11 @@ def handle_get_quote(body):
         return utils._json_response(200, {"rates": [], "message": "Envíos deshabilitados temporalmente"})
 
     markup = float(ship_cfg.get("markup", 0))
-    carriers = ship_cfg.get("carriers") or ["dhl", "fedex", "estafeta"]
+    carriers = list(dict.fromkeys(ship_cfg.get("carriers") or ["dhl", "fedex", "estafeta"]))
 
     # 2. Ejecutar Packing
     raw_items = body.get("items", [])
-    packages = _pack_items_for_shipping(raw_items)
+    packages = _pack_items_for_shipping(raw_items, packing_engine.box_catalog(ship_cfg))
 
     # 3. Consultar API Externa
     destination = {
@@ -179,48 +361,59 @@ def handle_get_quote(body):
         "postalCode": zip_to
     }
 
+    # 4. Caché (memoria -> DynamoDB) y solo las paqueterías faltantes van a Envia
+    keys_by_carrier = {carrier: _quote_cache_key(zip_to, packages, carrier) for carrier in carriers}
+    cached_rates, cache_sources = _load_cached_rates(keys_by_carrier)
+    missing = [carrier for carrier in carriers if carrier not in cached_rates]
+
+    deadline = float(ship_cfg.get("quoteDeadlineSeconds") or QUOTE_DEADLINE_SECONDS)
+    carrier_results = _fan_out_carriers(missing, destination, packages, deadline) if missing else {}
+    fresh = {
+        keys_by_carrier[carrier]: (carrier, result["rates"])
+        for carrier, result in carrier_results.items() if result["status"] == "ok"
+    }
+    total_weight = sum(float(pkg.get("weight") or 0) for pkg in packages)
+    if fresh:
+        _store_cached_rates(fresh, int(ship_cfg.get("quoteCacheTtlSeconds") or QUOTE_CACHE_TTL_SECONDS), zip_to, total_weight)
+    for carrier, rates in cached_rates.items():
+        carrier_results[carrier] = {"carrier": carrier, "status": "ok", "rates": rates, "latencyMs": 0}
+    for carrier, result in carrier_results.items():
+        result["source"] = cache_sources.get(carrier, "live")
+
+    # 5. Paqueterías sin respuesta a tiempo: tarifa estimada de la tabla local de zonas
+    unanswered = [c for c in carriers if carrier_results[c]["status"] != "ok"]
+    if unanswered:
+        estimated = zone_rates.estimate_rates(_get_rate_table(), zip_to, total_weight, unanswered)
+        for carrier in unanswered:
+            if estimated.get(carrier):
+                carrier_results[carrier].update({"rates": estimated[carrier], "source": "estimate", "estimated": True})
+
+    cache_metrics = {
+        "memoryHits": sum(1 for v in cache_sources.values() if v == "memory"),
+        "dynamoHits": sum(1 for v in cache_sources.values() if v == "dynamo"),
+        "misses": len(missing),
+    }
+    print(json.dumps({"event": "shipping_quote_cache", "destZip": zip_to, **cache_metrics}))
+
     all_rates = []
+    carrier_status = []
     for carrier in carriers:
-        api_payload = {
-            "origin": ORIGIN_DATA,
-            "destination": destination,
-            "packages": packages,
-            "shipment": {"type": 1, "carrier": carrier}
-        }
+        result = carrier_results[carrier]
+        for rate_item in result.pop("rates", []):
+            base_price = float(rate_item.get("totalPrice", 0))
+            # Aplicar el markup configurado por el dueño del negocio
+            final_price = round(base_price * (1 + markup), 2)
 
-        try:
-            req = urllib.request.Request(ENVIA_API_URL, data=json.dumps(api_payload).encode())
-            print(f"[REQUEST] {carrier.upper()} - Payload: {json.dumps(api_payload)}")
-            req.add_header("Authorization", f"Bearer {ENVIA_API_KEY}")
-            req.add_header("Content-Type", "application/json")
-            req.add_header("User-Agent", "FinfingU/1.0")
-            print(f"[REQUEST] {carrier.upper()} - URL: {ENVIA_API_URL}")
-            print(f"[REQUEST] {carrier.upper()} - Headers: {req.header_items()}")
-            
-            with urllib.request.urlopen(req, timeout=8) as res:
-                result = json.loads(res.read().decode())
-                print(f"[RESPONSE] {carrier.upper()} - Result: {json.dumps(result)}")
-                for rate_item in result.get("data", []):
-                    base_price = float(rate_item.get("totalPrice", 0))
-                    # Aplicar el markup configurado por el dueño del negocio
-                    final_price = round(base_price * (1 + markup), 2)
-                    
-                    all_rates.append({
-                        "carrier": rate_item.get("carrierDescription", carrier),
-                        "service": rate_item.get("serviceDescription", ""),
-                        "price": base_price,
-                        "displayPrice": final_price,
-                        "currency": "MXN",
-                        "deliveryEstimate": rate_item.get("deliveryEstimate", "")
-                    })
-        except urllib.error.HTTPError as exc:
-            print(f"[shipping_quote] HTTPError carrier={carrier}: {exc.code}")
-            print(f"[shipping_quote] HTTPError details: {exc.read().decode()}")
-            print(f"[shipping_quote] HTTPError headers: {exc.headers}")
-            print(f"[shipping_quote] HTTPError body: {exc.read().decode()}")
-        except Exception as exc:
-            print(f"[shipping_quote] Error carrier={carrier}: {exc}")
-            
+            all_rates.append({
+                "carrier": rate_item.get("carrierDescription", carrier),
+                "service": rate_item.get("serviceDescription", ""),
+                "price": base_price,
+                "displayPrice": final_price,
+                "currency": "MXN",
+                "deliveryEstimate": rate_item.get("deliveryEstimate", ""),
+                "estimated": bool(result.get("estimated"))
+            })
+        carrier_status.append(result)
 
     # Ordenar por precio más bajo
     all_rates.sort(key=lambda r: r["displayPrice"])
@@ -228,19 +421,31 @@ def handle_get_quote(body):
     return utils._json_response(200, {
         "rates": all_rates,
         "packages": len(packages),
-        "destZip": zip_to
+        "destZip": zip_to,
+        "carriers": carrier_status,
+        "cache": cache_metrics
     })
 
 # --- LAMBDA HANDLER ---
 
 def lambda_handler(event, context):
+    # Invocación programada (EventBridge) del job de la tabla de zonas
+    if event.get("action") == "REFRESH_RATE_TABLE":
+        return handle_refresh_rate_table(event.get("months"))
+
     path = event.get("path", "")
     method = event.get("httpMethod", "")
     if method == "OPTIONS":
         return utils._cors_preflight_response()
     body = utils._parse_body(event)
+    headers = event.get("headers") or {}
 
     if "/shipping/quote" in path and method == "POST":
         return handle_get_quote(body)
 
+    if "/shipping/rate-table/refresh" in path and method == "POST":
+        err = utils._require_admin(headers, "config_manage")
+        if err: return err
+        return utils._json_response(200, handle_refresh_rate_table(body.get("months")))
+
     return utils._json_response(404, {"message": "Ruta de logística no encontrada"})
@@ -0,0 +1,162 @@
+"""
+Asignación de surtido multi-almacén.
+
+Dadas las líneas de una orden y los inventarios de STOCK (cargados una sola vez), elige el
+almacén o el conjunto mínimo de almacenes que puede surtirla, prefiriendo el más cercano al
+destino (prefijo de código postal) y después el almacén principal (`isMainWarehouse`).
+Lógica pura: no accede a DynamoDB.
+"""
+from decimal import Decimal
+from itertools import combinations
+from typing import Dict, List, Optional, Tuple
+
+# Hasta este tamaño de conjunto se busca la combinación exacta; después, cobertura greedy
+MAX_EXACT_SET_SIZE = 3
+
+
+def parse_quantity(raw) -> Optional[int]:
+    """Cantidad entera de una línea ("2", 2 o 2.0); None si no es un entero válido."""
+    try:
+        value = Decimal(str(raw if raw is not None else 0).strip())
+        if value != value.to_integral_value():
+            return None
+        return int(value)
+    except (ArithmeticError, ValueError):
+        return None
+
+
+def normalize_lines(raw_lines) -> Dict[str, int]:
+    """
+    [{productId, quantity|qty}] -> {productId: qty} (agrega productos repetidos).
+    Lanza ValueError si una cantidad no es un entero; las líneas en cero se ignoran.
+    """
+    needs: Dict[str, int] = {}
+    for line in raw_lines or []:
+        if not isinstance(line, dict):
+            continue
+        pid = str(line.get("productId") or "").strip()
+        qty = parse_quantity(line.get("quantity") or line.get("qty") or 0)
+        if qty is None:
+            raise ValueError(f"Cantidad invalida para el producto {pid}")
+        if pid and qty > 0:
+            needs[pid] = needs.get(pid, 0) + qty
+    return needs
+
+
+def _inventory(stock: dict) -> Dict[str, int]:
+    return {str(k): int(v) for k, v in (stock.get("inventory") or {}).items()}
+
+
+def _proximity(stock: dict, dest_zip: Optional[str]) -> int:
+    """Longitud del prefijo común de código postal (en MX los 2 primeros dígitos = estado)."""
+    stock_zip = str(stock.get("postalCode") or "").strip()
+    dest = str(dest_zip or "").strip()
+    common = 0
+    for a, b in zip(stock_zip, dest):
+        if a != b:
+            break
+        common += 1
+    return common
+
+
+def _preference_key(stock: dict, dest_zip: Optional[str]) -> Tuple:
+    return (-_proximity(stock, dest_zip), 0 if stock.get("isMainWarehouse") else 1, str(stock.get("stockId")))
+
+
+def missing_lines(inventory: Dict[str, int], needs: Dict[str, int]) -> List[dict]:
+    return [
+        {"productId": pid, "requested": qty, "available": max(0, inventory.get(pid, 0))}
+        for pid, qty in needs.items()
+        if inventory.get(pid, 0) < qty
+    ]
+
+
+def _split(needs: Dict[str, int], ordered: List[dict]) -> Tuple[List[dict], Dict[str, int]]:
+    """Reparte las necesidades entre los almacenes en orden de preferencia."""
+    remaining = dict(needs)
+    allocations = []
+    for stock in ordered:
+        inventory = _inventory(stock)
+        lines = []
+        for pid, qty in remaining.items():
+            take = min(qty, max(0, inventory.get(pid, 0)))
+            if take > 0:
+                lines.append({"productId": pid, "qty": take})
+        if not lines:
+            continue
+        for line in lines:
+            remaining[line["productId"]] -= line["qty"]
+        remaining = {pid: qty for pid, qty in remaining.items() if qty > 0}
+        allocations.append({"stockId": stock.get("stockId"), "lines": lines})
+        if not remaining:
+            break
+    return allocations, remaining
+
+
+def _covers(stocks: Tuple[dict, ...], needs: Dict[str, int]) -> bool:
+    totals: Dict[str, int] = {}
+    for stock in stocks:
+        for pid, qty in _inventory(stock).items():
+            if pid in needs and qty > 0:
+                totals[pid] = totals.get(pid, 0) + qty
+    return all(totals.get(pid, 0) >= qty for pid, qty in needs.items())
+
+
+def allocate(raw_lines, stocks: List[dict], dest_zip: Optional[str] = None) -> dict:
+    """
+    -> {"fulfillable", "split", "allocations": [{stockId, lines}], "unfulfilled": [{productId, qty}]}
+    1) un solo almacén que surta todo; 2) la combinación más pequeña (<= MAX_EXACT_SET_SIZE);
+    3) cobertura greedy con lo que haya (puede quedar faltante).
+    """
+    needs = normalize_lines(raw_lines)
+    if not needs:
+        return {"fulfillable": True, "split": False, "allocations": [], "unfulfilled": []}
+    candidates = sorted(
+        [s for s in stocks if s.get("stockId") and any(_inventory(s).get(pid, 0) > 0 for pid in needs)],
+        key=lambda s: _preference_key(s, dest_zip),
+    )
+
+    for size in range(1, min(MAX_EXACT_SET_SIZE, len(candidates)) + 1):
+        # combinations respeta el orden de `candidates`: la primera que cubre es la preferida
+        for combo in combinations(candidates, size):
+            if _covers(combo, needs):
+                allocations, _ = _split(needs, list(combo))
+                return {"fulfillable": True, "split": len(allocations) > 1, "allocations": allocations, "unfulfilled": []}
+
+    # Greedy: siempre el almacén que cubre más unidades pendientes
+    remaining = dict(needs)
+    pool = list(candidates)
+    chosen: List[dict] = []
+    while remaining and pool:
+        best = max(pool, key=lambda s: sum(min(q, max(0, _inventory(s).get(p, 0))) for p, q in remaining.items()))
+        if sum(min(q, max(0, _inventory(best).get(p, 0))) for p, q in remaining.items()) <= 0:
+            break
+        pool.remove(best)
+        chosen.append(best)
+        _, remaining = _split(remaining, [best])
+    allocations, remaining = _split(needs, chosen)
+    return {
+        "fulfillable": not remaining,
+        "split": len(allocations) > 1,
+        "allocations": allocations,
+        "unfulfilled": [{"productId": pid, "qty": qty} for pid, qty in remaining.items()],
+    }
+
+
+def pickup_availability(raw_lines, stocks: List[dict]) -> List[dict]:
+    """Para cada sucursal con pickup: si puede surtir el carrito completo y qué le falta."""
+    needs = normalize_lines(raw_lines)
+    rows = []
+    for stock in stocks:
+        if not stock.get("allowPickup") or not stock.get("stockId"):
+            continue
+        missing = missing_lines(_inventory(stock), needs)
+        rows.append({
+            "stockId": stock.get("stockId"),
+            "name": stock.get("name"),
+            "location": stock.get("location"),
+            "canFulfill": not missing,
+            "missing": missing,
+        })
+    rows.sort(key=lambda r: (not r["canFulfill"], len(r["missing"]), str(r["name"] or r["stockId"])))
+    return rows
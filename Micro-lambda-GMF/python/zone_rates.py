@@ -0,0 +1,132 @@
+"""
+Tabla local de tarifas por zona para cotizar cuando Envia no responde a tiempo.
+
+Se aprende de muestras de cotizaciones reales (las que alimentan la caché de cotizaciones):
+  - prefijo de CP (2 dígitos) -> zona: los prefijos se ordenan por su índice de costo
+    (precio observado / mediana nacional del mismo carrier+servicio+banda) y se reparten
+    en N zonas por cuantiles (Z1 = la más barata);
+  - zona x banda de peso -> mediana del precio por carrier+servicio.
+La tabla es un dict compacto serializable a JSON; la consulta es O(servicios).
+Lógica pura: no accede a red ni a DynamoDB.
+"""
+from collections import Counter, defaultdict
+from statistics import median
+from typing import Dict, List, Optional
+
+WEIGHT_BANDS = [1, 2, 3, 5, 10, 15, 20, 30, 50, 70]
+DEFAULT_ZONES = 5
+TABLE_VERSION = 1
+
+
+def weight_band(weight_kg: float) -> int:
+    for band in WEIGHT_BANDS:
+        if weight_kg <= band:
+            return band
+    return WEIGHT_BANDS[-1]
+
+
+def _zip_prefix(dest_zip) -> str:
+    return str(dest_zip or "").strip()[:2]
+
+
+def build_rate_table(samples: List[dict], zones: int = DEFAULT_ZONES, built_at: Optional[str] = None) -> dict:
+    """
+    samples: [{destZip, weightKg, carrier, service, price, deliveryEstimate?}]
+    -> {"version", "builtAt", "bands", "zoneByPrefix", "defaultZone", "rates": {zona: {"carrier|service": {banda: {...}}}}, "samples"}
+    """
+    rows = []
+    for s in samples:
+        prefix = _zip_prefix(s.get("destZip"))
+        try:
+            price = float(s.get("price"))
+            weight = float(s.get("weightKg"))
+        except (TypeError, ValueError):
+            continue
+        if len(prefix) != 2 or price <= 0 or weight <= 0:
+            continue
+        service_key = f"{s.get('carrier') or ''}|{s.get('service') or ''}"
+        rows.append((prefix, service_key, str(weight_band(weight)), price, s.get("deliveryEstimate") or ""))
+
+    # 1) Índice de costo por prefijo contra la mediana nacional del mismo servicio y banda
+    national: Dict[tuple, List[float]] = defaultdict(list)
+    for prefix, service_key, band, price, _ in rows:
+        national[(service_key, band)].append(price)
+    national_median = {key: median(prices) for key, prices in national.items()}
+
+    ratios: Dict[str, List[float]] = defaultdict(list)
+    for prefix, service_key, band, price, _ in rows:
+        ratios[prefix].append(price / national_median[(service_key, band)])
+    prefix_index = sorted((median(values), prefix) for prefix, values in ratios.items())
+
+    # 2) Cuantiles -> zonas
+    zone_count = max(1, min(zones, len(prefix_index)))
+    zone_by_prefix = {}
+    for pos, (_, prefix) in enumerate(prefix_index):
+        zone_by_prefix[prefix] = f"Z{pos * zone_count // max(1, len(prefix_index)) + 1}"
+
+    # 3) Zona x servicio x banda -> mediana
+    grouped: Dict[tuple, List[float]] = defaultdict(list)
+    estimates: Dict[tuple, Counter] = defaultdict(Counter)
+    for prefix, service_key, band, price, estimate in rows:
+        key = (zone_by_prefix[prefix], service_key, band)
+        grouped[key].append(price)
+        if estimate:
+            estimates[key][estimate] += 1
+
+    rates: Dict[str, Dict[str, Dict[str, dict]]] = {}
+    for (zone, service_key, band), prices in grouped.items():
+        common = estimates[(zone, service_key, band)].most_common(1)
+        rates.setdefault(zone, {}).setdefault(service_key, {})[band] = {
+            "price": round(median(prices), 2),
+            "n": len(prices),
+            "deliveryEstimate": common[0][0] if common else "",
+        }
+
+    return {
+        "version": TABLE_VERSION,
+        "builtAt": built_at,
+        "bands": WEIGHT_BANDS,
+        "zoneByPrefix": zone_by_prefix,
+        "defaultZone": f"Z{(zone_count + 1) // 2}",
+        "rates": rates,
+        "samples": len(rows),
+    }
+
+
+def _price_for_band(bands: Dict[str, dict], weight_kg: float) -> Optional[dict]:
+    target = weight_band(weight_kg)
+    if str(target) in bands:
+        return bands[str(target)]
+    available = sorted(int(b) for b in bands)
+    upper = [b for b in available if b > target]
+    if upper:
+        return bands[str(upper[0])]
+    # Solo hay bandas menores: extrapolar linealmente por peso desde la mayor disponible
+    base_band = available[-1]
+    base = bands[str(base_band)]
+    return dict(base, price=round(base["price"] * max(weight_kg, target) / base_band, 2))
+
+
+def estimate_rates(table: Optional[dict], dest_zip, weight_kg: float, carriers: List[str]) -> Dict[str, List[dict]]:
+    """-> {carrier: [items con forma de Envia: totalPrice, carrierDescription, serviceDescription, deliveryEstimate]}"""
+    if not table or not table.get("rates"):
+        return {}
+    zone = table.get("zoneByPrefix", {}).get(_zip_prefix(dest_zip)) or table.get("defaultZone")
+    zone_rates = table["rates"].get(zone) or {}
+    wanted = {str(c).lower() for c in carriers}
+    result: Dict[str, List[dict]] = {}
+    for service_key, bands in zone_rates.items():
+        carrier, _, service = service_key.partition("|")
+        if carrier.lower() not in wanted or not bands:
+            continue
+        entry = _price_for_band(bands, weight_kg)
+        if not entry:
+            continue
+        result.setdefault(carrier, []).append({
+            "totalPrice": entry["price"],
+            "carrierDescription": carrier,
+            "serviceDescription": service,
+            "deliveryEstimate": entry.get("deliveryEstimate", ""),
+            "zone": zone,
+        })
+    return result
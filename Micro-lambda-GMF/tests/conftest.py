@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Las lambdas importan sus módulos hermanos por nombre (como en la Layer)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("AWS_DEFAULT_REGION", os.environ["AWS_REGION"])
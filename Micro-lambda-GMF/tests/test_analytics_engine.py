@@ -0,0 +1,135 @@
+"""Almacén analítico sobre archivos locales: esquemas, vistas del último snapshot, caché y compactación."""
+from decimal import Decimal
+
+import pyarrow.parquet as pq
+import pytest
+
+import analytics_engine as ae
+
+MONTH = "2026-03"
+
+
+def _order(order_id, status="paid", net="150.00", items=None, **extra):
+    return {
+        "orderId": order_id, "monthKey": MONTH, "createdAt": f"{MONTH}-14T10:00:00Z",
+        "status": status, "customerId": 7, "buyerType": "associate", "stockId": "S1",
+        "grossSubtotal": net, "discountAmount": "0", "netTotal": net,
+        "items": items if items is not None else [{"productId": "P1", "name": "Jabón", "quantity": 2, "price": "75"}],
+        **extra,
+    }
+
+
+def _ledger(rows):
+    return {"beneficiaryId": "3", "monthKey": MONTH, "ledger": rows}
+
+
+def _sync(store, orders, ledgers, synced_at):
+    """Un flush: la orden antes que sus hijas (WRITE_ORDER)."""
+    days = {str(o["orderId"]): ae.order_day(o) for o in orders}
+    rows = {
+        "orders": [ae.order_row(o, synced_at) for o in orders],
+        "lines": [row for o in orders for row in ae.line_rows(o, synced_at)],
+        "commissions": [row for item in ledgers for row in ae.commission_rows(item, days, synced_at)],
+    }
+    for dataset in ae.WRITE_ORDER:
+        if rows[dataset]:
+            store.append(dataset, rows[dataset])
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ae.AnalyticsStore(str(tmp_path))
+
+
+def test_files_follow_dataset_schemas_and_day_partition(store):
+    _sync(store, [_order("ORD-1")], [_ledger([{"rowId": "ORD-1#L1", "orderId": "ORD-1", "level": 1, "status": "pending", "amount": "9.5"}])], 1)
+
+    for dataset, schema in ae.SCHEMAS.items():
+        files = store.files(dataset)
+        assert len(files) == 1
+        assert f"/{dataset}/month={MONTH}/day=14/" in files[0].path
+        assert pq.read_schema(files[0].path, filesystem=store.fs).equals(schema)
+
+    order = store.query("SELECT * FROM orders")[0]
+    assert order["channel"] == "online"
+    assert order["itemsCount"] == 2
+    assert order["netTotal"] == Decimal("150.00")
+    line = store.query("SELECT * FROM lines")[0]
+    assert (line["lineNo"], line["quantity"], line["lineTotal"]) == (1, 2, Decimal("150.00"))
+    commission = store.query("SELECT * FROM commissions")[0]
+    assert (commission["dayKey"], commission["amount"]) == (f"{MONTH}-14", Decimal("9.50"))
+
+
+def test_order_outside_its_month_lands_on_day_01():
+    assert ae.order_day(_order("ORD-1", createdAt="2026-02-28T23:59:00Z")) == f"{MONTH}-01"
+
+
+def test_coerce_rows_matches_schema_types():
+    row = ae.coerce_rows("orders", [{"orderId": 5, "itemsCount": Decimal("3"), "netTotal": Decimal("10.006"), "syncedAt": Decimal("9")}])[0]
+    assert row["orderId"] == "5"
+    assert row["itemsCount"] == 3 and row["syncedAt"] == 9
+    assert row["netTotal"] == Decimal("10.01")
+    assert row["status"] is None
+
+
+def test_views_keep_latest_snapshot_after_resync_and_void(store):
+    ledger_row = {"rowId": "ORD-1#L1", "orderId": "ORD-1", "level": 1, "status": "pending", "amount": "10"}
+    _sync(store, [_order("ORD-1")], [_ledger([ledger_row])], 1)
+    # Re-sincronización: la orden cambió de estado y la comisión se anuló (ya no está en el ledger)
+    refunded = _order("ORD-1", status="refunded", items=[{"productId": "P2", "quantity": 1, "price": "150"}])
+    _sync(store, [refunded], [_ledger([])], 2)
+
+    assert store.query("SELECT count(*) AS n FROM orders_raw")[0]["n"] == 2
+    orders = store.query("SELECT orderId, status, syncedAt FROM orders")
+    assert orders == [{"orderId": "ORD-1", "status": "refunded", "syncedAt": 2}]
+    assert [r["productId"] for r in store.query("SELECT productId FROM lines")] == ["P2"]
+    assert store.query("SELECT * FROM commissions") == []
+
+
+def test_repeated_flush_rows_are_counted_once(store):
+    _sync(store, [_order("ORD-1")], [], 1)
+    _sync(store, [_order("ORD-1")], [], 1)
+    assert store.query("SELECT count(*) AS n FROM lines")[0]["n"] == 1
+
+
+def test_query_cache_is_invalidated_by_a_new_file(store):
+    _sync(store, [_order("ORD-1")], [], 1)
+    sql = "SELECT count(*) AS n FROM orders"
+
+    assert store.query(sql)[0]["n"] == 1
+    assert store.query(sql)[0]["n"] == 1
+    assert store.cache_stats == {"hits": 1, "misses": 1}
+
+    _sync(store, [_order("ORD-2")], [], 2)
+    assert store.query(sql)[0]["n"] == 2
+    assert store.cache_stats == {"hits": 1, "misses": 2}
+
+
+def test_compaction_keeps_admin_stats(store):
+    for synced_at in range(1, 6):
+        status = "delivered" if synced_at == 5 else "paid"
+        orders = [_order(f"ORD-{n}", status=status, net=f"{100 + n}.00") for n in range(3)]
+        orders.append(_order(f"POS-{synced_at}", net="20.00"))
+        ledger = _ledger([
+            {"rowId": f"ORD-{n}#L1", "orderId": f"ORD-{n}", "level": 1, "status": status, "amount": "5"}
+            for n in range(3)
+        ])
+        _sync(store, orders, [ledger], synced_at)
+    before = store.admin_stats(MONTH)
+    files_before = {name: len(store.files(name)) for name in ae.SCHEMAS}
+
+    summary = store.compact(min_files=4)
+
+    assert summary["partitions"] == 1
+    assert summary["filesRead"] == sum(files_before.values())
+    assert summary["rowsDropped"] > 0
+    assert {name: len(store.files(name)) for name in ae.SCHEMAS} == {name: 1 for name in ae.SCHEMAS}
+    assert store.admin_stats(MONTH) == before
+    assert before["order_count"] == 8
+    assert {row["channel"] for row in before["byChannel"]} == {"online", "pos"}
+
+
+def test_compaction_skips_partitions_below_min_files(store):
+    _sync(store, [_order("ORD-1")], [], 1)
+    assert store.compact(min_files=4)["partitions"] == 0
+    assert len(store.files("orders")) == 1
@@ -3,11 +3,15 @@ import hashlib
 import json
 import os
 import random
+import time
 import uuid
 import functools
-import urllib.error
+import http.client
+import socket
+import ssl
+import threading
 import urllib.parse
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from typing import Any, Dict, List, Optional, Tuple, Union
@@ -52,6 +56,9 @@ _SHIPPING_ORIGIN_CITY = (os.getenv("SHIPPING_ORIGIN_CITY") or "Monterrey").strip
 _SHIPPING_ORIGIN_STATE = (os.getenv("SHIPPING_ORIGIN_STATE") or "NL").strip()
 _SHIPPING_ORIGIN_POSTAL_CODE = (os.getenv("SHIPPING_ORIGIN_POSTAL_CODE") or "64060").strip()
 _SHIPPING_DESTINATION_COUNTRY = (os.getenv("SHIPPING_DESTINATION_COUNTRY") or "MX").strip()
+# Overall budget for one quote: carriers are queried concurrently and stragglers are reported as timeout
+_SHIPPING_QUOTE_DEADLINE_SECONDS = float(os.getenv("SHIPPING_QUOTE_DEADLINE_SECONDS") or 6)
+_SHIPPING_CARRIER_TIMEOUT_SECONDS = 10.0
 
 # Standard box sizes (L, W, H) in cm — sorted by volume ascending
 _STANDARD_BOXES: List[Tuple[float, float, float]] = [
@@ -89,6 +96,20 @@ def _json_default(value):
         return list(value)
     raise TypeError(f"Object of type {value.__class__.__name__} is not JSON serializable")
 
+def _content_hash(value: Any) -> str:
+    """Stable sha256 (sorted keys) of any JSON-serializable value."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=_json_default).encode("utf-8")).hexdigest()
+
+def _floats_to_decimal(value: Any) -> Any:
+    """DynamoDB rejects floats: convert them to Decimal recursively."""
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _floats_to_decimal(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_floats_to_decimal(v) for v in value]
+    return value
+
 def _json_response(status_code: int, payload: dict) -> dict:
     return {
         "statusCode": status_code,
@@ -101,8 +122,10 @@ def _json_response(status_code: int, payload: dict) -> dict:
                 "X-User-Id,X-User-Name,X-User-Role,"
                 "x-user-id,x-user-name,x-user-role,"
                 "X-Webhook-Secret,x-webhook-secret,"
-                "X-MercadoLibre-Signature,x-mercadolibre-signature"
+                "X-MercadoLibre-Signature,x-mercadolibre-signature,"
+                "Idempotency-Key,idempotency-key"
             ),
+            "Access-Control-Expose-Headers": "Idempotent-Replayed,Retry-After",
         },
         "body": json.dumps(payload, default=_json_default),
     }
@@ -158,21 +181,44 @@ def _now_iso() -> str:
 def _utc_now() -> datetime:
     return datetime.now(timezone.utc)
 
-def _generate_order_id(now: Optional[datetime] = None, max_attempts: int = 6) -> str:
-    base_dt = now or datetime.now(timezone.utc)
-    prefix = base_dt.strftime("%y%m%d")
-    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    
-    # Try simpler suffix first
-    for _ in range(max_attempts):
-        suffix = "".join(random.choices(alphabet, k=6))
-        order_id = f"{prefix}{suffix}"
-        if not _get_by_id("ORDER", order_id):
-            return order_id
-            
-    # Fallback
-    suffix = "".join(random.choices(alphabet, k=8))
-    return f"{prefix}{suffix}"
+# Time-ordered IDs: yymmdd + 12 Crockford base32 chars encoding 60 bits
+#   27 bits ms of day | 10 bits sequence | 23 bits node (random per container)
+# Monotonic within a container (same ms -> next sequence; exhausted sequence or clock going
+# backwards -> logical ms advances), so uniqueness needs no reads. Two containers only collide
+# with the same node in the same ms and sequence; _put_entity(..., unique=True) guards that.
+_ID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_ID_SEQ_BITS = 10
+_ID_NODE_BITS = 23
+_ID_NODE = int.from_bytes(os.urandom(4), "big") & ((1 << _ID_NODE_BITS) - 1)
+_ID_LOCK = threading.Lock()
+_ID_STATE = {"ms": 0, "seq": 0}
+
+
+class EntityIdCollision(Exception):
+    """The ID already existed; the conditional put refused to overwrite it."""
+
+
+def _new_id(prefix: str = "") -> str:
+    now_ms = int(time.time() * 1000)
+    with _ID_LOCK:
+        if now_ms > _ID_STATE["ms"]:
+            _ID_STATE["ms"], _ID_STATE["seq"] = now_ms, 0
+        else:
+            _ID_STATE["seq"] += 1
+            if _ID_STATE["seq"] >= (1 << _ID_SEQ_BITS):
+                _ID_STATE["ms"], _ID_STATE["seq"] = _ID_STATE["ms"] + 1, 0
+        ms, seq = _ID_STATE["ms"], _ID_STATE["seq"]
+    day = datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+    value = ((((ms % 86_400_000) << _ID_SEQ_BITS) | seq) << _ID_NODE_BITS) | _ID_NODE
+    chars = []
+    for _ in range(12):
+        chars.append(_ID_ALPHABET[value & 31])
+        value >>= 5
+    return f"{prefix}{day.strftime('%y%m%d')}{''.join(reversed(chars))}"
+
+
+def _generate_order_id() -> str:
+    return _new_id()
 
 def _month_key(dt: Optional[datetime] = None) -> str:
     d = dt or datetime.now(timezone.utc)
@@ -588,18 +634,40 @@ def _build_goals(customer: dict, root_tree: dict, customers_raw: List[dict], cfg
 
     return goals
 
-def _persist_customer_dashboard_fields(customer_id: Any, goals: List[dict], network_members: List[dict], buy_again_ids: List[str]) -> None:
+# Per-container counters, emitted with every dashboard_fields_write log line
+_dashboard_fields_writes: Dict[str, int] = {"written": 0, "skipped": 0, "failed": 0}
+
+def _persist_customer_dashboard_fields(customer: Optional[dict], goals: List[dict], network_members: List[dict], buy_again_ids: List[str]) -> str:
+    """
+    Write the dashboard copy on CUSTOMER only when its content changed. The content hash is
+    stored next to the fields and the update is conditional on it. -> written | skipped | failed
+    """
+    customer_id = customer.get("customerId") if isinstance(customer, dict) else None
     if customer_id is None:
-        return
-    try:
-        _update_by_id(
-            "CUSTOMER",
-            customer_id,
-            "SET goals = :g, networkMembers = :n, buyAgainIds = :b, updatedAt = :u",
-            {":g": goals, ":n": network_members, ":b": buy_again_ids, ":u": _now_iso()},
-        )
-    except Exception:
-        pass
+        return "skipped"
+    fields_hash = _content_hash({"goals": goals, "networkMembers": network_members, "buyAgainIds": buy_again_ids})
+    if customer.get("dashboardFieldsHash") == fields_hash:
+        result = "skipped"
+    else:
+        try:
+            _update_by_id(
+                "CUSTOMER",
+                customer_id,
+                "SET goals = :g, networkMembers = :n, buyAgainIds = :b, dashboardFieldsHash = :h, updatedAt = :u",
+                _floats_to_decimal({
+                    ":g": goals, ":n": network_members, ":b": buy_again_ids,
+                    ":h": fields_hash, ":u": _now_iso(),
+                }),
+                condition_expression="attribute_not_exists(dashboardFieldsHash) OR dashboardFieldsHash <> :h",
+            )
+            result = "written"
+        except Exception as exc:
+            # A concurrent request already stored the same content
+            conflict = (getattr(exc, "response", None) or {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException"
+            result = "skipped" if conflict else "failed"
+    _dashboard_fields_writes[result] += 1
+    print(json.dumps({"event": "dashboard_fields_write", "customerId": str(customer_id), "result": result, "totals": dict(_dashboard_fields_writes)}))
+    return result
 
 def _compute_buy_again_ids_and_maybe_update(customer: Optional[dict], products: List[dict]) -> Tuple[List[str], bool]:
     if not customer or not isinstance(customer, dict):
@@ -636,7 +704,8 @@ def _ref_pk(entity: str, entity_id: Any) -> str:
 def _make_bucket_sk(created_at_iso: str, entity_id: Any) -> str:
     return f"{created_at_iso}#{entity_id}"
 
-def _put_entity(entity: str, entity_id: Any, item: dict, created_at_iso: Optional[str] = None) -> dict:
+def _put_entity(entity: str, entity_id: Any, item: dict, created_at_iso: Optional[str] = None, unique: bool = False) -> dict:
+    """unique=True writes the REF first with attribute_not_exists (freshly generated IDs)."""
     entity = entity.upper()
     created_at = created_at_iso or item.get("createdAt") or _now_iso()
     sk = item.get("SK") or _make_bucket_sk(created_at, entity_id)
@@ -671,8 +740,17 @@ def _put_entity(entity: str, entity_id: Any, item: dict, created_at_iso: Optiona
             addressCount=len(main_item.get("addresses") or main_item.get("shippingAddresses") or []),
         )
     try:
-        _table.put_item(Item=main_item)
-        _table.put_item(Item=ref_item)
+        if unique:
+            try:
+                _table.put_item(Item=ref_item, ConditionExpression="attribute_not_exists(PK)")
+            except Exception as exc:
+                if (getattr(exc, "response", None) or {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                    raise EntityIdCollision(f"{entity}#{entity_id}") from exc
+                raise
+            _table.put_item(Item=main_item)
+        else:
+            _table.put_item(Item=main_item)
+            _table.put_item(Item=ref_item)
     except Exception as exc:
         if entity in {"ORDER", "CUSTOMER"}:
             _address_log(
@@ -714,6 +792,7 @@ def _update_by_id(
     eav: dict,
     ean: Optional[dict] = None,
     return_values: str = "ALL_NEW",
+    condition_expression: Optional[str] = None,
 ) -> dict:
     ref = _get_ref(entity, entity_id)
     if not ref:
@@ -729,6 +808,8 @@ def _update_by_id(
     }
     if ean:
         kwargs["ExpressionAttributeNames"] = ean
+    if condition_expression:
+        kwargs["ConditionExpression"] = condition_expression
 
     if str(entity).upper() == "CUSTOMER":
         _address_log(
@@ -804,6 +885,17 @@ def _query_bucket(entity: str, limit: Optional[int] = None, scan_forward: bool =
             
     return items
 
+def _batch_get_items(keys: List[dict]) -> List[dict]:
+    """BatchGetItem in chunks of 100 (retrying unprocessed keys); missing keys are skipped."""
+    items: List[dict] = []
+    for start in range(0, len(keys), 100):
+        request = {TABLE_NAME: {"Keys": keys[start:start + 100]}}
+        while request:
+            resp = _dynamodb.batch_get_item(RequestItems=request)
+            items.extend(resp.get("Responses", {}).get(TABLE_NAME, []))
+            request = resp.get("UnprocessedKeys") or None
+    return items
+
 def _query_exact_pk(pk: str, limit: Optional[int] = None, scan_forward: bool = False) -> List[dict]:
     items = []
     query_kwargs = {
@@ -2125,12 +2217,290 @@ def _upline_chain(buyer_id: Any, max_levels: Optional[int] = 3, safety_cap: int
 
     return chain
 
+# ---------------------------------------------------------------------------
+# KPI Counters (KPI#<scope>#<period>)
+# ---------------------------------------------------------------------------
+# Shared with the micro lambdas: writers apply atomic ADDs and the admin dashboard reads one
+# item per counter instead of draining ORDER / STOCK_TRANSFER / POS_SALE.
+#   KPI#ORDERS#ALL          ordersTotal, salesTotal, status_<status>
+#   KPI#TRANSFERS#ALL       status_<status>
+#   KPI#POS#<yyyy-mm-dd>    salesCount, salesTotal
+#   KPI#COMMISSIONS#<month> pendingDeposit, confirmedTotal
+# A failed ADD never breaks the business write; the micro dashboard job (RECONCILE_KPIS)
+# recounts from the source partitions and fixes drift.
+KPI_SK = "TOTALS"
+KPI_ALL = "ALL"
+
+def _kpi_key(scope: str, period: str = KPI_ALL) -> dict:
+    return {"PK": f"KPI#{scope}#{period}", "SK": KPI_SK}
+
+def _kpi_status_attr(status: Any) -> Optional[str]:
+    status = str(status or "").strip().lower()
+    return f"status_{status}" if status else None
+
+COUNTER_ADD_MAX_ATTRS = 100  # attributes per UpdateItem (keeps the expression under 4 KB)
+
+def _counter_add(key: dict, deltas: Dict[str, Any], tag: str) -> None:
+    """Atomic ADD of several counters on one item; failures are logged under `tag` and swallowed."""
+    deltas = {attr: _to_decimal(delta) for attr, delta in deltas.items() if attr and _to_decimal(delta) != 0}
+    ordered = sorted(deltas.items())
+    for start in range(0, len(ordered), COUNTER_ADD_MAX_ATTRS):
+        names, values, parts = {"#u": "updatedAt"}, {":u": _now_iso()}, []
+        for idx, (attr, delta) in enumerate(ordered[start:start + COUNTER_ADD_MAX_ATTRS]):
+            names[f"#k{idx}"] = attr
+            values[f":k{idx}"] = delta
+            parts.append(f"#k{idx} :k{idx}")
+        try:
+            _table.update_item(
+                Key=key,
+                UpdateExpression="SET #u = :u ADD " + ", ".join(parts),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+        except Exception as e:
+            print(f"{tag} key={key['PK']} err={e}")
+
+def _kpi_add(scope: str, period: str, deltas: Dict[str, Any]) -> None:
+    _counter_add(_kpi_key(scope, period), deltas, "[kpi][add][error]")
+
+def _order_kpi_total(order: dict) -> Decimal:
+    return _to_decimal(order.get("netTotal") or order.get("total") or 0)
+
+def _kpi_order_created(order: dict) -> None:
+    deltas: Dict[str, Any] = {"ordersTotal": 1, "salesTotal": _order_kpi_total(order)}
+    status_attr = _kpi_status_attr(order.get("status"))
+    if status_attr:
+        deltas[status_attr] = 1
+    _kpi_add("ORDERS", KPI_ALL, deltas)
+
+def _kpi_status_change(scope: str, previous_status: Any, new_status: Any) -> None:
+    before, after = _kpi_status_attr(previous_status), _kpi_status_attr(new_status)
+    if before == after:
+        return
+    deltas = {}
+    if before:
+        deltas[before] = -1
+    if after:
+        deltas[after] = 1
+    _kpi_add(scope, KPI_ALL, deltas)
+
+def _kpi_pos_sale(sale: dict) -> None:
+    day = str(sale.get("createdAt") or _now_iso())[:10]
+    _kpi_add("POS", day, {"salesCount": 1, "salesTotal": sale.get("total")})
+
+def _commission_pending_deposit(item: Optional[dict]) -> bool:
+    return bool(item) and _to_decimal(item.get("totalConfirmed")) > 0 and (item.get("status") or "") != "PAID"
+
+def _kpi_commission_month_change(before: Optional[dict], after: Optional[dict]) -> None:
+    month_key = str((after or before or {}).get("monthKey") or "").strip()
+    if not month_key:
+        return
+    _kpi_add("COMMISSIONS", month_key, {
+        "pendingDeposit": int(_commission_pending_deposit(after)) - int(_commission_pending_deposit(before)),
+        "confirmedTotal": _to_decimal((after or {}).get("totalConfirmed")) - _to_decimal((before or {}).get("totalConfirmed")),
+    })
+
+def _get_kpis(keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], dict]:
+    """One BatchGetItem for a handful of counters; missing counters come back as {}."""
+    found = {item.get("PK"): item for item in _batch_get_items([_kpi_key(scope, period) for scope, period in keys])}
+    return {(scope, period): found.get(_kpi_key(scope, period)["PK"]) or {} for scope, period in keys}
+
+def _kpi_int(item: dict, attr: str) -> int:
+    return int(_to_decimal((item or {}).get(attr)))
+
+# ---------------------------------------------------------------------------
+# Daily Sales Rollups (ROLLUP#SALES#<yyyy-mm-dd>)
+# ---------------------------------------------------------------------------
+# Shared with the micro lambdas: one item per day of flat ADD counters per event and dimension:
+#   <event>#orders | <event>#qty | <event>#amount                 day totals
+#   <event>#channel#<online|pickup|pos>#qty | #amount
+#   <event>#stock#<stockId|unassigned>#qty | #amount
+#   <event>#product#<productId>#qty | #amount
+# Events: paid (sale recognised when leaving pending, or at POS registration), delivered and
+# refunded. Amounts are netTotal; per product the order discount is prorated over its lines.
+# The day is the day of the transition. Period reports sum days with one BatchGetItem
+# (_get_sales_rollups) and never read ORDER.
+SALES_ROLLUP_EVENTS = ("paid", "delivered", "refunded")
+SALES_ROLLUP_DIMENSIONS = {"channel": "byChannel", "stock": "byStock", "product": "byProduct"}
+SALES_ROLLUP_MAX_DAYS = 370
+_SALES_ROLLUP_UNPAID = ("", "pending")
+_SALES_ROLLUP_SOLD = ("paid", "shipped", "delivered")
+
+def _sales_rollup_key(day: str) -> dict:
+    return {"PK": f"ROLLUP#SALES#{day}", "SK": KPI_SK}
+
+def _order_sales_channel(order: dict) -> str:
+    if str(order.get("orderId") or "").startswith("POS-"):
+        return "pos"
+    return "pickup" if order.get("deliveryType") == "pickup" else "online"
+
+def _sales_rollup_deltas(order: dict, events: List[str], channel: Optional[str] = None) -> Dict[str, Decimal]:
+    deltas: Dict[str, Decimal] = {}
+
+    def add(attr: str, value) -> None:
+        deltas[attr] = deltas.get(attr, D_ZERO) + _to_decimal(value)
+
+    lines = []
+    for line in order.get("items") or []:
+        pid = str(line.get("productId") or "").strip()
+        qty = int(line.get("quantity") or line.get("qty") or 0)
+        if pid and qty > 0:
+            lines.append((pid, qty, _to_decimal(line.get("price")) * qty))
+    net = _order_kpi_total(order)
+    gross = sum((amount for _, _, amount in lines), D_ZERO)
+    qty_total = sum(qty for _, qty, _ in lines)
+    dimensions = (("channel", channel or _order_sales_channel(order)),
+                  ("stock", str(order.get("stockId") or order.get("pickupStockId") or "unassigned")))
+    for event in events:
+        add(f"{event}#orders", 1)
+        add(f"{event}#qty", qty_total)
+        add(f"{event}#amount", net)
+        for dimension, value in dimensions:
+            add(f"{event}#{dimension}#{value}#qty", qty_total)
+            add(f"{event}#{dimension}#{value}#amount", net)
+        for pid, qty, amount in lines:
+            add(f"{event}#product#{pid}#qty", qty)
+            add(f"{event}#product#{pid}#amount", (net * amount / gross).quantize(D_CENT) if gross > 0 else D_ZERO)
+    return deltas
+
+def _sales_rollup_order_status_change(order: dict, previous_status: Any, new_status: Any) -> None:
+    before = str(previous_status or "").strip().lower()
+    after = str(new_status or "").strip().lower()
+    if before == after:
+        return
+    events = []
+    if after in _SALES_ROLLUP_SOLD and before in _SALES_ROLLUP_UNPAID:
+        events.append("paid")
+    if after in ("delivered", "refunded"):
+        events.append(after)
+    if events:
+        _counter_add(_sales_rollup_key(_now_iso()[:10]), _sales_rollup_deltas(order, events), "[sales_rollup][add][error]")
+
+def _sales_rollup_pos_order(order: dict) -> None:
+    """POS orders are registered already paid (and delivered when handed over at the branch)."""
+    status = str(order.get("status") or "").strip().lower()
+    events = (["paid"] if status in _SALES_ROLLUP_SOLD else []) + (["delivered"] if status == "delivered" else [])
+    if events:
+        day = str(order.get("createdAt") or _now_iso())[:10]
+        _counter_add(_sales_rollup_key(day), _sales_rollup_deltas(order, events, channel="pos"), "[sales_rollup][add][error]")
+
+def _sales_rollup_days(start_day: str, end_day: str) -> List[str]:
+    """Days in [start_day, end_day]; ValueError on malformed dates or an invalid span."""
+    start = datetime.strptime(start_day, "%Y-%m-%d")
+    end = datetime.strptime(end_day, "%Y-%m-%d")
+    span = (end - start).days + 1
+    if span < 1 or span > SALES_ROLLUP_MAX_DAYS:
+        raise ValueError(f"el rango debe ser de 1 a {SALES_ROLLUP_MAX_DAYS} dias")
+    return [(start + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(span)]
+
+def _get_sales_rollups(start_day: str, end_day: str, group_by: str = "total") -> dict:
+    """
+    Sum the rollups of a date range (one BatchGetItem) grouped by "total", "month" or "day".
+    Each period has totals[event] (plus net = paid - refunded) and
+    byChannel/byStock/byProduct[value][event] = {qty, amount}.
+    """
+    days = _sales_rollup_days(start_day, end_day)
+    period_of = {"total": lambda d: f"{days[0]}..{days[-1]}", "month": lambda d: d[:7], "day": lambda d: d}[group_by]
+    stored = {item.get("PK"): item for item in _batch_get_items([_sales_rollup_key(day) for day in days])}
+
+    periods: Dict[str, dict] = {}
+    for day in days:
+        period = period_of(day)
+        bucket = periods.setdefault(period, {
+            "period": period,
+            "totals": {event: {"orders": D_ZERO, "qty": D_ZERO, "amount": D_ZERO} for event in SALES_ROLLUP_EVENTS},
+            **{field: {} for field in SALES_ROLLUP_DIMENSIONS.values()},
+        })
+        for attr, value in (stored.get(_sales_rollup_key(day)["PK"]) or {}).items():
+            parts = attr.split("#")
+            if len(parts) < 2 or parts[0] not in SALES_ROLLUP_EVENTS:
+                continue
+            event, metric = parts[0], parts[-1]
+            if len(parts) == 2:
+                target = bucket["totals"][event]
+            elif len(parts) >= 4 and parts[1] in SALES_ROLLUP_DIMENSIONS:
+                values = bucket[SALES_ROLLUP_DIMENSIONS[parts[1]]].setdefault("#".join(parts[2:-1]), {})
+                target = values.setdefault(event, {"qty": D_ZERO, "amount": D_ZERO})
+            else:
+                continue
+            target[metric] = target.get(metric, D_ZERO) + _to_decimal(value)
+
+    for bucket in periods.values():
+        paid, refunded = bucket["totals"]["paid"], bucket["totals"]["refunded"]
+        bucket["totals"]["net"] = {key: paid[key] - refunded[key] for key in ("orders", "qty", "amount")}
+    return {"from": days[0], "to": days[-1], "groupBy": group_by, "days": len(days), "periods": list(periods.values())}
+
 # ---------------------------------------------------------------------------
 # Commission Ledger
 # ---------------------------------------------------------------------------
 def _commission_month_sk(beneficiary_id: Any, month_key: str) -> str:
     return f"#BENEFICIARY#{beneficiary_id}#MONTH#{month_key}"
 
+# Month mirror of COMMISSION_MONTH for admin summaries: COMMISSION_MONTH#<monthKey>#<segment> / SK <beneficiaryId>.
+# Beneficiaries are spread by hash over segments that are read in parallel; every write to a
+# COMMISSION_MONTH item goes through _put_commission_month / _update_commission_month so the
+# mirror stays in sync. Changing the segment count requires re-running the backfill.
+COMMISSION_MONTH_INDEX_SEGMENTS = 4
+
+def _commission_month_beneficiary_key(beneficiary_id: Any) -> str:
+    try:
+        return str(int(beneficiary_id))
+    except (TypeError, ValueError):
+        return str(beneficiary_id or "").strip()
+
+def _commission_month_index_pk(month_key: str, segment: int) -> str:
+    return f"COMMISSION_MONTH#{month_key}#{segment}"
+
+def _commission_month_index_item(item: Optional[dict]) -> Optional[dict]:
+    beneficiary_key = _commission_month_beneficiary_key((item or {}).get("beneficiaryId"))
+    month_key = str((item or {}).get("monthKey") or "").strip()
+    if not beneficiary_key or not month_key:
+        return None
+    segment = int(hashlib.sha1(beneficiary_key.encode("utf-8")).hexdigest()[:8], 16) % COMMISSION_MONTH_INDEX_SEGMENTS
+    row = {k: v for k, v in item.items() if k not in ("PK", "SK")}
+    row.update({"PK": _commission_month_index_pk(month_key, segment), "SK": beneficiary_key, "entityType": "commissionMonthIndex"})
+    return row
+
+def _sync_commission_month_index(items: List[Optional[dict]]) -> int:
+    written = 0
+    with _table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as writer:
+        for item in items:
+            row = _commission_month_index_item(item)
+            if row:
+                writer.put_item(Item=row)
+                written += 1
+    return written
+
+def _put_commission_month(item: dict, previous: Optional[dict] = None) -> None:
+    _table.put_item(Item=item)
+    _sync_commission_month_index([item])
+    _kpi_commission_month_change(previous, item)
+
+def _update_commission_month(
+    beneficiary_id: Any, month_key: str, previous: Optional[dict] = None, **update_kwargs
+) -> Optional[dict]:
+    """`previous` is the item as read before the write; omit it only when status and totalConfirmed do not change."""
+    resp = _table.update_item(
+        Key={"PK": "COMMISSION_MONTH", "SK": _commission_month_sk(beneficiary_id, month_key)},
+        ReturnValues="ALL_NEW",
+        **update_kwargs,
+    )
+    attrs = resp.get("Attributes")
+    _sync_commission_month_index([attrs])
+    if previous is not None:
+        _kpi_commission_month_change(previous, attrs)
+    return attrs
+
+def _query_commission_month(month_key: str) -> List[dict]:
+    """Every beneficiary of one month: one paginated query per segment, run in parallel."""
+    pks = [_commission_month_index_pk(month_key, seg) for seg in range(COMMISSION_MONTH_INDEX_SEGMENTS)]
+    with ThreadPoolExecutor(max_workers=len(pks)) as pool:
+        return [item for rows in pool.map(lambda pk: _query_exact_pk(pk, scan_forward=True), pks) for item in rows]
+
+def _backfill_commission_month_index() -> dict:
+    written = _sync_commission_month_index(_query_exact_pk("COMMISSION_MONTH", scan_forward=True))
+    return _json_response(200, {"ok": True, "written": written})
+
 def _get_commission_month_item(beneficiary_id: Any, month_key: str) -> Optional[dict]:
     if beneficiary_id is None or not month_key:
         return None
@@ -2246,8 +2616,8 @@ def _unlock_blocked_commissions_for_customer(customer_id: Any, month_key: str) -
             continue
 
         tp, tc, tb = _recalc_commission_totals(ledger)
-        _table.update_item(
-            Key={"PK": "COMMISSION_MONTH", "SK": _commission_month_sk(beneficiary_id, month_key)},
+        _update_commission_month(
+            beneficiary_id, month_key, previous=item,
             UpdateExpression="SET ledger = :l, totalPending = :tp, totalConfirmed = :tc, totalBlocked = :tb, updatedAt = :u",
             ExpressionAttributeValues={
                 ":l": ledger,
@@ -2284,8 +2654,8 @@ def _add_commission_to_ledger(
         row.update({k: v for k, v in meta.items() if v is not None})
 
     try:
-        _table.update_item(
-            Key={"PK": "COMMISSION_MONTH", "SK": _commission_month_sk(beneficiary_id, month_key)},
+        _update_commission_month(
+            beneficiary_id, month_key,
             UpdateExpression=(
                 "SET ledger = list_append(if_not_exists(ledger, :empty), :rows), "
                 "totalPending = if_not_exists(totalPending, :zero) + :amt, "
@@ -2374,8 +2744,8 @@ def _confirm_order_commissions(order_item: dict) -> List[dict]:
         tp, tc, tb = _recalc_commission_totals(ledger)
 
         # Persistir SOLO ledger+totales (no agrega nada)
-        _table.update_item(
-            Key={"PK": "COMMISSION_MONTH", "SK": _commission_month_sk(beneficiary_id, month_key)},
+        _update_commission_month(
+            beneficiary_id, month_key, previous=item,
             UpdateExpression="SET ledger = :l, totalPending = :tp, totalConfirmed = :tc, totalBlocked = :tb, updatedAt = :u",
             ExpressionAttributeValues={
                 ":l": ledger,
@@ -2443,8 +2813,8 @@ def _void_commissions_for_order(order_id: str, reason: str) -> List[dict]:
             continue
 
         try:
-            _table.update_item(
-                Key={"PK": "COMMISSION_MONTH", "SK": _commission_month_sk(beneficiary_id, month_key)},
+            _update_commission_month(
+                beneficiary_id, month_key, previous=item,
                 UpdateExpression="SET ledger = :ledger, totalPending = if_not_exists(totalPending, :zero) - :pd, totalConfirmed = if_not_exists(totalConfirmed, :zero) - :cd, totalBlocked = if_not_exists(totalBlocked, :zero) - :bd, updatedAt = :u",
                 ExpressionAttributeValues={
                     ":ledger": new_ledger, ":pd": pending_delta, ":cd": confirmed_delta, ":bd": blocked_delta, ":zero": D_ZERO, ":u": _now_iso(),
@@ -2480,6 +2850,227 @@ def _mercadolibre_config() -> dict:
         return {**cfg, **env_overrides}
     return cfg
 
+# Outbound HTTP: pooled keep-alive connections reused across warm invocations,
+# per-host timeouts, retries for idempotent calls, circuit breaker and latency histograms.
+_HTTP_IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+_HTTP_RETRY_STATUSES = {429, 502, 503, 504}
+_HTTP_LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+_HTTP_MAX_IDLE_PER_HOST = 8
+_HTTP_STATS_LOG_INTERVAL_SECONDS = 60.0
+_HTTP_DEFAULT_HOST_SETTINGS = {
+    "timeout": 15.0,
+    "retries": 2,
+    "backoffBase": 0.2,
+    "backoffMax": 2.0,
+    "failureThreshold": 5,
+    "resetSeconds": 30.0,
+}
+_HTTP_HOST_SETTINGS: Dict[str, dict] = {
+    "api.mercadopago.com": {"timeout": 10.0},
+    "api.envia.com": {"timeout": 8.0, "retries": 1},
+    "api-test.envia.com": {"timeout": 8.0, "retries": 1},
+}
+_HTTP_STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, http.client.CannotSendRequest)
+_HTTP_SSL_CONTEXT = ssl.create_default_context()
+_HTTP_LOCK = threading.Lock()
+_HTTP_IDLE: Dict[tuple, list] = {}
+_HTTP_BREAKERS: Dict[str, dict] = {}
+_HTTP_LATENCY: Dict[str, dict] = {}
+_HTTP_STATS_LOGGED_AT = [time.monotonic()]
+
+
+class _UpstreamHTTPError(Exception):
+    def __init__(self, code: int, body: bytes):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+        self.body = body or b""
+
+
+class _CircuitOpenError(Exception):
+    pass
+
+
+def _http_host_settings(host: str) -> dict:
+    return {**_HTTP_DEFAULT_HOST_SETTINGS, **(_HTTP_HOST_SETTINGS.get(host) or {})}
+
+
+def _http_breaker_allow(host: str, settings: dict) -> bool:
+    with _HTTP_LOCK:
+        breaker = _HTTP_BREAKERS.setdefault(host, {"failures": 0, "openedAt": None, "probing": False})
+        if breaker["openedAt"] is None:
+            return True
+        if time.monotonic() - breaker["openedAt"] < settings["resetSeconds"] or breaker["probing"]:
+            return False
+        breaker["probing"] = True  # Half-open: let a single probe through
+        return True
+
+
+def _http_breaker_record(host: str, ok: Optional[bool], settings: dict) -> None:
+    """ok=None releases a half-open probe without changing the circuit state."""
+    with _HTTP_LOCK:
+        breaker = _HTTP_BREAKERS.setdefault(host, {"failures": 0, "openedAt": None, "probing": False})
+        breaker["probing"] = False
+        if ok is None:
+            return
+        if ok:
+            breaker["failures"] = 0
+            breaker["openedAt"] = None
+            return
+        breaker["failures"] += 1
+        if breaker["openedAt"] is not None or breaker["failures"] >= settings["failureThreshold"]:
+            breaker["openedAt"] = time.monotonic()
+
+
+def _http_observe_latency(host: str, elapsed_ms: float, failed: bool) -> None:
+    idx = next((i for i, limit in enumerate(_HTTP_LATENCY_BUCKETS_MS) if elapsed_ms <= limit), len(_HTTP_LATENCY_BUCKETS_MS))
+    with _HTTP_LOCK:
+        hist = _HTTP_LATENCY.setdefault(
+            host, {"buckets": [0] * (len(_HTTP_LATENCY_BUCKETS_MS) + 1), "count": 0, "errors": 0, "totalMs": 0.0, "maxMs": 0.0}
+        )
+        hist["buckets"][idx] += 1
+        hist["count"] += 1
+        hist["errors"] += 1 if failed else 0
+        hist["totalMs"] += elapsed_ms
+        hist["maxMs"] = max(hist["maxMs"], elapsed_ms)
+
+
+def _http_stats() -> dict:
+    """Per-upstream latency histogram and circuit state for this warm container."""
+    labels = [f"le{limit}" for limit in _HTTP_LATENCY_BUCKETS_MS] + ["inf"]
+    with _HTTP_LOCK:
+        out = {}
+        for host, hist in _HTTP_LATENCY.items():
+            breaker = _HTTP_BREAKERS.get(host) or {}
+            out[host] = {
+                "count": hist["count"],
+                "errors": hist["errors"],
+                "avgMs": round(hist["totalMs"] / hist["count"], 1) if hist["count"] else 0,
+                "maxMs": round(hist["maxMs"], 1),
+                "buckets": dict(zip(labels, hist["buckets"])),
+                "circuit": "closed" if breaker.get("openedAt") is None else ("half_open" if breaker.get("probing") else "open"),
+            }
+        return out
+
+
+def _http_maybe_log_stats() -> None:
+    now = time.monotonic()
+    if now - _HTTP_STATS_LOGGED_AT[0] < _HTTP_STATS_LOG_INTERVAL_SECONDS:
+        return
+    _HTTP_STATS_LOGGED_AT[0] = now
+    print(f"[http_client] stats {json.dumps(_http_stats())}")
+
+
+def _http_send_once(method: str, parts, path: str, headers: dict, body: Optional[bytes], timeout: float) -> Tuple[int, dict, bytes]:
+    key = (parts.scheme, parts.hostname, parts.port)
+    for attempt in range(2):
+        with _HTTP_LOCK:
+            pool = _HTTP_IDLE.get(key)
+            conn = pool.pop() if pool else None
+        reused = conn is not None
+        if conn is None:
+            if parts.scheme == "https":
+                conn = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=timeout, context=_HTTP_SSL_CONTEXT)
+            else:
+                conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+        else:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            raw = resp.read()
+        except _HTTP_STALE_ERRORS:
+            conn.close()
+            if reused and attempt == 0:
+                continue  # The server closed the idle keep-alive connection; retry on a fresh one
+            raise
+        except BaseException:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            with _HTTP_LOCK:
+                pool = _HTTP_IDLE.setdefault(key, [])
+                if len(pool) < _HTTP_MAX_IDLE_PER_HOST:
+                    pool.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+        return resp.status, {k.lower(): v for k, v in resp.getheaders()}, raw
+    raise http.client.RemoteDisconnected("connection closed")
+
+
+def _http_request(
+    method: str,
+    url: str,
+    headers: Optional[dict] = None,
+    body: Optional[bytes] = None,
+    timeout_seconds: Optional[float] = None,
+    idempotent: Optional[bool] = None,
+    deadline: Optional[float] = None,
+) -> Tuple[int, bytes]:
+    """
+    Outbound call over the shared keep-alive pool. Idempotent calls are retried with
+    exponential backoff + jitter on network errors and 429/502/503/504; `deadline` is an
+    absolute time.monotonic() value no attempt or backoff may exceed. Raises the network
+    error of the last attempt or _CircuitOpenError.
+    """
+    method = method.upper()
+    parts = urllib.parse.urlsplit(url)
+    host = parts.hostname or ""
+    settings = _http_host_settings(host)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    req_headers = {"Connection": "keep-alive", **(headers or {})}
+    if idempotent is None:
+        idempotent = method in _HTTP_IDEMPOTENT_METHODS
+    max_retries = settings["retries"] if idempotent else 0
+    per_try = float(timeout_seconds or settings["timeout"])
+
+    attempt = 0
+    while True:
+        if not _http_breaker_allow(host, settings):
+            raise _CircuitOpenError(f"circuit open for {host}")
+        attempt_timeout = per_try
+        if deadline is not None:
+            attempt_timeout = min(per_try, deadline - time.monotonic())
+            if attempt_timeout <= 0:
+                _http_breaker_record(host, None, settings)
+                raise socket.timeout(f"deadline exceeded for {host}")
+        t0 = time.monotonic()
+        error = None
+        status, resp_headers, raw = 0, {}, b""
+        recorded = False
+        try:
+            try:
+                status, resp_headers, raw = _http_send_once(method, parts, path, req_headers, body, attempt_timeout)
+            except (OSError, http.client.HTTPException) as exc:
+                error = exc
+            failed = error is not None or status >= 500
+            _http_observe_latency(host, (time.monotonic() - t0) * 1000, failed)
+            _http_breaker_record(host, not failed, settings)
+            recorded = True
+        finally:
+            if not recorded:
+                # Non-network error: release a half-open probe so the breaker doesn't wedge
+                _http_breaker_record(host, None, settings)
+        _http_maybe_log_stats()
+
+        if (error is not None or status in _HTTP_RETRY_STATUSES) and attempt < max_retries:
+            pause = random.uniform(0, min(settings["backoffMax"], settings["backoffBase"] * (2 ** attempt)))
+            retry_after = resp_headers.get("retry-after")
+            if retry_after and retry_after.isdigit():
+                pause = min(settings["backoffMax"], float(retry_after))
+            if deadline is None or time.monotonic() + pause < deadline:
+                attempt += 1
+                time.sleep(pause)
+                continue
+        if error is not None:
+            raise error
+        return status, raw
+
+
 def _http_json_request(
     method: str,
     url: str,
@@ -2493,20 +3084,21 @@ def _http_json_request(
     body = None
     if payload is not None:
         body = json.dumps(payload, default=_json_default).encode("utf-8")
-    req = urllib.request.Request(url=url, data=body, headers=req_headers, method=method.upper())
     try:
-        with urllib.request.urlopen(req, timeout=timeout_seconds) as resp:
-            raw = resp.read().decode("utf-8") if resp else ""
-            return int(getattr(resp, "status", 200) or 200), (json.loads(raw) if raw else {})
-    except urllib.error.HTTPError as e:
-        raw = e.read().decode("utf-8") if getattr(e, "fp", None) else ""
+        status, raw_bytes = _http_request(method, url, headers=req_headers, body=body, timeout_seconds=timeout_seconds)
+    except Exception as e:
+        return 500, {"message": str(e)}
+    raw = raw_bytes.decode("utf-8") if raw_bytes else ""
+    if status >= 400:
         parsed = {}
         if raw:
             try:
                 parsed = json.loads(raw)
             except Exception:
                 parsed = {"raw": raw}
-        return int(e.code or 500), parsed
+        return int(status or 500), parsed
+    try:
+        return int(status or 200), (json.loads(raw) if raw else {})
     except Exception as e:
         return 500, {"message": str(e)}
 
@@ -2913,6 +3505,124 @@ def _validate_order_access(item: dict, headers: Optional[dict]) -> Optional[dict
         return None
     return _json_response(403, {"message": "No autorizado para consultar esta orden", "Error": "Forbidden"})
 
+# Idempotency-Key header -> IDEMPOTENCY#<key> item holding the stored response (TTL'd)
+_IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# An in-flight run holds the key for as long as the Lambda can run; until then it may still be writing
+_IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("LAMBDA_TIMEOUT_SECONDS", "900")) + 5
+_IDEMPOTENCY_MAX_KEY_LENGTH = 128
+
+def _idempotency_key(headers: Optional[dict]) -> Optional[str]:
+    for name, value in (headers or {}).items():
+        if str(name).lower() in ("idempotency-key", "x-idempotency-key") and str(value or "").strip():
+            return str(value).strip()
+    return None
+
+_idempotency_state = threading.local()
+
+def _idempotency_mark_written() -> None:
+    """Called by the handler right before its first write: from then on a failure keeps the key."""
+    _idempotency_state.wrote = True
+
+def _with_idempotency(scope: str, headers: Optional[dict], payload: Any, handler) -> dict:
+    """
+    Runs handler() once per (Idempotency-Key, scope). A retry with the same key and body
+    replays the stored response in one read; a different body gets 422 and a request still
+    in flight gets 409 with Retry-After. An exception, 5xx or `Error` response before the first
+    write releases the key; after it the key is kept as `failed` with the response, so a retry
+    gets that response instead of creating a second order or sale. No header: no-op.
+    """
+    key = _idempotency_key(headers)
+    if not key:
+        return handler()
+    if len(key) > _IDEMPOTENCY_MAX_KEY_LENGTH:
+        return _json_response(400, {"message": "Idempotency-Key invalida", "Error": "BadRequest"})
+
+    item_key = {"PK": f"IDEMPOTENCY#{key}", "SK": scope}
+    request_hash = _content_hash(payload or {})
+    now_epoch = int(time.time())
+
+    existing = _table.get_item(Key=item_key, ConsistentRead=True).get("Item")
+    stale_lock = (
+        existing is not None
+        and existing.get("status") == "in_progress"
+        and existing.get("requestHash") == request_hash
+        and int(existing.get("lockedUntil") or 0) < now_epoch
+    )
+    if existing is None or stale_lock:
+        existing = None
+        try:
+            _table.put_item(
+                Item={
+                    **item_key,
+                    "status": "in_progress",
+                    "requestHash": request_hash,
+                    "lockedUntil": now_epoch + _IDEMPOTENCY_LOCK_SECONDS,
+                    "createdAt": _now_iso(),
+                    "ttl": now_epoch + _IDEMPOTENCY_TTL_SECONDS,
+                },
+                ConditionExpression="attribute_not_exists(PK) OR (#s = :in_progress AND lockedUntil < :now)",
+                ExpressionAttributeNames={"#s": "status"},
+                ExpressionAttributeValues={":in_progress": "in_progress", ":now": now_epoch},
+            )
+        except Exception as exc:
+            if (getattr(exc, "response", None) or {}).get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+            existing = _table.get_item(Key=item_key, ConsistentRead=True).get("Item") or {}
+
+    if existing is not None:
+        if existing.get("requestHash") != request_hash:
+            return _json_response(422, {"message": "Idempotency-Key ya usada con otro cuerpo", "Error": "BadRequest"})
+        if existing.get("status") in ("completed", "failed"):
+            headers_out = dict(existing.get("responseHeaders") or {})
+            headers_out["Idempotent-Replayed"] = "true"
+            return {"statusCode": int(existing.get("statusCode") or 200), "headers": headers_out, "body": existing.get("responseBody") or "{}"}
+        response = _json_response(409, {"message": "Peticion en proceso", "Error": "Conflict", "retryable": True})
+        response["headers"]["Retry-After"] = "1"
+        return response
+
+    _idempotency_state.wrote = False
+    try:
+        response = handler()
+    except Exception:
+        if not _idempotency_state.wrote:
+            _table.delete_item(Key=item_key)
+            raise
+        response = _json_response(500, {
+            "message": "La peticion fallo despues de registrar cambios; revisa su estado antes de repetirla",
+            "Error": "PartialFailure",
+            "retryable": False,
+        })
+        _store_idempotent_response(item_key, request_hash, "failed", response)
+        raise
+    status_code = int(response.get("statusCode") or 200)
+    # Errors come back as 200 with an `Error` key: never replay them as completed
+    failed = status_code >= 500 or _response_has_error(response)
+    if failed and not _idempotency_state.wrote:
+        _table.delete_item(Key=item_key)
+        return response
+    _store_idempotent_response(item_key, request_hash, "failed" if failed else "completed", response)
+    return response
+
+def _response_has_error(response: dict) -> bool:
+    try:
+        body = json.loads(response.get("body") or "{}")
+    except (TypeError, ValueError):
+        return False
+    return isinstance(body, dict) and bool(body.get("Error"))
+
+def _store_idempotent_response(item_key: dict, request_hash: str, status: str, response: dict) -> None:
+    status_code = int(response.get("statusCode") or 200)
+    _table.put_item(Item={
+        **item_key,
+        "status": status,
+        "requestHash": request_hash,
+        "statusCode": status_code,
+        "responseHeaders": response.get("headers") or {},
+        "responseBody": response.get("body") or "",
+        "completedAt": _now_iso(),
+        "ttl": int(time.time()) + _IDEMPOTENCY_TTL_SECONDS,
+    })
+
 def _create_order(payload: dict, headers: Optional[dict] = None) -> dict:
     customer_id = payload.get("customerId")
     customer_name = payload.get("customerName")
@@ -3146,7 +3856,9 @@ def _create_order(payload: dict, headers: Optional[dict] = None) -> dict:
         shippingAddressId=order_item.get("shippingAddressId"),
         shippingAddressLabel=order_item.get("shippingAddressLabel"),
     )
-    main = _put_entity("ORDER", order_id, order_item, created_at_iso=now)
+    _idempotency_mark_written()
+    main = _put_entity("ORDER", order_id, order_item, created_at_iso=now, unique=True)
+    _kpi_order_created(order_item)
     print(
         f"[order][create][ok] order_id={order_id} status={order_item.get('status')} "
         "mercadopago_flow=not_started"
@@ -3258,6 +3970,30 @@ def _create_order(payload: dict, headers: Optional[dict] = None) -> dict:
 def _find_order(order_id: str) -> Optional[dict]:
     return _get_by_id("ORDER", order_id)
 
+def _update_order_status_if_unchanged(
+    order_id: str,
+    order_item: dict,
+    update_expression: str,
+    eav: dict,
+    ean: dict,
+) -> Optional[dict]:
+    # Only transition from the status we read; None means another writer won the race
+    prev = order_item.get("status")
+    eav = dict(eav)
+    if prev is None:
+        condition = "attribute_not_exists(#s)"
+    else:
+        condition = "#s = :prev_status"
+        eav[":prev_status"] = prev
+    try:
+        return _update_by_id("ORDER", order_id, update_expression, eav, ean=ean, condition_expression=condition)
+    except Exception as exc:
+        if (getattr(exc, "response", None) or {}).get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+        return None
+
+_ORDER_STATUS_CHANGED_RESPONSE = {"message": "El pedido cambio de estado; vuelve a intentarlo", "Error": "Conflict"}
+
 def _check_commission_requirements(
     beneficiary_id: Any,
     level: int,
@@ -3396,6 +4132,7 @@ def _apply_rewards_on_paid_order(order_item: dict) -> dict:
         "SET grossSubtotal = :g, discountRate = :dr, discountAmount = :da, netTotal = :n, monthKey = :mk, updatedAt = :u",
         {":g": gross, ":dr": discount_rate, ":da": discount_amount, ":n": net, ":mk": month_key, ":u": _now_iso()},
     )
+    _kpi_add("ORDERS", KPI_ALL, {"salesTotal": net - _order_kpi_total(order_item)})
 
     # Si es guest + referrer: comisión one-shot (solo referrer)
     if buyer_type == "guest" and referrer_id:
@@ -3445,7 +4182,7 @@ def _apply_rewards_on_paid_order(order_item: dict) -> dict:
         tp, tc, tb = _recalc_totals(ledger)
 
         # 3) Guardar el item mensual (reemplaza ledger + totales)
-        _table.put_item(Item={
+        _put_commission_month({
             "PK": "COMMISSION_MONTH",
             "SK": _commission_month_sk(beneficiary_id, month_key),
             "entityType": "commissionMonth",
@@ -3458,7 +4195,7 @@ def _apply_rewards_on_paid_order(order_item: dict) -> dict:
             "totalBlocked": tb,
             "createdAt": item.get("createdAt") or now,
             "updatedAt": _now_iso(),
-        })
+        }, previous=item)
 
         # Cache (opcional): ajusta solo por delta (idempotente)
         if delta_for_cache != 0:
@@ -3556,7 +4293,7 @@ def _apply_rewards_on_paid_order(order_item: dict) -> dict:
         tp, tc, tb = _recalc_totals(ledger)
 
         # 3) Persistir (ledger + totales recalculados)
-        _table.put_item(Item={
+        _put_commission_month({
             "PK": "COMMISSION_MONTH",
             "SK": _commission_month_sk(beneficiary_id, month_key),
             "entityType": "commissionMonth",
@@ -3569,7 +4306,7 @@ def _apply_rewards_on_paid_order(order_item: dict) -> dict:
             "totalBlocked": tb,
             "createdAt": item.get("createdAt") or now,
             "updatedAt": _now_iso(),
-        })
+        }, previous=item)
         print(f"Persisted commission month item for beneficiary_id: {beneficiary_id}, month_key: {month_key}")
         # Cache (opcional): ajusta solo por delta (idempotente)
         if delta_for_cache != 0:
@@ -3648,8 +4385,8 @@ def _update_order_status(order_id: str, payload: dict, headers: Optional[dict] =
             return _json_response(200, {"message": "Se requiere stock origen para enviar", "Error": "BadRequest"})
         if require_dispatch_lines_on_shipped and not dispatch_lines:
             return _json_response(200, {"message": "Se requieren lineas para descontar inventario", "Error": "BadRequest"})
+    deltas: Dict[str, int] = {}
     if status == "shipped" and prev_status != "shipped" and stock_id and dispatch_lines:
-        deltas: Dict[str, int] = {}
         for line in dispatch_lines:
             pid_key = str(line.get("productId"))
             qty = int(line.get("qty") or 0)
@@ -3659,6 +4396,14 @@ def _update_order_status(order_id: str, payload: dict, headers: Optional[dict] =
         _, stock_error = _apply_stock_delta(stock_id, deltas)
         if stock_error:
             return _json_response(200, {"message": stock_error, "Error": "BadRequest"})
+
+    updated = _update_order_status_if_unchanged(order_id, order_item, "SET " + ", ".join(updates), eav, ean)
+    if updated is None:
+        # Lost the race: give the stock back and leave the deltas to the winning writer
+        if deltas:
+            _apply_stock_delta(stock_id, {pid: -delta for pid, delta in deltas.items()})
+        return _json_response(200, _ORDER_STATUS_CHANGED_RESPONSE)
+    if deltas:
         for line in dispatch_lines:
             stock_movements.append(
                 _movement_payload(
@@ -3672,8 +4417,8 @@ def _update_order_status(order_id: str, payload: dict, headers: Optional[dict] =
                     )
                 )
             )
-
-    updated = _update_by_id("ORDER", order_id, "SET " + ", ".join(updates), eav, ean=ean)
+    _kpi_status_change("ORDERS", prev_status, status)
+    _sales_rollup_order_status_change(updated, prev_status, status)
 
     rewards_result = None
     if status == "paid" and prev_status != "paid":
@@ -3732,19 +4477,28 @@ def _update_order_status(order_id: str, payload: dict, headers: Optional[dict] =
 
 def _refund_order(order_id: str, payload: dict) -> dict:
     reason = payload.get("reason") or "refund"
-    if not _find_order(order_id):
+    order_item = _find_order(order_id)
+    if not order_item:
         return _json_response(200, {"message": "Pedido no encontrado", "Error": "NoEncontrado"})
 
-    _update_by_id("ORDER", order_id, "SET #s = :s, refundReason = :r, updatedAt = :u", {":s": "refunded", ":r": reason, ":u": _now_iso()}, ean={"#s": "status"})
+    updated = _update_order_status_if_unchanged(order_id, order_item, "SET #s = :s, refundReason = :r, updatedAt = :u", {":s": "refunded", ":r": reason, ":u": _now_iso()}, {"#s": "status"})
+    if updated is None:
+        return _json_response(200, _ORDER_STATUS_CHANGED_RESPONSE)
+    _kpi_status_change("ORDERS", order_item.get("status"), "refunded")
+    _sales_rollup_order_status_change(order_item, order_item.get("status"), "refunded")
     actions = _void_commissions_for_order(order_id, reason="refund")
     return _json_response(200, {"orderId": order_id, "status": "refunded", "commissionActions": actions})
 
 def _cancel_order(order_id: str, payload: dict) -> dict:
     reason = payload.get("reason") or "cancel"
-    if not _find_order(order_id):
+    order_item = _find_order(order_id)
+    if not order_item:
         return _json_response(200, {"message": "Pedido no encontrado", "Error": "NoEncontrado"})
 
-    _update_by_id("ORDER", order_id, "SET #s = :s, cancelReason = :r, updatedAt = :u", {":s": "canceled", ":r": reason, ":u": _now_iso()}, ean={"#s": "status"})
+    updated = _update_order_status_if_unchanged(order_id, order_item, "SET #s = :s, cancelReason = :r, updatedAt = :u", {":s": "canceled", ":r": reason, ":u": _now_iso()}, {"#s": "status"})
+    if updated is None:
+        return _json_response(200, _ORDER_STATUS_CHANGED_RESPONSE)
+    _kpi_status_change("ORDERS", order_item.get("status"), "canceled")
     actions = _void_commissions_for_order(order_id, reason="cancel")
     return _json_response(200, {"orderId": order_id, "status": "canceled", "commissionActions": actions})
 
@@ -4458,7 +5212,7 @@ def _create_inventory_movement(
     reference_id: Optional[str] = None,
 ) -> dict:
     now = _now_iso()
-    movement_id = f"MOV-{uuid.uuid4().hex[:12]}"
+    movement_id = _new_id("MOV-")
     item = {
         "entityType": "inventoryMovement",
         "movementId": movement_id,
@@ -4472,7 +5226,112 @@ def _create_inventory_movement(
         "createdAt": now,
         "updatedAt": now,
     }
-    return _put_entity("INVENTORY_MOVEMENT", movement_id, item, created_at_iso=now)
+    saved = _put_entity("INVENTORY_MOVEMENT", movement_id, item, created_at_iso=now, unique=True)
+    ledger_item = _movement_ledger_item(saved)
+    if ledger_item:
+        _table.put_item(Item=ledger_item)
+    return saved
+
+# Ledger particionado: PK MOVEMENT#<stockId>#<yyyy-mm>, SK <createdAt>#<movementId>
+_MOVEMENT_LEDGER_DEFAULT_DAYS = 30
+_MOVEMENT_LEDGER_MAX_MONTHS = 24
+_MOVEMENT_LEDGER_MAX_LIMIT = 500
+
+def _movement_ledger_item(movement: dict) -> Optional[dict]:
+    stock_id = str(movement.get("stockId") or "").strip()
+    movement_id = str(movement.get("movementId") or "").strip()
+    if not stock_id or not movement_id:
+        return None
+    created_at = str(movement.get("createdAt") or _now_iso())
+    item = {k: v for k, v in movement.items() if k not in ("PK", "SK")}
+    item["PK"] = f"MOVEMENT#{stock_id}#{created_at[:7]}"
+    item["SK"] = f"{created_at}#{movement_id}"
+    item["entityType"] = "inventoryMovementLedger"
+    return item
+
+def _movement_ledger_bound(raw: Any, end_of_day: bool = False) -> Optional[str]:
+    value = str(raw or "").strip()
+    if not value:
+        return None
+    if len(value) == 10:
+        datetime.strptime(value, "%Y-%m-%d")
+        return f"{value}T23:59:59Z" if end_of_day else f"{value}T00:00:00Z"
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
+
+def _movement_ledger_cursor(month_key: str, last_sk: Optional[str]) -> str:
+    payload = {"m": month_key}
+    if last_sk:
+        payload["sk"] = last_sk
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("utf-8").rstrip("=")
+
+def _query_movement_ledger(stock_id: str, query: dict) -> Tuple[List[dict], Optional[str]]:
+    to_iso = _movement_ledger_bound(query.get("to"), end_of_day=True) or _now_iso()
+    from_iso = _movement_ledger_bound(query.get("from")) or (
+        datetime.strptime(to_iso, "%Y-%m-%dT%H:%M:%SZ") - timedelta(days=_MOVEMENT_LEDGER_DEFAULT_DAYS)
+    ).strftime("%Y-%m-%dT%H:%M:%SZ")
+    if from_iso > to_iso:
+        raise ValueError("from debe ser anterior a to")
+
+    months: List[str] = []
+    year, month = int(to_iso[:4]), int(to_iso[5:7])
+    while f"{year:04d}-{month:02d}" >= from_iso[:7]:
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    if len(months) > _MOVEMENT_LEDGER_MAX_MONTHS:
+        raise ValueError(f"El rango no puede exceder {_MOVEMENT_LEDGER_MAX_MONTHS} meses")
+
+    page_size = min(max(int(query.get("limit") or 100), 1), _MOVEMENT_LEDGER_MAX_LIMIT)
+
+    start: Optional[dict] = None
+    raw_cursor = str(query.get("cursor") or "").strip()
+    if raw_cursor:
+        try:
+            padded = raw_cursor + ("=" * (-len(raw_cursor) % 4))
+            start = json.loads(base64.urlsafe_b64decode(padded.encode("utf-8")).decode("utf-8"))
+        except Exception:
+            raise ValueError("cursor invalido")
+        if not isinstance(start, dict) or start.get("m") not in months:
+            raise ValueError("cursor invalido")
+        months = months[months.index(start["m"]):]
+
+    filters = None
+    movement_type = (query.get("type") or "").strip().lower()
+    if movement_type:
+        filters = Attr("movementType").eq(movement_type)
+    product_id = _parse_int_or_str(query.get("productId")) if query.get("productId") not in (None, "") else None
+    if product_id is not None:
+        product_filter = Attr("productId").eq(product_id)
+        filters = product_filter if filters is None else filters & product_filter
+
+    items: List[dict] = []
+    for idx, month_key in enumerate(months):
+        pk = f"MOVEMENT#{stock_id}#{month_key}"
+        query_kwargs = {
+            "KeyConditionExpression": Key("PK").eq(pk) & Key("SK").between(from_iso, f"{to_iso}~"),
+            "ScanIndexForward": False,
+        }
+        if filters is not None:
+            query_kwargs["FilterExpression"] = filters
+        if start and start.get("m") == month_key and start.get("sk"):
+            query_kwargs["ExclusiveStartKey"] = {"PK": pk, "SK": start["sk"]}
+        while True:
+            query_kwargs["Limit"] = page_size - len(items)
+            resp = _table.query(**query_kwargs)
+            items.extend(resp.get("Items", []))
+            lek = resp.get("LastEvaluatedKey")
+            if len(items) >= page_size:
+                if lek:
+                    return items, _movement_ledger_cursor(month_key, lek.get("SK"))
+                if idx + 1 < len(months):
+                    return items, _movement_ledger_cursor(months[idx + 1], None)
+                return items, None
+            if not lek:
+                break
+            query_kwargs["ExclusiveStartKey"] = lek
+    return items, None
 
 def _product_display_name(product_id: Any) -> str:
     product_key = _parse_int_or_str(product_id)
@@ -4607,6 +5466,78 @@ def _pack_items_for_shipping(raw_items: List[dict]) -> List[dict]:
     return packages
 
 
+def _request_envia_rates(
+    api_key: str,
+    carrier: str,
+    origin: dict,
+    destination: dict,
+    packages: List[dict],
+    timeout: float,
+    deadline: Optional[float] = None,
+) -> List[dict]:
+    body = {
+        "origin": origin,
+        "destination": destination,
+        "packages": packages,
+        "shipment": {"type": 1, "carrier": carrier},
+    }
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json", "accept": "application/json"}
+    # Rating has no side effects, so it may be retried within the quote deadline
+    status, raw = _http_request(
+        "POST", _ENVIA_API_URL, headers=headers, body=json.dumps(body).encode("utf-8"),
+        timeout_seconds=timeout, idempotent=True, deadline=deadline,
+    )
+    if status >= 400:
+        raise _UpstreamHTTPError(status, raw)
+    result = json.loads(raw.decode("utf-8")) if raw else {}
+    return result.get("data") or []
+
+
+def _fan_out_shipping_carriers(
+    api_key: str,
+    carriers: List[str],
+    origin: dict,
+    destination: dict,
+    packages: List[dict],
+    deadline_seconds: float,
+) -> Dict[str, dict]:
+    """
+    Queries every carrier concurrently under one shared deadline.
+    Returns {carrier: {"carrier", "status": ok|error|timeout, "latencyMs", "rates", "error"?}}.
+    """
+    started = time.monotonic()
+    timeout = max(0.5, min(_SHIPPING_CARRIER_TIMEOUT_SECONDS, deadline_seconds))
+
+    def _call(carrier: str) -> dict:
+        t0 = time.monotonic()
+        try:
+            rates = _request_envia_rates(api_key, carrier, origin, destination, packages, timeout, started + deadline_seconds)
+            return {"carrier": carrier, "status": "ok", "rates": rates, "latencyMs": int((time.monotonic() - t0) * 1000)}
+        except _UpstreamHTTPError as exc:
+            print(f"[shipping_quote] HTTPError carrier={carrier}: {exc.code}")
+            error = f"HTTP {exc.code}"
+        except Exception as exc:
+            print(f"[shipping_quote] Error carrier={carrier}: {exc}")
+            error = str(exc)
+        return {"carrier": carrier, "status": "error", "rates": [], "error": error, "latencyMs": int((time.monotonic() - t0) * 1000)}
+
+    executor = ThreadPoolExecutor(max_workers=max(1, len(carriers)))
+    try:
+        futures = {executor.submit(_call, carrier): carrier for carrier in carriers}
+        done, _ = wait(futures, timeout=deadline_seconds)
+    finally:
+        executor.shutdown(wait=False)
+
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    results: Dict[str, dict] = {}
+    for future, carrier in futures.items():
+        if future in done:
+            results[carrier] = future.result()
+        else:
+            results[carrier] = {"carrier": carrier, "status": "timeout", "rates": [], "latencyMs": elapsed_ms}
+    return results
+
+
 def _get_shipping_quote(payload: dict) -> dict:
     """POST /shipping/quote"""
     api_key = _ENVIA_API_KEY
@@ -4650,6 +5581,7 @@ def _get_shipping_quote(payload: dict) -> dict:
     carriers: List[str] = shipping_cfg.get("carriers") or ["dhl", "fedex"]
     if not isinstance(carriers, list) or not carriers:
         carriers = ["dhl", "fedex"]
+    carriers = list(dict.fromkeys(carriers))
     markup = float(shipping_cfg.get("markup") or 0)
 
     origin = {
@@ -4673,43 +5605,31 @@ def _get_shipping_quote(payload: dict) -> dict:
         "postalCode": zip_to,
     }
 
+    deadline = float(shipping_cfg.get("quoteDeadlineSeconds") or _SHIPPING_QUOTE_DEADLINE_SECONDS)
+    carrier_results = _fan_out_shipping_carriers(api_key, carriers, origin, destination, packages, deadline)
+
     all_rates: List[dict] = []
+    carrier_status: List[dict] = []
     for carrier in carriers:
-        body = {
-            "origin": origin,
-            "destination": destination,
-            "packages": packages,
-            "shipment": {"type": 1, "carrier": carrier},
-        }
-        json_bytes = json.dumps(body).encode("utf-8")
-        req = urllib.request.Request(_ENVIA_API_URL, data=json_bytes)
-        req.add_header("Authorization", f"Bearer {api_key}")
-        req.add_header("Content-Type", "application/json")
-        req.add_header("accept", "application/json")
-        try:
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                result = json.loads(resp.read().decode("utf-8"))
-                for rate_item in result.get("data") or []:
-                    base_price = float(rate_item.get("totalPrice") or 0)
-                    display_price = round(base_price * (1 + markup), 2)
-                    delivery_date = rate_item.get("deliveryDate") or {}
-                    transit_days = delivery_date.get("dateDifference") if isinstance(delivery_date, dict) else None
-                    all_rates.append({
-                        "carrier": str(rate_item.get("carrierDescription") or rate_item.get("carrier") or carrier),
-                        "service": str(rate_item.get("serviceDescription") or rate_item.get("service") or ""),
-                        "price": base_price,
-                        "displayPrice": display_price,
-                        "currency": str(rate_item.get("currency") or "MXN"),
-                        "transitDays": int(transit_days) if transit_days is not None else None,
-                        "deliveryEstimate": str(rate_item.get("deliveryEstimate") or ""),
-                    })
-        except urllib.error.HTTPError as exc:
-            print(f"[shipping_quote] HTTPError carrier={carrier}: {exc.code}")
-        except Exception as exc:
-            print(f"[shipping_quote] Error carrier={carrier}: {exc}")
+        result = carrier_results[carrier]
+        for rate_item in result.pop("rates", []):
+            base_price = float(rate_item.get("totalPrice") or 0)
+            display_price = round(base_price * (1 + markup), 2)
+            delivery_date = rate_item.get("deliveryDate") or {}
+            transit_days = delivery_date.get("dateDifference") if isinstance(delivery_date, dict) else None
+            all_rates.append({
+                "carrier": str(rate_item.get("carrierDescription") or rate_item.get("carrier") or carrier),
+                "service": str(rate_item.get("serviceDescription") or rate_item.get("service") or ""),
+                "price": base_price,
+                "displayPrice": display_price,
+                "currency": str(rate_item.get("currency") or "MXN"),
+                "transitDays": int(transit_days) if transit_days is not None else None,
+                "deliveryEstimate": str(rate_item.get("deliveryEstimate") or ""),
+            })
+        carrier_status.append(result)
 
     all_rates.sort(key=lambda r: r.get("displayPrice") or 9999999)
-    return _json_response(200, {"rates": all_rates})
+    return _json_response(200, {"rates": all_rates, "carriers": carrier_status})
 
 
 def _list_pickup_stocks() -> dict:
@@ -4889,7 +5809,7 @@ def _create_stock_transfer(payload: dict, headers: Optional[dict] = None) -> dic
         return _json_response(200, {"message": error, "Error": "BadRequest"})
 
     now = _now_iso()
-    transfer_id = f"TRF-{uuid.uuid4().hex[:10].upper()}"
+    transfer_id = _new_id("TRF-")
     transfer_item = {
         "entityType": "stockTransfer",
         "transferId": transfer_id,
@@ -4901,7 +5821,8 @@ def _create_stock_transfer(payload: dict, headers: Optional[dict] = None) -> dic
         "createdAt": now,
         "updatedAt": now,
     }
-    transfer = _put_entity("STOCK_TRANSFER", transfer_id, transfer_item, created_at_iso=now)
+    transfer = _put_entity("STOCK_TRANSFER", transfer_id, transfer_item, created_at_iso=now, unique=True)
+    _kpi_status_change("TRANSFERS", None, "pending")
 
     movements = []
     for line in lines:
@@ -4954,6 +5875,7 @@ def _receive_stock_transfer(transfer_id: str, payload: dict, headers: Optional[d
         {":s": "received", ":ra": now, ":rb": receiver, ":u": now},
         ean={"#s": "status"},
     )
+    _kpi_status_change("TRANSFERS", transfer.get("status"), "received")
 
     movements = []
     for line in lines:
@@ -4989,6 +5911,13 @@ def _list_stock_transfers(query: dict) -> dict:
 def _list_inventory_movements(query: dict) -> dict:
     stock_id = _stock_id(query.get("stockId"))
     movement_type = (query.get("type") or "").strip().lower()
+    if stock_id:
+        try:
+            items, next_cursor = _query_movement_ledger(stock_id, query)
+        except ValueError as exc:
+            return _json_response(200, {"message": f"Parametros invalidos: {exc}", "Error": "BadRequest"})
+        return _json_response(200, {"movements": [_movement_payload(item) for item in items], "nextCursor": next_cursor})
+    # Sin almacen no hay particion que consultar: vista global legacy
     items = _query_bucket("INVENTORY_MOVEMENT")
     rows = []
     for item in items:
@@ -5000,6 +5929,14 @@ def _list_inventory_movements(query: dict) -> dict:
         rows.append(_movement_payload(item))
     return _json_response(200, {"movements": rows})
 
+def _backfill_movement_ledger() -> dict:
+    written = 0
+    with _table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as writer:
+        for item in filter(None, (_movement_ledger_item(m) for m in _query_bucket("INVENTORY_MOVEMENT"))):
+            writer.put_item(Item=item)
+            written += 1
+    return _json_response(200, {"ok": True, "written": written})
+
 def _pos_sale_payload(item: dict) -> dict:
     return {
         "id": item.get("saleId"),
@@ -5180,13 +6117,14 @@ def _register_pos_sale(payload: dict, headers: Optional[dict] = None) -> dict:
         if not customer:
             return _json_response(200, {"message": "Cliente no encontrado", "Error": "NoEncontrado"})
 
+    _idempotency_mark_written()
     updated_stock, error = _apply_stock_delta(stock_id, deltas)
     if error:
         return _json_response(200, {"message": error, "Error": "BadRequest"})
 
     now = _now_iso()
-    sale_id = _stock_id(payload.get("saleId") or f"SALE-{uuid.uuid4().hex[:10].upper()}")
-    order_id = _stock_id(payload.get("orderId") or f"POS-{uuid.uuid4().hex[:10].upper()}")
+    sale_id = _stock_id(payload.get("saleId") or _new_id("SALE-"))
+    order_id = _stock_id(payload.get("orderId") or _new_id("POS-"))
     buyer_type = "guest"
     if customer:
         buyer_type = "associate" if bool(customer.get("isAssociate", True)) else "registered"
@@ -5253,7 +6191,8 @@ def _register_pos_sale(payload: dict, headers: Optional[dict] = None) -> dict:
         "createdAt": now,
         "updatedAt": now,
     }
-    stored_order = _put_entity("ORDER", order_id, order_item, created_at_iso=now)
+    stored_order = _put_entity("ORDER", order_id, order_item, created_at_iso=now, unique=not payload.get("orderId"))
+    _kpi_order_created(order_item)
     if customer and order_status in {"paid", "delivered"}:
         _apply_rewards_on_paid_order(stored_order)
         stored_order = _find_order(order_id) or stored_order
@@ -5264,7 +6203,9 @@ def _register_pos_sale(payload: dict, headers: Optional[dict] = None) -> dict:
                 pass
             stored_order = _find_order(order_id) or stored_order
 
-    sale = _put_entity("POS_SALE", sale_id, sale_item, created_at_iso=now)
+    sale = _put_entity("POS_SALE", sale_id, sale_item, created_at_iso=now, unique=not payload.get("saleId"))
+    _kpi_pos_sale(sale_item)
+    _sales_rollup_pos_order(order_item)
 
     movements = []
     for line in lines:
@@ -5430,6 +6371,62 @@ def _update_customer_clabe(payload: dict) -> dict:
     )
     return _json_response(200, {"ok": True, "clabeLast4": clabe[-4:]})
 
+# Receipt indexes: COMMISSION_RECEIPT#<customerId> / SK <monthKey>#<receiptId> (dashboard lookups)
+# and COMMISSION_RECEIPT_MONTH#<monthKey> / SK <customerId>#<receiptId> (admin summaries)
+def _receipt_customer_pk(customer_id: Any) -> str:
+    return f"COMMISSION_RECEIPT#{customer_id}"
+
+def _receipt_month_pk(month_key: str) -> str:
+    return f"COMMISSION_RECEIPT_MONTH#{month_key}"
+
+def _receipt_index_items(receipt: dict) -> List[dict]:
+    customer_id = receipt.get("customerId")
+    month_key = str(receipt.get("monthKey") or "").strip()
+    receipt_id = str(receipt.get("receiptId") or "").strip()
+    if customer_id is None or not month_key or not receipt_id:
+        return []
+    base = {k: v for k, v in receipt.items() if k not in ("PK", "SK")}
+    return [
+        {**base, "PK": _receipt_customer_pk(customer_id), "SK": f"{month_key}#{receipt_id}"},
+        {**base, "PK": _receipt_month_pk(month_key), "SK": f"{customer_id}#{receipt_id}"},
+    ]
+
+def _put_commission_receipt(receipt_id: str, item: dict, created_at_iso: Optional[str] = None) -> dict:
+    main = _put_entity("COMMISSION_RECEIPT", receipt_id, item, created_at_iso=created_at_iso)
+    with _table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as writer:
+        for index_item in _receipt_index_items(main):
+            writer.put_item(Item=index_item)
+    return main
+
+def _get_customer_receipts(customer_id: Any, month_key: str) -> List[dict]:
+    query_kwargs = {
+        "KeyConditionExpression": Key("PK").eq(_receipt_customer_pk(customer_id)) & Key("SK").begins_with(f"{month_key}#"),
+    }
+    items: List[dict] = []
+    while True:
+        resp = _table.query(**query_kwargs)
+        items.extend(resp.get("Items", []))
+        lek = resp.get("LastEvaluatedKey")
+        if not lek:
+            break
+        query_kwargs["ExclusiveStartKey"] = lek
+    return items
+
+def _latest_receipt_url(receipts: List[dict]) -> str:
+    """Receipt ids end in a uuid, so recency comes from createdAt, not from the SK order."""
+    with_url = [r for r in receipts if r.get("assetUrl")]
+    latest = max(with_url, key=lambda r: str(r.get("createdAt") or ""), default=None)
+    return latest.get("assetUrl") if latest else ""
+
+def _backfill_receipt_index() -> dict:
+    written = 0
+    with _table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as writer:
+        for receipt in _query_bucket("COMMISSION_RECEIPT"):
+            for index_item in _receipt_index_items(receipt):
+                writer.put_item(Item=index_item)
+                written += 1
+    return _json_response(200, {"ok": True, "written": written})
+
 def _upload_commission_receipt(payload: dict) -> dict:
     customer_id = payload.get("customerId")
     month_key = payload.get("monthKey") or payload.get("month") or _month_key()
@@ -5451,7 +6448,7 @@ def _upload_commission_receipt(payload: dict) -> dict:
         "monthKey": month_key, "assetId": asset.get("assetId"), "assetUrl": asset.get("url"),
         "status": "uploaded", "createdAt": now, "updatedAt": now,
     }
-    main = _put_entity("COMMISSION_RECEIPT", receipt_id, receipt_item, created_at_iso=now)
+    main = _put_commission_receipt(receipt_id, receipt_item, created_at_iso=now)
     return _json_response(201, {"receipt": main, "asset": asset})
 
 def _upload_admin_commission_receipt(payload: dict, headers: Optional[dict] = None) -> dict:
@@ -5475,10 +6472,10 @@ def _upload_admin_commission_receipt(payload: dict, headers: Optional[dict] = No
         "monthKey": month_key, "assetId": asset.get("assetId"), "assetUrl": asset.get("url"),
         "status": "paid", "createdAt": now, "updatedAt": now,
     }
-    main = _put_entity("COMMISSION_RECEIPT", receipt_id, receipt_item, created_at_iso=now)
+    main = _put_commission_receipt(receipt_id, receipt_item, created_at_iso=now)
     try:
-        _table.update_item(
-            Key={"PK": "COMMISSION_MONTH", "SK": _commission_month_sk(int(customer_id), month_key)},
+        _update_commission_month(
+            int(customer_id), month_key, previous=_get_commission_month_item(int(customer_id), month_key) or {},
             UpdateExpression="SET #s = :s, updatedAt = :u",
             ExpressionAttributeNames={"#s": "status"},
             ExpressionAttributeValues={":s": "PAID", ":u": _now_iso()},
@@ -5773,9 +6770,7 @@ def _commissions_paid_summary(month_key: str, customers_raw: List[dict]) -> dict
     if not month_key:
         return {"monthKey": "", "count": 0, "total": 0.0, "rows": []}
     
-    # Optimized: Query bucket ledger directly
-    resp = _table.query(KeyConditionExpression=Key("PK").eq("COMMISSION_MONTH"), FilterExpression=Attr("monthKey").eq(month_key))
-    items = resp.get("Items", []) or []
+    items = _query_commission_month(month_key)
 
     # Map customers for O(1) lookup
     customers_by_id = {str(c.get("customerId")): c for c in customers_raw}
@@ -5804,36 +6799,43 @@ def _commissions_paid_summary(month_key: str, customers_raw: List[dict]) -> dict
 
     return {"monthKey": month_key, "count": len(rows), "total": float(total), "rows": rows}
 
-def _get_admin_dashboard() -> dict:
-    app_cfg = _load_app_config()
-    # Optimized fetch all
-    customers_raw = _query_bucket("CUSTOMER")
-    orders_raw = _query_bucket("ORDER")
-    products_raw = _query_bucket("PRODUCT")
-    campaigns_raw = _query_bucket("CAMPAIGN")
-    receipts_raw = _query_bucket("COMMISSION_RECEIPT")
-    commission_month_items = _query_exact_pk("COMMISSION_MONTH")
-    pom_item = _get_product_of_month_item()
-    product_of_month_id = int(pom_item.get("productId")) if pom_item and pom_item.get("productId") is not None else None
+# Sectioned admin dashboard: GET /admin/dashboard/summary plus cursor-paginated sections
+# (GET /admin/dashboard/<section>?limit=&cursor=&fields=). GET /admin/dashboard is kept as a
+# compatibility shim that still returns every section in full.
+_ADMIN_DASHBOARD_DEFAULT_LIMIT = 50
+_ADMIN_DASHBOARD_MAX_LIMIT = 200
 
-    customers = []
-    customers_by_level = {}
-    commissions_count = 0
-    commissions_total = 0.0
+def _admin_customer_commission_maps(customer_ids: Optional[List[Any]] = None) -> Tuple[Dict[str, dict], Dict[str, str]]:
+    """
+    COMMISSION_MONTH rows (current and previous month) and previous-month receipt urls keyed by
+    "<customerId>#<monthKey>". customer_ids=None reads whole month mirrors (full dashboard);
+    a page of ids batch-gets just its mirror rows.
+    """
     prev_month_key = _prev_month_key()
     current_month_key = _month_key()
 
-    receipt_by_customer_month: Dict[str, str] = {}
-    for r in receipts_raw:
-        cid = r.get("customerId")
-        mk = r.get("monthKey")
-        url = r.get("assetUrl")
-        if cid is None or not mk or not url:
-            continue
-        key = f"{cid}#{mk}"
-        if key not in receipt_by_customer_month:
-            receipt_by_customer_month[key] = url
+    # Only the previous month is shown: read its mirror partition instead of every receipt
+    receipts_by_customer: Dict[str, List[dict]] = {}
+    for r in _query_exact_pk(_receipt_month_pk(prev_month_key), scan_forward=True):
+        if r.get("customerId") is not None:
+            receipts_by_customer.setdefault(str(r.get("customerId")), []).append(r)
+    receipt_by_customer_month: Dict[str, str] = {
+        f"{cid}#{prev_month_key}": _latest_receipt_url(rows) for cid, rows in receipts_by_customer.items()
+    }
 
+    if customer_ids is None:
+        commission_month_items = _query_commission_month(current_month_key) + _query_commission_month(prev_month_key)
+    else:
+        keys = [
+            {"PK": row["PK"], "SK": row["SK"]}
+            for row in (
+                _commission_month_index_item({"beneficiaryId": cid, "monthKey": mk})
+                for cid in customer_ids if cid is not None
+                for mk in (current_month_key, prev_month_key)
+            )
+            if row
+        ]
+        commission_month_items = _batch_get_items(keys)
     commission_month_by_customer_month: Dict[str, dict] = {}
     for item in commission_month_items:
         beneficiary_id = item.get("beneficiaryId")
@@ -5841,7 +6843,14 @@ def _get_admin_dashboard() -> dict:
         if beneficiary_id in (None, "") or not month_key:
             continue
         commission_month_by_customer_month[f"{beneficiary_id}#{month_key}"] = item
+    return commission_month_by_customer_month, receipt_by_customer_month
+
+def _admin_customer_rows(customers_raw: List[dict], customer_ids: Optional[List[Any]] = None) -> List[dict]:
+    commission_month_by_customer_month, receipt_by_customer_month = _admin_customer_commission_maps(customer_ids)
+    prev_month_key = _prev_month_key()
+    current_month_key = _month_key()
 
+    customers = []
     for item in customers_raw:
         comm = float(item.get("commissions") or 0)
         cid = item.get("customerId")
@@ -5878,90 +6887,92 @@ def _get_admin_dashboard() -> dict:
             "commissionsPrevReceiptUrl": prev_receipt_url,
             "clabeInterbancaria": clabe_interbancaria,
         })
+    return customers
+
+def _admin_order_payload(item: dict) -> dict:
+    return {
+        "id": item.get("orderId"), "createdAt": item.get("createdAt"),
+        "customer": item.get("customerName"), "total": float(item.get("netTotal") or item.get("total") or 0),
+        "status": item.get("status"),
+        "items": item.get("items") or [],
+        "stockId": item.get("stockId"),
+        "attendantUserId": item.get("attendantUserId"),
+        "paymentStatus": item.get("paymentStatus"),
+        "deliveryStatus": item.get("deliveryStatus"),
+        "shippingType": item.get("shippingType"),
+        "trackingNumber": item.get("trackingNumber"),
+        "deliveryPlace": item.get("deliveryPlace"),
+        "deliveryDate": item.get("deliveryDate"),
+        "recipientName": item.get("recipientName"),
+        "phone": item.get("phone"),
+        "street": item.get("street"),
+        "number": item.get("number"),
+        "address": item.get("address"),
+        "city": item.get("city"),
+        "postalCode": item.get("postalCode"),
+        "state": item.get("state"),
+        "country": item.get("country"),
+        "betweenStreets": item.get("betweenStreets"),
+        "references": item.get("references"),
+        "deliveryNotes": item.get("deliveryNotes"),
+        "deliveryType": item.get("deliveryType") or "delivery",
+        "pickupStockId": item.get("pickupStockId"),
+        "pickupPaymentMethod": item.get("pickupPaymentMethod"),
+    }
+
+def _admin_product_payload(item: dict) -> dict:
+    return {
+        "id": int(item.get("productId")), "name": item.get("name"),
+        "price": float(item.get("price") or 0), "active": bool(item.get("active")),
+        "sku": item.get("sku"), "hook": item.get("hook"),
+        "description": item.get("description"),
+        "copyFacebook": item.get("copyFacebook"),
+        "copyInstagram": item.get("copyInstagram"),
+        "copyWhatsapp": item.get("copyWhatsapp"),
+        "tags": item.get("tags"), "images": item.get("images"),
+        "variants": item.get("variants") or [],
+        "weightKg": float(item.get("weightKg")) if item.get("weightKg") is not None else None,
+        "lengthCm": float(item.get("lengthCm")) if item.get("lengthCm") is not None else None,
+        "widthCm": float(item.get("widthCm")) if item.get("widthCm") is not None else None,
+        "heightCm": float(item.get("heightCm")) if item.get("heightCm") is not None else None,
+        "categoryIds": item.get("categoryIds") or [],
+    }
+
+def _admin_dashboard_summary() -> dict:
+    """KPIs, status counts and warnings: counters plus CUSTOMER/PRODUCT tallies, no row payloads."""
+    app_cfg = _load_app_config()
+    pom_item = _get_product_of_month_item()
+    product_of_month_id = int(pom_item.get("productId")) if pom_item and pom_item.get("productId") is not None else None
+
+    customers_total = 0
+    customers_by_level = {}
+    commissions_count = 0
+    commissions_total = 0.0
+    for item in _query_bucket("CUSTOMER"):
+        customers_total += 1
         level = item.get("level") or "Sin nivel"
         customers_by_level[level] = customers_by_level.get(level, 0) + 1
+        comm = float(item.get("commissions") or 0)
         if comm > 0:
             commissions_count += 1
             commissions_total += comm
 
-    status_counts = {"pending": 0, "paid": 0, "delivered": 0, "shipped": 0, "canceled": 0, "refunded": 0}
-    sales_total = 0.0
-    orders = []
-    
-    for item in orders_raw:
-        st = (item.get("status") or "").lower()
-        if st in status_counts:
-            status_counts[st] += 1
-        tot = float(item.get("netTotal") or item.get("total") or 0)
-        sales_total += tot
-        orders.append({
-            "id": item.get("orderId"), "createdAt": item.get("createdAt"),
-            "customer": item.get("customerName"), "total": tot, "status": item.get("status"),
-            "items": item.get("items") or [],
-            "stockId": item.get("stockId"),
-            "attendantUserId": item.get("attendantUserId"),
-            "paymentStatus": item.get("paymentStatus"),
-            "deliveryStatus": item.get("deliveryStatus"),
-            "shippingType": item.get("shippingType"),
-            "trackingNumber": item.get("trackingNumber"),
-            "deliveryPlace": item.get("deliveryPlace"),
-            "deliveryDate": item.get("deliveryDate"),
-            "recipientName": item.get("recipientName"),
-            "phone": item.get("phone"),
-            "street": item.get("street"),
-            "number": item.get("number"),
-            "address": item.get("address"),
-            "city": item.get("city"),
-            "postalCode": item.get("postalCode"),
-            "state": item.get("state"),
-            "country": item.get("country"),
-            "betweenStreets": item.get("betweenStreets"),
-            "references": item.get("references"),
-            "deliveryNotes": item.get("deliveryNotes"),
-            "deliveryType": item.get("deliveryType") or "delivery",
-            "pickupStockId": item.get("pickupStockId"),
-            "pickupPaymentMethod": item.get("pickupPaymentMethod"),
-        })
-
-    active_products = 0
-    products = []
-    for item in products_raw:
-        if item.get("active"): active_products += 1
-        products.append({
-            "id": int(item.get("productId")), "name": item.get("name"),
-            "price": float(item.get("price") or 0), "active": bool(item.get("active")),
-            "sku": item.get("sku"), "hook": item.get("hook"),
-            "description": item.get("description"),
-            "copyFacebook": item.get("copyFacebook"),
-            "copyInstagram": item.get("copyInstagram"),
-            "copyWhatsapp": item.get("copyWhatsapp"),
-            "tags": item.get("tags"), "images": item.get("images"),
-            "variants": item.get("variants") or [],
-            "weightKg": float(item.get("weightKg")) if item.get("weightKg") is not None else None,
-            "lengthCm": float(item.get("lengthCm")) if item.get("lengthCm") is not None else None,
-            "widthCm": float(item.get("widthCm")) if item.get("widthCm") is not None else None,
-            "heightCm": float(item.get("heightCm")) if item.get("heightCm") is not None else None,
-            "categoryIds": item.get("categoryIds") or [],
-        })
+    active_products = sum(1 for item in _query_bucket("PRODUCT") if item.get("active"))
 
-    campaigns = [_campaign_payload(item) for item in campaigns_raw]
-    notifications = _list_notifications_for_admin()
-
-    stock_transfers_raw = _query_bucket("STOCK_TRANSFER")
-    pending_transfers_count = 0
-    for transfer in stock_transfers_raw:
-        if (transfer.get("status") or "").strip().lower() == "pending":
-            pending_transfers_count += 1
-
-    pos_sales_raw = _query_bucket("POS_SALE")
+    # Counts, totals and warnings come from the KPI counters (one BatchGetItem)
     today_prefix = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    pos_sales_today_count = 0
-    for sale in pos_sales_raw:
-        created_at = str(sale.get("createdAt") or "")
-        if created_at.startswith(today_prefix):
-            pos_sales_today_count += 1
+    kpis = _get_kpis([("ORDERS", KPI_ALL), ("TRANSFERS", KPI_ALL), ("POS", today_prefix)])
+    orders_kpi = kpis[("ORDERS", KPI_ALL)]
+    status_counts = {
+        st: _kpi_int(orders_kpi, f"status_{st}")
+        for st in ("pending", "paid", "delivered", "shipped", "canceled", "refunded")
+    }
+    sales_total = float(_to_decimal(orders_kpi.get("salesTotal")))
+    orders_count = _kpi_int(orders_kpi, "ordersTotal")
+    pending_transfers_count = _kpi_int(kpis[("TRANSFERS", KPI_ALL)], "status_pending")
+    pos_sales_today_count = _kpi_int(kpis[("POS", today_prefix)], "salesCount")
 
-    average_ticket = sales_total / len(orders) if orders else 0
+    average_ticket = sales_total / orders_count if orders_count else 0
     warnings = _build_admin_warnings(
         status_counts["paid"],
         status_counts["pending"],
@@ -5969,26 +6980,109 @@ def _get_admin_dashboard() -> dict:
         pending_transfers_count,
         pos_sales_today_count,
     )
-
-    employees_raw = _query_bucket("EMPLOYEE")
-    employees = [_employee_payload(e) for e in employees_raw]
-
-    categories_raw = _query_bucket("PRODUCT_CATEGORY")
-    categories = [_category_payload(i) for i in categories_raw if i.get("active", True) is not False]
-
-    return _json_response(200, {
+    return {
         "kpis": {
             "salesTotal": sales_total, "averageTicket": average_ticket, "activeProducts": active_products,
-            "customersTotal": len(customers), "commissionsTotalPending": commissions_total,
+            "customersTotal": customers_total, "commissionsTotalPending": commissions_total,
         },
         "statusCounts": status_counts, "customersByLevel": customers_by_level,
         "warnings": warnings,
-        "customers": customers, "orders": orders, "products": products, "campaigns": campaigns,
-        "notifications": notifications,
         "productOfMonthId": product_of_month_id,
         "businessConfig": app_cfg,
-        "employees": employees,
-        "categories": categories,
+    }
+
+def _admin_dashboard_cursor(last_sk: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"sk": last_sk}).encode("utf-8")).decode("utf-8").rstrip("=")
+
+def _query_bucket_page(entity: str, limit: int, cursor: Optional[str]) -> Tuple[List[dict], Optional[str]]:
+    """One page of an entity bucket, newest first (same order as _query_bucket)."""
+    pk = _bucket_pk(entity)
+    query_kwargs = {"KeyConditionExpression": Key("PK").eq(pk), "ScanIndexForward": False}
+    raw_cursor = str(cursor or "").strip()
+    if raw_cursor:
+        try:
+            padded = raw_cursor + ("=" * (-len(raw_cursor) % 4))
+            start = json.loads(base64.urlsafe_b64decode(padded.encode("utf-8")).decode("utf-8"))
+        except Exception:
+            raise ValueError("cursor invalido")
+        if not isinstance(start, dict) or not start.get("sk"):
+            raise ValueError("cursor invalido")
+        query_kwargs["ExclusiveStartKey"] = {"PK": pk, "SK": start["sk"]}
+
+    items: List[dict] = []
+    while True:
+        query_kwargs["Limit"] = limit - len(items)
+        resp = _table.query(**query_kwargs)
+        items.extend(resp.get("Items", []))
+        lek = resp.get("LastEvaluatedKey")
+        if not lek:
+            return items, None
+        if len(items) >= limit:
+            return items, _admin_dashboard_cursor(lek.get("SK"))
+        query_kwargs["ExclusiveStartKey"] = lek
+
+def _select_fields(row: dict, fields: Optional[List[str]]) -> dict:
+    return {k: row[k] for k in fields if k in row} if fields else row
+
+def _admin_customer_page_rows(items: List[dict]) -> List[dict]:
+    return _admin_customer_rows(items, customer_ids=[item.get("customerId") for item in items])
+
+# section -> (bucket entity, page rows builder)
+_ADMIN_DASHBOARD_SECTIONS: Dict[str, Tuple[str, Any]] = {
+    "orders": ("ORDER", lambda items: [_admin_order_payload(i) for i in items]),
+    "customers": ("CUSTOMER", _admin_customer_page_rows),
+    "products": ("PRODUCT", lambda items: [_admin_product_payload(i) for i in items]),
+    "campaigns": ("CAMPAIGN", lambda items: [_campaign_payload(i) for i in items]),
+    "employees": ("EMPLOYEE", lambda items: [_employee_payload(i) for i in items]),
+    "categories": ("PRODUCT_CATEGORY", lambda items: [_category_payload(i) for i in items if i.get("active", True) is not False]),
+}
+
+def _get_admin_dashboard_section(section: str, query: dict) -> dict:
+    """GET /admin/dashboard/<section>?limit=&cursor=&fields=a,b"""
+    if section == "summary":
+        return _json_response(200, _admin_dashboard_summary())
+    fields = [f.strip() for f in str(query.get("fields") or "").split(",") if f.strip()]
+    if section == "notifications":
+        return _json_response(200, {"notifications": [_select_fields(n, fields) for n in _list_notifications_for_admin()], "nextCursor": None})
+    if section not in _ADMIN_DASHBOARD_SECTIONS:
+        return _json_response(200, {"message": f"Seccion desconocida: {section}", "Error": "NotFound"})
+    try:
+        limit = min(max(int(query.get("limit") or _ADMIN_DASHBOARD_DEFAULT_LIMIT), 1), _ADMIN_DASHBOARD_MAX_LIMIT)
+    except (TypeError, ValueError):
+        return _json_response(200, {"message": "Parametros invalidos: limit", "Error": "BadRequest"})
+
+    entity, build_rows = _ADMIN_DASHBOARD_SECTIONS[section]
+    try:
+        items, next_cursor = _query_bucket_page(entity, limit, query.get("cursor"))
+    except ValueError as exc:
+        return _json_response(200, {"message": f"Parametros invalidos: {exc}", "Error": "BadRequest"})
+    rows = [_select_fields(row, fields) for row in build_rows(items)]
+    return _json_response(200, {section: rows, "nextCursor": next_cursor})
+
+def _get_admin_sales_rollups(query: dict) -> dict:
+    """GET /admin/sales-rollups?from=YYYY-MM-DD&to=YYYY-MM-DD&groupBy=total|month|day (defaults: month to date)"""
+    end_day = str(query.get("to") or "").strip() or _now_iso()[:10]
+    start_day = str(query.get("from") or "").strip() or f"{end_day[:7]}-01"
+    group_by = str(query.get("groupBy") or "total").strip().lower()
+    if group_by not in ("total", "month", "day"):
+        return _json_response(200, {"message": "groupBy debe ser total, month o day", "Error": "BadRequest"})
+    try:
+        return _json_response(200, _get_sales_rollups(start_day, end_day, group_by))
+    except ValueError as exc:
+        return _json_response(200, {"message": f"Rango invalido: {exc}", "Error": "BadRequest"})
+
+def _get_admin_dashboard() -> dict:
+    """Compatibility shim: summary plus every section in full (large; prefer the sectioned routes)."""
+    summary = _admin_dashboard_summary()
+    return _json_response(200, {
+        **summary,
+        "customers": _admin_customer_rows(_query_bucket("CUSTOMER")),
+        "orders": [_admin_order_payload(item) for item in _query_bucket("ORDER")],
+        "products": [_admin_product_payload(item) for item in _query_bucket("PRODUCT")],
+        "campaigns": [_campaign_payload(item) for item in _query_bucket("CAMPAIGN")],
+        "notifications": _list_notifications_for_admin(),
+        "employees": [_employee_payload(e) for e in _query_bucket("EMPLOYEE")],
+        "categories": [_category_payload(i) for i in _query_bucket("PRODUCT_CATEGORY") if i.get("active", True) is not False],
     })
 
 # ---------------------------------------------------------------------------
@@ -6121,7 +7215,7 @@ def _get_user_dashboard(query: dict, headers: dict) -> dict:
         computed_goals = _build_goals(customer, tree, customers_raw, cfg)
         
         buy_again_ids, _ = _compute_buy_again_ids_and_maybe_update(customer, products_raw)
-        _persist_customer_dashboard_fields(customer.get("customerId"), computed_goals, computed_network, buy_again_ids)
+        _persist_customer_dashboard_fields(customer, computed_goals, computed_network, buy_again_ids)
         active_notifications = _active_notifications_for_customer(customer.get("customerId"))
 
         cid = int(customer.get("customerId"))
@@ -6133,16 +7227,7 @@ def _get_user_dashboard(query: dict, headers: dict) -> dict:
         prev_comm_item = _get_commission_month_item(cid, prev_month_key)
         prev_confirmed = _to_decimal(prev_comm_item.get("totalConfirmed")) if prev_comm_item else D_ZERO
 
-        receipt_url = ""
-        receipts = _query_bucket("COMMISSION_RECEIPT")
-        for r in receipts:
-            if int(r.get("customerId") or 0) != cid:
-                continue
-            if str(r.get("monthKey")) != str(prev_month_key):
-                continue
-            if r.get("assetUrl"):
-                receipt_url = r.get("assetUrl")
-                break
+        receipt_url = _latest_receipt_url(_get_customer_receipts(cid, prev_month_key))
         
         clabe = (customer.get("clabeInterbancaria") or customer.get("clabe") or "").strip()
         if prev_confirmed <= 0:
@@ -6445,7 +7530,12 @@ def lambda_handler(event, context):
     if route_key == (1, "product-categories", "POST"): return _save_product_category(_parse_body(event), headers)
     if route_key == (1, "campaigns", "POST"): return _save_campaign(_parse_body(event), headers)
     if route_key == (1, "notifications", "POST"): return _save_notification(_parse_body(event), headers)
-    if route_key == (1, "orders", "POST"): return _create_order(_parse_body(event), headers)
+    if route_key == (1, "orders", "POST"):
+        order_payload = _parse_body(event)
+        return _with_idempotency(
+            f"POST /orders#{headers.get('x-user-id') or headers.get('X-User-Id') or ''}", headers, order_payload,
+            lambda: _create_order(order_payload, headers),
+        )
     if route_key == (2, "shipping", "POST") and segments[1] == "quote": return _get_shipping_quote(_parse_body(event))
     if route_key == (1, "orders", "GET") and query.get("customerId"): return _list_orders_for_customer(query.get("customerId"))
     if route_key == (1, "customers", "POST"): return _create_customer(_parse_body(event), headers)
@@ -6482,18 +7572,26 @@ def lambda_handler(event, context):
     if route_key == (2, "customers", "PATCH"): return _update_customer(segments[1], _parse_body(event), headers)
     if route_key == (2, "customers", "POST") and segments[1] == "clabe": return _update_customer_clabe(_parse_body(event))
     if route_key == (2, "admin", "GET") and segments[1] == "dashboard": return _get_admin_dashboard()
+    if route_key == (2, "admin", "GET") and segments[1] == "sales-rollups": return _get_admin_sales_rollups(query)
     if route_key == (2, "stocks", "PATCH"): return _update_stock(segments[1], _parse_body(event), headers)
     if route_key == (2, "stocks", "GET") and segments[1] == "transfers": return _list_stock_transfers(query)
     if route_key == (2, "stocks", "POST") and segments[1] == "transfers": return _create_stock_transfer(_parse_body(event), headers)
     if route_key == (2, "stocks", "GET") and segments[1] == "movements": return _list_inventory_movements(query)
+    if route_key == (3, "stocks", "POST") and segments[1] == "movements" and segments[2] == "backfill": return _backfill_movement_ledger()
     if route_key == (2, "pos", "GET") and segments[1] == "sales": return _list_pos_sales(query)
     if route_key == (2, "pos", "GET") and segments[1] == "cash-control": return _get_pos_cash_control(query, headers)
-    if route_key == (2, "pos", "POST") and segments[1] == "sales": return _register_pos_sale(_parse_body(event), headers)
+    if route_key == (2, "pos", "POST") and segments[1] == "sales":
+        sale_payload = _parse_body(event)
+        return _with_idempotency(
+            f"POST /pos/sales#{headers.get('x-user-id') or headers.get('X-User-Id') or ''}", headers, sale_payload,
+            lambda: _register_pos_sale(sale_payload, headers),
+        )
     if route_key == (2, "pos", "POST") and segments[1] == "cash-cut": return _create_pos_cash_cut(_parse_body(event), headers)
     if route_key == (2, "webhooks", "POST") and segments[1] == "mercadolibre": return _mercadolibre_webhook(query, _parse_body(event), headers)
     if route_key == (2, "webhooks", "GET") and segments[1] == "mercadolibre": return _mercadolibre_webhook(query, _parse_body(event), headers)
 
     # 3 segments
+    if route_key == (3, "admin", "GET") and segments[1] == "dashboard": return _get_admin_dashboard_section(segments[2], query)
     if route_key == (3, "admin", "POST") and segments[1] == "commissions" and segments[2] == "receipt": return _upload_admin_commission_receipt(_parse_body(event), headers)
     if route_key == (3, "associates", "GET") and segments[2] == "commissions": return _get_associate_commissions(segments[1], query)
     if route_key == (3, "orders", "POST") and segments[2] == "refund": return _refund_order(segments[1], _parse_body(event))
@@ -6509,6 +7607,8 @@ def lambda_handler(event, context):
 
     # 4 segments
     if route_key == (4, "associates", "GET") and segments[2] == "month": return _get_associate_month(segments[1], segments[3])
+    if route_key == (4, "admin", "POST") and segments[1] == "commissions" and segments[2] == "receipt" and segments[3] == "backfill": return _backfill_receipt_index()
+    if route_key == (4, "admin", "POST") and segments[1] == "commissions" and segments[2] == "month-index" and segments[3] == "backfill": return _backfill_commission_month_index()
     if route_key == (4, "stocks", "POST") and segments[1] == "transfers" and segments[3] == "receive":
         return _receive_stock_transfer(segments[2], _parse_body(event), headers)
 
@@ -1,6 +1,6 @@
 import { Injectable } from '@angular/core';
-import { HttpClient, HttpHeaders } from '@angular/common/http';
-import { catchError, map, Observable, throwError } from 'rxjs';
+import { HttpClient, HttpErrorResponse, HttpHeaders } from '@angular/common/http';
+import { catchError, map, Observable, retry, throwError, timer } from 'rxjs';
 
 import { environment } from '../../environments/environment';
 import {
@@ -465,8 +465,11 @@ export class RealApiService {
 
   createOrder(payload: CreateAdminOrderPayload): Observable<AdminOrder> {
     return this.http
-      .post<{ order: AdminOrder }>(`${this.baseUrl}/orders/create`, payload, { headers: this.actorHeaders() })
-      .pipe(map((response) => this.normalizeAdminOrder(response.order)));
+      .post<{ order: AdminOrder }>(`${this.baseUrl}/orders/create`, payload, { headers: this.idempotentHeaders() })
+      .pipe(
+        this.retryIdempotent(),
+        map((response) => this.normalizeAdminOrder(response.order))
+      );
   }
 
   createOrderCheckout(
@@ -796,9 +799,10 @@ export class RealApiService {
   }): Observable<{ sale: PosSale }> {
     return this.http
       .post<{ sale?: Record<string, unknown>; saleId?: string; orderId?: string; message?: string; Error?: string }>(`${this.baseUrl}/inventory/pos/sales`, payload, {
-        headers: this.actorHeaders()
+        headers: this.idempotentHeaders()
       })
       .pipe(
+        this.retryIdempotent(),
         map((response) => ({ sale: this.normalizePosSaleResponse(response, payload) }))
       );
   }
@@ -1125,6 +1129,33 @@ export class RealApiService {
     );
   }
 
+  /** Una llave por intento lógico: los reintentos la reutilizan y el backend devuelve la respuesta guardada. */
+  private idempotentHeaders(): HttpHeaders {
+    const key = typeof crypto !== 'undefined' && typeof crypto.randomUUID === 'function'
+      ? crypto.randomUUID()
+      : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    return this.actorHeaders().set('Idempotency-Key', key);
+  }
+
+  /** Reintenta ante red caída, timeout, 409 (en proceso) y 5xx; seguro solo con Idempotency-Key. */
+  private retryIdempotent<T>() {
+    return retry<T>({
+      count: 3,
+      delay: (error: unknown, attempt: number) => {
+        const status = error instanceof HttpErrorResponse ? error.status : 0;
+        if (status !== 0 && status !== 409 && status < 500) {
+          return throwError(() => error);
+        }
+        // El backend guardó la falla tras escribir: repetir devolvería la misma respuesta
+        const body = error instanceof HttpErrorResponse ? error.error : null;
+        if (body && typeof body === 'object' && body.retryable === false) {
+          return throwError(() => error);
+        }
+        return timer(Math.min(4000, 500 * 2 ** (attempt - 1)));
+      }
+    });
+  }
+
   private actorHeaders(): HttpHeaders {
     let headers = new HttpHeaders();
     const raw = localStorage.getItem('auth-user');